@@ -65,14 +65,29 @@ class Config(object):
         self.database = "postgresql+psycopg2://cmsuser@localhost/cms"
         self.database_debug = False
         self.twophase_commit = False
+        self.large_object_pool_size = 8
+
+        # FileCacher.
+        self.shared_cache = True
+        self.cache_max_size = None
+        self.storage_compression = None
+
+        # EvaluationService.
+        self.result_journal = False
 
         # Worker.
         self.keep_sandbox = True
         self.use_cgroups = True
+        self.worker_slots = 1
+        self.share_evaluation_sandbox = False
+        self.compilation_cache_size = 10000
         self.sandbox_implementation = 'isolate'
 
         # Sandbox.
         self.max_file_size = 1048576
+        self.sandbox_cpu_pinning = False
+        self.sandbox_exclude_smt_siblings = True
+        self.sandbox_reuse_boxes = True
 
         # WebServers.
         self.secret_key_default = "8e045a51e4b102ea803c06f92841a1fb"
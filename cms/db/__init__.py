@@ -86,7 +86,7 @@ __all__ = [
 
 # Instantiate or import these objects.
 
-version = 28
+version = 29
 
 engine = create_engine(config.database, echo=config.database_debug,
                        pool_timeout=60, pool_recycle=120)
@@ -32,7 +32,8 @@ from sqlalchemy.orm.session import object_session
 from sqlalchemy.orm import \
     class_mapper, object_mapper, ColumnProperty, RelationshipProperty
 from sqlalchemy.types import \
-    Boolean, Integer, Float, String, Unicode, DateTime, Interval, Enum
+    Boolean, Integer, BigInteger, Float, String, Unicode, DateTime, \
+    Interval, Enum
 
 import six
 
@@ -42,6 +43,7 @@ from . import CastingArray, RepeatedUnicode, engine
 _TYPE_MAP = {
     Boolean: bool,
     Integer: six.integer_types,
+    BigInteger: six.integer_types,
     Float: float,
     String: six.string_types,  # TODO Use six.binary_type.
     Unicode: six.string_types,  # TODO Use six.text_type.
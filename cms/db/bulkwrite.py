@@ -0,0 +1,230 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Set-based writes of the results of the evaluations.
+
+Writing the evaluations through the ORM costs a few round trips for
+each of them (the insert, and the savepoint guarding it against a
+duplicate). Here instead each function issues one statement for many
+rows: evaluations are inserted with multi-row INSERTs skipping the
+duplicates (ON CONFLICT DO NOTHING; with PostgreSQL older than 9.5,
+which lacks it, they are inserted one at a time instead), and
+submission results are updated by joining them with a list of VALUES.
+
+These functions bypass the ORM: objects already loaded in the session
+are not updated, so they should be expired (for example, committing)
+before being used again.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+
+# Columns of the evaluations given to insert_evaluations.
+EVALUATION_COLUMNS = [
+    "submission_id", "dataset_id", "testcase_id", "outcome", "text",
+    "execution_time", "execution_wall_clock_time", "execution_memory",
+    "evaluation_shard", "evaluation_sandbox"]
+
+# Maximum number of rows written by a single statement (to keep the
+# statements, and the number of their parameters, reasonable).
+CHUNK_SIZE = 1000
+
+# First version of PostgreSQL supporting ON CONFLICT.
+ON_CONFLICT_SERVER_VERSION = (9, 5)
+
+
+INSERT_EVALUATIONS_QUERY = """\
+INSERT INTO evaluations (%(columns)s)
+VALUES %(values)s
+ON CONFLICT (submission_id, dataset_id, testcase_id) DO NOTHING
+RETURNING submission_id, dataset_id, testcase_id
+"""
+
+INSERT_EVALUATION_QUERY = """\
+INSERT INTO evaluations (%(columns)s)
+VALUES %(values)s
+"""
+
+EVALUATION_EXISTS_QUERY = """\
+SELECT 1 FROM evaluations
+WHERE submission_id = :submission_id
+    AND dataset_id = :dataset_id
+    AND testcase_id = :testcase_id
+"""
+
+INCREMENT_EVALUATION_TRIES_QUERY = """\
+UPDATE submission_results
+SET evaluation_tries = submission_results.evaluation_tries + v.tries
+FROM (VALUES %(values)s) AS v (submission_id, dataset_id, tries)
+WHERE submission_results.submission_id = v.submission_id
+    AND submission_results.dataset_id = v.dataset_id
+"""
+
+SET_EVALUATION_OUTCOMES_QUERY = """\
+UPDATE submission_results
+SET evaluation_outcome = 'ok'
+FROM (VALUES %(values)s) AS v (submission_id, dataset_id)
+WHERE submission_results.submission_id = v.submission_id
+    AND submission_results.dataset_id = v.dataset_id
+    AND submission_results.evaluation_outcome IS NULL
+    AND (SELECT count(*) FROM evaluations
+         WHERE evaluations.submission_id = v.submission_id
+             AND evaluations.dataset_id = v.dataset_id)
+        = (SELECT count(*) FROM testcases
+           WHERE testcases.dataset_id = v.dataset_id)
+RETURNING submission_results.submission_id, submission_results.dataset_id
+"""
+
+
+def _values(rows, columns):
+    """Return a list of VALUES for a statement, and its parameters.
+
+    rows ([dict]): the rows.
+    columns ([unicode]): the keys of the rows to use, in order.
+
+    return ((unicode, dict)): the list of tuples of placeholders, and
+        the parameters to bind to them.
+
+    """
+    tuples = []
+    params = dict()
+    for i, row in enumerate(rows):
+        names = []
+        for column in columns:
+            name = "%s_%d" % (column, i)
+            params[name] = row[column]
+            names.append(":%s" % name)
+        tuples.append("(%s)" % ", ".join(names))
+    return ", ".join(tuples), params
+
+
+def _chunks(rows):
+    """Split some rows in chunks of at most CHUNK_SIZE rows.
+
+    rows ([object]): the rows.
+
+    yield ([object]): the chunks.
+
+    """
+    for start in xrange(0, len(rows), CHUNK_SIZE):
+        yield rows[start:start + CHUNK_SIZE]
+
+
+def insert_evaluations(session, rows):
+    """Insert evaluations, skipping those already present.
+
+    session (Session): the session to use.
+    rows ([dict]): the evaluations to insert, as dictionaries with
+        all the keys in EVALUATION_COLUMNS.
+
+    return ([dict]): the rows that were not inserted because an
+        evaluation for the same submission, dataset and testcase was
+        already present.
+
+    raise (IntegrityError): if a row violates a constraint other than
+        the uniqueness of the evaluations (for example, its testcase
+        or submission result doesn't exist).
+
+    """
+    if session.connection().dialect.server_version_info \
+            < ON_CONFLICT_SERVER_VERSION:
+        return _insert_evaluations_one_at_a_time(session, rows)
+    inserted = set()
+    for chunk in _chunks(rows):
+        values, params = _values(chunk, EVALUATION_COLUMNS)
+        inserted.update(tuple(row) for row in session.execute(
+            text(INSERT_EVALUATIONS_QUERY % {
+                "columns": ", ".join(EVALUATION_COLUMNS),
+                "values": values}),
+            params).fetchall())
+    return [row for row in rows
+            if (row["submission_id"], row["dataset_id"],
+                row["testcase_id"]) not in inserted]
+
+
+def _insert_evaluations_one_at_a_time(session, rows):
+    """Insert evaluations without ON CONFLICT, each in a savepoint.
+
+    See insert_evaluations.
+
+    """
+    skipped = []
+    for row in rows:
+        values, params = _values([row], EVALUATION_COLUMNS)
+        try:
+            with session.begin_nested():
+                session.execute(text(INSERT_EVALUATION_QUERY % {
+                    "columns": ", ".join(EVALUATION_COLUMNS),
+                    "values": values}), params)
+        except IntegrityError:
+            if session.execute(text(EVALUATION_EXISTS_QUERY),
+                               row).first() is None:
+                raise
+            skipped.append(row)
+    return skipped
+
+
+def increment_evaluation_tries(session, tries):
+    """Add to the failed evaluation attempts of submission results.
+
+    session (Session): the session to use.
+    tries ({(int, int): int}): the attempts to add for each pair of
+        submission id and dataset id.
+
+    """
+    rows = [{"submission_id": submission_id, "dataset_id": dataset_id,
+             "tries": count}
+            for (submission_id, dataset_id), count in tries.iteritems()]
+    for chunk in _chunks(rows):
+        values, params = _values(
+            chunk, ["submission_id", "dataset_id", "tries"])
+        session.execute(
+            text(INCREMENT_EVALUATION_TRIES_QUERY % {"values": values}),
+            params)
+
+
+def set_evaluation_outcomes(session, keys):
+    """Mark as evaluated the submission results that are complete.
+
+    A submission result is complete when it has an evaluation for
+    each testcase of its dataset; those already evaluated are left
+    untouched.
+
+    session (Session): the session to use.
+    keys ([(int, int)]): the pairs of submission id and dataset id of
+        the submission results to check.
+
+    return ({(int, int)}): the pairs of the submission results that
+        have been marked as evaluated.
+
+    """
+    rows = [{"submission_id": submission_id, "dataset_id": dataset_id}
+            for submission_id, dataset_id in keys]
+    evaluated = set()
+    for chunk in _chunks(rows):
+        values, params = _values(chunk, ["submission_id", "dataset_id"])
+        evaluated.update(tuple(row) for row in session.execute(
+            text(SET_EVALUATION_OUTCOMES_QUERY % {"values": values}),
+            params).fetchall())
+    return evaluated
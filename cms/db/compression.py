@@ -0,0 +1,241 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compression of the files stored by the FileCacher backends.
+
+Backends can store each file compressed with one of the codecs listed
+in CODECS, recording which one (if any) alongside the file. Digests
+always refer to the uncompressed content, and files are decompressed
+as they are read, so compression is invisible outside the backends.
+
+zlib is always available; zstd needs the zstandard package.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import zlib
+
+import gevent
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Files smaller than this are never compressed, as the saving wouldn't
+# be worth the additional work.
+MIN_SIZE = 4096
+
+# Files are compressed only if their first SAMPLE_SIZE bytes shrink to
+# at most this fraction of their size.
+SAMPLE_SIZE = 64 * 1024
+MAX_RATIO = 0.9
+
+CHUNK_SIZE = 2 ** 14
+
+
+def _zstd_compressobj():
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def _zstd_decompressobj():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# Map from the name of each codec to a pair of functions creating,
+# respectively, a compressor and a decompressor object (with the
+# interface of those of zlib).
+CODECS = {
+    "zlib": (lambda: zlib.compressobj(6), zlib.decompressobj),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd_compressobj, _zstd_decompressobj)
+
+
+def is_available(codec):
+    """Return whether a codec can be used.
+
+    codec (unicode): the name of the codec.
+
+    return (bool): whether it is known and its module is installed.
+
+    """
+    return codec in CODECS
+
+
+def should_compress(sample, codec, size=None):
+    """Decide whether a file is worth compressing.
+
+    sample (bytes): the first bytes of the file (ideally, SAMPLE_SIZE
+        of them).
+    codec (unicode): the name of the codec to use.
+    size (int|None): the size of the whole file, if known.
+
+    return (bool): whether the file should be stored compressed.
+
+    """
+    if size is None:
+        size = len(sample)
+    if size < MIN_SIZE or len(sample) == 0:
+        return False
+    compressor = CODECS[codec][0]()
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed <= MAX_RATIO * len(sample)
+
+
+class CompressingWriter(io.RawIOBase):
+    """Writable file-object compressing what is written to another.
+
+    The underlying file-object is closed when this one is.
+
+    """
+
+    def __init__(self, fobj, codec):
+        """Initialize the writer.
+
+        fobj (fileobj): a writable binary file-like object where to
+            write the compressed content.
+        codec (unicode): the name of the codec to use.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._fobj = fobj
+        self._compressor = CODECS[codec][0]()
+
+    def writable(self):
+        """See IOBase.writable().
+
+        """
+        return True
+
+    def _write_all(self, data):
+        """Write all data to the underlying file-object.
+
+        """
+        while len(data) > 0:
+            written = self._fobj.write(data)
+            # Cooperative yield.
+            gevent.sleep(0)
+            if written is None:
+                break
+            data = data[written:]
+
+    def write(self, buf):
+        """See RawIOBase.write().
+
+        """
+        self._write_all(self._compressor.compress(bytes(buf)))
+        return len(buf)
+
+    def close(self):
+        """Write the end of the compressed stream and close.
+
+        """
+        if self.closed:
+            return
+        try:
+            self._write_all(self._compressor.flush())
+        finally:
+            try:
+                self._fobj.close()
+            finally:
+                io.RawIOBase.close(self)
+
+
+class DecompressingReader(io.RawIOBase):
+    """Readable file-object decompressing what is read from another.
+
+    The underlying file-object is closed when this one is.
+
+    """
+
+    def __init__(self, fobj, codec):
+        """Initialize the reader.
+
+        fobj (fileobj): a readable binary file-like object providing
+            the compressed content.
+        codec (unicode): the name of the codec the content has been
+            compressed with.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._fobj = fobj
+        self._decompressor = CODECS[codec][1]()
+        # Decompressed data not yet returned, starting at _offset.
+        self._buffer = b""
+        self._offset = 0
+        self._eof = False
+
+    def readable(self):
+        """See IOBase.readable().
+
+        """
+        return True
+
+    def readinto(self, buf):
+        """See RawIOBase.readinto().
+
+        """
+        while self._offset == len(self._buffer) and not self._eof:
+            data = self._fobj.read(CHUNK_SIZE)
+            if len(data) == 0:
+                self._buffer = self._decompressor.flush()
+                self._eof = True
+            else:
+                self._buffer = self._decompressor.decompress(data)
+            self._offset = 0
+
+        count = min(len(buf), len(self._buffer) - self._offset)
+        buf[:count] = self._buffer[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self):
+        """See IOBase.close().
+
+        """
+        if self.closed:
+            return
+        try:
+            self._fobj.close()
+        finally:
+            io.RawIOBase.close(self)
+
+
+def get_uncompressed_size(fobj, codec):
+    """Compute the size of a compressed file, once decompressed.
+
+    fobj (fileobj): a readable binary file-like object providing the
+        compressed content; it is closed by this function.
+    codec (unicode): the name of the codec used.
+
+    return (int): the size of the uncompressed content.
+
+    """
+    size = 0
+    with DecompressingReader(fobj, codec) as reader:
+        buf = reader.read(CHUNK_SIZE)
+        while len(buf) > 0:
+            size += len(buf)
+            buf = reader.read(CHUNK_SIZE)
+    return size
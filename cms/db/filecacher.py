@@ -29,19 +29,33 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
+import fcntl
 import hashlib
 import io
+import json
 import logging
+import multiprocessing
 import os
+import re
+import stat
 import tempfile
 
+from contextlib import contextmanager
+
 import gevent
+import gevent.pool
 
 from sqlalchemy.exc import IntegrityError
 
 from cms import config, mkdir
-from cms.db import SessionGen, FSObject
-from cms.io.GeventUtils import copyfileobj, move, rmtree
+from cms.db import SessionGen, FSObject, engine, fsobject
+from cms.db.compression import CODECS, MIN_SIZE, SAMPLE_SIZE, \
+    CompressingWriter, DecompressingReader, get_uncompressed_size, \
+    is_available, should_compress
+from cms.db.fsobject import LargeObject, LargeObjectBatch
+from cms.io.GeventUtils import copyfileobj, rmtree
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -73,20 +87,87 @@ class FileCacherBackend(object):
         """
         raise NotImplementedError("Please subclass this class.")
 
-    def put_file(self, digest, desc=""):
+    def get_files(self, digests):
+        """Retrieve many files from the storage.
+
+        Backends that can fetch many files more efficiently than one
+        at a time should override this implementation.
+
+        digests ([unicode]): the digests of the files to retrieve.
+
+        return (iterator): yield, for each digest, a pair with the
+            digest and either a readable binary file-like object or
+            the exception (usually a KeyError) that prevented to
+            retrieve the file. Each file-like object has to be read
+            (and closed) before advancing the iterator.
+
+        """
+        for digest in digests:
+            try:
+                fobj = self.get_file(digest)
+            except (KeyError, IOError) as error:
+                yield digest, error
+            else:
+                yield digest, fobj
+
+    def put_file(self, digest, desc="", compression=None):
         """Store a file to the storage.
 
         digest (unicode): the digest of the file to store.
         desc (unicode): the optional description of the file to
             store, intended for human beings.
+        compression (unicode|None): the codec to compress the file
+            with (see cms.db.compression), or None to store it as it
+            is. Backends not supporting compression ignore it.
 
         return (fileobj): a writable binary file-like object on which
-            to write the contents of the file, or None if the file is
-            already stored.
+            to write the (uncompressed) contents of the file, or None
+            if the file is already stored.
 
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def set_compression(self, digest, compression):
+        """Store again a file with a different compression.
+
+        Readers that are concurrently opening the file may fail.
+
+        digest (unicode): the digest of the file.
+        compression (unicode|None): the codec to compress the file
+            with, or None to store it uncompressed.
+
+        return (bool): whether the file has been rewritten (it isn't
+            if it was already stored with that compression).
+
+        raise (KeyError): if the file cannot be found.
+
+        """
+        raise NotImplementedError("This backend doesn't support "
+                                  "compression.")
+
+    def create_file(self, desc="", compression=None):
+        """Start storing a file whose digest is not known yet.
+
+        This allows to send a file to the storage while reading it for
+        the first time. The content is written to the returned object,
+        whose commit method, called with the digest of the content,
+        stores the file (or discards it, if it is already stored).
+        Closing the object without committing discards the content.
+
+        This implementation buffers the content in a temporary file and
+        uses put_file on commit; backends able to receive the content
+        before knowing the digest should override it.
+
+        desc (unicode): the optional description of the file.
+        compression (unicode|None): the codec to compress the file
+            with, as in put_file.
+
+        return (fileobj): a writable binary file-like object, with the
+            additional method commit(digest).
+
+        """
+        return BufferedBackendWriter(self, desc, compression)
+
     def describe(self, digest):
         """Return the description of a file given its digest.
 
@@ -99,6 +180,23 @@ class FileCacherBackend(object):
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def touch(self, digest):
+        """Check that a file is stored, before referring to it again.
+
+        Backends whose unreferenced files can be deleted concurrently
+        should record that the file is being used, so that it is kept.
+
+        digest (unicode): the digest of the file.
+
+        return (bool): whether the file is stored.
+
+        """
+        try:
+            self.describe(digest)
+        except KeyError:
+            return False
+        return True
+
     def get_size(self, digest):
         """Return the size of a file given its digest.
 
@@ -130,21 +228,286 @@ class FileCacherBackend(object):
         raise NotImplementedError("Please subclass this class.")
 
 
+class BufferedBackendWriter(io.RawIOBase):
+    """Writable file-object returned by FileCacherBackend.create_file.
+
+    The content is kept in a temporary file until the digest is known.
+
+    """
+
+    def __init__(self, backend, desc, compression):
+        """Initialize the writer.
+
+        backend (FileCacherBackend): the backend storing the file.
+        desc (unicode): the description of the file.
+        compression (unicode|None): the codec to compress the file
+            with, if any.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._backend = backend
+        self._desc = desc
+        self._compression = compression
+        self._file = tempfile.NamedTemporaryFile('w+b', dir=config.temp_dir)
+
+    def writable(self):
+        """See IOBase.writable().
+
+        """
+        return True
+
+    def write(self, buf):
+        """See RawIOBase.write().
+
+        """
+        self._file.write(buf)
+        return len(buf)
+
+    def commit(self, digest):
+        """Store the content under the given digest.
+
+        digest (unicode): the digest of the content.
+
+        """
+        try:
+            fobj = self._backend.put_file(digest, self._desc,
+                                          self._compression)
+            if fobj is not None:
+                try:
+                    self._file.seek(0)
+                    copyfileobj(self._file, fobj, FileCacher.CHUNK_SIZE)
+                finally:
+                    fobj.close()
+        finally:
+            self.close()
+
+    def close(self):
+        """Discard the content (if it was not committed).
+
+        """
+        if self.closed:
+            return
+        try:
+            self._file.close()
+        finally:
+            io.RawIOBase.close(self)
+
+
+class FSBackendWriter(io.RawIOBase):
+    """Writable file-object for a file being stored in an FSBackend.
+
+    The content is written to a temporary file, which is published
+    under its digest only when this object is closed, and only if the
+    content actually matches the digest; hence interrupted writes never
+    leave partial files in the storage. If the digest is not known when
+    the writer is created, it has to be given to commit instead.
+
+    """
+
+    def __init__(self, backend, digest, desc, temp_path, compression=None):
+        """Initialize the writer.
+
+        backend (FSBackend): the backend storing the file.
+        digest (unicode|None): the digest of the file, if known.
+        desc (unicode): the description of the file.
+        temp_path (string): the temporary file to write to.
+        compression (unicode|None): the codec to compress the file
+            with, if any.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._backend = backend
+        self._digest = digest
+        self._desc = desc
+        self._temp_path = temp_path
+        self._compression = compression
+        self._file = io.open(temp_path, 'wb')
+        if compression is not None:
+            self._file = CompressingWriter(self._file, compression)
+        self._hasher = hashlib.sha1()
+        self._size = 0
+
+    def writable(self):
+        """See IOBase.writable().
+
+        """
+        return True
+
+    def write(self, buf):
+        """See RawIOBase.write().
+
+        """
+        self._hasher.update(buf)
+        self._file.write(buf)
+        self._size += len(buf)
+        return len(buf)
+
+    def commit(self, digest):
+        """Publish the file under the given digest.
+
+        See FileCacherBackend.create_file.
+
+        digest (unicode): the digest of the content.
+
+        """
+        self._digest = digest
+        self.close()
+
+    def close(self):
+        """Publish the file, if its content is complete.
+
+        """
+        if self.closed:
+            return
+        try:
+            self._file.close()
+            if self._digest is None:
+                os.unlink(self._temp_path)
+            elif self._hasher.hexdigest() != self._digest:
+                logger.warning("Content written for file %s doesn't match "
+                               "its digest, discarding it.", self._digest)
+                os.unlink(self._temp_path)
+            elif self._backend._find(self._digest) is not None:
+                # Stored by someone else in the meantime.
+                os.unlink(self._temp_path)
+            else:
+                self._backend._publish(self._digest, self._desc,
+                                       self._temp_path, self._size,
+                                       self._compression)
+        finally:
+            io.RawIOBase.close(self)
+
+
+class DBBackendWriter(io.RawIOBase):
+    """Writable file-object returned by DBBackend.create_file and
+    put_file.
+
+    The content is written to a new large object, and the FSObject
+    referring to it is created only on commit (or, if the digest is
+    known from the start, on close, if the content matches it): this
+    way, nobody can see the file before it is complete.
+
+    """
+
+    def __init__(self, desc, compression, digest=None):
+        """Initialize the writer.
+
+        desc (unicode): the description of the file.
+        compression (unicode|None): the codec to compress the file
+            with, if any.
+        digest (unicode|None): the digest of the file, if known.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._desc = desc
+        self._compression = compression
+        self._digest = digest
+        self._committed = False
+        self._file = LargeObject(0, mode='wb')
+        self._loid = self._file.loid
+        if compression is not None:
+            self._file = CompressingWriter(self._file, compression)
+        self._hasher = hashlib.sha1()
+        self._size = 0
+
+    def writable(self):
+        """See IOBase.writable().
+
+        """
+        return True
+
+    def write(self, buf):
+        """See RawIOBase.write().
+
+        """
+        if self._digest is not None:
+            self._hasher.update(buf)
+        self._file.write(buf)
+        self._size += len(buf)
+        return len(buf)
+
+    def commit(self, digest):
+        """Create the FSObject for the file, if there is none yet
+        (touching it otherwise, see FileCacherBackend.touch).
+
+        See FileCacherBackend.create_file.
+
+        digest (unicode): the digest of the content.
+
+        """
+        try:
+            self._file.close()
+            with SessionGen() as session:
+                if FSObject.touch(digest, session):
+                    session.commit()
+                else:
+                    fso = FSObject(description=self._desc, loid=self._loid,
+                                   compression=self._compression,
+                                   size=self._size)
+                    fso.digest = digest
+                    session.add(fso)
+                    session.commit()
+                    self._committed = True
+                    logger.debug("File %s stored on the database.", digest)
+        except IntegrityError:
+            # Stored by someone else in the meantime.
+            logger.debug("File %s caused an IntegrityError, ignoring...",
+                         digest)
+        finally:
+            self.close()
+
+    def close(self):
+        """Commit the file, if its digest was given and its content
+        matches it; otherwise, delete the large object, if the file
+        was not committed.
+
+        """
+        if self.closed:
+            return
+        if self._digest is not None:
+            digest, self._digest = self._digest, None
+            if self._hasher.hexdigest() == digest:
+                self.commit(digest)
+                return
+            logger.warning("Content written for file %s doesn't match "
+                           "its digest, discarding it.", digest)
+        try:
+            self._file.close()
+            if not self._committed:
+                LargeObject.unlink(self._loid)
+        finally:
+            io.RawIOBase.close(self)
+
+
 class FSBackend(FileCacherBackend):
     """This class implements a backend for FileCacher that keeps all
     the files in a file system directory, named after their digest. Of
     course this directory can be shared, for example with NFS, acting
     as an actual remote file storage.
 
-    TODO: Actually store the descriptions, that get discarded at the
-    moment.
+    To alleviate the work of the file system driver, files are put in
+    two levels of subdirectories named after the first characters of
+    their digest (e.g., 'ROOT/ab/cd/abcdef...'). Their sizes,
+    descriptions and compressions are recorded in an append-only index
+    file (one JSON array per line), so that describe, get_size and
+    list don't need to look at the files at all, and a file is looked
+    for only where the index says it is.
+
+    Compressed files have the name of their codec as extension (e.g.,
+    'ROOT/ab/cd/abcdef....zlib'); the size in the index is always the
+    one of the uncompressed content.
 
-    TODO: Use an additional level of directories, to alleviate the
-    work of the file system driver (e.g., 'ROOT/a/abcdef...' instead
-    of 'ROOT/abcdef...'.
+    Files stored with the old flat layout ('ROOT/abcdef...') are still
+    found; cmsMigrateFSStorage moves them to the sharded layout, and
+    can be run while the storage is in use.
 
     """
 
+    INDEX_FILENAME = "index"
+    INDEX_LOCK_FILENAME = "index.lock"
+
+    DIGEST_RE = re.compile(r"^[0-9a-f]{40}$")
+
     def __init__(self, path):
         """Initialize the backend.
 
@@ -152,6 +515,9 @@ class FSBackend(FileCacherBackend):
 
         """
         self.path = path
+        self.index_path = os.path.join(self.path, FSBackend.INDEX_FILENAME)
+        self.index_lock_path = os.path.join(self.path,
+                                            FSBackend.INDEX_LOCK_FILENAME)
 
         # Create the directory if it doesn't exist
         try:
@@ -159,35 +525,314 @@ class FSBackend(FileCacherBackend):
         except OSError:
             pass
 
-    def get_file(self, digest):
-        """See FileCacherBackend.get_file().
+        # Our copy of the index, mapping each digest to a tuple (size,
+        # description, compression), and how much of the index file it
+        # reflects.
+        self._index = dict()
+        self._index_inode = None
+        self._index_offset = 0
+
+    @staticmethod
+    def is_digest(name):
+        """Return whether a file name is a valid digest.
+
+        name (string): the name to check.
+
+        return (bool): whether it can be the name of a stored file.
 
         """
-        file_path = os.path.join(self.path, digest)
+        return FSBackend.DIGEST_RE.match(name) is not None
+
+    @staticmethod
+    def parse_name(name):
+        """Split the name of a stored file.
+
+        name (string): the name of a file in the sharded layout.
+
+        return ((unicode, unicode|None)|None): the digest of the file
+            and its compression, or None if name is not the name of a
+            stored file.
+
+        """
+        digest, dot, compression = name.partition(".")
+        if not FSBackend.is_digest(digest):
+            return None
+        if dot == "":
+            return digest, None
+        if compression in CODECS:
+            return digest, compression
+        return None
+
+    def get_path(self, digest, compression=None):
+        """Return where a file is (or is going to be) stored.
+
+        digest (unicode): the digest of the file.
+        compression (unicode|None): the codec the file is compressed
+            with, if any.
+
+        return (string): the path of the file in the sharded layout.
 
-        if not os.path.exists(file_path):
+        """
+        path = os.path.join(self.path, digest[0:2], digest[2:4], digest)
+        if compression is not None:
+            path += "." + compression
+        return path
+
+    def _get_flat_path(self, digest):
+        """Return where a file was stored with the flat layout.
+
+        """
+        return os.path.join(self.path, digest)
+
+    def _find_compressed(self, digest):
+        """Return the path and the compression of a stored file.
+
+        The file is looked for where our copy of the index says it is
+        and, if it isn't there (e.g., it is not indexed, or it has been
+        recompressed), everywhere it can be.
+
+        digest (unicode): the digest of the file to find.
+
+        return ((string, unicode|None)|None): the path of the file and
+            the codec it is compressed with, or None if it is not
+            stored.
+
+        """
+        entry = self._index.get(digest)
+        if entry is not None:
+            path = self.get_path(digest, entry[2])
+            if os.path.exists(path):
+                return path, entry[2]
+
+        # The flat layout comes first, as files are only moved from it
+        # to the sharded one.
+        candidates = [(self._get_flat_path(digest), None),
+                      (self.get_path(digest), None)]
+        candidates.extend((self.get_path(digest, compression), compression)
+                          for compression in sorted(CODECS))
+        for path, compression in candidates:
+            if os.path.exists(path):
+                return path, compression
+
+        # The file could have been recompressed while we were looking
+        # for it: set_compression indexes the new path before deleting
+        # the old one.
+        self._refresh_index()
+        new_entry = self._index.get(digest)
+        if new_entry is not None and new_entry != entry:
+            path = self.get_path(digest, new_entry[2])
+            if os.path.exists(path):
+                return path, new_entry[2]
+        return None
+
+    def _find(self, digest):
+        """Return the path of a stored file.
+
+        digest (unicode): the digest of the file to find.
+
+        return (string|None): the path of the file, or None if it is
+            not stored.
+
+        """
+        found = self._find_compressed(digest)
+        return found[0] if found is not None else None
+
+    def _open(self, digest):
+        """Open a stored file for reading its uncompressed content.
+
+        digest (unicode): the digest of the file.
+
+        return (fileobj): a readable binary file-like object.
+
+        raise (KeyError): if the file cannot be found.
+
+        """
+        found = self._find_compressed(digest)
+        if found is None:
             raise KeyError("File not found.")
+        path, compression = found
+        fobj = io.open(path, 'rb')
+        if compression is not None:
+            fobj = DecompressingReader(fobj, compression)
+        return fobj
 
-        return io.open(file_path, 'rb')
+    def _refresh_index(self):
+        """Read the records appended to the index since the last time.
 
-    def put_file(self, digest, desc=""):
-        """See FileCacherBackend.put_file().
+        If the index has been rewritten by someone else, reload it from
+        scratch.
 
         """
-        file_path = os.path.join(self.path, digest)
+        try:
+            index = io.open(self.index_path, 'rb')
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            self._index = dict()
+            self._index_inode = None
+            self._index_offset = 0
+            return
+
+        with index:
+            inode = os.fstat(index.fileno()).st_ino
+            if inode != self._index_inode:
+                self._index = dict()
+                self._index_inode = inode
+                self._index_offset = 0
+            index.seek(self._index_offset)
+            data = index.read()
+
+        # Ignore the last line if it's still being written.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if len(line) == 0:
+                continue
+            try:
+                record = json.loads(line.decode("utf-8"))
+                digest, size, desc = record[:3]
+            except (ValueError, TypeError):
+                logger.warning("Invalid line in the index of %s, "
+                               "ignoring it.", self.path)
+                continue
+            # Records written before the compression was recorded are
+            # taken as uncompressed (_find_compressed copes if not).
+            compression = record[3] if len(record) > 3 else None
+            if size is None:
+                self._index.pop(digest, None)
+            else:
+                self._index[digest] = (size, desc, compression)
+        self._index_offset += end
+
+    @contextmanager
+    def _lock_index(self):
+        """Hold the lock serializing the writes to the index.
+
+        It is an flock on a file of its own: a lockf on the index
+        would be released as soon as the process closes any of its
+        descriptors of the index, for example when reading it.
+
+        """
+        lock_fd = os.open(self.index_lock_path, os.O_RDWR | os.O_CREAT,
+                          0o666)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
 
-        if os.path.exists(file_path):
+    def _append_index(self, digest, size, desc, compression=None):
+        """Add a record to the index.
+
+        digest (unicode): the digest of the file.
+        size (int|None): its size, or None if the file was deleted.
+        desc (unicode|None): its description.
+        compression (unicode|None): the codec it is compressed with,
+            if any.
+
+        """
+        line = json.dumps([digest, size, desc, compression],
+                          separators=(",", ":")) + "\n"
+        # Under the lock, the index cannot be replaced by
+        # rewrite_index between opening it and writing.
+        with self._lock_index():
+            with io.open(self.index_path, 'ab') as index:
+                index.write(line.encode("utf-8"))
+
+    def _publish(self, digest, desc, temp_path, size, compression=None):
+        """Move a completely written file to its place.
+
+        See FSBackendWriter.
+
+        """
+        file_path = self.get_path(digest, compression)
+        try:
+            os.makedirs(os.path.dirname(file_path))
+        except OSError:
+            pass
+        os.rename(temp_path, file_path)
+        self._append_index(digest, size, desc, compression)
+
+    def get_file(self, digest):
+        """See FileCacherBackend.get_file().
+
+        """
+        return self._open(digest)
+
+    def put_file(self, digest, desc="", compression=None):
+        """See FileCacherBackend.put_file().
+
+        """
+        if self._find(digest) is not None:
             return None
 
-        return io.open(file_path, 'wb')
+        file_dir = os.path.dirname(self.get_path(digest))
+        try:
+            os.makedirs(file_dir)
+        except OSError:
+            pass
+
+        # Hidden, so that it's not mistaken for a stored file.
+        fd, temp_path = tempfile.mkstemp(dir=file_dir, prefix=".")
+        os.close(fd)
+
+        return FSBackendWriter(self, digest, desc, temp_path, compression)
+
+    def create_file(self, desc="", compression=None):
+        """See FileCacherBackend.create_file().
+
+        """
+        # Hidden, so that it's not mistaken for a stored file.
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        os.close(fd)
+
+        return FSBackendWriter(self, None, desc, temp_path, compression)
+
+    def set_compression(self, digest, compression):
+        """See FileCacherBackend.set_compression().
+
+        The file is written again next to the current one, which is
+        deleted only after the new one has been indexed.
+
+        """
+        self._refresh_index()
+        found = self._find_compressed(digest)
+        if found is None:
+            raise KeyError("File not found.")
+        path, current = found
+        if current == compression and \
+                path == self.get_path(digest, compression):
+            return False
+        size = self.get_size(digest)
+        desc = self.describe(digest)
+
+        file_path = self.get_path(digest, compression)
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path), prefix=".")
+        try:
+            dst = io.open(fd, 'wb')
+            if compression is not None:
+                dst = CompressingWriter(dst, compression)
+            with dst:
+                with self._open(digest) as src:
+                    copyfileobj(src, dst, FileCacher.CHUNK_SIZE)
+        except:
+            os.unlink(temp_path)
+            raise
+        os.rename(temp_path, file_path)
+        self._append_index(digest, size, desc, compression)
+        if path != file_path:
+            os.unlink(path)
+        return True
 
     def describe(self, digest):
         """See FileCacherBackend.describe().
 
         """
-        file_path = os.path.join(self.path, digest)
+        self._refresh_index()
+        if digest in self._index:
+            return self._index[digest][1]
 
-        if not os.path.exists(file_path):
+        if self._find(digest) is None:
             raise KeyError("File not found.")
 
         return ""
@@ -196,29 +841,179 @@ class FSBackend(FileCacherBackend):
         """See FileCacherBackend.get_size().
 
         """
-        file_path = os.path.join(self.path, digest)
+        self._refresh_index()
+        if digest in self._index:
+            return self._index[digest][0]
 
-        if not os.path.exists(file_path):
+        found = self._find_compressed(digest)
+
+        if found is None:
             raise KeyError("File not found.")
 
-        return os.stat(file_path).st_size
+        path, compression = found
+        if compression is None:
+            return os.stat(path).st_size
+        # Files are indexed when stored; this one is not (e.g., the
+        # index was lost), so record its size, which can only be known
+        # decompressing it, for the next times.
+        size = get_uncompressed_size(io.open(path, 'rb'), compression)
+        self._append_index(digest, size, "", compression)
+        return size
 
     def delete(self, digest):
         """See FileCacherBackend.delete().
 
         """
-        file_path = os.path.join(self.path, digest)
+        paths = [self.get_path(digest, compression)
+                 for compression in sorted(CODECS)]
+        paths += [self.get_path(digest), self._get_flat_path(digest)]
+        for file_path in paths:
+            try:
+                os.unlink(file_path)
+            except OSError:
+                pass
+
+        self._refresh_index()
+        if digest in self._index:
+            self._append_index(digest, None, None)
+
+    def list(self):
+        """See FileCacherBackend.list().
+
+        """
+        self._refresh_index()
+        files = list((digest, desc)
+                     for digest, (_, desc, _) in self._index.iteritems())
+
+        # Files still stored with the flat layout.
+        files.extend((name, "") for name in os.listdir(self.path)
+                     if FSBackend.is_digest(name) and name not in self._index)
+
+        return files
+
+    def list_legacy_files(self):
+        """List the files stored with the flat layout.
+
+        return ([unicode]): their digests.
+
+        """
+        return list(name for name in os.listdir(self.path)
+                    if FSBackend.is_digest(name))
+
+    def migrate_legacy_file(self, digest):
+        """Move a file from the flat layout to the sharded one.
+
+        The file is always reachable by concurrent readers during the
+        move. Symbolic links (as created by setup_fs_storage.sh) are
+        recreated so that they point to the same target.
+
+        digest (unicode): the digest of the file to move.
+
+        return (bool): whether the file has been moved (it is not if
+            it is a dangling symbolic link).
+
+        """
+        flat_path = self._get_flat_path(digest)
+        file_path = self.get_path(digest)
+        file_dir = os.path.dirname(file_path)
 
         try:
-            os.unlink(file_path)
+            size = os.stat(flat_path).st_size
+        except OSError:
+            logger.warning("Cannot access %s, not moving it.", flat_path)
+            return False
+
+        try:
+            os.makedirs(file_dir)
         except OSError:
             pass
 
-    def list(self):
-        """See FileCacherBackend.list().
+        if os.path.islink(flat_path):
+            target = os.readlink(flat_path)
+            if not os.path.isabs(target):
+                target = os.path.relpath(
+                    os.path.join(self.path, target), file_dir)
+            if not os.path.lexists(file_path):
+                os.symlink(target, file_path)
+            os.unlink(flat_path)
+        else:
+            os.rename(flat_path, file_path)
+
+        self._refresh_index()
+        if digest not in self._index:
+            self._append_index(digest, size, "")
+        return True
+
+    def rewrite_index(self, rescan=False):
+        """Replace the index with a compact one.
+
+        The new index has one record for each file, dropping the
+        records of deleted files and the duplicates.
+
+        rescan (bool): if True, rebuild the index from the files
+            actually stored in the sharded layout, keeping the known
+            descriptions; otherwise just compact the current index.
+
+        return (int): the number of records in the new index.
 
         """
-        return list((x, "") for x in os.listdir(self.path))
+        self._refresh_index()
+        entries = dict(self._index)
+        inode, offset = self._index_inode, self._index_offset
+        if rescan:
+            entries = dict()
+            for dir_path, _, names in os.walk(self.path):
+                for name in names:
+                    parsed = FSBackend.parse_name(name)
+                    if parsed is None or dir_path == self.path:
+                        continue
+                    digest, compression = parsed
+                    path = os.path.join(dir_path, name)
+                    try:
+                        if compression is None:
+                            size = os.stat(path).st_size
+                        elif digest in self._index:
+                            size = self._index[digest][0]
+                        else:
+                            size = get_uncompressed_size(
+                                io.open(path, 'rb'), compression)
+                    except (OSError, IOError):
+                        continue
+                    entries[digest] = (
+                        size, self._index.get(digest, (0, ""))[1],
+                        compression)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        with io.open(fd, 'wb') as new_index:
+            for digest, (size, desc, compression) \
+                    in sorted(entries.iteritems()):
+                new_index.write((json.dumps(
+                    [digest, size, desc, compression],
+                    separators=(",", ":")) + "\n").encode("utf-8"))
+
+        # Block appends to the old index while we copy its last records
+        # and replace it.
+        with self._lock_index():
+            try:
+                with io.open(self.index_path, 'rb') as index:
+                    # If someone else rewrote the index in the
+                    # meantime, copy all of it: the records that
+                    # follow ours take precedence anyway.
+                    if os.fstat(index.fileno()).st_ino == inode:
+                        index.seek(offset)
+                    tail = index.read()
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                tail = b""
+            # Ignore the last line if it was never completed.
+            tail = tail[:tail.rfind(b"\n") + 1]
+            with io.open(temp_path, 'ab') as new_index:
+                new_index.write(tail)
+            os.rename(temp_path, self.index_path)
+
+        self._refresh_index()
+        return len(entries)
 
 
 class DBBackend(FileCacherBackend):
@@ -238,50 +1033,114 @@ class DBBackend(FileCacherBackend):
             if fso is None:
                 raise KeyError("File not found.")
 
-            return fso.get_lobject(mode='rb')
+            return fso.get_file()
 
-    def put_file(self, digest, desc=""):
-        """See FileCacherBackend.put_file().
+    def get_files(self, digests):
+        """See FileCacherBackend.get_files().
+
+        All the files are read using a single connection. The beginning
+        of each of them is fetched with a single query, so that files
+        smaller than LargeObjectBatch.HEAD_SIZE don't need any further
+        round trip.
 
         """
+        with SessionGen() as session:
+            rows = session.query(FSObject.digest, FSObject.loid,
+                                 FSObject.compression)\
+                .filter(FSObject.digest.in_(digests)).all()
+        loids = dict((digest, loid) for digest, loid, _ in rows)
+        compressions = dict((digest, compression)
+                            for digest, _, compression in rows)
+
+        for digest in digests:
+            if digest not in loids:
+                yield digest, KeyError("File not found.")
+
+        found = [digest for digest in digests if digest in loids]
+        if len(found) == 0:
+            return
+
         try:
-            with SessionGen() as session:
-                fso = FSObject.get_from_digest(digest, session)
+            batch = LargeObjectBatch([loids[digest] for digest in found])
+        except IOError:
+            # Some large object is broken: go on one file at a time, so
+            # that we can tell which one.
+            logger.warning("Cannot read %d files together, reading them "
+                           "one at a time.", len(found))
+            for item in FileCacherBackend.get_files(self, found):
+                yield item
+            return
 
-                # Check digest uniqueness
-                if fso is not None:
-                    logger.debug("File %s already stored on database, not "
-                                 "sending it again.", digest)
-                    session.rollback()
-                    return None
+        with batch:
+            for digest in found:
+                fobj = batch.get_lobject(loids[digest])
+                if compressions[digest] is not None:
+                    fobj = DecompressingReader(fobj, compressions[digest])
+                yield digest, fobj
 
-                # If it is not already present, copy the file into the
-                # lobject
-                else:
-                    fso = FSObject(description=desc)
-                    fso.digest = digest
+    def put_file(self, digest, desc="", compression=None):
+        """See FileCacherBackend.put_file().
 
-                    session.add(fso)
+        The FSObject is created when the returned writer is closed,
+        with the size of the content written.
 
-                    logger.debug("File %s stored on the database.", digest)
+        """
+        # Check digest uniqueness
+        if self.touch(digest):
+            logger.debug("File %s already stored on database, not "
+                         "sending it again.", digest)
+            return None
+
+        return DBBackendWriter(desc, compression, digest)
+
+    def create_file(self, desc="", compression=None):
+        """See FileCacherBackend.create_file().
+
+        """
+        return DBBackendWriter(desc, compression)
+
+    def describe(self, digest):
+        """See FileCacherBackend.describe().
+
+        """
+        with SessionGen() as session:
+            fso = FSObject.get_from_digest(digest, session)
+
+            if fso is None:
+                raise KeyError("File not found.")
+
+            return fso.description
+
+    def touch(self, digest):
+        """See FileCacherBackend.touch().
+
+        The row of the file is written again, which makes the
+        collections of orphans running concurrently keep it.
+
+        """
+        with SessionGen() as session:
+            found = FSObject.touch(digest, session)
+            session.commit()
+        return found
 
-                    # FIXME There is a remote possibility that someone
-                    # will try to access this file, believing it has
-                    # already been stored (since its FSObject exists),
-                    # while we're still sending its content.
+    @staticmethod
+    def _compute_size(fso):
+        """Return the size of the content of a file, reading it.
 
-                    lobject = fso.get_lobject(mode='wb')
+        fso (FSObject): the file, whose size was not recorded.
 
-                    session.commit()
+        return (int): the size of its (uncompressed) content.
 
-                    return lobject
+        """
+        if fso.compression is not None:
+            return get_uncompressed_size(fso.get_lobject(mode='rb'),
+                                         fso.compression)
 
-        except IntegrityError:
-            logger.warning("File %s caused an IntegrityError, ignoring...",
-                           digest)
+        with fso.get_lobject(mode='rb') as lobj:
+            return lobj.seek(0, io.SEEK_END)
 
-    def describe(self, digest):
-        """See FileCacherBackend.describe().
+    def get_size(self, digest):
+        """See FileCacherBackend.get_size().
 
         """
         with SessionGen() as session:
@@ -290,22 +1149,55 @@ class DBBackend(FileCacherBackend):
             if fso is None:
                 raise KeyError("File not found.")
 
-            return fso.description
+            if fso.size is not None:
+                return fso.size
+            return DBBackend._compute_size(fso)
 
-    def get_size(self, digest):
-        """See FileCacherBackend.get_size().
+    def set_compression(self, digest, compression):
+        """See FileCacherBackend.set_compression().
+
+        The content is copied to a new large object, which replaces the
+        old one (that is then deleted) in the FSObject. It goes through
+        a temporary file, so that the two large objects aren't open at
+        the same time, as that would need two connections of the pool.
 
         """
-        # TODO - The business logic may be moved in FSObject, for
-        # better generality
         with SessionGen() as session:
-            fso = FSObject.get_from_digest(digest, session)
+            fso = session.query(FSObject)\
+                .filter(FSObject.digest == digest)\
+                .with_for_update().first()
 
             if fso is None:
                 raise KeyError("File not found.")
+            if fso.compression == compression:
+                return False
+
+            with tempfile.TemporaryFile(dir=config.temp_dir) as temp:
+                with fso.get_file() as src:
+                    copyfileobj(src, temp, FileCacher.CHUNK_SIZE)
+                size = temp.tell()
+                temp.seek(0)
+
+                dst = LargeObject(0, mode='wb')
+                new_loid = dst.loid
+                try:
+                    if compression is not None:
+                        dst = CompressingWriter(dst, compression)
+                    with dst:
+                        copyfileobj(temp, dst, FileCacher.CHUNK_SIZE)
+                except:
+                    LargeObject.unlink(new_loid)
+                    raise
+
+            old_loid = fso.loid
+            if fso.size is None:
+                fso.size = size
+            fso.loid = new_loid
+            fso.compression = compression
+            session.commit()
 
-            with fso.get_lobject(mode='rb') as lobj:
-                return lobj.seek(0, io.SEEK_END)
+        LargeObject.unlink(old_loid)
+        return True
 
     def delete(self, digest):
         """See FileCacherBackend.delete().
@@ -357,7 +1249,7 @@ class NullBackend(FileCacherBackend):
     def get_file(self, digest):
         raise KeyError("File not found.")
 
-    def put_file(self, digest, desc=""):
+    def put_file(self, digest, desc="", compression=None):
         return None
 
     def describe(self, digest):
@@ -396,6 +1288,28 @@ class FileCacher(object):
     # The fake digest used to mark a file as deleted in the backend.
     TOMBSTONE_DIGEST = "x"
 
+    # When the local cache grows over its maximum size, files are
+    # evicted until it is back under this fraction of the maximum, so
+    # that we don't have to rescan the cache after every new file.
+    EVICTION_LOW_WATERMARK = 0.9
+
+    # Number of files load_many requests to the backend together.
+    BATCH_SIZE = 32
+
+    # Seconds between two attempts to take the lock to fetch a file
+    # that someone else is already fetching.
+    FETCH_LOCK_POLL_INTERVAL = 0.05
+
+    # The ioctl cloning a whole file on Linux (FICLONE), supported by
+    # copy-on-write file systems like btrfs and XFS.
+    FICLONE = 0x40049409
+
+    # Errors telling that a kind of link between the cache and a file
+    # system is never going to work, so there is no point in trying
+    # it again.
+    LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                               errno.EINVAL, errno.EPERM, errno.ENOSYS)
+
     def __init__(self, service=None, path=None, null=False):
         """Initialize.
 
@@ -404,8 +1318,10 @@ class FileCacher(object):
 
         service (Service|None): the service we are running for. Only
             used if present to determine the location of the
-            file-system cache (and to provide the shard number to the
-            Sandbox... sigh!).
+            file-system cache, which, if shared_cache is set in the
+            configuration, is the same for all the services of the
+            same kind on this machine (and to provide the shard number
+            to the Sandbox... sigh!).
         path (string|None): if specified, back the FileCacher with a
             file system-based storage instead of the default
             database-based one. The specified directory will be used
@@ -427,23 +1343,69 @@ class FileCacher(object):
 
         if service is None:
             self.file_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        elif config.shared_cache:
+            self.file_dir = os.path.join(
+                config.cache_dir, "fs-cache-%s" % service.name)
         else:
             self.file_dir = os.path.join(
                 config.cache_dir,
                 "fs-cache-%s-%d" % (service.name, service.shard))
 
+        # Names starting with an underscore cannot be digests, hence
+        # they are used for the internal housekeeping of the cache.
         self.temp_dir = os.path.join(self.file_dir, "_temp")
+        self.pins_dir = os.path.join(self.file_dir, "_pins")
+        self.fetch_dir = os.path.join(self.file_dir, "_fetch")
+        self.eviction_lock_path = os.path.join(self.file_dir, "_evict.lock")
+        self.size_path = os.path.join(self.file_dir, "_size")
 
         if not mkdir(config.cache_dir) or not mkdir(config.temp_dir) \
-                or not mkdir(self.file_dir) or not mkdir(self.temp_dir):
+                or not mkdir(self.file_dir) or not mkdir(self.temp_dir) \
+                or not mkdir(self.pins_dir) or not mkdir(self.fetch_dir):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
+        # Maximum size of the local cache in bytes (None if unbounded)
+        # and the last known estimate of its current size (None until
+        # the first time we need it); the estimate is kept in the size
+        # file, shared by all the processes using the cache.
+        self.max_cache_size = None
+        if config.cache_max_size is not None:
+            self.max_cache_size = config.cache_max_size * 1024 * 1024
+        self._cache_size = None
+
+        # Map from digest to [file descriptor of the pin file, number
+        # of pins held by this object].
+        self._pins = dict()
+
+        # Pairs (kind of link, device) for which link_file_to_path
+        # found that linking from the cache is not possible.
+        self._unsupported_links = set()
+
+        # The codec to compress the files we store with (when they
+        # are worth it), if the one in the configuration is available.
+        self.compression = config.storage_compression
+        if self.compression is not None and \
+                not is_available(self.compression):
+            logger.warning("Compression %s is not available, storing "
+                           "files uncompressed.", self.compression)
+            self.compression = None
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "evicted_bytes": 0,
+        }
+
     def load(self, digest, if_needed=False):
         """Load the file with the given digest into the cache.
 
         Ask the backend to provide the file and, if it's available,
-        copy its content into the file-system cache.
+        copy its content into the file-system cache. Only one process
+        at a time fetches a given file: if someone else sharing the
+        cache is already doing it, wait for them to finish (and, if
+        if_needed, use their copy).
 
         digest (unicode): the digest of the file to load.
         if_needed (bool): only load the file if it is not present in
@@ -457,25 +1419,215 @@ class FileCacher(object):
             raise TombstoneError()
         cache_file_path = os.path.join(self.file_dir, digest)
         if if_needed and os.path.exists(cache_file_path):
+            self._stats["hits"] += 1
+            self._touch(cache_file_path)
             return
 
-        ftmp_handle, temp_file_path = tempfile.mkstemp(dir=self.temp_dir,
-                                                       text=False)
-        ftmp = os.fdopen(ftmp_handle, 'w')
+        lock_fd = self._lock_fetch(digest)
+        try:
+            # The file could have been fetched while we were waiting.
+            if if_needed and os.path.exists(cache_file_path):
+                self._stats["hits"] += 1
+                self._touch(cache_file_path)
+                return
+
+            self._stats["misses"] += 1
+
+            fobj = self.backend.get_file(digest)
+            self._write_to_cache(digest, fobj)
+        finally:
+            self._unlock_fetch(digest, lock_fd)
+
+    def load_many(self, digests, concurrency=4):
+        """Load many files into the cache.
+
+        Files already present in the local cache are skipped; the
+        others are requested to the backend in batches of BATCH_SIZE
+        (for DBBackend, each batch needs just a few queries on a single
+        connection), fetching at most concurrency batches at a time.
+        Files that someone else sharing the cache is already fetching
+        are waited for afterwards, instead.
+
+        digests ([unicode]): the digests of the files to load.
+        concurrency (int): the maximum number of batches to fetch at
+            the same time.
+
+        return ({unicode: Exception}): the errors, for the digests
+            that couldn't be loaded (KeyError if the backend cannot
+            find the file, TombstoneError for the tombstone).
+
+        """
+        errors = dict()
+        missing = list()
+        for digest in set(digests):
+            if digest == FileCacher.TOMBSTONE_DIGEST:
+                errors[digest] = TombstoneError()
+                continue
+            cache_file_path = os.path.join(self.file_dir, digest)
+            if os.path.exists(cache_file_path):
+                self._stats["hits"] += 1
+                self._touch(cache_file_path)
+            else:
+                missing.append(digest)
 
-        fobj = self.backend.get_file(digest)
+        if len(missing) == 0:
+            return errors
 
-        # Copy the file to a temporary position
+        # Take the fetch locks of the missing files we are the first to
+        # ask for; the others are being fetched by someone else.
+        lock_fds = dict()
+        to_fetch = list()
+        fetched_by_others = list()
         try:
-            copyfileobj(fobj, ftmp, self.CHUNK_SIZE)
+            for digest in missing:
+                lock_fd = self._lock_fetch(digest, blocking=False)
+                if lock_fd is None:
+                    fetched_by_others.append(digest)
+                    continue
+                lock_fds[digest] = lock_fd
+                cache_file_path = os.path.join(self.file_dir, digest)
+                if os.path.exists(cache_file_path):
+                    # Fetched right before we took the lock.
+                    self._stats["hits"] += 1
+                    self._touch(cache_file_path)
+                else:
+                    to_fetch.append(digest)
+
+            self._fetch_many(to_fetch, concurrency, errors)
         finally:
+            for digest, lock_fd in lock_fds.iteritems():
+                self._unlock_fetch(digest, lock_fd)
+
+        for digest in fetched_by_others:
+            try:
+                self.load(digest, if_needed=True)
+            except (KeyError, IOError) as error:
+                errors[digest] = error
+
+        return errors
+
+    def _fetch_many(self, digests, concurrency, errors):
+        """Load files into the cache, in batches.
+
+        digests ([unicode]): the digests of the files to load.
+        concurrency (int): the maximum number of batches to fetch at
+            the same time.
+        errors ({unicode: Exception}): where to record the errors.
+
+        """
+        if len(digests) == 0:
+            return
+
+        def fetch(batch):
+            """Load the files of a batch, recording the errors.
+
+            """
+            for digest, fobj in self.backend.get_files(batch):
+                if isinstance(fobj, Exception):
+                    errors[digest] = fobj
+                    continue
+                self._stats["misses"] += 1
+                try:
+                    self._write_to_cache(digest, fobj)
+                except IOError as error:
+                    errors[digest] = error
+
+        logger.debug("Loading %d files into the cache.", len(digests))
+        batches = list(digests[i:i + FileCacher.BATCH_SIZE]
+                       for i in xrange(0, len(digests), FileCacher.BATCH_SIZE))
+        gevent.pool.Pool(concurrency).map(fetch, batches)
+
+    def _lock_fetch(self, digest, blocking=True):
+        """Take the lock that allows to fetch a file into the cache.
+
+        The lock is shared by all the processes using the cache, so
+        that a file is downloaded just once even if many of them need
+        it at the same time. While waiting, other greenlets can run.
+
+        digest (unicode): the digest of the file to fetch.
+        blocking (bool): whether to wait for the lock if someone else
+            holds it.
+
+        return (int|None): the file descriptor holding the lock, to
+            be passed to _unlock_fetch, or None if blocking is False
+            and the lock is held by someone else.
+
+        """
+        lock_path = os.path.join(self.fetch_dir, digest)
+        while True:
+            lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except IOError as error:
+                        if error.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+                    if not blocking:
+                        os.close(lock_fd)
+                        return None
+                    gevent.sleep(FileCacher.FETCH_LOCK_POLL_INTERVAL)
+
+                # The previous holder deletes the lock file before
+                # releasing it; if that happened after our open we are
+                # holding a lock on a dead file.
+                try:
+                    if os.fstat(lock_fd).st_ino == os.stat(lock_path).st_ino:
+                        return lock_fd
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+            except:
+                os.close(lock_fd)
+                raise
+            os.close(lock_fd)
+
+    def _unlock_fetch(self, digest, lock_fd):
+        """Release a lock taken with _lock_fetch.
+
+        digest (unicode): the digest of the fetched file.
+        lock_fd (int): the file descriptor holding the lock.
+
+        """
+        try:
+            os.unlink(os.path.join(self.fetch_dir, digest))
+        except OSError:
+            pass
+        os.close(lock_fd)
+
+    def _write_to_cache(self, digest, fobj):
+        """Copy a file from the backend into the local cache.
+
+        digest (unicode): the digest of the file.
+        fobj (fileobj): the file as returned by the backend; it is
+            closed by this method.
+
+        """
+        cache_file_path = os.path.join(self.file_dir, digest)
+
+        try:
+            ftmp_handle, temp_file_path = tempfile.mkstemp(
+                dir=self.temp_dir, text=False)
+            ftmp = os.fdopen(ftmp_handle, 'w')
+
+            # Copy the file to a temporary position
+            try:
+                copyfileobj(fobj, ftmp, self.CHUNK_SIZE)
+            except:
+                ftmp.close()
+                os.unlink(temp_file_path)
+                raise
             ftmp.close()
+        finally:
             fobj.close()
 
         # Then move it to its real location (this operation is atomic
         # by POSIX requirement)
         os.rename(temp_file_path, cache_file_path)
 
+        self._account(cache_file_path)
+
     def get_file(self, digest):
         """Retrieve a file from the storage.
 
@@ -502,13 +1654,23 @@ class FileCacher(object):
 
         logger.debug("Getting file %s.", digest)
 
-        if not os.path.exists(cache_file_path):
-            logger.debug("File %s not in cache, downloading "
-                         "from database.", digest)
+        if os.path.exists(cache_file_path):
+            self._stats["hits"] += 1
+            self._touch(cache_file_path)
+            try:
+                return io.open(cache_file_path, 'rb')
+            except IOError as error:
+                # Another process sharing the cache evicted the file
+                # right after our check: just download it again.
+                if error.errno != errno.ENOENT:
+                    raise
+
+        logger.debug("File %s not in cache, downloading "
+                     "from database.", digest)
 
-            self.load(digest)
+        self.load(digest, if_needed=True)
 
-            logger.debug("File %s downloaded.", digest)
+        logger.debug("File %s downloaded.", digest)
 
         return io.open(cache_file_path, 'rb')
 
@@ -569,6 +1731,109 @@ class FileCacher(object):
             with io.open(dst_path, 'wb') as dst:
                 copyfileobj(src, dst, self.CHUNK_SIZE)
 
+    def link_file_to_path(self, digest, dst_path, mode=0o444,
+                          hardlink=True):
+        """Make a file available at a location without copying it.
+
+        The file is loaded into the cache if needed, then dst_path is
+        created as a reflink (a copy-on-write clone, on file systems
+        supporting it) or as a hard link of the cached copy. A hard
+        link shares the inode with the cache, hence the cached copy
+        itself is made read-only (and its permissions can only be
+        widened, as other links may be in use): it's up to the caller
+        to make sure that nobody that can change them back has access
+        to dst_path.
+
+        digest (unicode): the digest of the file to get.
+        dst_path (string): the location to create; it must not exist.
+        mode (int): the permissions for the new file; write
+            permissions are ignored when hard linking.
+        hardlink (bool): whether a hard link is acceptable.
+
+        return (bool): whether dst_path has been created; if not (for
+            example because it is on a different file system than the
+            cache) the caller has to copy the file in some other way.
+
+        raise (KeyError): if the file cannot be found.
+        raise (TombstoneError): if the digest is the tombstone.
+        raise (OSError): if dst_path cannot be created.
+
+        """
+        if digest == FileCacher.TOMBSTONE_DIGEST:
+            raise TombstoneError()
+
+        dst_dev = os.stat(os.path.dirname(os.path.abspath(dst_path))).st_dev
+        methods = [("reflink", self._reflink)]
+        if hardlink:
+            methods.append(("hardlink", self._hardlink))
+        methods = [(name, method) for name, method in methods
+                   if (name, dst_dev) not in self._unsupported_links]
+        if len(methods) == 0:
+            return False
+
+        cache_file_path = os.path.join(self.file_dir, digest)
+        self.pin(digest)
+        try:
+            self.load(digest, if_needed=True)
+            for name, method in methods:
+                try:
+                    method(cache_file_path, dst_path, mode)
+                except EnvironmentError as error:
+                    if error.errno == errno.EEXIST:
+                        raise
+                    logger.debug("Cannot %s %s: %s.", name, digest, error)
+                    if error.errno in FileCacher.LINK_UNSUPPORTED_ERRNOS:
+                        self._unsupported_links.add((name, dst_dev))
+                else:
+                    logger.debug("File %s materialized with a %s.",
+                                 digest, name)
+                    return True
+        finally:
+            self.unpin(digest)
+
+        return False
+
+    def _reflink(self, src_path, dst_path, mode):
+        """Create dst_path as a copy-on-write clone of src_path.
+
+        src_path (string): the file to clone.
+        dst_path (string): the location to create.
+        mode (int): the permissions for the new file.
+
+        raise (EnvironmentError): if the clone is not possible.
+
+        """
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            try:
+                fcntl.ioctl(dst_fd, FileCacher.FICLONE, src_fd)
+                # The mode given to open is subject to the umask.
+                os.fchmod(dst_fd, mode)
+            except:
+                os.close(dst_fd)
+                os.unlink(dst_path)
+                raise
+            os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def _hardlink(self, src_path, dst_path, mode):
+        """Create dst_path as a read-only hard link to src_path.
+
+        src_path (string): the file to link.
+        dst_path (string): the location to create.
+        mode (int): the permissions to add to the file, except for
+            the write ones.
+
+        raise (EnvironmentError): if the link is not possible.
+
+        """
+        os.link(src_path, dst_path)
+        current_mode = stat.S_IMODE(os.stat(src_path).st_mode)
+        os.chmod(src_path, (current_mode | mode) & ~0o222)
+
     def save(self, digest, desc=""):
         """Save the file with the given digest into the backend.
 
@@ -586,7 +1851,9 @@ class FileCacher(object):
             raise TombstoneError()
         cache_file_path = os.path.join(self.file_dir, digest)
 
-        fobj = self.backend.put_file(digest, desc)
+        fobj = self.backend.put_file(
+            digest, desc, compression=self._choose_compression(
+                cache_file_path))
 
         if fobj is None:
             return
@@ -597,12 +1864,39 @@ class FileCacher(object):
         finally:
             fobj.close()
 
-    def put_file_from_fobj(self, src, desc=""):
+    def _choose_compression(self, path):
+        """Decide how to compress a file when storing it.
+
+        path (string): the path of the file.
+
+        return (unicode|None): the codec to use, or None if the file
+            is better stored uncompressed.
+
+        """
+        if self.compression is None:
+            return None
+        with io.open(path, 'rb') as fobj:
+            size = os.fstat(fobj.fileno()).st_size
+            if size < MIN_SIZE:
+                return None
+            sample = fobj.read(SAMPLE_SIZE)
+        if should_compress(sample, self.compression, size):
+            return self.compression
+        return None
+
+    def put_file_from_fobj(self, src, desc="", digest=None):
         """Store a file in the storage.
 
-        If it's already (for some reason...) in the cache send that
-        copy to the backend. Otherwise store it in the file-system
-        cache first.
+        The file is read only once: while reading it we compute its
+        digest, write its copy in the file-system cache and send it to
+        the backend, which stores it only at the end, once the digest
+        is known (or discards it, if it already has it). Small files
+        are instead read completely before talking to the backend, so
+        that they are not sent at all if it already has them.
+
+        If the caller already knows the digest, it can pass it as a
+        hint: if the backend already has that file, its content is
+        not sent again (but the digest is still verified).
 
         The file is obtained from a file-object. Other interfaces are
         available as `put_file_content', `put_file_from_path'.
@@ -611,54 +1905,112 @@ class FileCacher(object):
             to read the contents of the file.
         desc (unicode): the (optional) description to associate to the
             file.
+        digest (unicode|None): the expected digest of the file, if
+            known.
 
         return (unicode): the digest of the stored file.
 
         """
         logger.debug("Reading input file to store on the database.")
 
-        # Unfortunately, we have to read the whole file-obj to compute
-        # the digest but we take that chance to save it to a temporary
-        # path so that we then just need to move it. Hoping that both
-        # locations will be on the same filesystem, that should be way
-        # faster than reading the whole file-obj again (as it could be
-        # compressed or require network communication).
-        # XXX We're *almost* reimplementing copyfileobj.
-        with tempfile.NamedTemporaryFile('wb', delete=False,
-                                         dir=config.temp_dir) as dst:
-            hasher = hashlib.sha1()
+        upload = digest is None or not self._backend_has(digest)
+
+        # We read a first chunk, as large as needed to decide whether
+        # to compress the file.
+        buf = src.read(self.CHUNK_SIZE)
+        sample = [buf]
+        sample_size = len(buf)
+        while len(buf) > 0 and sample_size < SAMPLE_SIZE:
             buf = src.read(self.CHUNK_SIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                while len(buf) > 0:
-                    written = dst.write(buf)
-                    # Cooperative yield.
-                    gevent.sleep(0)
-                    if written is None:
-                        break
-                    buf = buf[written:]
-                buf = src.read(self.CHUNK_SIZE)
-            digest = hasher.hexdigest().decode("ascii")
-            dst.flush()
+            sample.append(buf)
+            sample_size += len(buf)
+        complete = len(buf) == 0
+        buf = b"".join(sample)
+
+        writer = None
+        if upload and not complete:
+            compression = None
+            if self.compression is not None and \
+                    should_compress(buf, self.compression):
+                compression = self.compression
+            writer = self.backend.create_file(desc, compression)
 
-            logger.debug("File has digest %s.", digest)
+        try:
+            fd, temp_file_path = tempfile.mkstemp(dir=self.temp_dir)
+            try:
+                hasher = hashlib.sha1()
+                with io.open(fd, 'wb') as dst:
+                    while len(buf) > 0:
+                        hasher.update(buf)
+                        dst.write(buf)
+                        if writer is not None:
+                            self._write_all(writer, buf)
+                        # Cooperative yield.
+                        gevent.sleep(0)
+                        buf = src.read(self.CHUNK_SIZE)
+                new_digest = hasher.hexdigest().decode("ascii")
+
+                logger.debug("File has digest %s.", new_digest)
+
+                # The backend stores the file only now, complete.
+                if writer is not None:
+                    writer.commit(new_digest)
+
+                cache_file_path = os.path.join(self.file_dir, new_digest)
+                new_in_cache = not os.path.exists(cache_file_path)
+                if new_in_cache:
+                    os.rename(temp_file_path, cache_file_path)
+            finally:
+                if os.path.exists(temp_file_path):
+                    os.unlink(temp_file_path)
+        finally:
+            if writer is not None:
+                writer.close()
 
-            cache_file_path = os.path.join(self.file_dir, digest)
+        if not upload and new_digest != digest:
+            logger.warning("File expected to have digest %s has digest %s "
+                           "instead.", digest, new_digest)
+            upload = True
 
-            if not os.path.exists(cache_file_path):
-                move(dst.name, cache_file_path)
-            else:
-                os.unlink(dst.name)
+        # The file has not been sent yet, because it is small or the
+        # hint was wrong; save sends it if the backend doesn't have it.
+        if upload and writer is None:
+            self.save(new_digest, desc)
+
+        if new_in_cache:
+            self._account(cache_file_path)
+
+        return new_digest
+
+    def _backend_has(self, digest):
+        """Return whether the backend already stores a file.
+
+        The file is touched (see touch), as it is going to be referred
+        to again.
+
+        digest (unicode): the digest of the file.
+
+        return (bool): whether the file is stored in the backend.
+
+        """
+        return self.backend.touch(digest)
 
-        # Store the file in the backend. We do that even if the file
-        # was already in the cache (that is, we ignore the check above)
-        # because there's a (small) chance that the file got removed
-        # from the backend but somehow remained in the cache.
-        self.save(digest, desc)
+    @staticmethod
+    def _write_all(fobj, buf):
+        """Write the whole buffer to a file-object.
 
-        return digest
+        fobj (fileobj): a writable binary file-like object, whose
+            write method may write only part of the data.
+        buf (bytes): the data to write.
 
-    def put_file_content(self, content, desc=""):
+        """
+        while len(buf) > 0:
+            written = fobj.write(buf)
+            if written is None:
+                break
+            buf = buf[written:]
+
+    def put_file_content(self, content, desc="", digest=None):
         """Store a file in the storage.
 
         See `put_file_from_fobj'. This method will read the content of
@@ -667,14 +2019,16 @@ class FileCacher(object):
         content (bytes): the content of the file to store.
         desc (unicode): the (optional) description to associate to the
             file.
+        digest (unicode|None): the expected digest of the file, if
+            known.
 
         return (unicode): the digest of the stored file.
 
         """
         with io.BytesIO(content) as src:
-            return self.put_file_from_fobj(src, desc)
+            return self.put_file_from_fobj(src, desc, digest)
 
-    def put_file_from_path(self, src_path, desc=""):
+    def put_file_from_path(self, src_path, desc="", digest=None):
         """Store a file in the storage.
 
         See `put_file_from_fobj'. This method will read the content of
@@ -684,12 +2038,14 @@ class FileCacher(object):
             from which to read the contents of the file.
         desc (unicode): the (optional) description to associate to the
             file.
+        digest (unicode|None): the expected digest of the file, if
+            known.
 
         return (unicode): the digest of the stored file.
 
         """
         with io.open(src_path, 'rb') as src:
-            return self.put_file_from_fobj(src, desc)
+            return self.put_file_from_fobj(src, desc, digest)
 
     def describe(self, digest):
         """Return the description of a file given its digest.
@@ -721,6 +2077,25 @@ class FileCacher(object):
             raise TombstoneError()
         return self.backend.get_size(digest)
 
+    def touch(self, digest):
+        """Check that a file is stored, before referring to it again.
+
+        Until a reference to a file is stored in the database, the file
+        can be deleted as an orphan by cmsCleanFiles: touching it makes
+        sure that it is kept, if it is still there, as long as the
+        reference is added within the grace period of cmsCleanFiles.
+
+        digest (unicode): the digest of the file.
+
+        return (bool): whether the file is stored.
+
+        raise (TombstoneError): if the digest is the tombstone.
+
+        """
+        if digest == FileCacher.TOMBSTONE_DIGEST:
+            raise TombstoneError()
+        return self.backend.touch(digest)
+
     def delete(self, digest):
         """Delete a file from the backend and the local cache.
 
@@ -752,9 +2127,12 @@ class FileCacher(object):
 
         """
         self.destroy_cache()
-        if not mkdir(config.cache_dir) or not mkdir(self.file_dir):
+        if not mkdir(config.cache_dir) or not mkdir(self.file_dir) \
+                or not mkdir(self.temp_dir) or not mkdir(self.pins_dir) \
+                or not mkdir(self.fetch_dir):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
+        self._cache_size = None
 
     def destroy_cache(self):
         """Completely remove and destroy the cache.
@@ -763,8 +2141,285 @@ class FileCacher(object):
         left on disk. After that, this instance isn't usable anymore.
 
         """
+        for pin_fd, _ in self._pins.itervalues():
+            os.close(pin_fd)
+        self._pins.clear()
         rmtree(self.file_dir)
 
+    def pin(self, digest):
+        """Protect a file in the local cache from eviction.
+
+        Pins are reference-counted and are honored by all the
+        FileCachers sharing the same cache directory, even if they
+        live in other processes. A file can be pinned before being
+        loaded in the cache. Every call must be matched by a call to
+        unpin.
+
+        digest (unicode): the digest of the file to pin.
+
+        """
+        if digest == FileCacher.TOMBSTONE_DIGEST:
+            return
+        if digest in self._pins:
+            self._pins[digest][1] += 1
+            return
+
+        pin_path = os.path.join(self.pins_dir, digest)
+        while True:
+            pin_fd = os.open(pin_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(pin_fd, fcntl.LOCK_SH)
+            # The evictor deletes the pin file while holding an
+            # exclusive lock on it; if that happened between our open
+            # and our flock we are holding a lock on a dead file.
+            try:
+                if os.fstat(pin_fd).st_ino == os.stat(pin_path).st_ino:
+                    break
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    os.close(pin_fd)
+                    raise
+            os.close(pin_fd)
+
+        self._pins[digest] = [pin_fd, 1]
+
+    def unpin(self, digest):
+        """Release a pin previously acquired with pin.
+
+        When the last pin on a file is released, its pin file is
+        deleted, unless someone else is still pinning it.
+
+        digest (unicode): the digest of the file to unpin.
+
+        """
+        if digest not in self._pins:
+            return
+        self._pins[digest][1] -= 1
+        if self._pins[digest][1] > 0:
+            return
+
+        pin_fd = self._pins.pop(digest)[0]
+        pin_path = os.path.join(self.pins_dir, digest)
+        try:
+            try:
+                fcntl.flock(pin_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                # Pinned by someone else.
+                return
+            # As in pin, the file could have been deleted (and created
+            # again) meanwhile, and then it's not ours to delete.
+            try:
+                if os.fstat(pin_fd).st_ino == os.stat(pin_path).st_ino:
+                    os.unlink(pin_path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+        finally:
+            os.close(pin_fd)
+
+    def get_cache_stats(self):
+        """Return the counters describing the use of the local cache.
+
+        return ({string: int|None}): the number of hits, misses,
+            evictions and evicted bytes since the creation of this
+            object, and the last known size of the local cache in
+            bytes (None if it has not been computed yet).
+
+        """
+        stats = dict(self._stats)
+        stats["size"] = self._cache_size
+        return stats
+
+    def _touch(self, cache_file_path):
+        """Mark a file in the local cache as just used.
+
+        We set the access time explicitly, as the file system could be
+        mounted with noatime or relatime.
+
+        cache_file_path (string): the path of the file in the cache.
+
+        """
+        try:
+            os.utime(cache_file_path, None)
+        except OSError:
+            pass
+
+    def _account(self, cache_file_path):
+        """Take note of a new file in the local cache.
+
+        If this makes the cache grow over its maximum size, trigger an
+        eviction.
+
+        cache_file_path (string): the path of the new file.
+
+        """
+        if self.max_cache_size is None:
+            return
+
+        try:
+            size = os.stat(cache_file_path).st_size
+        except OSError:
+            return
+        self._cache_size = self._update_cache_size(delta=size)
+
+        if self._cache_size > self.max_cache_size:
+            self.evict()
+
+    def _update_cache_size(self, delta=0, size=None):
+        """Update the estimate of the size of the local cache.
+
+        The estimate is stored in the size file, so that all the
+        processes sharing the cache contribute to it; it is computed
+        from scratch the first time, and corrected at every eviction.
+        Files removed outside of evictions are not subtracted, so it
+        can only err towards triggering an eviction too early.
+
+        delta (int): the number of bytes to add to the estimate.
+        size (int|None): if given, the exact size, replacing the
+            estimate.
+
+        return (int): the new estimate, in bytes.
+
+        """
+        size_fd = os.open(self.size_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(size_fd, fcntl.LOCK_EX)
+            if size is None:
+                try:
+                    size = int(os.read(size_fd, 32)) + delta
+                except ValueError:
+                    # Empty (just created) or corrupted.
+                    size = sum(file_size
+                               for _, _, file_size in self._scan_cache())
+            os.lseek(size_fd, 0, os.SEEK_SET)
+            os.ftruncate(size_fd, 0)
+            os.write(size_fd, b"%d" % size)
+            return size
+        finally:
+            os.close(size_fd)
+
+    def _scan_cache(self):
+        """List the files in the local cache.
+
+        return ([(float, unicode, int)]): for each file its access
+            time, its digest and its size in bytes.
+
+        """
+        entries = []
+        for digest in os.listdir(self.file_dir):
+            if digest.startswith("_"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.file_dir, digest))
+            except OSError:
+                # Removed concurrently.
+                continue
+            entries.append((stat.st_atime, digest, stat.st_size))
+        return entries
+
+    def evict(self, target_size=None):
+        """Remove least recently used files from the local cache.
+
+        Pinned files are never evicted. If another process sharing the
+        same cache directory is already evicting, return immediately.
+
+        target_size (int|None): the size in bytes the cache should be
+            reduced to; by default a fraction of its maximum size.
+
+        return (int): the number of evicted files.
+
+        """
+        if target_size is None:
+            if self.max_cache_size is None:
+                return 0
+            target_size = int(self.max_cache_size *
+                              FileCacher.EVICTION_LOW_WATERMARK)
+
+        lock_fd = os.open(self.eviction_lock_path,
+                          os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                logger.debug("Cache eviction already in progress.")
+                return 0
+
+            entries = self._scan_cache()
+            entries.sort()
+            total_size = sum(size for _, _, size in entries)
+            evicted = 0
+            for _, digest, size in entries:
+                if total_size <= target_size:
+                    break
+                if self._evict_file(digest):
+                    total_size -= size
+                    evicted += 1
+                    self._stats["evictions"] += 1
+                    self._stats["evicted_bytes"] += size
+                    # Cooperative yield.
+                    gevent.sleep(0)
+            self._cache_size = self._update_cache_size(size=total_size)
+
+            if total_size > target_size:
+                logger.warning("Cannot shrink the file cache below %d "
+                               "bytes, too many files are pinned.",
+                               total_size)
+            if evicted > 0:
+                logger.info("Evicted %d files from the file cache, "
+                            "which is now %d bytes.", evicted, total_size)
+            return evicted
+
+        finally:
+            os.close(lock_fd)
+
+    def _evict_file(self, digest):
+        """Remove a file from the local cache, unless it is pinned.
+
+        digest (unicode): the digest of the file to evict.
+
+        return (bool): whether the file has been evicted.
+
+        """
+        if digest in self._pins:
+            return False
+
+        pin_path = os.path.join(self.pins_dir, digest)
+        try:
+            pin_fd = os.open(pin_path, os.O_RDWR)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            # Nobody ever pinned it.
+            self.drop(digest)
+            return True
+
+        try:
+            try:
+                fcntl.flock(pin_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                # Pinned by someone else.
+                return False
+            # The pin file could have been deleted by unpin (and
+            # created again by pin) since we opened it: in that case
+            # our lock protects nothing.
+            try:
+                if os.fstat(pin_fd).st_ino != os.stat(pin_path).st_ino:
+                    return False
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                return False
+            self.drop(digest)
+            os.unlink(pin_path)
+            return True
+        finally:
+            os.close(pin_fd)
+
     def list(self):
         """List the files available in the storage.
 
@@ -774,37 +2429,170 @@ class FileCacher(object):
         """
         return self.backend.list()
 
-    def check_backend_integrity(self, delete=False):
+    def check_backend_integrity(self, delete=False, workers=1,
+                                checkpoint_path=None, report_interval=60):
         """Check the integrity of the backend.
 
         Request all the files from the backend. For each of them the
         digest is recomputed and checked against the one recorded in
         the backend.
 
+        Files are read and hashed by a pool of workers processes (each
+        reading one file at a time), so that reads from the backend
+        and hashing both happen in parallel. Progress, throughput and
+        an estimate of the remaining time are logged periodically.
+
+        If a checkpoint file is given, the digests of the files found
+        to be correct are appended to it, and the files it already
+        lists are skipped: this way an interrupted check can be
+        resumed. Files with mismatches are checked again every time.
+
         If mismatches are found, they are reported with ERROR
         severity. The method returns False if at least a mismatch is
         found, True otherwise.
 
         delete (bool): if True, files with wrong digest are deleted.
+        workers (int): the number of worker processes; if 1, the check
+            is done by this process.
+        checkpoint_path (string|None): the checkpoint file, if any.
+        report_interval (float): seconds between progress reports.
 
         """
-        clean = True
-        for digest, _ in self.list():
-            fobj = self.backend.get_file(digest)
-            hasher = hashlib.sha1()
+        digests = list(digest for digest, _ in self.list()
+                       if digest != FileCacher.TOMBSTONE_DIGEST)
+
+        checkpoint = None
+        if checkpoint_path is not None:
+            verified = set()
             try:
-                buf = fobj.read(self.CHUNK_SIZE)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = fobj.read(self.CHUNK_SIZE)
-            finally:
-                fobj.close()
-            computed_digest = hasher.hexdigest().decode("ascii")
-            if digest != computed_digest:
-                logger.error("File with hash %s actually has hash %s",
-                             digest, computed_digest)
-                if delete:
-                    self.delete(digest)
-                clean = False
+                with io.open(checkpoint_path, 'rt', encoding='ascii') as f:
+                    verified.update(line.strip() for line in f)
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+            digests = list(digest for digest in digests
+                           if digest not in verified)
+            if len(verified) > 0:
+                logger.info("Resuming from checkpoint, %d files already "
+                            "verified.", len(verified))
+            checkpoint = io.open(checkpoint_path, 'at', encoding='ascii')
+
+        logger.info("Checking %d files.", len(digests))
+
+        pool = None
+        if workers > 1:
+            # The workers must open their own connections, hence we
+            # make sure they don't inherit any.
+            engine.dispose()
+            fsobject.lo_connection_pool.close_idle()
+            pool = multiprocessing.Pool(
+                workers, _init_integrity_worker, (self.backend,))
+            results = pool.imap_unordered(_check_file_integrity, digests,
+                                          chunksize=16)
+        else:
+            _init_integrity_worker(self.backend, fork=False)
+            results = (_check_file_integrity(digest) for digest in digests)
 
+        clean = True
+        checked = 0
+        checked_bytes = 0
+        start = monotonic_time()
+        last_report = start
+        try:
+            for digest, computed_digest, size in results:
+                checked += 1
+                checked_bytes += size
+                if computed_digest is None:
+                    logger.error("File with hash %s cannot be read.",
+                                 digest)
+                    clean = False
+                elif digest != computed_digest:
+                    logger.error("File with hash %s actually has hash %s",
+                                 digest, computed_digest)
+                    if delete:
+                        self.delete(digest)
+                    clean = False
+                elif checkpoint is not None:
+                    checkpoint.write(digest + "\n")
+
+                now = monotonic_time()
+                if now - last_report >= report_interval:
+                    last_report = now
+                    if checkpoint is not None:
+                        checkpoint.flush()
+                    self._report_integrity_progress(
+                        checked, len(digests), checked_bytes, now - start)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if checkpoint is not None:
+                checkpoint.close()
+
+        self._report_integrity_progress(
+            checked, len(digests), checked_bytes, monotonic_time() - start)
         return clean
+
+    @staticmethod
+    def _report_integrity_progress(checked, total, checked_bytes, elapsed):
+        """Log the progress of check_backend_integrity.
+
+        checked (int): the number of files checked so far.
+        total (int): the number of files to check.
+        checked_bytes (int): their total size.
+        elapsed (float): seconds since the start of the check.
+
+        """
+        elapsed = max(elapsed, 1e-6)
+        eta = (total - checked) * elapsed / max(checked, 1)
+        logger.info("Checked %d/%d files (%.1f MB) in %d s, %.1f files/s, "
+                    "%.1f MB/s, ETA %d min.", checked, total,
+                    checked_bytes / 1024.0 / 1024.0, elapsed,
+                    checked / elapsed, checked_bytes / 1024.0 / 1024.0
+                    / elapsed, eta // 60)
+
+
+# The backend used by the current process of the pool of
+# check_backend_integrity.
+_integrity_backend = None
+
+
+def _init_integrity_worker(backend, fork=True):
+    """Prepare a process to check the integrity of files.
+
+    backend (FileCacherBackend): the backend to read the files from.
+    fork (bool): whether we are in a newly forked process.
+
+    """
+    global _integrity_backend
+    if fork:
+        gevent.reinit()
+    _integrity_backend = backend
+
+
+def _check_file_integrity(digest):
+    """Read a file from the backend and compute its digest.
+
+    digest (unicode): the digest of the file to check.
+
+    return ((unicode, unicode|None, int)): the digest, the computed
+        digest (None if the file cannot be read) and the size of the
+        file.
+
+    """
+    hasher = hashlib.sha1()
+    size = 0
+    try:
+        fobj = _integrity_backend.get_file(digest)
+        try:
+            buf = fobj.read(FileCacher.CHUNK_SIZE)
+            while len(buf) > 0:
+                hasher.update(buf)
+                size += len(buf)
+                buf = fobj.read(FileCacher.CHUNK_SIZE)
+        finally:
+            fobj.close()
+    except (KeyError, IOError):
+        logger.warning("Cannot read file %s.", digest, exc_info=True)
+        return digest, None, size
+    return digest, hasher.hexdigest().decode("ascii"), size
@@ -29,32 +29,193 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import io
+import logging
+import time
 
 import six
 
+import gevent.lock
+
 from sqlalchemy.schema import Column
-from sqlalchemy.types import Integer, String, Unicode
+from sqlalchemy.types import BigInteger, Integer, String, Unicode
 
 import psycopg2
 import psycopg2.extensions
 
+from cms import config
+
 from . import Base, custom_psycopg2_connection
+from .compression import DecompressingReader
+
+
+logger = logging.getLogger(__name__)
+
+
+class LargeObjectConnectionPool(object):
+
+    """A pool of psycopg2 connections dedicated to large objects.
+
+    Opening a connection (and authenticating) is much more expensive
+    than reading or writing a small file, hence we keep the connections
+    open after a large object is closed and hand them out again to the
+    following ones. These connections are not the ones pooled by
+    SQLAlchemy, for the reasons explained in LargeObject.
+
+    The number of connections in use at the same time is bounded: when
+    all of them are taken, acquire blocks (cooperatively) until one is
+    released. Connections are always returned to the pool outside of a
+    transaction, and idle connections that are too old are closed
+    instead of being reused.
+
+    """
+
+    def __init__(self, max_connections, max_idle=None, recycle=120,
+                 timeout=60):
+        """Initialize the pool.
+
+        max_connections (int): the maximum number of connections that
+            can be in use at the same time.
+        max_idle (int|None): the maximum number of idle connections to
+            keep open (by default, max_connections); 0 means that each
+            connection is closed as soon as it is released.
+        recycle (float): the number of seconds after which an idle
+            connection is closed instead of being reused.
+        timeout (float): the number of seconds to wait for a
+            connection before giving up.
+
+        """
+        self.max_connections = max_connections
+        self.max_idle = max_idle if max_idle is not None else max_connections
+        self.recycle = recycle
+        self.timeout = timeout
+
+        self._semaphore = gevent.lock.BoundedSemaphore(max_connections)
+        # Idle connections, each with the time it was last released.
+        self._idle = []
+        self._in_use = 0
+
+        self._stats = {
+            "connections_created": 0,
+            "connections_reused": 0,
+            "connections_discarded": 0,
+            "waits": 0,
+        }
+
+    def acquire(self):
+        """Get a connection from the pool, opening it if needed.
+
+        The connection is outside of any transaction and has to be
+        given back with release.
+
+        return (connection): a psycopg2 connection.
+
+        raise (IOError): if no connection became available in time.
+
+        """
+        if self._semaphore.locked():
+            self._stats["waits"] += 1
+        if not self._semaphore.acquire(timeout=self.timeout):
+            raise IOError("Timed out waiting for a connection to access "
+                          "large objects.")
+
+        try:
+            while len(self._idle) > 0:
+                conn, released_at = self._idle.pop()
+                if not conn.closed and \
+                        time.time() - released_at < self.recycle:
+                    self._stats["connections_reused"] += 1
+                    break
+                self._discard(conn)
+            else:
+                conn = custom_psycopg2_connection()
+                self._stats["connections_created"] += 1
+        except:
+            self._semaphore.release()
+            raise
+
+        self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        """Give a connection obtained with acquire back to the pool.
+
+        Any pending transaction on the connection is rolled back.
+        Broken connections are closed and not reused.
+
+        conn (connection): the connection to release.
+
+        """
+        self._in_use -= 1
+        try:
+            reusable = not conn.closed and len(self._idle) < self.max_idle
+            if reusable and conn.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+                reusable = conn.get_transaction_status() == \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        except psycopg2.Error:
+            reusable = False
+
+        if reusable:
+            self._idle.append((conn, time.time()))
+        else:
+            self._discard(conn)
+        self._semaphore.release()
+
+    def _discard(self, conn):
+        """Close a connection that will not be reused.
+
+        conn (connection): the connection to close.
+
+        """
+        self._stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def close_idle(self):
+        """Close all the idle connections held by the pool.
+
+        """
+        while len(self._idle) > 0:
+            self._discard(self._idle.pop()[0])
+
+    def get_stats(self):
+        """Return the counters describing the use of the pool.
+
+        return ({string: int}): the number of connections created,
+            reused and discarded, the number of times a caller had to
+            wait for a connection, and the number of connections
+            currently in use and idle.
+
+        """
+        stats = dict(self._stats)
+        stats["in_use"] = self._in_use
+        stats["idle"] = len(self._idle)
+        return stats
+
+
+# The pool used by all large objects of this process.
+lo_connection_pool = LargeObjectConnectionPool(
+    config.large_object_pool_size)
 
 
 class LargeObject(io.RawIOBase):
 
     """Present a PostgreSQL large object as a Python file-object.
 
-    A LargeObject creates and maintains (i.e. closes when done) its
-    own connection to the database. This approach is preferred over
-    using one of the connections pooled by SQLAlchemy (for example by
-    "borrowing" the one of the Session of the FSObject that created the
-    LO instance, if any!) to make these objects independent from the
-    Session (in particular, to allow them to live longer) and to avoid
-    polluting the connections in the SQLAlchemy pool (because executing
-    queries on the underlying DB API driver connection means kind of
-    "abusing" the SQLAlchemy API, and also because we don't want to
-    interfere with the life-cycle of these connections).
+    A LargeObject borrows its own connection to the database from
+    lo_connection_pool, and gives it back when closed. This approach is
+    preferred over using one of the connections pooled by SQLAlchemy
+    (for example by "borrowing" the one of the Session of the FSObject
+    that created the LO instance, if any!) to make these objects
+    independent from the Session (in particular, to allow them to live
+    longer) and to avoid polluting the connections in the SQLAlchemy
+    pool (because executing queries on the underlying DB API driver
+    connection means kind of "abusing" the SQLAlchemy API, and also
+    because we don't want to interfere with the life-cycle of these
+    connections).
 
     We cannot use the lobject interface provided by psycopg2 because
     it's incompatible with asynchronous connections and thus coroutine
@@ -88,6 +249,9 @@ class LargeObject(io.RawIOBase):
 
         self.loid = loid
 
+        # Set before anything can fail, as the destructor calls close.
+        self._fd = None
+
         # Check mode value.
         mode = set(mode)
         if not mode.issubset('rwb'):
@@ -100,27 +264,34 @@ class LargeObject(io.RawIOBase):
         self._readable = 'r' in mode
         self._writable = 'w' in mode
 
-        self._conn = custom_psycopg2_connection()
-        cursor = self._conn.cursor()
+        self._conn = lo_connection_pool.acquire()
 
-        # If the loid is 0, create the large object.
-        if self.loid == 0:
-            creat_mode = LargeObject.INV_READ | LargeObject.INV_WRITE
-            self.loid = self._execute("SELECT lo_creat(%(mode)s);",
-                                      {'mode': creat_mode},
-                                      "Couldn't create large object.", cursor)
-            if self.loid == 0:
-                raise IOError("Couldn't create large object.")
+        try:
+            cursor = self._conn.cursor()
 
-        # Open the large object.
-        open_mode = (LargeObject.INV_READ if self._readable else 0) | \
-                    (LargeObject.INV_WRITE if self._writable else 0)
-        self._fd = self._execute("SELECT lo_open(%(loid)s, %(mode)s);",
-                                 {'loid': self.loid, 'mode': open_mode},
-                                 "Couldn't open large object with LOID "
-                                 "%s." % (self.loid), cursor)
+            # If the loid is 0, create the large object.
+            if self.loid == 0:
+                creat_mode = LargeObject.INV_READ | LargeObject.INV_WRITE
+                self.loid = self._execute("SELECT lo_creat(%(mode)s);",
+                                          {'mode': creat_mode},
+                                          "Couldn't create large object.",
+                                          cursor)
+                if self.loid == 0:
+                    raise IOError("Couldn't create large object.")
+
+            # Open the large object.
+            open_mode = (LargeObject.INV_READ if self._readable else 0) | \
+                        (LargeObject.INV_WRITE if self._writable else 0)
+            self._fd = self._execute("SELECT lo_open(%(loid)s, %(mode)s);",
+                                     {'loid': self.loid, 'mode': open_mode},
+                                     "Couldn't open large object with LOID "
+                                     "%s." % (self.loid), cursor)
 
-        cursor.close()
+            cursor.close()
+        except:
+            conn, self._conn = self._conn, None
+            lo_connection_pool.release(conn)
+            raise
 
     def _execute(self, operation, parameters, message, cursor=None):
         """Run the given query making many success checks.
@@ -323,15 +494,20 @@ class LargeObject(io.RawIOBase):
         if self._fd is None:
             return
 
-        self._execute("SELECT lo_close(%(fd)s);",
-                      {'fd': self._fd},
-                      "Couldn't close large object.")
+        try:
+            self._execute("SELECT lo_close(%(fd)s);",
+                          {'fd': self._fd},
+                          "Couldn't close large object.")
 
-        self._conn.commit()
+            self._conn.commit()
 
-        # We delete the fd number to avoid writing on another file by
-        # mistake
-        self._fd = None
+        finally:
+            # We delete the fd number to avoid writing on another file
+            # by mistake, and give the connection back to the pool
+            # (which rolls back if the commit didn't happen).
+            self._fd = None
+            conn, self._conn = self._conn, None
+            lo_connection_pool.release(conn)
 
     @staticmethod
     def unlink(loid, conn=None):
@@ -341,15 +517,163 @@ class LargeObject(io.RawIOBase):
         with caution!
 
         """
-        if conn is None:
-            conn = custom_psycopg2_connection()
-            conn.autocommit = True
+        pooled = conn is None
+        if pooled:
+            conn = lo_connection_pool.acquire()
+
+        try:
+            # FIXME Use context manager as soon as we require
+            # psycopg2-2.5.
+            cursor = conn.cursor()
+            cursor.execute("SELECT lo_unlink(%(loid)s);",
+                           {'loid': loid})
+            cursor.close()
+            if pooled:
+                conn.commit()
+        finally:
+            if pooled:
+                lo_connection_pool.release(conn)
+
+
+class LargeObjectBatch(object):
+
+    """Read many large objects through a single connection.
 
-        # FIXME Use context manager as soon as we require psycopg2-2.5.
-        cursor = conn.cursor()
-        cursor.execute("SELECT lo_unlink(%(loid)s);",
-                       {'loid': loid})
-        cursor.close()
+    All the large objects are opened, and the first HEAD_SIZE bytes of
+    each of them are read, with a single query, saving most of the
+    round trips when the files are small. The rest of each file is
+    read on demand through the file-like objects returned by
+    get_lobject, which share the connection (hence they must be used
+    by one greenlet at a time).
+
+    The batch acts as a context manager: on exit all the large objects
+    are closed and the connection is given back to lo_connection_pool.
+
+    """
+
+    HEAD_SIZE = 256 * 1024
+
+    def __init__(self, loids):
+        """Open the large objects.
+
+        loids ([int]): the large object IDs.
+
+        raise (IOError): if any of the large objects cannot be opened.
+
+        """
+        self._conn = lo_connection_pool.acquire()
+        try:
+            cursor = self._conn.cursor()
+            # OFFSET 0 prevents the subquery from being flattened, which
+            # could cause lo_open to be called more than once per row.
+            cursor.execute("SELECT loid, fd, loread(fd, %(len)s) FROM "
+                           "(SELECT loid, lo_open(loid, %(mode)s) AS fd "
+                           "FROM unnest(%(loids)s::oid[]) AS t(loid) "
+                           "OFFSET 0) AS s;",
+                           {'loids': list(set(loids)),
+                            'mode': LargeObject.INV_READ,
+                            'len': LargeObjectBatch.HEAD_SIZE})
+            self._heads = dict((loid, (fd, bytes(head)))
+                               for loid, fd, head in cursor.fetchall())
+            cursor.close()
+        except psycopg2.DatabaseError:
+            self.close()
+            raise IOError("Couldn't open large objects.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, unused1, unused2, unused3):
+        self.close()
+
+    def get_lobject(self, loid):
+        """Return a readable file-object for one of the large objects.
+
+        loid (int): the large object ID, among those of the batch.
+
+        return (BatchedLargeObject): the file-like object.
+
+        """
+        fd, head = self._heads[loid]
+        return BatchedLargeObject(self, fd, head,
+                                  len(head) < LargeObjectBatch.HEAD_SIZE)
+
+    def read(self, fd, size):
+        """Read from one of the open large objects.
+
+        fd (int): the large object descriptor.
+        size (int): the maximum number of bytes to read.
+
+        return (bytes): the data read.
+
+        raise (IOError): if the read fails.
+
+        """
+        if self._conn is None:
+            raise io.UnsupportedOperation("Large object batch is closed.")
+        try:
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT loread(%(fd)s, %(len)s);",
+                           {'fd': fd, 'len': size})
+            data, = cursor.fetchone()
+            cursor.close()
+        except psycopg2.DatabaseError:
+            raise IOError("Couldn't read from large object.")
+        return bytes(data)
+
+    def close(self):
+        """Close all the large objects and release the connection.
+
+        """
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        # Nothing was written, and rolling back closes the descriptors.
+        lo_connection_pool.release(conn)
+
+
+class BatchedLargeObject(io.RawIOBase):
+
+    """A large object opened for reading by a LargeObjectBatch.
+
+    """
+
+    def __init__(self, batch, fd, head, complete):
+        """Initialize the object.
+
+        batch (LargeObjectBatch): the batch that opened the object.
+        fd (int): the large object descriptor.
+        head (bytes): the data already read from the large object.
+        complete (bool): whether head is the whole content.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._batch = batch
+        self._fd = fd
+        self._head = head
+        self._head_pos = 0
+        self._eof = complete
+
+    def readable(self):
+        """See IOBase.readable().
+
+        """
+        return True
+
+    def readinto(self, buf):
+        """See RawIOBase.readinto().
+
+        """
+        if self._head_pos < len(self._head):
+            data = self._head[self._head_pos:self._head_pos + len(buf)]
+            self._head_pos += len(data)
+        elif self._eof:
+            return 0
+        else:
+            data = self._batch.read(self._fd, len(buf))
+            self._eof = len(data) == 0
+        buf[:len(data)] = data
+        return len(data)
 
 
 class FSObject(Base):
@@ -380,6 +704,20 @@ class FSObject(Base):
         Unicode,
         nullable=True)
 
+    # Name of the codec the large object is compressed with (see
+    # cms.db.compression), or None if it's stored uncompressed. The
+    # digest always refers to the uncompressed content.
+    compression = Column(
+        String,
+        nullable=True)
+
+    # Size of the (uncompressed) content, recorded when the file is
+    # stored so that it doesn't need to be decompressed to know it, or
+    # None for the files stored before it was recorded.
+    size = Column(
+        BigInteger,
+        nullable=True)
+
     def get_lobject(self, mode='rb'):
         """Return an open file bound to the represented large object.
 
@@ -401,6 +739,19 @@ class FSObject(Base):
         # FIXME Wrap with a io.BufferedReader/Writer/Random?
         return lobj
 
+    def get_file(self):
+        """Return an open file with the content of the represented file.
+
+        Unlike get_lobject, the content is decompressed, if needed.
+
+        return (fileobj): a readable binary file-like object.
+
+        """
+        lobj = self.get_lobject(mode='rb')
+        if self.compression is not None:
+            return DecompressingReader(lobj, self.compression)
+        return lobj
+
     def delete(self):
         """Delete this file.
 
@@ -416,6 +767,22 @@ class FSObject(Base):
         """
         return cls.get_from_id(digest, session)
 
+    @classmethod
+    def touch(cls, digest, session):
+        """Record that the FSObject with the specified digest is being
+        used again, writing a new version of its row.
+
+        A collection of orphans (see cms.db.orphans) doesn't delete
+        the files whose row changed since it found them, so a file
+        touched before its reference is added isn't lost.
+
+        return (bool): whether the FSObject exists.
+
+        """
+        return session.query(cls).filter(cls.digest == digest).update(
+            {cls.description: cls.description},
+            synchronize_session=False) > 0
+
     @classmethod
     def get_all(cls, session):
         """Iterate over all the FSObjects available in the database.
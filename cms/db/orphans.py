@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Garbage collection of the files stored in the database.
+
+A file (FSObject) is an orphan when no column referring to files (that
+is, having a DigestConstraint) contains its digest. Orphans are found
+(marked) with set-based queries, one range of digests at a time, and
+then deleted (swept) in small batches, each checking again, in the
+same transaction, that the files are still orphans. While a batch is
+swept the tables referring to files are locked against writes, so
+that no reference can be added concurrently.
+
+A file becomes referenced only after it has been stored, or found
+already stored, so a file marked as orphan could be just waiting for
+its reference. FileCacher touches the files it finds already stored
+(see FSObject.touch), which writes a new version of their row: the
+version of each orphan (the xmin of its row) is recorded when marking,
+and files whose version changed are not swept. Files stored, or
+touched, just before marking are instead kept only if their reference
+is added in the meantime, so the caller should wait a while between
+marking and sweeping.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from sqlalchemy import text
+
+from . import DigestConstraint, FSObject, metadata
+from .filecacher import FileCacher
+
+
+# Flag of lo_open to open a large object for reading.
+INV_READ = 0x40000
+
+# First version of PostgreSQL with lo_lseek64 (lo_lseek fails on large
+# objects of 2 GB or more).
+LO_LSEEK64_SERVER_VERSION = (9, 3)
+
+
+def get_digest_columns():
+    """Return the columns referring to files by digest.
+
+    return ([Column]): the columns, in the order of their tables in the
+        metadata.
+
+    """
+    columns = []
+    for table in metadata.sorted_tables:
+        for column in table.columns:
+            if any(isinstance(constraint, DigestConstraint)
+                   for constraint in column.constraints):
+                columns.append(column)
+    return columns
+
+
+def get_digest_ranges(slices):
+    """Split the space of digests into ranges.
+
+    slices (int): the number of ranges, a power of 16.
+
+    return ([(unicode|None, unicode|None)]): the ranges, as pairs of
+        inclusive lower bound and exclusive upper bound, None meaning
+        unbounded.
+
+    raise (ValueError): if slices is not a power of 16.
+
+    """
+    length = 0
+    while 16 ** length < slices:
+        length += 1
+    if 16 ** length != slices:
+        raise ValueError("The number of slices must be a power of 16.")
+    bounds = [None] + ["%0*x" % (length, i) for i in xrange(1, slices)] \
+        + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _range_condition(column_name, start, end):
+    """Return the SQL condition selecting a range of digests.
+
+    column_name (unicode): the name of the column with the digests.
+    start (unicode|None): the inclusive lower bound, if any.
+    end (unicode|None): the exclusive upper bound, if any.
+
+    return (unicode): the condition, using the :start and :end
+        parameters.
+
+    """
+    conditions = ["%s IS NOT NULL" % column_name]
+    if start is not None:
+        conditions.append("%s >= :start" % column_name)
+    if end is not None:
+        conditions.append("%s < :end" % column_name)
+    return " AND ".join(conditions)
+
+
+def find_orphans(session, start=None, end=None):
+    """Find the stored files not referenced anywhere (mark phase).
+
+    session (Session): the session to use.
+    start (unicode|None): only consider digests from this one on.
+    end (unicode|None): only consider digests before this one.
+
+    return ([(unicode, unicode)]): the digests of the orphan files in
+        the range, sorted, each with the version of its row.
+
+    """
+    queries = ["SELECT digest FROM %s WHERE %s AND digest != :tombstone"
+               % (FSObject.__tablename__,
+                  _range_condition("digest", start, end))]
+    for column in get_digest_columns():
+        queries.append("SELECT %s FROM %s WHERE %s" % (
+            column.name, column.table.name,
+            _range_condition(column.name, start, end)))
+    rows = session.execute(text(
+        "SELECT digest, CAST(xmin AS TEXT) FROM %s WHERE digest IN (%s)"
+        % (FSObject.__tablename__, " EXCEPT ".join(queries))), {
+            "start": start,
+            "end": end,
+            "tombstone": FileCacher.TOMBSTONE_DIGEST})
+    return sorted((digest, version) for digest, version in rows)
+
+
+def get_stored_sizes(session, digests):
+    """Return how much space some files take in the database.
+
+    This is the size of their large objects, which, if they are
+    compressed, is less than the size of their content.
+
+    session (Session): the session to use.
+    digests ([unicode]): the digests of the files.
+
+    return ({unicode: int}): the size of each of the files that exist.
+
+    """
+    if len(digests) == 0:
+        return dict()
+    if session.connection().dialect.server_version_info \
+            < LO_LSEEK64_SERVER_VERSION:
+        lseek = "lo_lseek"
+    else:
+        lseek = "lo_lseek64"
+    rows = session.execute(text(
+        "SELECT digest, %s(lo_open(loid, :mode), 0, 2) "
+        "FROM %s WHERE digest = ANY(CAST(:digests AS VARCHAR[]))"
+        % (lseek, FSObject.__tablename__)),
+        {"mode": INV_READ, "digests": list(digests)})
+    return dict((digest, size) for digest, size in rows)
+
+
+def delete_orphans(session, orphans):
+    """Delete the files that are still orphans (sweep phase).
+
+    The files whose row has a different version than when they were
+    found are kept, as they may have been touched to be referenced
+    soon. The tables referring to files are locked until the end of
+    the transaction, which the caller should commit as soon as
+    possible.
+
+    session (Session): the session to use.
+    orphans ([(unicode, unicode)]): the digests of files found to be
+        orphans, each with the version of its row, as returned by
+        find_orphans.
+
+    return ([unicode]): the digests of the deleted files, that is, of
+        those that were still orphans.
+
+    """
+    if len(orphans) == 0:
+        return []
+    digests = [digest for digest, _ in orphans]
+    columns = get_digest_columns()
+    tables = sorted(set(column.table.name for column in columns))
+    session.execute(text("LOCK TABLE %s IN SHARE MODE" % ", ".join(tables)))
+
+    queries = ["SELECT unnest(CAST(:digests AS VARCHAR[]))"]
+    for column in columns:
+        queries.append(
+            "SELECT %s FROM %s WHERE %s = ANY(CAST(:digests AS VARCHAR[]))"
+            % (column.name, column.table.name, column.name))
+    rows = session.execute(text(
+        "DELETE FROM %s WHERE digest IN (%s) "
+        "AND (digest, CAST(xmin AS TEXT)) IN ("
+        "SELECT unnest(CAST(:digests AS VARCHAR[])), "
+        "unnest(CAST(:versions AS VARCHAR[]))) "
+        "RETURNING digest, loid"
+        % (FSObject.__tablename__, " EXCEPT ".join(queries))),
+        {"digests": digests,
+         "versions": [version for _, version in orphans]}).fetchall()
+
+    if len(rows) > 0:
+        session.execute(text(
+            "SELECT lo_unlink(loid) "
+            "FROM unnest(CAST(:loids AS OID[])) AS loid "
+            "WHERE loid IN (SELECT oid FROM pg_largeobject_metadata)"),
+            {"loids": list(loid for _, loid in rows)})
+    return sorted(digest for digest, _ in rows)
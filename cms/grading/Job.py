@@ -159,6 +159,17 @@ class Job(object):
             }
         return res
 
+    def get_digests(self):
+        """Return the digests of the files the job needs.
+
+        return ({unicode}): the digests.
+
+        """
+        digests = set()
+        for files in (self.files, self.managers, self.executables):
+            digests.update(f.digest for f in files.itervalues())
+        return digests
+
     @staticmethod
     def import_from_dict_with_type(data):
         """Create a Job from a dict having a type information.
@@ -275,11 +286,13 @@ class CompilationJob(Job):
     @classmethod
     def import_from_dict(cls, data):
         data['files'] = dict(
-            (k, File(k, v)) for k, v in data['files'].iteritems())
+            (k, File(k, v)) for k, v in data.get('files', {}).iteritems())
         data['managers'] = dict(
-            (k, Manager(k, v)) for k, v in data['managers'].iteritems())
+            (k, Manager(k, v))
+            for k, v in data.get('managers', {}).iteritems())
         data['executables'] = dict(
-            (k, Executable(k, v)) for k, v in data['executables'].iteritems())
+            (k, Executable(k, v))
+            for k, v in data.get('executables', {}).iteritems())
         return cls(**data)
 
     @staticmethod
@@ -477,6 +490,12 @@ class EvaluationJob(Job):
         self.only_execution = only_execution
         self.get_output = get_output
 
+    def get_digests(self):
+        """See Job.get_digests."""
+        digests = Job.get_digests(self)
+        digests.update(d for d in (self.input, self.output) if d is not None)
+        return digests
+
     def export_to_dict(self):
         res = Job.export_to_dict(self)
         res.update({
@@ -496,11 +515,13 @@ class EvaluationJob(Job):
     @classmethod
     def import_from_dict(cls, data):
         data['files'] = dict(
-            (k, File(k, v)) for k, v in data['files'].iteritems())
+            (k, File(k, v)) for k, v in data.get('files', {}).iteritems())
         data['managers'] = dict(
-            (k, Manager(k, v)) for k, v in data['managers'].iteritems())
+            (k, Manager(k, v))
+            for k, v in data.get('managers', {}).iteritems())
         data['executables'] = dict(
-            (k, Executable(k, v)) for k, v in data['executables'].iteritems())
+            (k, Executable(k, v))
+            for k, v in data.get('executables', {}).iteritems())
         return cls(**data)
 
     @staticmethod
@@ -560,16 +581,44 @@ class EvaluationJob(Job):
         # only if it is True.
 
         sr.evaluations += [Evaluation(
-            text=json.dumps(self.text, encoding='utf-8'),
-            outcome=self.outcome,
-            execution_time=self.plus.get('execution_time'),
-            execution_wall_clock_time=self.plus.get(
-                'execution_wall_clock_time'),
-            execution_memory=self.plus.get('execution_memory'),
-            evaluation_shard=self.shard,
-            evaluation_sandbox=":".join(self.sandboxes),
             testcase=sr.dataset.testcases[
-                self.operation["testcase_codename"]])]
+                self.operation["testcase_codename"]],
+            **self._get_evaluation_fields())]
+
+    def to_evaluation_row(self, sr):
+        """Return the evaluation given by the job result, as a row.
+
+        The evaluation is the same that to_submission would add, in
+        the form taken by cms.db.bulkwrite.insert_evaluations.
+
+        sr (SubmissionResult): the DB object the evaluation is for.
+
+        return (dict): the columns of the evaluation.
+
+        """
+        row = self._get_evaluation_fields()
+        row["submission_id"] = sr.submission_id
+        row["dataset_id"] = sr.dataset_id
+        row["testcase_id"] = \
+            sr.dataset.testcases[self.operation["testcase_codename"]].id
+        return row
+
+    def _get_evaluation_fields(self):
+        """Return the fields of the evaluation coming from the job.
+
+        return (dict): the fields, by name.
+
+        """
+        return {
+            "text": json.dumps(self.text, encoding='utf-8'),
+            "outcome": self.outcome,
+            "execution_time": self.plus.get('execution_time'),
+            "execution_wall_clock_time": self.plus.get(
+                'execution_wall_clock_time'),
+            "execution_memory": self.plus.get('execution_memory'),
+            "evaluation_shard": self.shard,
+            "evaluation_sandbox": ":".join(self.sandboxes),
+        }
 
     @staticmethod
     def from_user_test(operation, user_test, dataset):
@@ -654,6 +703,124 @@ class EvaluationJob(Job):
         ur.output = self.user_output
 
 
+# Fields of the jobs that, for jobs built from the same dataset, are
+# usually the same, and can therefore be sent only once as part of a
+# job template.
+TEMPLATE_FIELDS = ["task_type", "task_type_parameters", "managers",
+                   "time_limit", "memory_limit"]
+
+
+def get_job_template(dataset):
+    """Return the data of a dataset shared by the jobs built from it.
+
+    dataset (Dataset): the dataset.
+
+    return ({string: object}): the template, in a JSON-serializable
+        format: the values of TEMPLATE_FIELDS as exported by
+        export_to_dict, and the digests of input and output of each
+        testcase.
+
+    """
+    return {
+        "task_type": dataset.task_type,
+        "task_type_parameters": dataset.task_type_parameters,
+        "managers": dict((k, v.digest)
+                         for k, v in dataset.managers.iteritems()),
+        "time_limit": dataset.time_limit,
+        "memory_limit": dataset.memory_limit,
+        "testcases": dict((k, [v.input, v.output])
+                          for k, v in dataset.testcases.iteritems()),
+    }
+
+
+def compact_job_dict(data, dataset_id, version, template):
+    """Remove from an exported job the data found in its template.
+
+    A job compacted this way has a "dataset" item with the id and the
+    version of the dataset, and lacks the template fields (including
+    input and output, for testcases of the dataset) having the same
+    value as in the template; expand_job_dict restores them. The other
+    fields having their default value are removed too, as
+    import_from_dict sets them anyway.
+
+    data ({string: object}): a job exported with export_to_dict; it is
+        modified in place.
+    dataset_id (int): the id of the dataset the job was built from.
+    version (unicode): the version of the dataset.
+    template ({string: object}): the template of the dataset, as
+        returned by get_job_template.
+
+    """
+    defaults = _get_default_export(data["type"])
+    for key in list(data.iterkeys()):
+        if key in TEMPLATE_FIELDS:
+            if data[key] == template[key]:
+                del data[key]
+        elif key not in ("type", "input", "output") \
+                and key in defaults and data[key] == defaults[key]:
+            del data[key]
+
+    codename = data["operation"].get("testcase_codename")
+    if "input" in data and codename in template["testcases"] \
+            and [data["input"], data["output"]] \
+            == template["testcases"][codename]:
+        del data["input"]
+        del data["output"]
+
+    data["dataset"] = [dataset_id, version]
+
+
+def expand_job_dict(data, template):
+    """Restore the data removed from an exported job by
+    compact_job_dict.
+
+    data ({string: object}): a job compacted by compact_job_dict; it
+        is modified in place.
+    template ({string: object}|None): the template of the dataset,
+        as returned by get_job_template, or None to only remove the
+        information about the compaction (leaving the removed fields
+        to their default values on import).
+
+    """
+    del data["dataset"]
+    if template is None:
+        return
+
+    defaults = _get_default_export(data["type"])
+    for key in TEMPLATE_FIELDS:
+        if key in defaults and key not in data:
+            # The template is shared by all the jobs of the dataset.
+            if key == "managers":
+                data[key] = dict(template[key])
+            else:
+                data[key] = template[key]
+
+    codename = data["operation"].get("testcase_codename")
+    if "input" in defaults and "input" not in data \
+            and codename in template["testcases"]:
+        data["input"], data["output"] = template["testcases"][codename]
+
+
+def _get_default_export(type_):
+    """Return the export of a job with all fields at their default.
+
+    type_ (string): the type of the job, as in the "type" item of its
+        export.
+
+    return ({string: object}): the export of the job.
+
+    """
+    if type_ not in _DEFAULT_EXPORTS:
+        if type_ == "compilation":
+            _DEFAULT_EXPORTS[type_] = CompilationJob().export_to_dict()
+        else:
+            _DEFAULT_EXPORTS[type_] = EvaluationJob().export_to_dict()
+    return _DEFAULT_EXPORTS[type_]
+
+
+_DEFAULT_EXPORTS = dict()
+
+
 class JobGroup(object):
     """A simple collection of jobs."""
 
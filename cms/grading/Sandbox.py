@@ -32,13 +32,16 @@ import resource
 import select
 import stat
 import tempfile
+import weakref
 from functools import wraps, partial
 
 import gevent
+import gevent.local
 from gevent import subprocess
 #import gevent_subprocess as subprocess
 
 from cms import config
+from cms.grading.cpuaffinity import format_cpu_list, get_slot_cpus
 from cms.io.GeventUtils import copyfileobj, rmtree
 from cmscommon.commands import pretty_print_cmdline
 from cmscommon.datetime import monotonic_time
@@ -47,6 +50,48 @@ from cmscommon.datetime import monotonic_time
 logger = logging.getLogger(__name__)
 
 
+# The execution slot of the Worker (see Worker.get_slots) on whose
+# behalf the current greenlet creates sandboxes.
+_execution_slot = gevent.local.local()
+
+
+def set_execution_slot(slot, slots):
+    """Set the execution slot of the current greenlet.
+
+    slot (int): the index of the slot.
+    slots (int): how many slots the Worker has.
+
+    """
+    _execution_slot.slot = slot
+    _execution_slot.slots = slots
+
+
+def get_execution_slot():
+    """Return the execution slot of the current greenlet.
+
+    return ((int, int)): the index of the slot, and how many slots
+        there are; a greenlet that didn't set it runs in the only
+        slot.
+
+    """
+    return (getattr(_execution_slot, "slot", 0),
+            getattr(_execution_slot, "slots", 1))
+
+
+def _delete_path(path):
+    """Delete a file or a directory, with its content.
+
+    path (string): the path.
+
+    raise (OSError): if it cannot be deleted.
+
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        rmtree(path)
+    else:
+        os.remove(path)
+
+
 class SandboxInterfaceException(Exception):
     pass
 
@@ -195,6 +240,12 @@ class SandboxBase(object):
     EXIT_SYSCALL = 'syscall'
     EXIT_NONZERO_RETURN = 'nonzero return'
 
+    # Whether files from the storage can be hard linked into the
+    # sandbox. The cache and the sandbox then share the inode, so this
+    # is safe only if the sandboxed programs cannot write to files that
+    # are read-only, nor change their permissions.
+    HARDLINK_FROM_CACHE = False
+
     def __init__(self, multithreaded, file_cacher, temp_dir=None):
         """Initialization.
 
@@ -233,6 +284,35 @@ class SandboxBase(object):
         # packages.
         self.set_env["HOME"] = "./"
 
+    @classmethod
+    def clear_pool(cls):
+        """Delete what the sandboxes of this class keep for reuse, if
+        anything.
+
+        """
+        pass
+
+    def reset(self, keep=None):
+        """Prepare the sandbox for running another program, as if it
+        had just been created with only some of its files.
+
+        All the other files are deleted, and the parameters that the
+        executions may have changed are restored.
+
+        keep ([string]|None): relative paths of the files to keep (at
+            the top level of the sandbox).
+
+        raise (OSError): if some file cannot be deleted; the sandbox
+            should then not be used anymore.
+
+        """
+        keep = set(keep if keep is not None else [])
+        root = self.get_root_path()
+        for filename in os.listdir(root):
+            if filename not in keep:
+                _delete_path(os.path.join(root, filename))
+        self.max_processes = 1000 if self.multithreaded else 1
+
     def get_stats(self):
         """Return a human-readable string representing execution time
         and memory usage.
@@ -320,20 +400,48 @@ class SandboxBase(object):
                          "evalulate this submission. This may be due to "
                          "cheating. %s", real_path, e, exc_info=True)
             raise
+        os.chmod(real_path, self.get_file_mode(executable))
+        return file_
+
+    @staticmethod
+    def get_file_mode(executable=False):
+        """Return the permissions of the files created in the sandbox.
+
+        executable (bool): whether the file is executable.
+
+        return (int): the mode for the file.
+
+        """
         mod = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR
         if executable:
             mod |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-        os.chmod(real_path, mod)
-        return file_
+        return mod
 
     def create_file_from_storage(self, path, digest, executable=False):
         """Write a file taken from FS in the sandbox.
 
+        If the sandbox is on the same file system as the cache of the
+        FileCacher, the file is linked instead of being copied (see
+        HARDLINK_FROM_CACHE).
+
         path (string): relative path of the file inside the sandbox.
         digest (string): digest of the file in FS.
         executable (bool): to set permissions.
 
         """
+        real_path = self.relative_path(path)
+        try:
+            if self.file_cacher.link_file_to_path(
+                    digest, real_path, self.get_file_mode(executable),
+                    hardlink=self.HARDLINK_FROM_CACHE):
+                logger.debug("Linked file %s in sandbox.", path)
+                return
+        except OSError as e:
+            logger.error("Failed create file %s in sandbox. Unable to "
+                         "evalulate this submission. This may be due to "
+                         "cheating. %s", real_path, e, exc_info=True)
+            raise
+
         file_ = self.create_file(path, executable)
         self.file_cacher.get_file_to_fobj(digest, file_)
         file_.close()
@@ -760,13 +868,33 @@ class IsolateSandbox(SandboxBase):
        command number N.
 
     """
-    next_id = 0
+    # For each range of box ids (by its first id), the position in the
+    # range of the next id to try.
+    # Type: {int: int}
+    _next_ids = dict()
+
+    # The sandboxes not deleted yet, by their box id.
+    # Type: {int: IsolateSandbox}
+    _live = weakref.WeakValueDictionary()
+
+    # Sandboxed programs run as a different user than the owner of the
+    # cache, hence they cannot change the permissions of hard links.
+    HARDLINK_FROM_CACHE = True
 
     # If the command line starts with this command name, we are just
     # going to execute it without sandboxing, and with all permissions
     # on the current directory.
     SECURE_COMMANDS = ["/bin/cp", "/bin/mv", "/usr/bin/zip", "/usr/bin/unzip"]
 
+    # Deleted sandboxes whose box is still initialized, and whose
+    # directories are empty, ready to be taken over by the next
+    # sandbox with the same box id and temporary directory, so that it
+    # doesn't need to run isolate to initialize the box (and the
+    # deleted one to clean it up). Each Worker keeps at most one for
+    # each of its box ids.
+    # Type: {(int, unicode): IsolateSandbox}
+    _pool = dict()
+
     def __init__(self, multithreaded, file_cacher, temp_dir=None):
         """Initialization.
 
@@ -778,29 +906,49 @@ class IsolateSandbox(SandboxBase):
         # Isolate only accepts ids between 0 and 99. We assign the
         # range [(shard+1)*10, (shard+2)*10) to each Worker and keep
         # the range [0, 10) for other uses (command-line scripts like
-        # cmsMake or direct console users of isolate). Inside each
-        # range ids are assigned sequentially, with a wrap-around.
+        # cmsMake or direct console users of isolate). The range of a
+        # Worker is split evenly among its execution slots, so that
+        # job groups running at the same time never share a box.
+        # Inside each range ids are assigned sequentially, with a
+        # wrap-around, skipping those still in use.
         # FIXME This is the only use of FileCacher.service, and it's an
         # improper use! Avoid it!
+        # The same goes for the CPUs the slot is pinned to, if any.
         if file_cacher is not None and file_cacher.service is not None:
-            box_id = ((file_cacher.service.shard + 1) * 10
-                      + (IsolateSandbox.next_id % 10)) % 100
+            slot, slots = get_execution_slot()
+            ids_per_slot = 10 // slots
+            first_id = ((file_cacher.service.shard + 1) * 10
+                        + slot * ids_per_slot) % 100
+            self.cpus = get_slot_cpus(
+                file_cacher.service.shard, slot, slots)
         else:
-            box_id = IsolateSandbox.next_id % 10
-        IsolateSandbox.next_id += 1
+            ids_per_slot = 10
+            first_id = 0
+            self.cpus = None
+        box_id = self._get_free_box_id(first_id, ids_per_slot)
+        IsolateSandbox._live[box_id] = self
 
         # We create a directory "tmp" inside the outer temporary directory,
         # because the sandbox will bind-mount the inner one. The sandbox also
         # runs code as a different user, and so we need to ensure that they can
         # read and write to the directory. But we don't want everybody on the
         # system to, which is why the outer directory exists with no read
-        # permissions.
+        # permissions. A sandbox taken from the pool gives us both the
+        # directories and the box.
         self.inner_temp_dir = "/tmp"
-        self.outer_temp_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        reused = self._take_from_pool(box_id)
+        if reused is not None:
+            self.box_root = reused.box_root
+            self.outer_temp_dir = reused.outer_temp_dir
+        else:
+            # Where isolate keeps the box, known after initializing it.
+            self.box_root = None
+            self.outer_temp_dir = tempfile.mkdtemp(dir=self.temp_dir)
         # Don't use os.path.join here, because the absoluteness of /tmp will
         # bite you.
         self.path = self.outer_temp_dir + self.inner_temp_dir
-        os.mkdir(self.path)
+        if reused is None:
+            os.mkdir(self.path)
         self.allow_writing_all()
 
         self.exec_name = 'isolate'
@@ -842,14 +990,140 @@ class IsolateSandbox(SandboxBase):
         if os.path.isdir("/etc/alternatives"):
             self.add_mapped_directories(["/etc/alternatives"])
 
-        # Tell isolate to get the sandbox ready.
-        box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
-            + ["--box-id=%d" % self.box_id] + ["--init"]
-        ret = subprocess.call(box_cmd)
-        if ret != 0:
-            raise SandboxInterfaceException(
-                "Failed to initialize sandbox with command: %s "
-                "(error %d)" % (pretty_print_cmdline(box_cmd), ret))
+        # Tell isolate to get the sandbox ready (it prints where the
+        # box is).
+        if reused is None:
+            box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
+                + ["--box-id=%d" % self.box_id] + ["--init"]
+            process = subprocess.Popen(box_cmd, stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                raise SandboxInterfaceException(
+                    "Failed to initialize sandbox with command: %s "
+                    "(error %d)" % (pretty_print_cmdline(box_cmd),
+                                    process.returncode))
+            output = output.decode("utf-8", "replace").strip()
+            if os.path.isabs(output):
+                self.box_root = output
+
+    def _get_free_box_id(self, first_id, count):
+        """Return the next box id of a range that no other sandbox is
+        using.
+
+        An id is in use if a sandbox with it has not been deleted, or
+        if its box is kept for reuse by a sandbox with another
+        temporary directory.
+
+        first_id (int): the first id of the range.
+        count (int): the number of ids in the range.
+
+        return (int): the box id.
+
+        raise (SandboxInterfaceException): if all the ids of the range
+            are in use, that is, if more sandboxes are used at the same
+            time than the ids available to the execution slot.
+
+        """
+        used = set(IsolateSandbox._live.keys())
+        used.update(box_id for box_id, temp_dir in IsolateSandbox._pool
+                    if temp_dir != self.temp_dir)
+        next_id = IsolateSandbox._next_ids.get(first_id, 0)
+        for i in xrange(count):
+            box_id = first_id + (next_id + i) % count
+            if box_id not in used:
+                IsolateSandbox._next_ids[first_id] = (next_id + i + 1) % count
+                return box_id
+        raise SandboxInterfaceException(
+            "All the %d box ids from %d are in use; lower worker_slots "
+            "to have more for each slot." % (count, first_id))
+
+    def _take_from_pool(self, box_id):
+        """Take the deleted sandbox with a box, if it is still usable.
+
+        box_id (int): the id of the box.
+
+        return (IsolateSandbox|None): the deleted sandbox, or None if
+            there is none, or its box or directories are not in the
+            state it left them in (they are then deleted, and the box
+            is initialized again).
+
+        """
+        sandbox = IsolateSandbox._pool.pop((box_id, self.temp_dir), None)
+        if sandbox is None:
+            return None
+        try:
+            if os.path.isdir(os.path.join(sandbox.box_root, "box")) \
+                    and os.listdir(sandbox.path) == []:
+                logger.debug("Reusing box %d.", box_id)
+                return sandbox
+        except OSError:
+            pass
+        logger.warning("Box %d kept for reuse is not usable, "
+                       "initializing it again.", box_id)
+        try:
+            rmtree(sandbox.outer_temp_dir)
+        except (IOError, OSError):
+            logger.warning("Couldn't delete sandbox.", exc_info=True)
+        return None
+
+    def _return_to_pool(self):
+        """Empty the sandbox and keep its box for reuse.
+
+        return (bool): whether the sandbox has been kept; if not, it
+            must be deleted in full.
+
+        """
+        key = (self.box_id, self.temp_dir)
+        if not config.sandbox_reuse_boxes or self.box_root is None \
+                or key in IsolateSandbox._pool:
+            return False
+        # Both the directory we give to the sandboxed programs and the
+        # box itself (where they could write too) are emptied.
+        try:
+            rmtree(self.path)
+            os.mkdir(self.path)
+            self._empty_box()
+        except (IOError, OSError):
+            logger.warning("Couldn't empty box %d, deleting it.",
+                           self.box_id, exc_info=True)
+            return False
+        IsolateSandbox._pool[key] = self
+        return True
+
+    def _empty_box(self):
+        """Delete what the sandboxed programs left in the box of
+        isolate.
+
+        raise (OSError): if something cannot be deleted.
+
+        """
+        box_dir = os.path.join(self.box_root, "box")
+        for filename in os.listdir(box_dir):
+            _delete_path(os.path.join(box_dir, filename))
+
+    def reset(self, keep=None):
+        """See SandboxBase.reset.
+
+        The box of isolate is emptied as well, and the files kept are
+        writable again.
+
+        """
+        if self.box_root is None:
+            raise OSError("Cannot empty box %d, its path is unknown."
+                          % self.box_id)
+        SandboxBase.reset(self, keep)
+        self._empty_box()
+        self.allow_writing_all()
+
+    @classmethod
+    def clear_pool(cls):
+        """See SandboxBase.clear_pool."""
+        while len(IsolateSandbox._pool) > 0:
+            _, sandbox = IsolateSandbox._pool.popitem()
+            try:
+                sandbox._cleanup()
+            except (IOError, OSError):
+                logger.warning("Couldn't delete sandbox.", exc_info=True)
 
     def add_mapped_directories(self, dirs):
         """Add dirs to the external dirs visible to the sandboxed command.
@@ -863,10 +1137,15 @@ class IsolateSandbox(SandboxBase):
     def allow_writing_all(self):
         """Set permissions in such a way that any operation is allowed.
 
+        Files hard linked from the cache stay read-only (but they can
+        be deleted and created again).
+
         """
         os.chmod(self.path, 0o777)
         for filename in os.listdir(self.path):
-            os.chmod(os.path.join(self.path, filename), 0o777)
+            path = os.path.join(self.path, filename)
+            if not self._is_linked_from_cache(path):
+                os.chmod(path, 0o777)
 
     def allow_writing_none(self):
         """Set permissions in such a way that the user cannot write anything.
@@ -874,7 +1153,9 @@ class IsolateSandbox(SandboxBase):
         """
         os.chmod(self.path, 0o755)
         for filename in os.listdir(self.path):
-            os.chmod(os.path.join(self.path, filename), 0o755)
+            path = os.path.join(self.path, filename)
+            if not self._is_linked_from_cache(path):
+                os.chmod(path, 0o755)
 
     def allow_writing_only(self, paths):
         """Set permissions in so that the user can write only some paths.
@@ -884,16 +1165,48 @@ class IsolateSandbox(SandboxBase):
 
         """
         # If one of the specified file do not exists, we touch it to
-        # assign the correct permissions.
+        # assign the correct permissions; if it is shared with the
+        # cache, we give the sandbox its own copy.
         for path in (os.path.join(self.path, path) for path in paths):
             if not os.path.exists(path):
                 open(path, "w").close()
+            elif self._is_linked_from_cache(path):
+                self._unlink_from_cache(path)
 
         # Close everything, then open only the specified.
         self.allow_writing_none()
         for path in (os.path.join(self.path, path) for path in paths):
             os.chmod(path, 0o722)
 
+    def _is_linked_from_cache(self, path):
+        """Return whether a file in the sandbox is a hard link.
+
+        Hard links in the sandbox can only come from the cache of the
+        FileCacher (see HARDLINK_FROM_CACHE), and their permissions
+        must not be changed.
+
+        path (string): the real path of the file.
+
+        return (bool): whether path is a regular file with more than
+            one link.
+
+        """
+        stat_result = os.lstat(path)
+        return stat.S_ISREG(stat_result.st_mode) and stat_result.st_nlink > 1
+
+    def _unlink_from_cache(self, path):
+        """Replace a file hard linked from the cache with a copy.
+
+        path (string): the real path of the file.
+
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with io.open(path, "rb") as src:
+            with os.fdopen(fd, "wb") as dst:
+                copyfileobj(src, dst)
+        os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode) | 0o200)
+        os.rename(temp_path, path)
+
     def get_root_path(self):
         """Return the toplevel path of the sandbox.
 
@@ -1236,6 +1549,10 @@ class IsolateSandbox(SandboxBase):
             return p
 
         args = [self.box_exec] + self.build_box_options() + ["--"] + command
+        if self.cpus is not None:
+            # Isolate, and the program it runs, inherit the affinity.
+            args = ["taskset", "--cpu-list",
+                    format_cpu_list(self.cpus)] + args
         logger.debug("Executing program in sandbox with command: `%s'.",
                      pretty_print_cmdline(args))
         # Temporarily allow writing new files.
@@ -1317,9 +1634,21 @@ class IsolateSandbox(SandboxBase):
     def delete(self):
         """Delete the directory where the sandbox operated.
 
+        If possible, the directory and the box are only emptied, to be
+        reused by the next sandbox with the same box id.
+
         """
         logger.debug("Deleting sandbox in %s.", self.path)
+        if IsolateSandbox._live.get(self.box_id) is self:
+            del IsolateSandbox._live[self.box_id]
+        if self._return_to_pool():
+            return
+        self._cleanup()
 
+    def _cleanup(self):
+        """Clean up the box and delete the directories of the sandbox.
+
+        """
         # Tell isolate to cleanup the sandbox.
         box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
             + ["--box-id=%d" % self.box_id]
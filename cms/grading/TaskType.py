@@ -240,6 +240,31 @@ class TaskType(object):
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def get_max_sandboxes(self):
+        """Return how many sandboxes the jobs of this task type use at
+        the same time, at most.
+
+        return (int): the number of sandboxes.
+
+        """
+        return 1
+
+    def evaluate_testcases(self, jobs, file_cacher):
+        """Evaluate several EvaluationJobs of this task type.
+
+        Task types that can share some work among the testcases (for
+        example, preparing the sandbox) override this; by default, the
+        jobs are evaluated one by one. Each job must get the same
+        results it would get if evaluated by itself.
+
+        jobs ([EvaluationJob]): the jobs, usually for the same
+                                submission.
+        file_cacher (FileCacher): the file cacher to use.
+
+        """
+        for job in jobs:
+            self.evaluate(job, file_cacher)
+
     def execute_job(self, job, file_cacher):
         """Call compile() or execute() depending on the job passed
         when constructing the TaskType.
@@ -29,6 +29,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import io
+import itertools
 import json
 import logging
 import os
@@ -724,7 +725,117 @@ def white_diff_canonicalize(string):
     return string
 
 
-def white_diff(output, res):
+# Size of the blocks in which white_diff reads the files.
+WHITE_DIFF_CHUNK_SIZE = 1024 * 1024
+
+
+def _make_whites_table():
+    """Return a translation table mapping all the whitespaces but
+    newlines to spaces.
+
+    return (bytes): the table, for bytes.translate.
+
+    """
+    table = bytearray(xrange(256))
+    for char in bytearray(WHITES):
+        if char != ord(b"\n"):
+            table[char] = ord(b" ")
+    return bytes(table)
+
+
+_WHITES_TABLE = _make_whites_table()
+
+
+def _white_diff_collapse(data):
+    """Collapse the runs of whitespaces of a translated string.
+
+    data (bytes): a string with only spaces and newlines as
+        whitespaces, not ending in the middle of a run of them.
+
+    return (bytes): the string with each run of whitespaces replaced
+        by its newlines, or by one space if it has none.
+
+    """
+    while b"  " in data:
+        data = data.replace(b"  ", b" ")
+    return data.replace(b" \n", b"\n").replace(b"\n ", b"\n")
+
+
+def _white_diff_state(data, start, pending):
+    """Compute the state of the canonicalization after some data.
+
+    data (bytes): the data read from the file, not translated.
+    start (bool): whether no token was read before data.
+    pending (bytes): the final run of whitespaces before data, as
+        kept by _white_diff_canonical.
+
+    return ((bool, bytes)): the state after data.
+
+    """
+    cut = len(data.rstrip(WHITES))
+    if cut > 0:
+        start, pending = False, b""
+    pending = _white_diff_collapse(
+        pending + data[cut:].translate(_WHITES_TABLE))
+    return start, pending[-1:]
+
+
+def _white_diff_canonical(chunks, start=True, pending=b""):
+    """Convert a file in its canonical form for the white diff.
+
+    The canonical form keeps the tokens (the runs of
+    non-whitespaces), replacing each run of whitespaces between them
+    with its newlines, or with one space if it has none; the leading
+    whitespaces are replaced by their newlines and the trailing ones
+    by some newlines. Two files are equal for white_diff if and only
+    if their canonical forms are equal but for the trailing newlines.
+
+    chunks (iterable of bytes): the content of the file, in pieces.
+    start (bool): whether no token was read before chunks.
+    pending (bytes): the final run of whitespaces read before chunks,
+        collapsed (an empty string, a space or a newline).
+
+    yield (bytes): non-empty pieces of the canonical form (but for
+        what comes before chunks).
+
+    """
+    for data in chunks:
+        data = pending + data.translate(_WHITES_TABLE)
+        # The final run of whitespaces can continue in the next
+        # chunk, it is processed with it.
+        cut = len(data.rstrip(b" \n"))
+        if cut > 0:
+            piece = _white_diff_collapse(data[:cut])
+            if start:
+                piece = piece.lstrip(b" ")
+                start = False
+            yield piece
+        pending = _white_diff_collapse(data[cut:])
+        # Only the last newline of the final run is needed to tell it
+        # apart from a space; the others can be yielded already.
+        if len(pending) > 1:
+            yield pending[:-1]
+            pending = pending[-1:]
+
+
+def _read_chunks(fobj, chunk_size):
+    """Read a file in chunks.
+
+    fobj (file): the file, or anything with a read method (like an
+        mmap object).
+    chunk_size (int): the number of bytes to read at a time.
+
+    yield (bytes): the chunks, all of chunk_size bytes but the last.
+
+    """
+    while True:
+        data = fobj.read(chunk_size)
+        if len(data) == 0:
+            break
+        yield data
+
+
+def white_diff(output, res, chunk_size=WHITE_DIFF_CHUNK_SIZE):
     """Compare the two output files. Two files are equal if for every
     integer i, line i of first file is equal to line i of second
     file. Two lines are equal if they differ only by number or type of
@@ -735,12 +846,69 @@ def white_diff(output, res):
     'sequence of characters ending with \n or EOF and beginning right
     after BOF or \n'. In particular, every line has *at most* one \n.
 
-    output (file): the first file to compare.
-    res (file): the second file to compare.
+    The files are read in large chunks and compared as they are while
+    they are identical, then in their canonical form (see
+    _white_diff_canonical), stopping at the first difference.
+
+    output (file): the first file to compare (or an mmap object).
+    res (file): the second file to compare (or an mmap object).
+    chunk_size (int): the number of bytes to read at a time.
     return (bool): True if the two file are equal as explained above.
 
     """
+    out_chunks = _read_chunks(output, chunk_size)
+    res_chunks = _read_chunks(res, chunk_size)
+    start, pending = True, b""
+    while True:
+        out_data = next(out_chunks, b"")
+        res_data = next(res_chunks, b"")
+        if out_data != res_data:
+            break
+        if len(out_data) == 0:
+            return True
+        start, pending = _white_diff_state(out_data, start, pending)
+
+    out_chunks = _white_diff_canonical(
+        itertools.chain([out_data], out_chunks), start, pending)
+    res_chunks = _white_diff_canonical(
+        itertools.chain([res_data], res_chunks), start, pending)
+    out_data = res_data = b""
+    while True:
+        if len(out_data) == 0:
+            out_data = next(out_chunks, None)
+        if len(res_data) == 0:
+            res_data = next(res_chunks, None)
+        if out_data is None or res_data is None:
+            break
+        length = min(len(out_data), len(res_data))
+        if out_data[:length] != res_data[:length]:
+            return False
+        out_data, res_data = out_data[length:], res_data[length:]
+
+    # At least one file is finished: ok if the other has only trailing
+    # newlines left.
+    if out_data is None:
+        data, chunks = res_data, res_chunks
+    else:
+        data, chunks = out_data, out_chunks
+    while data is not None:
+        if len(data.strip(b"\n")) > 0:
+            return False
+        data = next(chunks, None)
+    return True
+
 
+def _white_diff_by_line(output, res):
+    """Compare the two output files as white_diff does, line by line.
+
+    This is the plain (and slow) implementation of the definition,
+    against which white_diff is tested and benchmarked.
+
+    output (file): the first file to compare.
+    res (file): the second file to compare.
+    return (bool): True if the two file are equal for white_diff.
+
+    """
     while True:
         lout = output.readline()
         lres = res.readline()
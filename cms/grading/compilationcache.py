@@ -0,0 +1,277 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of the results of the compilations.
+
+Compiling the same sources in the same way gives the same results, so
+when a submission is compiled again (because it was resubmitted, or
+its compilation invalidated) the Workers can reuse the executables
+and the messages of the first compilation, without running the
+compiler.
+
+The results are stored in the cache directory, one file for each, so
+that all the Workers of a machine share them. They are looked up by a
+key that is the digest of everything that determines the results: the
+names and digests of the files put into the sandbox, the language and
+the compilation commands (with their flags), and a fingerprint of the
+programs in the commands (their resolved path, size and modification
+time), so that changing the definition of a language or upgrading a
+compiler makes its old results unused. Compilations that timed out,
+or failed because of the sandbox, are not stored.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+
+from cms import config, mkdir
+from cms.db import Executable
+from cms.db.filecacher import TombstoneError
+from cms.grading.Sandbox import Sandbox
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompilationCache(object):
+    """The results of the compilations, stored in a directory.
+
+    """
+
+    # Version of the format of the keys and of the entries; changing
+    # it makes all the old entries unused.
+    VERSION = 1
+
+    # Number of entries stored between two checks of the size of the
+    # cache.
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path, max_entries):
+        """Initialize the cache.
+
+        path (string): the directory of the entries.
+        max_entries (int): the number of entries to keep; when there
+            are more, the least recently used are deleted.
+
+        raise (OSError): if the directory cannot be created.
+
+        """
+        self.path = path
+        self.max_entries = max_entries
+        if not mkdir(config.cache_dir) or not mkdir(self.path):
+            raise OSError("Cannot create directory %s." % self.path)
+        self._stores = 0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0}
+
+    @staticmethod
+    def _get_program_fingerprint(program):
+        """Return what identifies the version of a program.
+
+        program (string): the program, as in a command.
+
+        return ([object]): its resolved path, size and modification
+            time, if it is an existing absolute path.
+
+        """
+        if not os.path.isabs(program):
+            return [program]
+        path = os.path.realpath(program)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return [path]
+        return [path, stat.st_size, stat.st_mtime]
+
+    def get_key(self, language, commands, files, multithreaded):
+        """Return the key of a compilation.
+
+        language (Language): the language of the sources.
+        commands ([[string]]): the compilation commands.
+        files ({string: string}): the digests of the files put into
+            the sandbox, by their name.
+        multithreaded (bool): whether the sandbox allows many
+            processes.
+
+        return (string): the key.
+
+        """
+        key = {
+            "version": CompilationCache.VERSION,
+            "language": language.name,
+            "commands": commands,
+            "programs": [
+                CompilationCache._get_program_fingerprint(command[0])
+                for command in commands if len(command) > 0],
+            "files": sorted(files.iteritems()),
+            "multithreaded": multithreaded,
+        }
+        return hashlib.sha1(
+            json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, "%s.json" % key)
+
+    def load(self, key, job, file_cacher):
+        """Fill a compilation job with the results of the cache.
+
+        key (string): the key of the compilation.
+        job (CompilationJob): the job, whose results are set if the
+            compilation is in the cache.
+        file_cacher (FileCacher): the file cacher storing the
+            executables.
+
+        return (bool): whether the compilation was in the cache.
+
+        """
+        path = self._get_entry_path(key)
+        try:
+            with io.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+            # The executables could have been deleted from the
+            # storage since; touching them makes sure that they are
+            # kept until the results refer to them.
+            for digest in entry["executables"].itervalues():
+                if not file_cacher.touch(digest):
+                    raise KeyError("Executable %s not found." % digest)
+        except IOError:
+            self._stats["misses"] += 1
+            return False
+        except (ValueError, KeyError, TombstoneError):
+            logger.warning("Discarding invalid compilation cache entry "
+                           "%s.", key, exc_info=True)
+            self._delete(path)
+            self._stats["misses"] += 1
+            return False
+
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        job.success = True
+        job.compilation_success = entry["compilation_success"]
+        job.text = entry["text"]
+        job.plus = entry["plus"]
+        for filename, digest in entry["executables"].iteritems():
+            job.executables[filename] = Executable(filename, digest)
+        self._stats["hits"] += 1
+        return True
+
+    def store(self, key, job):
+        """Store the results of a compilation job, if reusable.
+
+        key (string): the key of the compilation.
+        job (CompilationJob): the job, after the compilation.
+
+        """
+        if not job.success or job.plus is None \
+                or job.plus.get("exit_status") in [
+                    Sandbox.EXIT_TIMEOUT, Sandbox.EXIT_TIMEOUT_WALL]:
+            return
+        entry = {
+            "compilation_success": job.compilation_success,
+            "text": job.text,
+            "plus": job.plus,
+            "executables": dict(
+                (filename, executable.digest)
+                for filename, executable in job.executables.iteritems()),
+        }
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with io.open(fd, "wb") as f:
+                f.write(json.dumps(entry).encode("utf-8"))
+            os.rename(temp_path, self._get_entry_path(key))
+        except (IOError, OSError):
+            logger.warning("Couldn't store compilation cache entry %s.",
+                           key, exc_info=True)
+            return
+        self._stats["stores"] += 1
+
+        self._stores += 1
+        if self._stores % CompilationCache.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    @staticmethod
+    def _delete(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Delete the least recently used entries beyond the maximum
+        number.
+
+        """
+        entries = []
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Deleted by someone else in the meantime.
+                pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            CompilationCache._delete(path)
+        logger.info("Deleted %d compilation cache entries.",
+                    len(entries) - self.max_entries)
+
+    def get_stats(self):
+        """Return the counters describing the use of the cache.
+
+        return ({string: int}): the number of hits, misses and stored
+            entries since the creation of this object.
+
+        """
+        return dict(self._stats)
+
+
+_compilation_cache = None
+
+
+def get_compilation_cache():
+    """Return the compilation cache of this process.
+
+    return (CompilationCache|None): the cache, or None if it is
+        disabled (or cannot be used).
+
+    """
+    global _compilation_cache
+    if config.compilation_cache_size <= 0:
+        return None
+    if _compilation_cache is None:
+        try:
+            _compilation_cache = CompilationCache(
+                os.path.join(config.cache_dir, "compilations"),
+                config.compilation_cache_size)
+        except OSError:
+            logger.warning("Compilation cache disabled.", exc_info=True)
+            config.compilation_cache_size = 0
+            return None
+    return _compilation_cache
@@ -0,0 +1,187 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Assignment of the CPUs of a machine to the execution slots of the
+Workers running on it.
+
+When the sandboxes of several slots run on the same cores they slow
+each other down, and the time measured for the contestants' programs
+varies. Pinning each slot to its own cores (see
+IsolateSandbox._popen) avoids that. The usable CPUs of the machine
+are split evenly among all the slots of the Workers with its address
+in the configuration; hardware threads of the same core are either
+kept together or, excluding the SMT siblings, left idle but one.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import logging
+import multiprocessing
+
+from cms import ServiceCoord, config
+
+
+logger = logging.getLogger(__name__)
+
+
+SYSFS_CPU_DIR = "/sys/devices/system/cpu"
+
+
+def parse_cpu_list(cpu_list):
+    """Parse a list of CPUs in the format used by Linux.
+
+    cpu_list (unicode): a list like "0-3,8,10-11".
+
+    return ([int]): the CPUs, sorted.
+
+    """
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(xrange(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    """Format a list of CPUs for taskset.
+
+    cpus ([int]): the CPUs.
+
+    return (unicode): the list, comma-separated.
+
+    """
+    return ",".join("%d" % cpu for cpu in cpus)
+
+
+def _read_cpu_list(path):
+    """Read a list of CPUs from sysfs.
+
+    path (unicode): the path of the file, relative to SYSFS_CPU_DIR.
+
+    return ([int]|None): the CPUs, or None if the file cannot be read.
+
+    """
+    try:
+        with io.open("%s/%s" % (SYSFS_CPU_DIR, path), "rt") as f:
+            return parse_cpu_list(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def get_cores():
+    """Return the online CPUs of the machine, grouped by core.
+
+    return ([[int]]): for each physical core, its hardware threads
+        (only one if there is no SMT, or it is unknown), in the order
+        of their first CPU.
+
+    """
+    online = _read_cpu_list("online")
+    if online is None:
+        online = range(multiprocessing.cpu_count())
+    cores = dict()
+    for cpu in online:
+        siblings = _read_cpu_list(
+            "cpu%d/topology/thread_siblings_list" % cpu)
+        if siblings is None or cpu not in siblings:
+            siblings = [cpu]
+        cores.setdefault(siblings[0], []).append(cpu)
+    return [cores[first] for first in sorted(cores)]
+
+
+def split_cores(cores, count, exclude_smt_siblings):
+    """Split the cores of a machine among some slots.
+
+    Each slot gets the same number of cores (the remainder is left
+    unused, to keep the slots alike); if there are fewer cores than
+    slots, slots share them.
+
+    cores ([[int]]): the hardware threads of each core.
+    count (int): the number of slots.
+    exclude_smt_siblings (bool): whether to use only the first
+        hardware thread of each core.
+
+    return ([[int]]): the CPUs of each slot.
+
+    """
+    if exclude_smt_siblings:
+        cores = [threads[:1] for threads in cores]
+    if len(cores) < count:
+        logger.warning("Only %d cores for %d execution slots, some of "
+                       "them will share the cores.", len(cores), count)
+        return [cores[index % len(cores)] for index in xrange(count)]
+    per_slot = len(cores) // count
+    return [sum(cores[index * per_slot:(index + 1) * per_slot], [])
+            for index in xrange(count)]
+
+
+def get_slot_index(shard, slot, slots):
+    """Return the position of a slot among those of its machine.
+
+    The machine of a Worker is identified by its address in the
+    configuration; all the Workers are assumed to have the same
+    number of slots.
+
+    shard (int): the shard of the Worker.
+    slot (int): the index of the slot in the Worker.
+    slots (int): the number of slots of each Worker.
+
+    return ((int, int)): the position of the slot, and how many slots
+        there are on the machine.
+
+    """
+    services = config.async.core_services
+    address = services.get(ServiceCoord("Worker", shard))
+    if address is None:
+        return slot, slots
+    shards = sorted(coord.shard for coord in services
+                    if coord.name == "Worker"
+                    and services[coord].ip == address.ip)
+    return shards.index(shard) * slots + slot, len(shards) * slots
+
+
+_slot_cpus = dict()
+
+
+def get_slot_cpus(shard, slot, slots):
+    """Return the CPUs to pin an execution slot to.
+
+    shard (int): the shard of the Worker.
+    slot (int): the index of the slot in the Worker.
+    slots (int): the number of slots of each Worker.
+
+    return ([int]|None): the CPUs, or None if pinning is disabled.
+
+    """
+    if not config.sandbox_cpu_pinning:
+        return None
+    key = (shard, slot, slots)
+    if key not in _slot_cpus:
+        index, count = get_slot_index(shard, slot, slots)
+        _slot_cpus[key] = split_cores(
+            get_cores(), count, config.sandbox_exclude_smt_siblings)[index]
+    return _slot_cpus[key]
@@ -27,9 +27,11 @@ from __future__ import unicode_literals
 
 import logging
 
+from cms import config
 from cms.grading import compilation_step, evaluation_step, \
     human_evaluation_message, is_evaluation_passed, extract_outcome_and_text, \
     white_diff_step
+from cms.grading.compilationcache import get_compilation_cache
 from cms.grading.languagemanager import \
     LANGUAGES, HEADER_EXTS, SOURCE_EXTS, OBJECT_EXTS, get_language
 from cms.grading.ParameterTypes import ParameterTypeCollection, \
@@ -100,12 +102,24 @@ class Batch(TaskType):
 
     ACCEPTED_PARAMETERS = [_COMPILATION, _USE_FILE, _EVALUATION]
 
+    def __init__(self, parameters):
+        """See TaskType.__init__."""
+        TaskType.__init__(self, parameters)
+        # The sandbox with the checker of the last job, and the digest
+        # of the checker (see _get_checker_sandbox).
+        self._checker_sandbox = None
+
     @property
     def name(self):
         """See TaskType.name."""
         # TODO add some details if a grader/comparator is used, etc...
         return "Batch"
 
+    def get_max_sandboxes(self):
+        """See TaskType.get_max_sandboxes."""
+        # The checker runs in a sandbox of its own.
+        return 2
+
     def get_compilation_commands(self, submission_format):
         """See TaskType.get_compilation_commands."""
         source_filenames = []
@@ -154,11 +168,7 @@ class Batch(TaskType):
                          len(job.files), extra={"operation": job.info})
             return True
 
-        # Create the sandbox
-        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
-        job.sandboxes.append(sandbox.path)
-
-        # Prepare the source files in the sandbox
+        # Prepare the source files for the sandbox
         files_to_get = {}
         format_filename = job.files.keys()[0]
         source_filenames = []
@@ -185,14 +195,28 @@ class Batch(TaskType):
                 files_to_get[filename] = \
                     job.managers[filename].digest
 
-        for filename, digest in files_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest)
-
         # Prepare the compilation command
         executable_filename = format_filename.replace(".%l", "")
         commands = language.get_compilation_commands(
             source_filenames, executable_filename)
 
+        # Reuse the results of an identical compilation, if any
+        cache = get_compilation_cache()
+        if cache is not None:
+            key = cache.get_key(language, commands, files_to_get,
+                                job.multithreaded_sandbox)
+            if cache.load(key, job, file_cacher):
+                logger.info("Compilation results found in the cache.",
+                            extra={"operation": job.info})
+                return
+
+        # Create the sandbox
+        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        job.sandboxes.append(sandbox.path)
+
+        for filename, digest in files_to_get.iteritems():
+            sandbox.create_file_from_storage(filename, digest)
+
         # Run the compilation
         operation_success, compilation_success, text, plus = \
             compilation_step(sandbox, commands)
@@ -209,6 +233,8 @@ class Batch(TaskType):
                 (executable_filename, job.info))
             job.executables[executable_filename] = \
                 Executable(executable_filename, digest)
+        if cache is not None:
+            cache.store(key, job)
 
         # Cleanup
         delete_sandbox(sandbox, job.success)
@@ -218,16 +244,125 @@ class Batch(TaskType):
         # Create the sandbox
         sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
 
+        # Put the executable into the sandbox
+        executable_filename = job.executables.keys()[0]
+        sandbox.create_file_from_storage(
+            executable_filename, job.executables[executable_filename].digest,
+            executable=True)
+
+        self._evaluate_in_sandbox(job, sandbox, file_cacher)
+
+        delete_sandbox(sandbox, job.success)
+        self._release_checker_sandbox()
+
+    def evaluate_testcases(self, jobs, file_cacher):
+        """See TaskType.evaluate_testcases.
+
+        Consecutive jobs with the same executable run in the same
+        sandbox, which is emptied (but for the executable) between
+        them, instead of each in a new one; the same holds for the
+        sandbox of the checker. When sandboxes are kept for
+        inspection, each job still gets its own.
+
+        """
+        if config.keep_sandbox:
+            TaskType.evaluate_testcases(self, jobs, file_cacher)
+            return
+
+        sandbox = None
+        prepared = None
+        for job in jobs:
+            executable_filename = job.executables.keys()[0]
+            executable = (executable_filename,
+                          job.executables[executable_filename].digest,
+                          job.multithreaded_sandbox)
+            if sandbox is not None and executable == prepared:
+                try:
+                    sandbox.reset(keep=[executable_filename])
+                except (IOError, OSError):
+                    logger.warning("Couldn't reset sandbox, using a new one.",
+                                   exc_info=True)
+                    delete_sandbox(sandbox)
+                    sandbox = None
+            elif sandbox is not None:
+                delete_sandbox(sandbox)
+                sandbox = None
+
+            if sandbox is None:
+                sandbox = create_sandbox(file_cacher,
+                                         job.multithreaded_sandbox)
+                sandbox.create_file_from_storage(
+                    executable_filename, executable[1], executable=True)
+                prepared = executable
+
+            self._evaluate_in_sandbox(job, sandbox, file_cacher)
+
+            # A sandbox in which something went wrong is kept around
+            # as it is.
+            if not job.success:
+                delete_sandbox(sandbox, False)
+                sandbox = None
+
+        if sandbox is not None:
+            delete_sandbox(sandbox)
+        self._release_checker_sandbox()
+
+    def _get_checker_sandbox(self, job, file_cacher):
+        """Return a sandbox containing only the checker of a job.
+
+        The sandbox of the checker of the previous job is reused, if
+        the checker is the same, until _release_checker_sandbox is
+        called.
+
+        job (EvaluationJob): the job.
+        file_cacher (FileCacher): the file cacher to use.
+
+        return (Sandbox): the sandbox.
+
+        """
+        digest = job.managers["checker"].digest
+        if self._checker_sandbox is not None:
+            sandbox, prepared_digest = self._checker_sandbox
+            if prepared_digest == digest:
+                try:
+                    sandbox.reset(keep=["checker"])
+                    return sandbox
+                except (IOError, OSError):
+                    logger.warning("Couldn't reset checker sandbox, using "
+                                   "a new one.", exc_info=True)
+            self._release_checker_sandbox()
+
+        sandbox = create_sandbox(file_cacher)
+        self._checker_sandbox = (sandbox, digest)
+        sandbox.create_file_from_storage("checker", digest, executable=True)
+        return sandbox
+
+    def _release_checker_sandbox(self, success=True):
+        """Delete the sandbox of the checker, if any.
+
+        success (bool): whether the last checker run succeeded (if
+            not, the sandbox is kept around).
+
+        """
+        if self._checker_sandbox is not None:
+            sandbox, _ = self._checker_sandbox
+            self._checker_sandbox = None
+            delete_sandbox(sandbox, success)
+
+    def _evaluate_in_sandbox(self, job, sandbox, file_cacher):
+        """Evaluate a job in a sandbox containing only the executable.
+
+        job (EvaluationJob): the job.
+        sandbox (Sandbox): the sandbox.
+        file_cacher (FileCacher): the file cacher to use.
+
+        """
         # Prepare the execution
         executable_filename = job.executables.keys()[0]
         language = get_language(job.language)
         commands = language.get_evaluation_commands(
             executable_filename,
             main="grader" if self._uses_grader() else executable_filename)
-        executables_to_get = {
-            executable_filename:
-            job.executables[executable_filename].digest
-            }
         input_filename, output_filename = self.parameters[1]
         stdin_redirect = None
         stdout_redirect = None
@@ -245,8 +380,6 @@ class Batch(TaskType):
             }
 
         # Put the required files into the sandbox
-        for filename, digest in executables_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest, executable=True)
         for filename, digest in files_to_get.iteritems():
             sandbox.create_file_from_storage(filename, digest)
 
@@ -305,13 +438,13 @@ class Batch(TaskType):
                 # Otherwise evaluate the output file.
                 else:
 
-                    # Put the reference solution into the sandbox
-                    sandbox.create_file_from_storage(
-                        "res.txt",
-                        job.output)
-
                     # Check the solution with white_diff
                     if self.parameters[2] == "diff":
+                        # Put the reference solution into the sandbox
+                        sandbox.create_file_from_storage(
+                            "res.txt",
+                            job.output)
+
                         outcome, text = white_diff_step(
                             sandbox, output_filename, "res.txt")
 
@@ -327,48 +460,9 @@ class Batch(TaskType):
                             success = False
 
                         else:
-                            sandbox.create_file_from_storage(
-                                manager_filename,
-                                job.managers[manager_filename].digest,
-                                executable=True)
-                            # Rewrite input file. The untrusted
-                            # contestant program should not be able to
-                            # modify it; however, the grader may
-                            # destroy the input file to prevent the
-                            # contestant's program from directly
-                            # accessing it. Since we cannot create
-                            # files already existing in the sandbox,
-                            # we try removing the file first.
-                            try:
-                                sandbox.remove_file(input_filename)
-                            except OSError as e:
-                                # Let us be extra sure that the file
-                                # was actually removed and we did not
-                                # mess up with permissions.
-                                assert not sandbox.file_exists(input_filename)
-                            sandbox.create_file_from_storage(
-                                input_filename,
-                                job.input)
-
-                            # Allow using any number of processes (because e.g.
-                            # one may want to write a bash checker who calls
-                            # other processes). Set to a high number because
-                            # to avoid fork-bombing the worker.
-                            sandbox.max_processes = 1000
-
-                            success, _ = evaluation_step(
-                                sandbox,
-                                [["./%s" % manager_filename,
-                                  input_filename, "res.txt", output_filename]])
-                        if success:
-                            try:
-                                outcome, text = \
-                                    extract_outcome_and_text(sandbox)
-                            except ValueError, e:
-                                logger.error("Invalid output from "
-                                             "comparator: %s", e.message,
-                                             extra={"operation": job.info})
-                                success = False
+                            success, outcome, text = self._run_checker(
+                                job, sandbox, file_cacher,
+                                input_filename, output_filename)
 
                     else:
                         raise ValueError("Unrecognized third parameter"
@@ -380,4 +474,53 @@ class Batch(TaskType):
         job.outcome = "%s" % outcome if outcome is not None else None
         job.text = text
 
-        delete_sandbox(sandbox, job.success)
+    def _run_checker(self, job, sandbox, file_cacher,
+                     input_filename, output_filename):
+        """Check the output of a job with the checker.
+
+        The checker runs in its own sandbox (see
+        _get_checker_sandbox), where the input and the reference
+        solution are put from the storage, and the output is copied
+        from the sandbox of the job. In this way the untrusted
+        contestant program cannot have modified the input, nor can it
+        access the checker.
+
+        job (EvaluationJob): the job.
+        sandbox (Sandbox): the sandbox where the job ran.
+        file_cacher (FileCacher): the file cacher to use.
+        input_filename (string): the name of the input file.
+        output_filename (string): the name of the output file.
+
+        return ((bool, float|None, [unicode]|None)): whether the
+            checker ran successfully, and the outcome and text it
+            gave.
+
+        """
+        checker_sandbox = self._get_checker_sandbox(job, file_cacher)
+        job.sandboxes.append(checker_sandbox.path)
+        checker_sandbox.create_file_from_storage(input_filename, job.input)
+        checker_sandbox.create_file_from_storage("res.txt", job.output)
+        with sandbox.get_file(output_filename) as output_file:
+            checker_sandbox.create_file_from_fileobj(output_filename,
+                                                     output_file)
+
+        # Allow using any number of processes (because e.g. one may
+        # want to write a bash checker who calls other processes). Set
+        # to a high number because to avoid fork-bombing the worker.
+        checker_sandbox.max_processes = 1000
+
+        success, _ = evaluation_step(
+            checker_sandbox,
+            [["./checker", input_filename, "res.txt", output_filename]])
+        outcome = None
+        text = None
+        if success:
+            try:
+                outcome, text = extract_outcome_and_text(checker_sandbox)
+            except ValueError, e:
+                logger.error("Invalid output from comparator: %s",
+                             e.message, extra={"operation": job.info})
+                success = False
+        if not success:
+            self._release_checker_sandbox(False)
+        return success, outcome, text
@@ -77,6 +77,21 @@ class Communication(TaskType):
 
     ACCEPTED_PARAMETERS = [_NUM_PROCESSES]
 
+    def _get_num_processes(self):
+        """Return the number of processes of the contestant's
+        solution.
+
+        """
+        if len(self.parameters) <= 0:
+            return 1
+        else:
+            return self.parameters[0]
+
+    def get_max_sandboxes(self):
+        """See TaskType.get_max_sandboxes."""
+        # One for the manager, and one for each process.
+        return self._get_num_processes() + 1
+
     def get_compilation_commands(self, submission_format):
         """See TaskType.get_compilation_commands."""
         res = dict()
@@ -172,10 +187,7 @@ class Communication(TaskType):
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
-        if len(self.parameters) <= 0:
-            num_processes = 1
-        else:
-            num_processes = self.parameters[0]
+        num_processes = self._get_num_processes()
         indices = range(num_processes)
         # Create sandboxes and FIFOs
         sandbox_mgr = create_sandbox(file_cacher, job.multithreaded_sandbox)
@@ -89,6 +89,10 @@ class TwoSteps(TaskType):
         # TODO add some details if a comparator is used, etc...
         return "Two steps"
 
+    def get_max_sandboxes(self):
+        """See TaskType.get_max_sandboxes."""
+        return 2
+
     def get_compilation_commands(self, submission_format):
         """See TaskType.get_compilation_commands."""
         res = dict()
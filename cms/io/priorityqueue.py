@@ -43,6 +43,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import heapq
+
+from bisect import insort
+
 from gevent.event import Event
 
 from cmscommon.datetime import make_datetime, make_timestamp
@@ -67,6 +71,8 @@ class QueueEntry(object):
 
     """
 
+    __slots__ = ("item", "priority", "timestamp", "index")
+
     def __init__(self, item, priority, timestamp, index):
         """Create a QueueEntry object.
 
@@ -76,8 +82,6 @@ class QueueEntry(object):
         index (int): used to enforce strict ordering.
 
         """
-        # TODO: item is not actually necessary, as we store the whole
-        # item in the reverse lookup array.
         self.item = item
         self.priority = priority
         self.timestamp = timestamp
@@ -92,17 +96,28 @@ class QueueEntry(object):
         else:
             return cmp(self.index, other.index)
 
+    def to_dict(self):
+        """Return a dict() representation of the entry."""
+        return {'item': self.item.to_dict(),
+                'priority': self.priority,
+                'timestamp': make_timestamp(self.timestamp)}
+
 
 class PriorityQueue(object):
 
     """A priority queue.
 
     It is greenlet-safe, and offers the ability of changing priorities
-    and removing arbitrary items.
+    and removing arbitrary items, also in bulk.
 
-    The queue is implemented as a custom min-heap. The priority is a
-    mix of a discrete priority level and of the timestamp. The
-    elements of the queue are QueueItems.
+    The entries with the same priority level are kept in a bucket, a
+    min-heap of (timestamp, index, entry) tuples, so that they are
+    compared by the interpreter without calling Python code. The
+    buckets of the levels with entries are visited in order of
+    priority. Removing an entry only drops it from the reverse lookup
+    dictionary: the tuples of removed entries are discarded when they
+    reach the top of their bucket, or all together when they take
+    more than half of it.
 
     """
 
@@ -112,14 +127,30 @@ class PriorityQueue(object):
     PRIORITY_LOW = 3
     PRIORITY_EXTRA_LOW = 4
 
+    # A bucket is compacted when it holds more than this many tuples
+    # of removed entries, and more than those of the entries still in
+    # the queue.
+    MIN_COMPACTION = 64
+
     def __init__(self):
         """Create a priority queue."""
-        # The queue: a min-heap whose elements are of the form
-        # (priority, timestamp, item), where item is the actual data.
-        self._queue = []
+        # The buckets, one for each priority level with entries.
+        # Type: {int: [(datetime, int, QueueEntry)]}
+        self._buckets = {}
+
+        # The number of entries in each bucket (not counting those
+        # removed).
+        # Type: {int: int}
+        self._sizes = {}
+
+        # The priority levels with entries, sorted.
+        # Type: [int]
+        self._priorities = []
 
         # Reverse lookup for the items in the queue: a dictionary
-        # associating the index in the queue to each item.
+        # associating its entry to each item. An entry in a bucket is
+        # in the queue only if it is the one associated to its item.
+        # Type: {QueueItem: QueueEntry}
         self._reverse = {}
 
         # Event to signal that there are items in the queue.
@@ -129,7 +160,7 @@ class PriorityQueue(object):
         self._next_index = 0
 
     def __len__(self):
-        return len(self._queue)
+        return len(self._reverse)
 
     def _verify(self):
         """Make sure that the internal state of the queue is consistent.
@@ -137,17 +168,26 @@ class PriorityQueue(object):
         This is used only for testing.
 
         """
-        if len(self._queue) != len(self._reverse):
+        if sorted(self._buckets) != self._priorities:
+            return False
+        if sorted(self._sizes) != self._priorities:
             return False
-        if len(self._queue) != self.length():
+        if sum(self._sizes.itervalues()) != len(self._reverse):
             return False
         if self.empty() != (self.length() == 0):
             return False
         if self._event.isSet() == self.empty():
             return False
-        for item, idx in self._reverse.iteritems():
-            if self._queue[idx].item != item:
+        for priority, bucket in self._buckets.iteritems():
+            live = [entry for _, _, entry in bucket
+                    if self._reverse.get(entry.item) is entry]
+            if len(live) != self._sizes[priority]:
                 return False
+            if any(entry.priority != priority for entry in live):
+                return False
+            for idx in xrange(1, len(bucket)):
+                if bucket[idx] < bucket[(idx - 1) // 2]:
+                    return False
         return True
 
     def __contains__(self, item):
@@ -160,70 +200,76 @@ class PriorityQueue(object):
         """
         return item in self._reverse
 
-    def _swap(self, idx1, idx2):
-        """Swap two elements in the queue, keeping their reverse
-        indices up to date.
-
-        idx1 (int): the index of the first element.
-        idx2 (int): the index of the second element.
+    def _is_live(self, entry):
+        """Return whether an entry in a bucket is still in the queue.
 
-        """
-        self._queue[idx1], self._queue[idx2] = \
-            self._queue[idx2], self._queue[idx1]
-        self._reverse[self._queue[idx1].item] = idx1
-        self._reverse[self._queue[idx2].item] = idx2
+        entry (QueueEntry): the entry.
 
-    def _up_heap(self, idx):
-        """Take the element in position idx up in the heap until its
-        position is the right one.
-
-        idx (int): the index of the element to lift.
-
-        return (int): the new index of the element.
+        return (bool): whether the entry was neither removed nor
+            moved to another bucket.
 
         """
-        while idx > 0:
-            parent = (idx - 1) // 2
-            if self._queue[idx] < self._queue[parent]:
-                self._swap(parent, idx)
-                idx = parent
-            else:
-                break
-        return idx
-
-    def _down_heap(self, idx):
-        """Take the element in position idx down in the heap until its
-        position is the right one.
+        return self._reverse.get(entry.item) is entry
 
-        idx (int): the index of the element to lower.
+    def _add(self, entries):
+        """Add new entries to their buckets.
 
-        return (int): the new index of the element.
+        entries ([QueueEntry]): the entries, whose items must already
+            be associated to them in the reverse lookup dictionary.
 
         """
-        last = len(self._queue) - 1
-        while 2 * idx + 1 <= last:
-            child = 2 * idx + 1
-            if 2 * idx + 2 <= last and \
-                    self._queue[2 * idx + 2] < self._queue[child]:
-                child = 2 * idx + 2
-            if self._queue[child] < self._queue[idx]:
-                self._swap(child, idx)
-                idx = child
+        by_priority = {}
+        for entry in entries:
+            by_priority.setdefault(entry.priority, []).append(
+                (entry.timestamp, entry.index, entry))
+        for priority, tuples in by_priority.iteritems():
+            bucket = self._buckets.get(priority)
+            if bucket is None:
+                bucket = self._buckets[priority] = []
+                self._sizes[priority] = 0
+                insort(self._priorities, priority)
+            self._sizes[priority] += len(tuples)
+            if len(tuples) == 1:
+                heapq.heappush(bucket, tuples[0])
+            elif 4 * len(tuples) < len(bucket):
+                for tuple_ in tuples:
+                    heapq.heappush(bucket, tuple_)
             else:
-                break
-        return idx
+                bucket.extend(tuples)
+                heapq.heapify(bucket)
 
-    def _updown_heap(self, idx):
-        """Perform both operations of up_heap and down_heap on an
-        element.
+        if len(self._reverse) > 0:
+            # Signal to listener greenlets that there might be
+            # something.
+            self._event.set()
 
-        idx (int): the index of the element to lift.
+    def _discard(self, entries):
+        """Account for entries dropped from the reverse lookup.
 
-        return (int): the new index of the element.
+        entries ([QueueEntry]): the entries, that are in their buckets
+            but not in the reverse lookup dictionary anymore.
 
         """
-        idx = self._up_heap(idx)
-        return self._down_heap(idx)
+        touched = set()
+        for entry in entries:
+            self._sizes[entry.priority] -= 1
+            touched.add(entry.priority)
+        for priority in touched:
+            size = self._sizes[priority]
+            bucket = self._buckets[priority]
+            if size == 0:
+                del self._buckets[priority]
+                del self._sizes[priority]
+                self._priorities.remove(priority)
+            elif len(bucket) - size > \
+                    max(size, PriorityQueue.MIN_COMPACTION):
+                bucket[:] = [tuple_ for tuple_ in bucket
+                             if self._is_live(tuple_[2])]
+                heapq.heapify(bucket)
+
+        if len(self._reverse) == 0:
+            # Signal that there is nothing left for listeners.
+            self._event.clear()
 
     def push(self, item, priority=None, timestamp=None):
         """Push an item in the queue. If timestamp is not specified,
@@ -239,26 +285,37 @@ class PriorityQueue(object):
             and was not pushed again, true otherwise..
 
         """
-        if item in self._reverse:
-            return False
+        return self.push_many([(item, priority, timestamp)]) == 1
 
-        if priority is None:
-            priority = PriorityQueue.PRIORITY_MEDIUM
-        if timestamp is None:
-            timestamp = make_datetime()
+    def push_many(self, items):
+        """Push several items in the queue.
 
-        index = self._next_index
-        self._next_index += 1
+        items ([(QueueItem, int|None, datetime|None)]): the items,
+            each with its priority and timestamp (see push).
 
-        self._queue.append(QueueEntry(item, priority, timestamp, index))
-        last = len(self._queue) - 1
-        self._reverse[item] = last
-        self._up_heap(last)
+        return (int): the number of items pushed, that is, of those
+            that were not already in the queue.
 
-        # Signal to listener greenlets that there might be something.
-        self._event.set()
-
-        return True
+        """
+        now = None
+        entries = []
+        for item, priority, timestamp in items:
+            if item in self._reverse:
+                continue
+            if priority is None:
+                priority = PriorityQueue.PRIORITY_MEDIUM
+            if timestamp is None:
+                if now is None:
+                    now = make_datetime()
+                timestamp = now
+
+            entry = QueueEntry(item, priority, timestamp, self._next_index)
+            self._next_index += 1
+            self._reverse[item] = entry
+            entries.append(entry)
+
+        self._add(entries)
+        return len(entries)
 
     def top(self, wait=False):
         """Return the first element in the queue without extracting it.
@@ -270,17 +327,16 @@ class PriorityQueue(object):
         raise (LookupError): on empty queue if wait was false.
 
         """
-        if not self.empty():
-            return self._queue[0]
-        else:
+        while self.empty():
             if not wait:
                 raise LookupError("Empty queue.")
-            else:
-                while True:
-                    if self.empty():
-                        self._event.wait()
-                        continue
-                    return self._queue[0]
+            self._event.wait()
+
+        # The first bucket has at least one entry still in the queue.
+        bucket = self._buckets[self._priorities[0]]
+        while not self._is_live(bucket[0][2]):
+            heapq.heappop(bucket)
+        return bucket[0][2]
 
     def pop(self, wait=False):
         """Extract (and return) the first element in the queue.
@@ -293,18 +349,9 @@ class PriorityQueue(object):
 
         """
         top = self.top(wait)
-        last = len(self._queue) - 1
-        self._swap(0, last)
-
+        heapq.heappop(self._buckets[top.priority])
         del self._reverse[top.item]
-        del self._queue[last]
-
-        # last is 0 when the queue becomes empty.
-        if last > 0:
-            self._down_heap(0)
-        else:
-            # Signal that there is nothing left for listeners.
-            self._event.clear()
+        self._discard([top])
         return top
 
     def remove(self, item):
@@ -317,21 +364,27 @@ class PriorityQueue(object):
         raise (KeyError): if item not present.
 
         """
-        pos = self._reverse[item]
-        entry = self._queue[pos]
+        entry = self._reverse.pop(item)
+        self._discard([entry])
+        return entry
 
-        last = len(self._queue) - 1
-        self._swap(pos, last)
+    def remove_many(self, predicate):
+        """Remove all the items satisfying a condition.
 
-        del self._reverse[item]
-        del self._queue[last]
-        if pos != last:
-            self._updown_heap(pos)
+        predicate (function): a function taking an item and returning
+            whether to remove it.
 
-        if self.empty():
-            self._event.clear()
+        return ([QueueEntry]): the entries removed, in no particular
+            order.
 
-        return entry
+        """
+        entries = [entry for item, entry in self._reverse.iteritems()
+                   if predicate(item)]
+        for entry in entries:
+            del self._reverse[entry.item]
+        if len(entries) > 0:
+            self._discard(entries)
+        return entries
 
     def set_priority(self, item, priority):
         """Change the priority of an item inside the queue. Raises an
@@ -343,9 +396,15 @@ class PriorityQueue(object):
         raise (LookupError): if item not present.
 
         """
-        pos = self._reverse[item]
-        self._queue[pos].priority = priority
-        self._updown_heap(pos)
+        old = self._reverse[item]
+        if old.priority == priority:
+            return
+        # A new entry, keeping the position among the entries with the
+        # same priority, so that the old one is left in its bucket.
+        entry = QueueEntry(item, priority, old.timestamp, old.index)
+        self._reverse[item] = entry
+        self._discard([old])
+        self._add([entry])
 
     def length(self):
         """Return the number of elements in the queue.
@@ -353,7 +412,7 @@ class PriorityQueue(object):
         return (int): length of the queue
 
         """
-        return len(self._queue)
+        return len(self._reverse)
 
     def empty(self):
         """Return if the queue is empty.
@@ -363,19 +422,80 @@ class PriorityQueue(object):
         """
         return self.length() == 0
 
-    def get_status(self):
-        """Return the content of the queue. Note that the order may be not
-        correct, but the first element is the one at the top.
+    def get_status(self, offset=0, limit=None, group_by=None):
+        """Return (part of) the content of the queue, in order.
+
+        offset (int): the number of entries to skip.
+        limit (int|None): the maximum number of entries to return, or
+            None for all of them.
+        group_by (function|None): if given, a function returning a key
+            for each item; only the first entry of the items with the
+            same key is considered, with the number of those items as
+            multiplicity of its item.
 
-        return ([QueueEntry]): a list of entries containing the
+        return ([dict]): a list of entries containing the
             representation of the item, the priority and the
             timestamp.
 
         """
-        return [{'item': entry.item.to_dict(),
-                 'priority': entry.priority,
-                 'timestamp': make_timestamp(entry.timestamp)}
-                for entry in self._queue]
+        if group_by is not None:
+            return self._get_grouped_status(offset, limit, group_by)
+
+        entries = []
+        for priority in self._priorities:
+            if limit is not None and len(entries) >= offset + limit:
+                break
+            size = self._sizes[priority]
+            if len(entries) + size <= offset:
+                # We can skip the whole bucket, keeping its place.
+                entries.extend([None] * size)
+                continue
+            bucket = self._buckets[priority]
+            if limit is None:
+                live = sorted(tuple_ for tuple_ in bucket
+                              if self._is_live(tuple_[2]))
+            else:
+                # Among the first ones there are at most as many
+                # removed entries as in the whole bucket.
+                needed = offset + limit - len(entries)
+                live = [tuple_ for tuple_ in heapq.nsmallest(
+                    needed + len(bucket) - size, bucket)
+                    if self._is_live(tuple_[2])][:needed]
+            entries.extend(entry for _, _, entry in live)
+
+        end = None if limit is None else offset + limit
+        return [entry.to_dict() for entry in entries[offset:end]]
+
+    def _get_grouped_status(self, offset, limit, group_by):
+        """Return (part of) the content of the queue, grouped.
+
+        See get_status.
+
+        """
+        groups = {}
+        for entry in self._reverse.itervalues():
+            key = group_by(entry.item)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [entry, 1]
+            else:
+                if (entry.priority, entry.timestamp, entry.index) < \
+                        (group[0].priority, group[0].timestamp,
+                         group[0].index):
+                    group[0] = entry
+                group[1] += 1
+
+        groups = sorted(
+            groups.itervalues(),
+            key=lambda group: (group[0].priority, group[0].timestamp,
+                               group[0].index))
+        end = None if limit is None else offset + limit
+        result = []
+        for entry, multiplicity in groups[offset:end]:
+            data = entry.to_dict()
+            data['item'] = dict(data['item'], multiplicity=multiplicity)
+            result.append(data)
+        return result
 
 
 # Fake objects for testing follow.
@@ -75,16 +75,22 @@ class Executor(object):  # pylint: disable=R0921
         """
         return item in self._operation_queue
 
-    def get_status(self):
+    def get_status(self, offset=0, limit=None, group_by=None):
         """Return a the status of the queues.
 
-        More precisely, a list of entries in the executor's queue. The
-        first item is the top item, the others are not in order.
+        More precisely, a list of entries in the executor's queue, in
+        order (see PriorityQueue.get_status).
+
+        offset (int): the number of entries to skip.
+        limit (int|None): the maximum number of entries to return, or
+            None for all of them.
+        group_by (function|None): if given, a function returning a key
+            for each item, to return only the first entry for each key.
 
         return ([QueueEntry]): the list with the queued elements.
 
         """
-        return self._operation_queue.get_status()
+        return self._operation_queue.get_status(offset, limit, group_by)
 
     def enqueue(self, item, priority=None, timestamp=None):
         """Add an item to the queue.
@@ -107,6 +113,17 @@ class Executor(object):  # pylint: disable=R0921
         """
         self._operation_queue.remove(item)
 
+    def dequeue_many(self, predicate):
+        """Remove from the queue all the items satisfying a condition.
+
+        predicate (function): a function taking an item and returning
+            whether to remove it.
+
+        return (int): the number of items removed.
+
+        """
+        return len(self._operation_queue.remove_many(predicate))
+
     def run(self):
         """Monitor the queue, and dispatch operations when available.
 
@@ -119,13 +136,19 @@ class Executor(object):  # pylint: disable=R0921
         """
         while True:
             # Wait for the queue to be non-empty.
-            to_execute = [self._operation_queue.pop(wait=True)]
+            self._operation_queue.top(wait=True)
             if self._batch_executions:
                 max_operations = self.max_operations_per_batch()
+                to_execute = [self._operation_queue.pop()]
                 while not self._operation_queue.empty() and (
                         max_operations == 0 or
-                        len(to_execute) < max_operations):
+                        len(to_execute) < max_operations) and \
+                        self.should_extend_batch(
+                            to_execute, self._operation_queue.top(),
+                            max_operations):
                     to_execute.append(self._operation_queue.pop())
+            else:
+                to_execute = [self._operation_queue.pop()]
 
             assert len(to_execute) > 0, "Expected at least one element."
             if self._batch_executions:
@@ -161,12 +184,30 @@ class Executor(object):  # pylint: disable=R0921
         maximum size of a batch (the batch might be smaller if not
         enough operations are present in the queue).
 
+        It is called when the queue is not empty, before extracting
+        the first operation of the batch.
+
         return (int): the maximum number of operations, or 0 to
             indicate no limits.
 
         """
         return 0
 
+    def should_extend_batch(self, batch, entry, max_operations):
+        """Return whether to add an entry to a batch being formed.
+
+        batch ([QueueEntry]): the entries already in the batch.
+        entry (QueueEntry): the top entry of the queue, which would be
+            the next one in the batch.
+        max_operations (int): the maximum number of operations in the
+            batch, as returned by max_operations_per_batch.
+
+        return (bool): False to stop the batch before entry, even if
+            it is not full.
+
+        """
+        return True
+
     def execute(self, entry):
         """Perform a single operation.
 
@@ -200,7 +241,9 @@ class TriggeredService(Service):
       used by subclasses when they receive a notification that an
       operations is needed, or in any other contexts.
     - A sweeper greenlet that asks subclasses to search and enqueue
-      operations that were missed by the previous step.
+      operations that were missed by the previous step; if searching
+      all of them is expensive, most sweeps can be limited to the
+      recent ones.
     - A list of executors (each running in its own greenlet), each of
       which takes care of performing all operations.
 
@@ -230,6 +273,9 @@ class TriggeredService(Service):
         self._sweeper_event = Event()
         self._sweeper_started = False
         self._sweeper_timeout = None
+        self._sweeper_full_timeout = None
+        self._sweeper_last_full = None
+        self._sweeper_full_requested = False
 
     def add_executor(self, executor):
         """Add an executor for the service.
@@ -276,15 +322,31 @@ class TriggeredService(Service):
         for executor in self._executors:
             executor.dequeue(operation)
 
-    def start_sweeper(self, timeout):
+    def dequeue_many(self, predicate):
+        """Remove from the queue of each executor the operations
+        satisfying a condition.
+
+        predicate (function): a function taking an operation and
+            returning whether to remove it.
+
+        """
+        for executor in self._executors:
+            executor.dequeue_many(predicate)
+
+    def start_sweeper(self, timeout, full_timeout=None):
         """Start sweeper loop with given timeout.
 
         timeout (float): timeout in seconds.
+        full_timeout (float|None): if given, a sweep looks for all the
+            missed operations only if this many seconds passed since
+            the last time it did, and otherwise only for the recent
+            ones (see _recent_missing_operations).
 
         """
         if not self._sweeper_started:
             self._sweeper_started = True
             self._sweeper_timeout = timeout
+            self._sweeper_full_timeout = full_timeout
 
             # TODO: link to greenlet and react to its death.
             gevent.spawn(self._sweeper_loop)
@@ -325,9 +387,20 @@ class TriggeredService(Service):
 
     def _sweep(self):
         """Check for missed operations."""
-        logger.info("Start looking for missing operations.")
+        now = monotonic_time()
+        full = self._sweeper_full_timeout is None \
+            or self._sweeper_full_requested \
+            or self._sweeper_last_full is None \
+            or now - self._sweeper_last_full >= self._sweeper_full_timeout
         start_time = time.time()
-        counter = self._missing_operations()
+        if full:
+            logger.info("Start looking for missing operations.")
+            self._sweeper_full_requested = False
+            self._sweeper_last_full = now
+            counter = self._missing_operations()
+        else:
+            logger.info("Start looking for recent missing operations.")
+            counter = self._recent_missing_operations()
         logger.info("Found %d missed operation(s) in %d ms.",
                     counter, (time.time() - start_time) * 1000)
 
@@ -342,20 +415,40 @@ class TriggeredService(Service):
         """
         return 0
 
+    def _recent_missing_operations(self):
+        """Enqueue missed operations among the recent ones.
+
+        Called instead of _missing_operations by the sweeps that are
+        not full ones (see start_sweeper). Subclasses can limit the
+        search to where operations can have been missed since the
+        previous sweep, for example the objects created or changed
+        since then.
+
+        return (int): the number of operations enqueued.
+
+        """
+        return self._missing_operations()
+
     @rpc_method
     def search_operations_not_done(self):
-        """Make the sweeper loop fire the sweeper as soon as possible."""
+        """Make the sweeper loop fire a full sweep as soon as possible."""
+        self._sweeper_full_requested = True
         self._sweeper_event.set()
 
     @rpc_method
-    def queue_status(self):
+    def queue_status(self, offset=0, limit=None):
         """Return the status of the queues.
 
         More precisely, a list indexed by each executor, whose
-        elements are the list of entries in the executor's queue. The
-        first item is the top item, the others are not in order.
+        elements are the list of entries in the executor's queue, in
+        order.
+
+        offset (int): the number of entries of each queue to skip.
+        limit (int|None): the maximum number of entries of each queue
+            to return, or None for all of them.
 
         return ([[QueueEntry]]): the list with the queued elements.
 
         """
-        return [executor.get_status() for executor in self._executors]
+        return [executor.get_status(offset, limit)
+                for executor in self._executors]
@@ -385,6 +385,10 @@ class AddManagerHandler(BaseHandler):
         self.sql_session.add(manager)
 
         if self.try_commit():
+            # Submissions that failed for the lack of the manager can
+            # now be judged.
+            self.application.service\
+                .evaluation_service.search_operations_not_done()
             self.redirect(self.url("task", task.id))
         else:
             self.redirect(fallback_page)
@@ -477,6 +481,9 @@ class AddTestcaseHandler(BaseHandler):
         if self.try_commit():
             # max_score and/or extra_headers might have changed.
             self.application.service.proxy_service.reinitialize()
+            # The submissions already evaluated need the new testcase.
+            self.application.service\
+                .evaluation_service.search_operations_not_done()
             self.redirect(self.url("task", task.id))
         else:
             self.redirect(fallback_page)
@@ -542,6 +549,9 @@ class AddTestcasesHandler(BaseHandler):
         self.application.service.add_notification(
             make_datetime(), successful_subject, successful_text)
         self.application.service.proxy_service.reinitialize()
+        # The submissions already evaluated need the new testcases.
+        self.application.service\
+            .evaluation_service.search_operations_not_done()
         self.redirect(self.url("task", task.id))
 
 
@@ -36,29 +36,37 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+import os
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import timedelta
 from functools import wraps
 
 import gevent.lock
 
+from sqlalchemy import func, tuple_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, subqueryload
 
-from cms import ServiceCoord, get_service_shards
+from cms import ServiceCoord, config, get_service_shards, mkdir
 from cms.io import Executor, TriggeredService, rpc_method
-from cms.db import SessionGen, Dataset, Submission, UserTest
+from cms.db import SessionGen, Dataset, Submission, SubmissionResult, \
+    UserTest
+from cms.db.bulkwrite import increment_evaluation_tries, \
+    insert_evaluations, set_evaluation_outcomes
 from cms.db.filecacher import FileCacher
 from cms.service import get_datasets_to_judge, \
     get_submissions, get_submission_results
-from cms.grading.Job import JobGroup
+from cms.grading.Job import Job, JobGroup, expand_job_dict
+from cmscommon.datetime import make_timestamp, monotonic_time
 
-from .esoperations import ESOperation, get_relevant_operations, \
-    get_submissions_operations, get_user_tests_operations, \
+from .batchsizer import BatchSizer
+from .esoperations import ESOperation, get_datasets_to_judge_signature, \
+    get_relevant_operations_filter, get_submissions_operations, \
+    get_user_tests_operations, \
     submission_get_operations, submission_to_evaluate, \
     user_test_get_operations
-from .flushingdict import FlushingDict
+from .flushingdict import FlushingDict, Journal
 from .workerpool import WorkerPool
 
 
@@ -70,6 +78,9 @@ class EvaluationExecutor(Executor):
     # Real maximum number of operations to be sent to a worker.
     MAX_OPERATIONS_PER_BATCH = 25
 
+    # Seconds a batch of operations sent to a worker should last.
+    TARGET_BATCH_TIME = 5.0
+
     def __init__(self, evaluation_service):
         """Create the single executor for ES.
 
@@ -80,6 +91,9 @@ class EvaluationExecutor(Executor):
 
         self.evaluation_service = evaluation_service
         self.pool = WorkerPool(self.evaluation_service)
+        self.batch_sizer = BatchSizer(
+            EvaluationExecutor.TARGET_BATCH_TIME,
+            EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
 
         # List of QueueItem (ESOperation) we have extracted from the
         # queue, but not yet finished to execute.
@@ -113,17 +127,43 @@ class EvaluationExecutor(Executor):
     def max_operations_per_batch(self):
         """Return the maximum number of operations per batch.
 
-        We derive the number from the length of the queue divided by
-        the number of workers, with a cap at MAX_OPERATIONS_PER_BATCH.
+        The number is chosen by the batch sizer, from how long the
+        operations like the one at the top of the queue take, and
+        from the length of the queue divided by the number of usable
+        workers.
+
+        """
+        return self.batch_sizer.get_size(
+            self._operation_queue.top().item,
+            len(self._operation_queue),
+            self.pool.get_usable_count())
+
+    def should_extend_batch(self, batch, entry, max_operations):
+        """Return whether to add an entry to a batch being formed.
+
+        To make the best use of the cache of the worker, the batch
+        stops where the operations of another submission (or user
+        test, or dataset) start, if it is already half full.
+
+        """
+        last = batch[-1].item
+        operation = entry.item
+        if (operation.type_, operation.object_id, operation.dataset_id) \
+                == (last.type_, last.object_id, last.dataset_id):
+            return True
+        return len(batch) < max_operations // 2
+
+    def batch_finished(self, slot):
+        """Account for a batch executed successfully by a worker.
+
+        To be called before releasing the worker.
+
+        slot ((int, int)): the worker, see WorkerPool.
 
         """
-        # TODO: len(self.pool) is the total number of workers,
-        # included those that are disabled.
-        ratio = len(self._operation_queue) // len(self.pool) + 1
-        ret = min(max(ratio, 1), EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
-        logger.info("Ratio is %d, executing %d operations together.",
-                    ratio, ret)
-        return ret
+        batch = self.pool.get_current_batch(slot)
+        if batch is not None:
+            self.batch_sizer.record(*batch)
 
     def execute(self, entries):
         """Execute a batch of operations in the queue.
@@ -176,6 +216,27 @@ class EvaluationExecutor(Executor):
                         return
             raise
 
+    def dequeue_many(self, predicate):
+        """Remove from the queue all the items satisfying a condition.
+
+        Like dequeue, this also removes the operations already
+        extracted, but not yet executed.
+
+        predicate (function): a function taking an ESOperation and
+            returning whether to remove it.
+
+        return (int): the number of operations removed.
+
+        """
+        removed = super(EvaluationExecutor, self).dequeue_many(predicate)
+        with self._current_execution_lock:
+            executing = len(self._currently_executing)
+            self._currently_executing = [
+                operation for operation in self._currently_executing
+                if not predicate(operation)]
+            removed += executing - len(self._currently_executing)
+        return removed
+
 
 def with_post_finish_lock(func):
     """Decorator for locking on self.post_finish_lock.
@@ -222,23 +283,32 @@ class EvaluationService(TriggeredService):
     # How often we check if a worker is connected.
     WORKER_CONNECTION_CHECK_TIME = timedelta(seconds=10)
 
-    # How many worker results we accumulate before processing them.
+    # How often we look for missed operations, and how often we look
+    # for them among all submissions and user tests instead of only
+    # the recent ones.
+    SWEEPER_TIMEOUT = timedelta(seconds=117)
+    FULL_SWEEPER_TIMEOUT = timedelta(minutes=30)
+
+    # How many sweeps are kept in the sweeper status.
+    SWEEPS_KEPT = 20
+
+    # How many worker results we accumulate before processing them,
+    # and how many at most when writing them to the DB is slow.
     RESULT_CACHE_SIZE = 100
-    # The maximum time since the last result before processing.
+    RESULT_CACHE_MAX_SIZE = 2000
+    # The maximum time since the last result before processing, and
+    # since the oldest result not yet processed.
     MAX_FLUSHING_TIME_SECONDS = 2
+    MAX_RESULT_AGE_SECONDS = 10
+    # How many results can be waiting to be processed before we stop
+    # accepting new ones from the workers.
+    MAX_PENDING_RESULTS = 10000
 
     def __init__(self, shard, contest_id=None):
         super(EvaluationService, self).__init__(shard)
 
         self.contest_id = contest_id
 
-        # Cache holding the results from the worker until they are
-        # written to the DB.
-        self.result_cache = FlushingDict(
-            EvaluationService.RESULT_CACHE_SIZE,
-            EvaluationService.MAX_FLUSHING_TIME_SECONDS,
-            self.write_results)
-
         # This lock is used to avoid inserting in the queue (which
         # itself is already thread-safe) an operation which is already
         # being processed. Such operation might be in one of the
@@ -265,8 +335,49 @@ class EvaluationService(TriggeredService):
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
+        # For submissions and user tests, the lowest id from which
+        # the next sweep looking only at the recent ones starts, and
+        # the highest id when the previous sweep ran.
+        # Type: {string: int|None}
+        self._sweep_from = {"submission": None, "user_test": None}
+        self._sweep_max_id = {"submission": None, "user_test": None}
+        # The testcases of the datasets to judge at the previous
+        # sweep (see get_datasets_to_judge_signature).
+        # Type: [(int, int, int|None)]|None
+        self._sweep_datasets = None
+        # The outcome of the latest sweeps.
+        # Type: deque of {string: object}
+        self._sweeps = deque(maxlen=EvaluationService.SWEEPS_KEPT)
+
         self.add_executor(EvaluationExecutor(self))
-        self.start_sweeper(117.0)
+
+        # Cache holding the results from the worker until they are
+        # written to the DB, and optionally the journal keeping them
+        # on disk meanwhile, so that they survive a crash. Results
+        # recovered from the journal are written as soon as possible,
+        # so everything needed by write_results must exist already.
+        journal = None
+        if config.result_journal:
+            if not mkdir(config.data_dir):
+                logger.error("Cannot create necessary directories.")
+                raise RuntimeError("Cannot create necessary directories.")
+            journal = Journal(
+                os.path.join(config.data_dir,
+                             "EvaluationService%d.journal" % shard),
+                EvaluationService._encode_result,
+                EvaluationService._decode_result)
+        self.result_cache = FlushingDict(
+            EvaluationService.RESULT_CACHE_SIZE,
+            EvaluationService.MAX_FLUSHING_TIME_SECONDS,
+            self.write_results,
+            max_size=EvaluationService.RESULT_CACHE_MAX_SIZE,
+            max_age_seconds=EvaluationService.MAX_RESULT_AGE_SECONDS,
+            max_pending=EvaluationService.MAX_PENDING_RESULTS,
+            journal=journal)
+
+        self.start_sweeper(
+            EvaluationService.SWEEPER_TIMEOUT.total_seconds(),
+            EvaluationService.FULL_SWEEPER_TIMEOUT.total_seconds())
 
         self.add_timeout(self.check_workers_timeout, None,
                          EvaluationService.WORKER_TIMEOUT_CHECK_TIME
@@ -332,21 +443,107 @@ class EvaluationService(TriggeredService):
         the queue.
 
         """
+        return self._enqueue_missing_operations(full=True)
+
+    @with_post_finish_lock
+    def _recent_missing_operations(self):
+        """Like _missing_operations, but only for the recent submissions
+        and user tests.
+
+        These are the ones from the oldest that still had operations to
+        do at the previous sweep, or created after the previous sweep
+        but one (to account for transactions committed late). Older
+        ones don't need any operation until they are invalidated, which
+        enqueues their operations directly, or the datasets to judge or
+        their testcases change: the sweep is then a full one (AWS also
+        asks for one right away when it changes them).
+
+        """
+        return self._enqueue_missing_operations(full=False)
+
+    def _enqueue_missing_operations(self, full):
+        """Enqueue the operations to do found in the database.
+
+        full (bool): whether to look at all the submissions and user
+            tests, or only at the recent ones.
+
+        return (int): the number of operations enqueued.
+
+        """
+        start_time = monotonic_time()
         counter = 0
         with SessionGen() as session:
+            max_ids = {
+                "submission": session.query(func.max(Submission.id))
+                .scalar() or 0,
+                "user_test": session.query(func.max(UserTest.id))
+                .scalar() or 0,
+            }
+            datasets = get_datasets_to_judge_signature(
+                session, self.contest_id)
+            if not full and datasets != self._sweep_datasets:
+                logger.info("The datasets to judge or their testcases "
+                            "have changed, sweeping all submissions.")
+                full = True
+            self._sweep_datasets = datasets
+            if full:
+                from_ids = {"submission": None, "user_test": None}
+            else:
+                from_ids = dict(self._sweep_from)
 
-            for operation, timestamp, priority in \
-                    get_submissions_operations(session, self.contest_id):
-                if self.enqueue(operation, timestamp, priority):
-                    counter += 1
+            submission_operations = get_submissions_operations(
+                session, self.contest_id, from_ids["submission"])
+            user_test_operations = get_user_tests_operations(
+                session, self.contest_id, from_ids["user_test"])
 
             for operation, timestamp, priority in \
-                    get_user_tests_operations(session, self.contest_id):
+                    submission_operations + user_test_operations:
                 if self.enqueue(operation, timestamp, priority):
                     counter += 1
 
+        for kind, operations in [("submission", submission_operations),
+                                 ("user_test", user_test_operations)]:
+            previous_max_id = self._sweep_max_id[kind]
+            if previous_max_id is None:
+                previous_max_id = max_ids[kind]
+            self._sweep_from[kind] = min(
+                [operation.object_id for operation, _, _ in operations] +
+                [previous_max_id + 1])
+            self._sweep_max_id[kind] = max_ids[kind]
+
+        duration = monotonic_time() - start_time
+        rows = len(submission_operations) + len(user_test_operations)
+        self._sweeps.append({
+            "full": full,
+            "timestamp": make_timestamp(),
+            "duration": duration,
+            "from_submission_id": from_ids["submission"],
+            "from_user_test_id": from_ids["user_test"],
+            "rows": rows,
+            "enqueued": counter,
+        })
+        logger.info("%s sweep from submission %s and user test %s: %d "
+                    "operations to do found in %.3f seconds.",
+                    "Full" if full else "Incremental",
+                    from_ids["submission"], from_ids["user_test"], rows,
+                    duration)
         return counter
 
+    @rpc_method
+    def sweeper_status(self):
+        """Return the outcome of the latest searches for missed
+        operations.
+
+        return ([dict]): for each sweep, from the oldest: whether it
+            was full, when it started, how long it took (in seconds),
+            the ids of submission and user test it started from (null
+            for full sweeps), how many operations to do it found (the
+            rows returned by the database) and how many of them were
+            enqueued.
+
+        """
+        return list(self._sweeps)
+
     @rpc_method
     def workers_status(self):
         """Returns a dictionary (indexed by shard number) whose values
@@ -358,6 +555,41 @@ class EvaluationService(TriggeredService):
         """
         return self.get_executor().pool.get_status()
 
+    @rpc_method
+    def batches_status(self):
+        """Return the estimates and the decisions used to choose how
+        many operations to give together to a worker. See
+        BatchSizer.get_status for more details.
+
+        return (dict): the status of the batch sizer.
+
+        """
+        return self.get_executor().batch_sizer.get_status()
+
+    @rpc_method
+    def results_status(self):
+        """Return the state of the results waiting to be written to
+        the DB. See FlushingDict.get_status for more details.
+
+        return (dict): the status of the result cache.
+
+        """
+        return self.result_cache.get_status()
+
+    @rpc_method
+    def get_job_template(self, dataset_id):
+        """Return the template of the jobs of a dataset, for the
+        Workers to fill the jobs they receive with it.
+
+        dataset_id (int): the id of the dataset.
+
+        return ([unicode, {string: object}]|None): the version of the
+            dataset and the template (see Job.get_job_template), or
+            None if the dataset doesn't exist.
+
+        """
+        return self.get_executor().pool.get_job_template(dataset_id)
+
     def check_workers_timeout(self):
         """We ask WorkerPool for the unresponsive workers, and we put
         again their operations in the queue.
@@ -405,13 +637,28 @@ class EvaluationService(TriggeredService):
         return super(EvaluationService, self).enqueue(
             operation, priority, timestamp) > 0
 
-    @with_post_finish_lock
-    def action_finished(self, data, shard, error=None):
+    def action_finished(self, data, slot, error=None):
         """Callback from a worker, to signal that is finished some
         action (compilation or evaluation).
 
+        If too many results are waiting to be written to the DB, we
+        wait for them before accepting the new ones (and releasing the
+        worker); this must happen without holding the lock, which is
+        needed to write them.
+
         data (dict): the JobGroup, exported to dict.
-        shard (int): the shard finishing the action.
+        slot ((int, int)): the worker finishing the action, see
+            WorkerPool.
+
+        """
+        self.result_cache.wait_for_room()
+        self._action_finished(data, slot, error)
+
+    @with_post_finish_lock
+    def _action_finished(self, data, slot, error=None):
+        """Process the results of some action of a worker.
+
+        See action_finished for the arguments.
 
         """
         # We notify the pool that the worker is available again for
@@ -422,9 +669,12 @@ class EvaluationService(TriggeredService):
         # this method and do nothing because in that case we know the
         # operation has returned to the queue and perhaps already been
         # reassigned to another worker.
-        to_ignore = self.get_executor().pool.release_worker(shard)
+        if error is None:
+            self.get_executor().batch_finished(slot)
+        to_ignore = self.get_executor().pool.release_worker(slot)
         if to_ignore is True:
-            logger.info("Ignored result from worker %s as requested.", shard)
+            logger.info("Ignored result from worker %s as requested.",
+                        slot[0])
             return
 
         job_group = None
@@ -435,6 +685,16 @@ class EvaluationService(TriggeredService):
 
         else:
             try:
+                # Results come back compacted against the template
+                # they were sent with; the fields found in it are not
+                # needed to store them, so if it has changed in the
+                # meantime they are left empty.
+                pool = self.get_executor().pool
+                for job_dict in data["jobs"]:
+                    if "dataset" in job_dict:
+                        expand_job_dict(
+                            job_dict, pool.get_cached_job_template(
+                                *job_dict["dataset"]))
                 job_group = JobGroup.import_from_dict(data)
             except:
                 logger.error("Couldn't build JobGroup for data %s.", data,
@@ -451,6 +711,33 @@ class EvaluationService(TriggeredService):
                 else:
                     self.result_cache.add(operation, Result(job, job.success))
 
+    @staticmethod
+    def _encode_result(operation, result):
+        """Return the representation of a result in the journal.
+
+        operation (ESOperation): the operation.
+        result (Result): its result.
+
+        return (dict): the representation.
+
+        """
+        return {"operation": operation.to_dict(),
+                "job": result.job.export_to_dict(),
+                "job_success": result.job_success}
+
+    @staticmethod
+    def _decode_result(data):
+        """Return the result represented in the journal.
+
+        data (dict): the output of _encode_result.
+
+        return ((ESOperation, Result)): the operation and its result.
+
+        """
+        return (ESOperation.from_dict(data["operation"]),
+                Result(Job.import_from_dict_with_type(data["job"]),
+                       data["job_success"]))
+
     @with_post_finish_lock
     def write_results(self, items):
         """Receive worker results from the cache and writes them to the DB.
@@ -461,6 +748,11 @@ class EvaluationService(TriggeredService):
         retrieving datasets and submission results only once instead
         of once for every result.
 
+        The results of the evaluations of submissions, which are by
+        far the most, are written with a few set-based statements for
+        all of them (see cms.db.bulkwrite); the others go through the
+        ORM, one at a time.
+
         items ([(operation, Result)]): the results received by ES but
             not yet written to the db.
 
@@ -476,24 +768,28 @@ class EvaluationService(TriggeredService):
             by_object_and_type[t].append((operation, result))
 
         with SessionGen() as session:
-            # Dictionary holding the objects we use repeatedly,
-            # indexed by id, to avoid querying them multiple times.
-            # TODO: this pattern is used in WorkerPool and should be
-            # abstracted away.
-            datasets = dict()
-            subs = dict()
+            # Load all the objects we need with a few queries, and
+            # index them by id.
+            datasets = EvaluationService._get_datasets(
+                session, set(dataset_id
+                             for _, _, dataset_id in by_object_and_type))
+            subs = EvaluationService._get_submissions(
+                session, set(object_id
+                             for type_, object_id, _ in by_object_and_type
+                             if type_ in [ESOperation.COMPILATION,
+                                          ESOperation.EVALUATION]))
             srs = dict()
 
+            # Evaluations to insert and failed evaluation attempts to
+            # count (for each submission result) with the bulk writes.
+            evaluation_rows = []
+            evaluation_tries = defaultdict(int)
+
             for key, operation_results in by_object_and_type.iteritems():
                 type_, object_id, dataset_id = key
 
                 # Get dataset.
-                if dataset_id not in datasets:
-                    datasets[dataset_id] = session.query(Dataset)\
-                        .filter(Dataset.id == dataset_id)\
-                        .options(joinedload(Dataset.testcases))\
-                        .first()
-                dataset = datasets[dataset_id]
+                dataset = datasets.get(dataset_id)
                 if dataset is None:
                     logger.error("Could not find dataset %d in the database.",
                                  dataset_id)
@@ -501,18 +797,22 @@ class EvaluationService(TriggeredService):
 
                 # Get submission or user test, and their results.
                 if type_ in [ESOperation.COMPILATION, ESOperation.EVALUATION]:
-                    if object_id not in subs:
-                        subs[object_id] = \
-                            Submission.get_from_id(object_id, session)
-                    object_ = subs[object_id]
+                    object_ = subs.get(object_id)
                     if object_ is None:
                         logger.error("Could not find submission %d "
                                      "in the database.", object_id)
                         continue
-                    result_id = (object_id, dataset_id)
-                    if result_id not in srs:
-                        srs[result_id] = object_.get_result_or_create(dataset)
-                    object_result = srs[result_id]
+                    # Evaluations are written in bulk only for the
+                    # submission results already in the database.
+                    object_result = object_.get_result(dataset)
+                    if type_ == ESOperation.EVALUATION and \
+                            object_result is not None:
+                        operation_results = self.collect_evaluation_results(
+                            object_result, operation_results,
+                            evaluation_rows, evaluation_tries)
+                    elif object_result is None:
+                        object_result = object_.get_result_or_create(dataset)
+                    srs[(object_id, dataset_id)] = object_result
                 else:
                     # We do not cache user tests as they can come up
                     # only once.
@@ -522,19 +822,24 @@ class EvaluationService(TriggeredService):
                 self.write_results_one_object_and_type(
                     session, object_result, operation_results)
 
+            # The bulk writes don't go through the ORM, so the changes
+            # of the ORM must reach the database before them.
+            session.flush()
+            self.write_evaluations_in_bulk(
+                session, evaluation_rows, evaluation_tries)
+            set_evaluation_outcomes(
+                session, [(object_id, dataset_id)
+                          for type_, object_id, dataset_id
+                          in by_object_and_type
+                          if type_ == ESOperation.EVALUATION and
+                          (object_id, dataset_id) in srs])
+
             logger.info("Committing evaluations...")
             session.commit()
 
-            for type_, object_id, dataset_id in by_object_and_type:
-                if type_ == ESOperation.EVALUATION:
-                    submission_result = srs[(object_id, dataset_id)]
-                    dataset = datasets[dataset_id]
-                    if len(submission_result.evaluations) == \
-                            len(dataset.testcases):
-                        submission_result.set_evaluation_outcome()
-
-            logger.info("Committing evaluation outcomes...")
-            session.commit()
+            # Committing expired the submission results, reload them
+            # all together.
+            EvaluationService._get_submission_results(session, srs.keys())
 
             logger.info("Ending operations for %s objects...",
                         len(by_object_and_type))
@@ -559,6 +864,132 @@ class EvaluationService(TriggeredService):
 
         logger.info("Done")
 
+    @staticmethod
+    def _get_datasets(session, dataset_ids):
+        """Load the datasets of some results, with their testcases.
+
+        session (Session): the session to use.
+        dataset_ids ({int}): the ids of the datasets.
+
+        return ({int: Dataset}): the datasets that exist.
+
+        """
+        if len(dataset_ids) == 0:
+            return dict()
+        return dict((dataset.id, dataset) for dataset in
+                    session.query(Dataset)
+                    .filter(Dataset.id.in_(dataset_ids))
+                    .options(subqueryload(Dataset.testcases))
+                    .all())
+
+    @staticmethod
+    def _get_submissions(session, submission_ids):
+        """Load the submissions of some results, with their results.
+
+        session (Session): the session to use.
+        submission_ids ({int}): the ids of the submissions.
+
+        return ({int: Submission}): the submissions that exist.
+
+        """
+        if len(submission_ids) == 0:
+            return dict()
+        return dict((submission.id, submission) for submission in
+                    session.query(Submission)
+                    .filter(Submission.id.in_(submission_ids))
+                    .options(subqueryload(Submission.results))
+                    .all())
+
+    @staticmethod
+    def _get_submission_results(session, keys):
+        """Load some submission results, with their submissions.
+
+        session (Session): the session to use.
+        keys ([(int, int)]): the pairs of submission id and dataset id
+            of the submission results.
+
+        return ([SubmissionResult]): the submission results that exist.
+
+        """
+        if len(keys) == 0:
+            return []
+        return session.query(SubmissionResult)\
+            .filter(tuple_(SubmissionResult.submission_id,
+                           SubmissionResult.dataset_id).in_(keys))\
+            .options(joinedload(SubmissionResult.submission))\
+            .all()
+
+    @staticmethod
+    def collect_evaluation_results(
+            submission_result, operation_results, rows, tries):
+        """Prepare the bulk write of the results of some evaluations.
+
+        submission_result (SubmissionResult): the DB object the
+            evaluations are for, already in the database.
+        operation_results ([(ESOperation, WorkerResult)]): the
+            evaluations and their results.
+        rows ([dict]): the evaluations to insert, where those of the
+            successful results are added.
+        tries ({(int, int): int}): the failed attempts for each
+            submission result, updated with the failed results.
+
+        return ([(ESOperation, WorkerResult)]): the results that need
+            to be written one at a time (the failures caused by an
+            executable no longer available).
+
+        """
+        remaining = []
+        key = (submission_result.submission_id, submission_result.dataset_id)
+        for operation, result in operation_results:
+            if result.job_success:
+                rows.append(result.job.to_evaluation_row(submission_result))
+            elif result.job.plus is not None and \
+                    result.job.plus.get("tombstone") is True:
+                remaining.append((operation, result))
+            else:
+                tries[key] += 1
+        return remaining
+
+    @staticmethod
+    def write_evaluations_in_bulk(session, rows, tries):
+        """Write the results of evaluations with set-based statements.
+
+        If inserting the evaluations fails (for example because a
+        testcase has been deleted meanwhile), they are inserted again
+        one at a time, so that only the wrong ones are lost.
+
+        session (Session): the DB session to use.
+        rows ([dict]): the evaluations to insert.
+        tries ({(int, int): int}): the failed attempts to add to the
+            submission results.
+
+        """
+        logger.info("Writing %d evaluations and %d failures to db.",
+                    len(rows), sum(tries.itervalues()))
+        if len(rows) > 0:
+            try:
+                with session.begin_nested():
+                    skipped = insert_evaluations(session, rows)
+            except IntegrityError:
+                logger.warning("Integrity error while inserting worker "
+                               "results, inserting them one at a time.",
+                               exc_info=True)
+                skipped = []
+                for row in rows:
+                    try:
+                        with session.begin_nested():
+                            skipped += insert_evaluations(session, [row])
+                    except IntegrityError:
+                        logger.warning(
+                            "Integrity error while inserting worker result.",
+                            exc_info=True)
+            for row in skipped:
+                logger.warning("Evaluation of submission %d on dataset %d "
+                               "and testcase %d already in the database.",
+                               row["submission_id"], row["dataset_id"],
+                               row["testcase_id"])
+        increment_evaluation_tries(session, tries)
+
     def write_results_one_object_and_type(
             self, session, object_result, operation_results):
         """Write to the DB the results for one object and type.
@@ -899,17 +1330,10 @@ class EvaluationService(TriggeredService):
             # Then we get all relevant operations, and we remove them
             # both from the queue and from the pool (i.e., we ignore
             # the workers involved in those operations).
-            operations = get_relevant_operations(
+            is_relevant = get_relevant_operations_filter(
                 level, submissions, dataset_id)
-            for operation in operations:
-                try:
-                    self.dequeue(operation)
-                except KeyError:
-                    pass  # Ok, the operation wasn't in the queue.
-                try:
-                    self.get_executor().pool.ignore_operation(operation)
-                except LookupError:
-                    pass  # Ok, the operation wasn't in the pool.
+            self.dequeue_many(is_relevant)
+            self.get_executor().pool.ignore_operations(is_relevant)
 
             # Then we find all existing results in the database, and
             # we remove them.
@@ -982,7 +1406,7 @@ class EvaluationService(TriggeredService):
         return True
 
     @rpc_method
-    def queue_status(self):
+    def queue_status(self, offset=0, limit=None):
         """Return the status of the queue.
 
         Parent method returns list of queues of each executor, but in
@@ -1000,21 +1424,15 @@ class EvaluationService(TriggeredService):
         The entries are then ordered by priority and timestamp (the
         same criteria used to look at what to complete next).
 
+        offset (int): the number of entries to skip.
+        limit (int|None): the maximum number of entries to return, or
+            None for all of them.
+
         return ([QueueEntry]): the list with the queued elements.
 
         """
-        entries = super(EvaluationService, self).queue_status()[0]
-        entries_by_key = dict()
-        for entry in entries:
-            key = (str(entry["item"]["type"]),
-                   str(entry["item"]["object_id"]),
-                   str(entry["item"]["dataset_id"]))
-            if key in entries_by_key:
-                entries_by_key[key]["item"]["multiplicity"] += 1
-            else:
-                entries_by_key[key] = entry
-                entries_by_key[key]["item"]["multiplicity"] = 1
-        return sorted(
-            entries_by_key.values(),
-            lambda x, y: cmp((x["priority"], x["timestamp"]),
-                             (y["priority"], y["timestamp"])))
+        return self.get_executor().get_status(
+            offset, limit,
+            group_by=lambda operation: (operation.type_,
+                                        operation.object_id,
+                                        operation.dataset_id))
@@ -32,14 +32,17 @@ from __future__ import unicode_literals
 import logging
 import time
 
-import gevent.lock
-
+from cms import ServiceCoord, config
 from cms.io import Service, rpc_method
 from cms.db import SessionGen, Contest
 from cms.db.filecacher import FileCacher, TombstoneError
 from cms.grading import JobException
+from cms.grading.compilationcache import get_compilation_cache
+from cms.grading.Sandbox import Sandbox, set_execution_slot
+from cms.grading.cpuaffinity import format_cpu_list, get_slot_cpus
 from cms.grading.tasktypes import get_task_type
-from cms.grading.Job import CompilationJob, EvaluationJob, JobGroup
+from cms.grading.Job import CompilationJob, EvaluationJob, JobGroup, \
+    compact_job_dict, expand_job_dict
 
 
 logger = logging.getLogger(__name__)
@@ -56,18 +59,55 @@ class Worker(Service):
     JOB_TYPE_COMPILATION = "compile"
     JOB_TYPE_EVALUATION = "evaluate"
 
+    # Maximum number of job groups executed at the same time (each
+    # slot needs at least two of the ten sandbox ids of the Worker,
+    # for the task types running two sandboxes together; those
+    # running more, like Communication with many processes, need
+    # fewer slots).
+    MAX_SLOTS = 5
+
     def __init__(self, shard, fake_worker_time=None):
         Service.__init__(self, shard)
         self.file_cacher = FileCacher(self)
 
-        self.work_lock = gevent.lock.RLock()
-        self._last_end_time = None
+        # The job groups are executed each in a free slot, and
+        # declined when there are none.
+        self.slots = config.worker_slots
+        if not 1 <= self.slots <= Worker.MAX_SLOTS:
+            self.slots = max(1, min(self.slots, Worker.MAX_SLOTS))
+            logger.warning("Worker slots must be between 1 and %d, "
+                           "using %d.", Worker.MAX_SLOTS, self.slots)
+        self._free_slots = range(self.slots - 1, -1, -1)
+        for slot in xrange(self.slots):
+            cpus = get_slot_cpus(shard, slot, self.slots)
+            if cpus is not None:
+                logger.info("Sandboxes of slot %d run on CPUs %s.",
+                            slot, format_cpu_list(cpus))
+        # For each slot, when it finished its last job group.
+        self._last_end_time = dict()
         self._total_free_time = 0
         self._total_busy_time = 0
         self._number_execution = 0
 
         self._fake_worker_time = fake_worker_time
 
+        self.evaluation_service = self.connect_to(
+            ServiceCoord("EvaluationService", 0))
+
+        # Templates of the jobs of the datasets, received from ES, with
+        # their version.
+        # Type: {int: (unicode, {string: object})}
+        self._job_templates = dict()
+
+    def run(self):
+        """See Service.run.
+
+        """
+        ret = Service.run(self)
+        # Delete the boxes the sandboxes kept for reuse.
+        Sandbox.clear_pool()
+        return ret
+
     @rpc_method
     def precache_files(self, contest_id):
         """RPC to ask the worker to precache of files in the contest.
@@ -84,16 +124,22 @@ class Worker(Service):
             contest = Contest.get_from_id(contest_id, session)
             files = contest.enumerate_files(skip_submissions=True,
                                             skip_user_tests=True)
-        for digest in files:
-            try:
-                self.file_cacher.load(digest, if_needed=True)
-            except KeyError:
-                # No problem (at this stage) if we cannot find the
-                # file
-                pass
+        # No problem (at this stage) if we cannot find some files.
+        errors = self.file_cacher.load_many(files)
+        if len(errors) > 0:
+            logger.info("%d files could not be precached.", len(errors))
 
         logger.info("Precaching finished.")
 
+    @rpc_method
+    def get_slots(self):
+        """Return how many job groups the worker can execute together.
+
+        return (int): the number of slots.
+
+        """
+        return self.slots
+
     @rpc_method
     def execute_job_group(self, job_group_dict):
         """Receive a group of jobs in a list format and executes them one by
@@ -106,26 +152,42 @@ class Worker(Service):
 
         """
         start_time = time.time()
+        # For each job, the dataset and the template it was compacted
+        # with, if it was.
+        compactions = list()
+        for job_dict in job_group_dict["jobs"]:
+            if "dataset" in job_dict:
+                dataset_id, version = job_dict["dataset"]
+                template = self._get_job_template(dataset_id, version)
+                expand_job_dict(job_dict, template)
+                compactions.append((dataset_id, version, template))
+            else:
+                compactions.append(None)
         job_group = JobGroup.import_from_dict(job_group_dict)
 
-        if self.work_lock.acquire(False):
+        if len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
+            set_execution_slot(slot, self.slots)
             try:
-                logger.info("Starting job group.")
-                for job in job_group.jobs:
-                    logger.info("Starting job.",
-                                extra={"operation": job.info})
-
-                    job.shard = self.shard
+                logger.info("Starting job group in slot %d.", slot)
+                if self._fake_worker_time is None:
+                    # Fetch together all the files the jobs will need;
+                    # errors (if any) are left to the jobs to handle.
+                    digests = set()
+                    for job in job_group.jobs:
+                        digests.update(job.get_digests())
+                    self.file_cacher.load_many(digests)
+
+                for jobs in self._get_runs(job_group.jobs):
+                    for job in jobs:
+                        logger.info("Starting job.",
+                                    extra={"operation": job.info})
+                        job.shard = self.shard
 
                     if self._fake_worker_time is None:
-                        task_type = get_task_type(job.task_type,
-                                                  job.task_type_parameters)
-                        try:
-                            task_type.execute_job(job, self.file_cacher)
-                        except TombstoneError:
-                            job.success = False
-                            job.plus = {"tombstone": True}
+                        self._execute_jobs(jobs)
                     else:
+                        job, = jobs
                         time.sleep(self._fake_worker_time)
                         job.success = True
                         job.text = ["ok"]
@@ -141,11 +203,30 @@ class Worker(Service):
                         elif isinstance(job, EvaluationJob):
                             job.outcome = "1.0"
 
-                    logger.info("Finished job.",
-                                extra={"operation": job.info})
+                    for job in jobs:
+                        logger.info("Finished job.",
+                                    extra={"operation": job.info})
 
                 logger.info("Finished job group.")
-                return job_group.export_to_dict()
+                stats = self.file_cacher.get_cache_stats()
+                logger.debug("File cache: %d hits, %d misses, %d evictions "
+                             "(%d bytes).", stats["hits"], stats["misses"],
+                             stats["evictions"], stats["evicted_bytes"])
+                cache = get_compilation_cache()
+                if cache is not None:
+                    stats = cache.get_stats()
+                    lookups = stats["hits"] + stats["misses"]
+                    if lookups > 0:
+                        logger.debug(
+                            "Compilation cache: %d hits, %d misses "
+                            "(%.1f%% hit rate).", stats["hits"],
+                            stats["misses"], 100.0 * stats["hits"] / lookups)
+                result = job_group.export_to_dict()
+                for job_dict, compaction in zip(result["jobs"],
+                                                compactions):
+                    if compaction is not None:
+                        compact_job_dict(job_dict, *compaction)
+                return result
 
             except:
                 err_msg = "Worker failed."
@@ -153,25 +234,134 @@ class Worker(Service):
                 raise JobException(err_msg)
 
             finally:
-                self._finalize(start_time)
-                self.work_lock.release()
+                self._finalize(start_time, slot)
+                self._free_slots.append(slot)
 
         else:
-            err_msg = "Request received, but declined because of acquired " \
-                "lock (Worker is busy executing another job, this should " \
-                "not happen: check if there are more than one ES running, " \
-                "or for bugs in ES."
+            err_msg = "Request received, but declined because all slots " \
+                "are busy (Worker is executing as many jobs as it can, " \
+                "this should not happen: check if there are more than " \
+                "one ES running, or for bugs in ES."
             logger.warning(err_msg)
-            self._finalize(start_time)
             raise JobException(err_msg)
 
-    def _finalize(self, start_time):
+    def _get_runs(self, jobs):
+        """Split the jobs of a group in runs to execute together.
+
+        If so configured, consecutive evaluation jobs of the same task
+        type (and parameters) are evaluated together, letting the task
+        type share the work among them (see
+        TaskType.evaluate_testcases); all other jobs are executed by
+        themselves.
+
+        jobs ([Job]): the jobs of the group.
+
+        return ([[Job]]): the runs, in order.
+
+        """
+        runs = []
+        for job in jobs:
+            if config.share_evaluation_sandbox \
+                    and self._fake_worker_time is None \
+                    and isinstance(job, EvaluationJob) \
+                    and len(runs) > 0 \
+                    and isinstance(runs[-1][0], EvaluationJob) \
+                    and runs[-1][0].task_type == job.task_type \
+                    and runs[-1][0].task_type_parameters \
+                    == job.task_type_parameters:
+                runs[-1].append(job)
+            else:
+                runs.append([job])
+        return runs
+
+    def _execute_jobs(self, jobs):
+        """Execute a run of jobs (see _get_runs).
+
+        jobs ([Job]): the jobs, all with the same task type.
+
+        """
+        task_type = get_task_type(jobs[0].task_type,
+                                  jobs[0].task_type_parameters)
+        # Each slot has its own ten box ids of the sandboxes, shared
+        # evenly.
+        if task_type.get_max_sandboxes() > 10 // self.slots:
+            logger.error("Task type %s needs %d sandboxes at once, but "
+                         "a slot has only %d; lower worker_slots.",
+                         jobs[0].task_type, task_type.get_max_sandboxes(),
+                         10 // self.slots)
+            for job in jobs:
+                job.success = False
+            return
+        # Keep the files of the jobs in the cache while they are
+        # running.
+        digests = set()
+        for job in jobs:
+            digests.update(job.get_digests())
+        for digest in digests:
+            self.file_cacher.pin(digest)
+        try:
+            if len(jobs) == 1:
+                task_type.execute_job(jobs[0], self.file_cacher)
+            else:
+                task_type.evaluate_testcases(jobs, self.file_cacher)
+        except TombstoneError:
+            # The jobs not completed yet cannot be.
+            for job in jobs:
+                if job.success is None:
+                    job.success = False
+                    job.plus = {"tombstone": True}
+        finally:
+            for digest in digests:
+                self.file_cacher.unpin(digest)
+
+    def _get_job_template(self, dataset_id, version):
+        """Return the template of the jobs of a dataset.
+
+        The templates are asked to ES the first time, and then every
+        time a job refers to a version of the dataset different from
+        the one we know.
+
+        dataset_id (int): the id of the dataset.
+        version (unicode): the version of the dataset the job refers
+            to.
+
+        return ({string: object}): the template.
+
+        raise (JobException): if the template cannot be retrieved, or
+            if the dataset has been changed after the job was created
+            (so that ES, which knows its current version, creates the
+            job again).
+
+        """
+        if dataset_id in self._job_templates \
+                and self._job_templates[dataset_id][0] == version:
+            return self._job_templates[dataset_id][1]
+
+        logger.debug("Asking template of dataset %d.", dataset_id)
+        result = self.evaluation_service.get_job_template(
+            dataset_id=dataset_id)
+        result.wait()
+        if not result.successful() or result.value is None:
+            err_msg = "Cannot get the template of dataset %d." % dataset_id
+            logger.error(err_msg)
+            raise JobException(err_msg)
+
+        new_version, template = result.value
+        self._job_templates[dataset_id] = (new_version, template)
+        if new_version != version:
+            err_msg = "Dataset %d has changed after the jobs were " \
+                "created." % dataset_id
+            logger.info(err_msg)
+            raise JobException(err_msg)
+        return template
+
+    def _finalize(self, start_time, slot):
         end_time = time.time()
         busy_time = end_time - start_time
         free_time = 0.0
-        if self._last_end_time is not None:
-            free_time = start_time - self._last_end_time
-        self._last_end_time = end_time
+        if slot in self._last_end_time:
+            free_time = start_time - self._last_end_time[slot]
+        self._last_end_time[slot] = end_time
         self._total_busy_time += busy_time
         self._total_free_time += free_time
         ratio = self._total_busy_time * 100.0 / \
@@ -0,0 +1,156 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Choice of the number of operations to give together to a worker.
+
+Operations are sent to the workers in batches: larger batches spare
+the overhead of each round trip (building the jobs, the RPC, fetching
+the files on the worker), but a batch of slow operations keeps the
+other workers waiting for its results (the batch is a straggler) and
+makes the results arrive late. The size of a batch is then chosen so
+that it lasts about a target time, estimating how long its operations
+take from how long the batches of operations of the same kind lasted.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSizer(object):
+    """Choose the size of the batches of operations for the workers.
+
+    Operations are of the same kind when they have the same type and
+    dataset. The size of a batch is the lowest of:
+    - the number of operations of the kind of the first one that
+      should take the target time ("estimate"), if we have an
+      estimate;
+    - the fair share of the queue for each worker, so that no worker
+      is left idle ("share");
+    - the maximum size ("maximum").
+
+    """
+
+    # Weight of the last measurement in the estimates (which are
+    # exponential moving averages).
+    SMOOTHING = 0.3
+
+    def __init__(self, target_time, max_operations):
+        """Create a batch sizer.
+
+        target_time (float): how many seconds a batch should last.
+        max_operations (int): the maximum size of a batch.
+
+        """
+        self.target_time = target_time
+        self.max_operations = max_operations
+
+        # Estimated seconds taken by each operation of each kind.
+        # Type: {(unicode, int): float}
+        self._estimates = dict()
+        # Number of batches whose size was limited by each reason.
+        # Type: {unicode: int}
+        self._decisions = defaultdict(int)
+        # Number of batches finished, and of operations in them.
+        self._batches = 0
+        self._operations = 0
+
+    @staticmethod
+    def _get_kind(operation):
+        """Return the kind of an operation.
+
+        operation (ESOperation): the operation.
+
+        return ((unicode, int)): its type and dataset.
+
+        """
+        return operation.type_, operation.dataset_id
+
+    def get_size(self, operation, queue_length, workers):
+        """Return the size of the next batch.
+
+        operation (ESOperation): the first operation of the batch.
+        queue_length (int): the number of operations in the queue.
+        workers (int): the number of workers that can take a batch.
+
+        return (int): the maximum number of operations in the batch.
+
+        """
+        candidates = [
+            (queue_length // max(workers, 1) + 1, "share"),
+            (self.max_operations, "maximum")]
+        estimate = self._estimates.get(BatchSizer._get_kind(operation))
+        if estimate is not None:
+            candidates.append(
+                (int(self.target_time / max(estimate, 1e-3)), "estimate"))
+        size, reason = min(candidates)
+        size = max(size, 1)
+
+        self._decisions[reason] += 1
+        logger.info("Executing up to %d operations together (limited by "
+                    "the %s).", size, reason)
+        return size
+
+    def record(self, operations, elapsed):
+        """Update the estimates with a batch that finished.
+
+        operations ([ESOperation]): the operations of the batch.
+        elapsed (float): the seconds from when the batch was assigned
+            to when its results were received.
+
+        """
+        if len(operations) == 0:
+            return
+        per_operation = elapsed / len(operations)
+        for kind in set(BatchSizer._get_kind(operation)
+                        for operation in operations):
+            old = self._estimates.get(kind)
+            if old is None:
+                self._estimates[kind] = per_operation
+            else:
+                self._estimates[kind] = \
+                    old + BatchSizer.SMOOTHING * (per_operation - old)
+        self._batches += 1
+        self._operations += len(operations)
+
+    def get_status(self):
+        """Return the estimates and the decisions taken.
+
+        return (dict): the estimated seconds per operation of each
+            kind (as "type dataset_id"), how many batch sizes were
+            limited by each reason, how many batches finished and
+            their average size.
+
+        """
+        return {
+            "estimates": dict(("%s %d" % kind, estimate)
+                              for kind, estimate
+                              in self._estimates.iteritems()),
+            "decisions": dict(self._decisions),
+            "batches": self._batches,
+            "average_size": float(self._operations) / self._batches
+            if self._batches > 0 else None,
+        }
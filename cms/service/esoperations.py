@@ -33,7 +33,7 @@ from __future__ import unicode_literals
 
 import logging
 
-from sqlalchemy import case, literal
+from sqlalchemy import case, func, literal
 
 from cms.io import PriorityQueue, QueueItem
 from cms.db import Dataset, Evaluation, Submission, SubmissionResult, \
@@ -246,54 +246,43 @@ def user_test_get_operations(user_test, dataset):
             user_test.timestamp
 
 
-def get_relevant_operations(level, submissions, dataset_id=None):
-    """Return all possible operations involving the submissions
+def get_relevant_operations_filter(level, submissions, dataset_id=None):
+    """Return a function telling which operations involve the submissions
 
-    level (string): the starting level; if 'compilation', then we
-        return operations for both compilation and evaluation; if
-        'evaluation', we return evaluations only.
+    level (string): the starting level; if 'compilation', then both
+        compilation and evaluation operations are relevant; if
+        'evaluation', evaluations only.
     submissions ([Submission]): submissions we want the operations for.
     dataset_id (int|None): id of the dataset to select, or None for all
         datasets
 
-    return ([ESOperation]): list of relevant operations.
+    return (function): a function taking an ESOperation and returning
+        whether it is relevant.
 
     """
-    operations = []
-    for submission in submissions:
-        # All involved datasets: all of the task's dataset unless
-        # one was specified.
-        datasets = submission.task.datasets
-        if dataset_id is not None:
-            for dataset in submission.task.datasets:
-                if dataset.id == dataset_id:
-                    datasets = [dataset]
-                    break
-
-        # For each submission and dataset, the operations are: one
-        # compilation, and one evaluation per testcase.
-        for dataset in datasets:
-            if level == 'compilation':
-                operations.append(ESOperation(
-                    ESOperation.COMPILATION,
-                    submission.id,
-                    dataset.id))
-            for codename in dataset.testcases:
-                operations.append(ESOperation(
-                    ESOperation.EVALUATION,
-                    submission.id,
-                    dataset.id,
-                    codename))
+    submission_ids = set(submission.id for submission in submissions)
+    if level == 'compilation':
+        types = set([ESOperation.COMPILATION, ESOperation.EVALUATION])
+    else:
+        types = set([ESOperation.EVALUATION])
 
-    return operations
+    def is_relevant(operation):
+        return operation.type_ in types \
+            and operation.object_id in submission_ids \
+            and (dataset_id is None or operation.dataset_id == dataset_id)
 
+    return is_relevant
 
-def get_submissions_operations(session, contest_id=None):
+
+def get_submissions_operations(session, contest_id=None,
+                               min_submission_id=None):
     """Return all the operations to do for submissions in the contest.
 
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    min_submission_id (int|None): if given, get operations only for
+        the submissions with at least this id.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -305,6 +294,8 @@ def get_submissions_operations(session, contest_id=None):
         contest_filter = literal(True)
     else:
         contest_filter = Task.contest_id == contest_id
+    if min_submission_id is not None:
+        contest_filter &= Submission.id >= min_submission_id
 
     # Retrieve the compilation operations for all submissions without
     # the corresponding result for a dataset to judge. Since we have
@@ -395,12 +386,45 @@ def get_submissions_operations(session, contest_id=None):
     return operations
 
 
-def get_user_tests_operations(session, contest_id=None):
+def get_datasets_to_judge_signature(session, contest_id=None):
+    """Return what identifies the testcases of the datasets to judge.
+
+    It changes when a dataset starts or stops being judged, or when a
+    testcase is added to or removed from one of them: then also the
+    old submissions and user tests could have operations to do.
+
+    session (Session): the database session to use.
+    contest_id (int|None): the contest of the datasets. If none, the
+        datasets of any contest.
+
+    return ([(int, int, int|None)]): for each dataset to judge, by id,
+        its id, and the number and the highest id of its testcases.
+
+    """
+    if contest_id is None:
+        contest_filter = literal(True)
+    else:
+        contest_filter = Task.contest_id == contest_id
+    rows = session.query(Dataset.id, func.count(Testcase.id),
+                         func.max(Testcase.id))\
+        .join(Task, Task.id == Dataset.task_id)\
+        .outerjoin(Testcase, Testcase.dataset_id == Dataset.id)\
+        .filter(contest_filter & FILTER_SUBMISSION_DATASETS_TO_JUDGE)\
+        .group_by(Dataset.id)\
+        .order_by(Dataset.id)\
+        .all()
+    return [tuple(row) for row in rows]
+
+
+def get_user_tests_operations(session, contest_id=None,
+                              min_user_test_id=None):
     """Return all the operations to do for user tests in the contest.
 
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    min_user_test_id (int|None): if given, get operations only for
+        the user tests with at least this id.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -412,6 +436,8 @@ def get_user_tests_operations(session, contest_id=None):
         contest_filter = literal(True)
     else:
         contest_filter = Task.contest_id == contest_id
+    if min_user_test_id is not None:
+        contest_filter &= UserTest.id >= min_user_test_id
 
     # Retrieve the compilation operations for all user tests without
     # the corresponding result for a dataset to judge. Since we have
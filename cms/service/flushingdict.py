@@ -18,41 +18,185 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""A dict flushing its content to a callback, optionally journaled.
+
+"""
+
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
 import gevent
+import io
+import json
 import logging
+import os
 
-from datetime import datetime, timedelta
 from gevent.lock import RLock
 
+from cmscommon.datetime import monotonic_time
+
 
 logger = logging.getLogger(__name__)
 
 
+class Journal(object):
+    """An append-only file keeping the key-values of a FlushingDict.
+
+    Every key-value added to the dict is appended to the file, as a
+    line of JSON, before being added. When a flush starts, the file is
+    renamed (with a ".flushing" suffix) and a new one is started; the
+    renamed file is deleted after the flush succeeded. Hence, the
+    key-values not yet flushed are always in one of the two files, and
+    can be recovered after a crash.
+
+    Lines are flushed to the operating system as they are written, so
+    they survive a crash of the process (but not necessarily of the
+    machine).
+
+    """
+
+    def __init__(self, path, encode, decode):
+        """Create a journal.
+
+        path (unicode): the file to use.
+        encode (function): takes a key and a value and returns an
+            object representing them that can be dumped to JSON.
+        decode (function): takes an object returned by encode and
+            returns the key and the value.
+
+        """
+        self.path = path
+        self.flushing_path = path + ".flushing"
+        self.encode = encode
+        self.decode = decode
+        self._file = None
+
+    def replay(self):
+        """Return the key-values in the journal, and start it anew.
+
+        return ([(object, object)]): the key-values in the journal, in
+            the order they were added.
+
+        """
+        items = []
+        for path in [self.flushing_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with io.open(path, "rb") as f:
+                for line in f:
+                    try:
+                        items.append(self.decode(json.loads(line)))
+                    except Exception:
+                        # The last line is incomplete if we crashed
+                        # while writing it.
+                        logger.warning("Cannot read line of journal %s, "
+                                       "skipping it.", path, exc_info=True)
+
+        # Write back what we found in a single file.
+        self._file = io.open(self.path + ".new", "wb")
+        for key, value in items:
+            self.append(key, value)
+        os.rename(self.path + ".new", self.path)
+        if os.path.exists(self.flushing_path):
+            os.remove(self.flushing_path)
+
+        logger.info("Recovered %d items from journal %s.",
+                    len(items), self.path)
+        return items
+
+    def append(self, key, value):
+        """Write a key-value at the end of the journal.
+
+        key (object): the key.
+        value (object): the value.
+
+        """
+        self._file.write(json.dumps(self.encode(key, value)) + b"\n")
+        self._file.flush()
+
+    def rotate(self):
+        """Put aside the current content, as a flush is starting."""
+        self._file.close()
+        os.rename(self.path, self.flushing_path)
+        self._file = io.open(self.path, "ab")
+
+    def commit(self):
+        """Delete the content put aside, as the flush has ended."""
+        os.remove(self.flushing_path)
+
+
 class FlushingDict(object):
     """A dict that periodically flushes its content to a callback.
 
     The dict flushes after a specified time since the latest entry
-    was added, or when it has reached its maximum size.
+    was added, when its oldest entry has waited for a maximum time, or
+    when it has reached its size.
+
+    The size adapts to how long the callback takes: while a flush is
+    running, new entries accumulate, and the size is raised so that
+    no more than about WRITING_FRACTION of the time is spent flushing
+    (up to a maximum size); when the callback becomes faster, the
+    size goes back down. If the callback fails, the entries are kept
+    and flushed again later.
+
+    Producers can call wait_for_room to be blocked while too many
+    entries are waiting to be flushed (backpressure).
 
     This dict is thread safe. Keys must be hashable. New values for an
     existing keys will overwrite the previous values.
 
     """
 
-    def __init__(self, size, flush_latency_seconds, callback):
-        # Elements contained in the dict that force a flush.
+    # Fraction of the time we aim to spend in the callback at most.
+    WRITING_FRACTION = 0.5
+
+    # Weight of the last flush in the moving averages.
+    SMOOTHING = 0.3
+
+    def __init__(self, size, flush_latency_seconds, callback,
+                 max_size=None, max_age_seconds=None, max_pending=None,
+                 journal=None):
+        """Create a flushing dict.
+
+        size (int): the number of elements that forces a flush.
+        flush_latency_seconds (float): how long we wait for other
+            elements after the latest one before flushing.
+        callback (function): the function receiving the elements, as
+            a list of key-value pairs.
+        max_size (int|None): the maximum the size can adapt to; if
+            None, the size doesn't change.
+        max_age_seconds (float|None): the maximum time an element
+            waits before a flush starts; if None, unbounded.
+        max_pending (int|None): the number of elements waiting to be
+            flushed over which wait_for_room blocks; if None,
+            unbounded.
+        journal (Journal|None): the journal where to keep the elements
+            until they are flushed; the elements it contains are added
+            to the dict immediately.
+
+        """
+        # Elements contained in the dict that force a flush, and the
+        # bounds of this number.
+        self.min_size = size
+        self.max_size = max_size if max_size is not None else size
         self.size = size
 
-        # How much time we wait for other key-values before flushing.
-        self.flush_latency = timedelta(seconds=flush_latency_seconds)
+        # How much time we wait for other key-values before flushing,
+        # and how long a key-value can wait at most.
+        self.flush_latency = flush_latency_seconds
+        self.max_age = max_age_seconds
+
+        # How many key-values can be waiting before the producers are
+        # asked to wait.
+        self.max_pending = max_pending
 
         # Function to flush the data to.
         self.callback = callback
 
+        # Where to keep the key-values until they are flushed.
+        self.journal = journal
+
         # This contains all the key-values received and not yet
         # flushed.
         self.d = dict()
@@ -60,44 +204,162 @@ class FlushingDict(object):
         # This contains all the key-values that are currently being flushed
         self.fd = dict()
 
-        # The greenlet that checks if the dict should be flushed or not
-        # TODO: do something if the FlushingDict is deleted
-        self.flush_greenlet = gevent.spawn(self._check_flush)
-
         # This lock ensures that if a key-value arrives while flush is
         # executing, it is not inserted in the dict until flush
         # terminates.
         self.d_lock = RLock()
 
-        # Time when an item was last inserted in the dict
-        self.last_insert = datetime.now()
+        # Time when an item was last inserted in the dict, and when
+        # the oldest item in it was inserted.
+        self.last_insert = monotonic_time()
+        self.first_insert = None
+
+        # Statistics on the flushes and on the backpressure.
+        self.flushes = 0
+        self.failures = 0
+        self.flush_time = None
+        self.waits = 0
+
+        if self.journal is not None:
+            for key, value in self.journal.replay():
+                self._add(key, value)
+
+        # The greenlet that checks if the dict should be flushed or not
+        # TODO: do something if the FlushingDict is deleted
+        self.flush_greenlet = gevent.spawn(self._check_flush)
 
     def add(self, key, value):
         logger.debug("Adding item %s", key)
         with self.d_lock:
-            self.d[key] = value
-            self.last_insert = datetime.now()
+            if self.journal is not None:
+                self.journal.append(key, value)
+            self._add(key, value)
+
+    def _add(self, key, value):
+        """Add a key-value, without writing it to the journal.
+
+        key (object): the key.
+        value (object): the value.
+
+        """
+        now = monotonic_time()
+        if len(self.d) == 0:
+            self.first_insert = now
+        self.d[key] = value
+        self.last_insert = now
+
+    def wait_for_room(self):
+        """Block until the elements waiting are not too many."""
+        if self.max_pending is None or len(self.d) < self.max_pending:
+            return
+        logger.warning("%d results are waiting to be flushed, waiting "
+                       "for them before accepting more.", len(self.d))
+        self.waits += 1
+        while len(self.d) >= self.max_pending:
+            gevent.sleep(0.05)
 
     def flush(self):
+        """Pass the key-values to the callback.
+
+        return (bool): whether the callback succeeded; if not, the
+            key-values are added back (unless they have been replaced
+            in the meantime).
+
+        """
         logger.debug("Flushing items")
         with self.d_lock:
             self.fd = self.d
             self.d = dict()
-        self.callback(self.fd.items())
-        self.fd = dict()
+            if self.journal is not None:
+                self.journal.rotate()
+
+        start = monotonic_time()
+        try:
+            self.callback(self.fd.items())
+        except Exception:
+            logger.error("Failed to flush %d items, will try again.",
+                         len(self.fd), exc_info=True)
+            self.failures += 1
+            with self.d_lock:
+                for key, value in self.fd.iteritems():
+                    if key not in self.d:
+                        self.add(key, value)
+                if self.journal is not None:
+                    self.journal.commit()
+                self.fd = dict()
+            return False
+        elapsed = monotonic_time() - start
+
+        with self.d_lock:
+            if self.journal is not None:
+                self.journal.commit()
+            self._adapt(elapsed)
+            self.fd = dict()
+        return True
+
+    def _adapt(self, elapsed):
+        """Update the statistics and the size after a flush.
+
+        elapsed (float): how many seconds the flush took.
+
+        """
+        self.flushes += 1
+        if self.flush_time is None:
+            self.flush_time = elapsed
+        else:
+            self.flush_time += \
+                FlushingDict.SMOOTHING * (elapsed - self.flush_time)
+
+        # The elements received during the flush would have been
+        # about WRITING_FRACTION of those received if we had waited
+        # for the target size.
+        target = len(self.d) / FlushingDict.WRITING_FRACTION
+        size = self.size + FlushingDict.SMOOTHING * (target - self.size)
+        self.size = int(min(max(size, self.min_size), self.max_size))
+
+    def get_status(self):
+        """Return the state of the dict and its statistics.
+
+        return (dict): the elements waiting and being flushed, the
+            current size, the number of flushes and failed flushes,
+            the average seconds taken by a flush and how many times
+            producers had to wait.
+
+        """
+        return {
+            "waiting": len(self.d),
+            "flushing": len(self.fd),
+            "size": self.size,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "flush_time": self.flush_time,
+            "waits": self.waits,
+        }
 
     def __contains__(self, key):
         with self.d_lock:
             return key in self.d or key in self.fd
 
+    def _should_flush(self):
+        """Return whether a flush should start now.
+
+        return (bool): whether to flush.
+
+        """
+        if len(self.d) == 0:
+            return False
+        now = monotonic_time()
+        return len(self.d) >= self.size or \
+            now - self.last_insert > self.flush_latency or \
+            (self.max_age is not None and
+             now - self.first_insert > self.max_age)
+
     def _check_flush(self):
         while True:
             while True:
                 with self.d_lock:
-                    since_last_insert = datetime.now() - self.last_insert
-                    if len(self.d) != 0 and (
-                            len(self.d) >= self.size or
-                            since_last_insert > self.flush_latency):
+                    if self._should_flush():
                         break
                 gevent.sleep(0.05)
-            self.flush()
+            if not self.flush():
+                gevent.sleep(self.flush_latency)
@@ -33,24 +33,60 @@ from __future__ import unicode_literals
 import logging
 import random
 
+from collections import OrderedDict
 from datetime import timedelta
 
 import gevent.lock
 
 from gevent.event import Event
 
-from cms.db import Dataset, SessionGen, Submission, UserTest
-from cms.grading.Job import Job, JobGroup
-from cmscommon.datetime import make_datetime, make_timestamp
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload, subqueryload
+
+from cms.db import Dataset, SessionGen, Submission, SubmissionResult, \
+    Task, UserTest, UserTestResult
+from cms.grading.Job import Job, JobGroup, \
+    compact_job_dict, get_job_template
+from cmscommon.datetime import make_datetime, make_timestamp, \
+    monotonic_time
 
 
 logger = logging.getLogger(__name__)
 
 
+# Query computing a fingerprint of the data of each dataset used to
+# build jobs, which changes whenever any of it does. The NULLs are
+# written as "-" (not skipped, so that they can't be confused with
+# the next field), and concat_ws is avoided, as PostgreSQL 9.0 lacks
+# it.
+DATASET_VERSION_QUERY = """
+SELECT d.id, md5(
+    coalesce(d.time_limit::text, '-') || '|'
+    || coalesce(d.memory_limit::text, '-') || '|'
+    || d.task_type || '|' || d.task_type_parameters || '|'
+    || coalesce((SELECT string_agg(m.id || ':' || m.filename || ':'
+                                   || m.digest, ',' ORDER BY m.id)
+                 FROM managers AS m WHERE m.dataset_id = d.id), '-')
+    || '|'
+    || coalesce((SELECT string_agg(t.id || ':' || t.codename || ':'
+                                   || t.input || ':' || t.output, ','
+                                   ORDER BY t.id)
+                 FROM testcases AS t WHERE t.dataset_id = d.id), '-'))
+FROM datasets AS d
+WHERE d.id = ANY(:dataset_ids)
+"""
+
+
 class WorkerPool(object):
     """This class keeps the state of the workers attached to ES, and
     allow the ES to get a usable worker when it needs it.
 
+    A Worker can run several job groups at the same time, one in each
+    of its execution slots (see Worker.get_slots). The pool considers
+    each slot as a worker by itself, identified by a pair (shard of
+    the Worker, index of the slot); a Worker has one slot until it
+    tells us otherwise.
+
     """
 
     WORKER_INACTIVE = None
@@ -59,31 +95,46 @@ class WorkerPool(object):
     # Seconds after which we declare a worker stale.
     WORKER_TIMEOUT = timedelta(seconds=600)
 
+    # Number of keys (digests of files, and submissions and user
+    # tests) remembered for each worker as a guess of what its cache
+    # contains.
+    AFFINITY_SUMMARY_SIZE = 10000
+
+    # Seconds we can wait for a busy worker likely to have in its
+    # cache more of the files needed by some operations than the idle
+    # workers, before giving the operations to one of them anyway.
+    AFFINITY_MAX_WAIT = 1.0
+
     def __init__(self, service):
         """service (Service): the EvaluationService using this
         WorkerPool.
 
         """
         self._service = service
+        # The connections to the Workers, and how many slots they
+        # have, by shard.
+        # Type: {int: RemoteServiceClient}
         self._worker = {}
+        # Type: {int: int}
+        self._slot_count = {}
         # These dictionary stores data about the workers (identified
-        # by their shard number). Schedule disabling to True means
-        # that we are going to disable the worker as soon as possible
-        # (when it finishes the current operations). The current
-        # operations are also discarded because we already re-assigned
-        # it. Ignore is true if the next results coming from the
+        # by their slot, a pair of shard and index). Schedule disabling
+        # to True means that we are going to disable the worker as soon
+        # as possible (when it finishes the current operations). The
+        # current operations are also discarded because we already
+        # re-assigned it. Ignore is true if the next results coming from the
         # worker should be discarded. Operations is the list of
         # operations currently executing. Operations to ignore is the
         # list of operations to ignore in the next batch of results.
-        # Type: {int: [ESOperation]}
+        # Type: {(int, int): [ESOperation]}
         self._operations = {}
-        # Type: {int: [ESOperation]}
+        # Type: {(int, int): [ESOperation]}
         self._operations_to_ignore = {}
-        # Type: {int: Datetime|None}
+        # Type: {(int, int): Datetime|None}
         self._start_time = {}
-        # Type: {int: bool}
+        # Type: {(int, int): bool}
         self._schedule_disabling = {}
-        # Type: {int: bool}
+        # Type: {(int, int): bool}
         self._ignore = {}
 
         # TODO: given the number of pieces data associated to each
@@ -94,8 +145,8 @@ class WorkerPool(object):
         # checks cannot be excluded. A refactoring of this class
         # should take that into account.
 
-        # A reverse lookup dictionary mapping operations to shards.
-        # Type: {ESOperation: int}
+        # A reverse lookup dictionary mapping operations to slots.
+        # Type: {ESOperation: (int, int)}
         self._operations_reverse = dict()
 
         # A lock to ensure that the reverse lookup stays in sync with
@@ -108,44 +159,110 @@ class WorkerPool(object):
         # set does not mean that there is a worker available.
         self._workers_available_event = Event()
 
+        # Datasets (with their managers and testcases) used to build
+        # the jobs, detached from any session, with their version and
+        # the template of their jobs.
+        # Type: {int: (unicode, Dataset, {string: object})}
+        self._dataset_cache = dict()
+
+        # For each Worker (as all its slots share its cache), the keys
+        # of what it received recently (the digests of the files, and
+        # the submissions and user tests, standing for their files),
+        # from the least recent.
+        # Type: {int: OrderedDict}
+        self._recent = {}
+        # For each Worker, how many of the keys of its operations were
+        # already in its summary, and how many there were.
+        # Type: {int: [int, int]}
+        self._cache_hits = {}
+        # Time since which we are waiting for a busy worker, if we are.
+        # Type: float|None
+        self._affinity_wait_start = None
+
     def __len__(self):
-        return len(self._worker)
+        return len(self._operations)
 
     def __contains__(self, operation):
         return operation in self._operations_reverse
 
-    def _remove_operations(self, shard, new_operation):
+    def _remove_operations(self, slot, new_operation):
         """Safely remove operations from a worker, assigning a new status.
 
-        shard (int): the worker from which to remove operations.
+        slot ((int, int)): the worker from which to remove operations.
         new_operations (unicode|None): the new operation, which can be
             INACTIVE or DISABLED.
 
         """
         with self._operation_lock:
-            operations = self._operations[shard]
-            self._operations[shard] = new_operation
+            operations = self._operations[slot]
+            self._operations[slot] = new_operation
             if isinstance(operations, list):
                 for operation in operations:
                     del self._operations_reverse[operation]
 
-    def _add_operations(self, shard, operations):
+    def _add_operations(self, slot, operations):
         """Assigns new operations to a currently inactive worker.
 
-        shard (int): shard of the worker.
+        slot ((int, int)): the worker.
         operations ([ESOperation]) operations to assign to the worker.
 
         """
-        if self._operations[shard] != WorkerPool.WORKER_INACTIVE:
-            raise ValueError("Shard %s is already doing an operation.", shard)
+        if self._operations[slot] != WorkerPool.WORKER_INACTIVE:
+            raise ValueError("Slot %s is already doing an operation.", slot)
         with self._operation_lock:
-            self._operations[shard] = operations
+            self._operations[slot] = operations
             for operation in operations:
-                self._operations_reverse[operation] = shard
+                self._operations_reverse[operation] = slot
+
+    def _get_slots(self, shard):
+        """Return the slots of a Worker.
+
+        shard (int): the shard of the Worker.
+
+        return ([(int, int)]): its slots, including those about to be
+            removed.
+
+        """
+        return sorted(slot for slot in self._operations if slot[0] == shard)
+
+    def _add_slot(self, slot, operation):
+        """Start keeping the state of a slot.
+
+        slot ((int, int)): the slot.
+        operation (unicode|None): its status, INACTIVE or DISABLED.
+
+        """
+        self._operations[slot] = operation
+        self._operations_to_ignore[slot] = []
+        self._start_time[slot] = None
+        self._schedule_disabling[slot] = False
+        self._ignore[slot] = False
+
+    def _remove_slot(self, slot):
+        """Stop keeping the state of a slot, which must have no
+        operations.
+
+        slot ((int, int)): the slot.
+
+        """
+        del self._operations[slot]
+        del self._operations_to_ignore[slot]
+        del self._start_time[slot]
+        del self._schedule_disabling[slot]
+        del self._ignore[slot]
 
     def wait_for_workers(self):
-        """Wait until a worker might be available."""
-        self._workers_available_event.wait()
+        """Wait until a worker might be available.
+
+        If we are waiting for a busy worker, return anyway as soon as
+        we have waited enough to give up on it.
+
+        """
+        timeout = None
+        if self._affinity_wait_start is not None:
+            timeout = max(0.0, self._affinity_wait_start +
+                          WorkerPool.AFFINITY_MAX_WAIT - monotonic_time())
+        self._workers_available_event.wait(timeout)
 
     def add_worker(self, worker_coord):
         """Add a new worker to the worker pool.
@@ -160,11 +277,10 @@ class WorkerPool(object):
             on_connect=self.on_worker_connected)
 
         # And we fill all data.
-        self._operations[shard] = WorkerPool.WORKER_INACTIVE
-        self._operations_to_ignore[shard] = []
-        self._start_time[shard] = None
-        self._schedule_disabling[shard] = False
-        self._ignore[shard] = False
+        self._slot_count[shard] = 1
+        self._add_slot((shard, 0), WorkerPool.WORKER_INACTIVE)
+        self._recent[shard] = OrderedDict()
+        self._cache_hits[shard] = [0, 0]
         self._workers_available_event.set()
         logger.debug("Worker %s added.", shard)
 
@@ -179,6 +295,9 @@ class WorkerPool(object):
         """
         shard = worker_coord.shard
         logger.info("Worker %s online again.", shard)
+        # The Worker could have been restarted with a different
+        # number of slots.
+        self._worker[shard].get_slots(callback=self._on_slots, plus=shard)
         if self._service.contest_id is not None:
             self._worker[shard].precache_files(
                 contest_id=self._service.contest_id
@@ -190,6 +309,49 @@ class WorkerPool(object):
         # so we wake up the consumers.
         self._workers_available_event.set()
 
+    def _on_slots(self, slots, shard, error=None):
+        """Callback for the number of slots of a Worker.
+
+        slots (int): the number of slots.
+        shard (int): the shard of the Worker.
+        error (unicode|None): the error, if any.
+
+        """
+        if error is not None:
+            logger.warning("Cannot get the number of slots of worker %s, "
+                           "assuming it has one: %s.", shard, error)
+            return
+        self.set_slot_count(shard, slots)
+
+    def set_slot_count(self, shard, slots):
+        """Set how many operations a Worker can run at the same time.
+
+        New slots are enabled only if the Worker is (that is, if its
+        first slot is); extra slots are removed as soon as they have no
+        operations.
+
+        shard (int): the shard of the Worker.
+        slots (int): the number of its slots.
+
+        """
+        slots = max(slots, 1)
+        if slots == self._slot_count[shard]:
+            return
+        logger.info("Worker %s has %d slots.", shard, slots)
+        self._slot_count[shard] = slots
+        if self._operations[(shard, 0)] == WorkerPool.WORKER_DISABLED:
+            status = WorkerPool.WORKER_DISABLED
+        else:
+            status = WorkerPool.WORKER_INACTIVE
+        for index in xrange(slots):
+            if (shard, index) not in self._operations:
+                self._add_slot((shard, index), status)
+        for slot in self._get_slots(shard):
+            if slot[1] >= slots and not isinstance(
+                    self._operations[slot], list):
+                self._remove_slot(slot)
+        self._workers_available_event.set()
+
     def acquire_worker(self, operations):
         """Tries to assign an operation to an available worker. If no workers
         are available then this returns None, otherwise this returns
@@ -197,59 +359,316 @@ class WorkerPool(object):
 
         operations ([ESOperation]): the operations to assign to a worker.
 
-        return (int|None): None if no workers are available, the worker
-            assigned to the operation otherwise.
+        return ((int, int)|None): None if no workers are available (or
+            we are waiting for a busy worker, see _choose_worker), the
+            worker assigned to the operation otherwise.
 
         """
-        # We look for an available worker.
-        try:
-            shard = self.find_worker(WorkerPool.WORKER_INACTIVE,
-                                     require_connection=True,
-                                     random_worker=True)
-        except LookupError:
+        # We look for the available worker most likely to have the
+        # files needed in its cache.
+        slot = self._choose_worker(self._get_affinity_keys(operations))
+        if slot is None:
             self._workers_available_event.clear()
             return None
+        shard = slot[0]
 
         # Then we fill the info for future memory.
-        self._add_operations(shard, operations)
-
-        logger.debug("Worker %s acquired.", shard)
-        self._start_time[shard] = make_datetime()
+        self._add_operations(slot, operations)
+        self._start_time[slot] = make_datetime()
 
         with SessionGen() as session:
             jobs = []
-            datasets = {}
-            submissions = {}
-            user_tests = {}
+            datasets = self._get_datasets(
+                session, set(operation.dataset_id
+                             for operation in operations))
+            submissions = self._get_submissions(
+                session, set(operation.object_id for operation in operations
+                             if operation.for_submission()))
+            user_tests = self._get_user_tests(
+                session, set(operation.object_id for operation in operations
+                             if not operation.for_submission()))
             for operation in operations:
-                if operation.dataset_id not in datasets:
-                    datasets[operation.dataset_id] = Dataset.get_from_id(
-                        operation.dataset_id, session)
-                object_ = None
                 if operation.for_submission():
-                    if operation.object_id not in submissions:
-                        submissions[operation.object_id] = \
-                            Submission.get_from_id(
-                                operation.object_id, session)
-                    object_ = submissions[operation.object_id]
+                    object_ = submissions.get(operation.object_id)
                 else:
-                    if operation.object_id not in user_tests:
-                        user_tests[operation.object_id] = \
-                            UserTest.get_from_id(operation.object_id, session)
-                    object_ = user_tests[operation.object_id]
-                logger.info("Asking worker %s to `%s'.", shard, operation)
+                    object_ = user_tests.get(operation.object_id)
+                logger.info("Asking worker %s to `%s'.",
+                            WorkerPool._repr_slot(slot), operation)
 
                 jobs.append(Job.from_operation(
-                    operation, object_, datasets[operation.dataset_id]))
+                    operation, object_, datasets.get(operation.dataset_id)))
             job_group_dict = JobGroup(jobs).export_to_dict()
 
+            keys = set(WorkerPool._get_object_key(operation)
+                       for operation in operations)
+            for job in jobs:
+                keys.update(job.get_digests())
+        self._remember(shard, keys)
+
+        # Workers know the templates of the datasets (or fetch them
+        # once), so we send only what is specific to each job.
+        for operation, job_dict in zip(operations, job_group_dict["jobs"]):
+            version, _, template = self._dataset_cache[operation.dataset_id]
+            compact_job_dict(job_dict, operation.dataset_id, version,
+                             template)
+
         self._worker[shard].execute_job_group(
             job_group_dict=job_group_dict,
             callback=self._service.action_finished,
-            plus=shard)
-        return shard
+            plus=slot)
+
+        # We may have waited for a busy worker, letting the consumers
+        # sleep while other workers were idle.
+        if any(operation == WorkerPool.WORKER_INACTIVE
+               for operation in self._operations.itervalues()):
+            self._workers_available_event.set()
+        return slot
+
+    @staticmethod
+    def _repr_slot(slot):
+        """Return a representation of a slot for logs and status.
+
+        slot ((int, int)): the slot.
+
+        return (unicode): the shard of the Worker, followed by the
+            index of the slot if it is not the first one.
+
+        """
+        if slot[1] == 0:
+            return "%d" % slot[0]
+        return "%d.%d" % slot
+
+    @staticmethod
+    def _get_object_key(operation):
+        """Return the key of the submission or user test of an operation.
+
+        operation (ESOperation): the operation.
+
+        return ((unicode, int)): the key.
+
+        """
+        if operation.for_submission():
+            return ("submission", operation.object_id)
+        else:
+            return ("user_test", operation.object_id)
+
+    def _get_affinity_keys(self, operations):
+        """Return the keys of what some operations need.
+
+        Before building the jobs we only know the digests of the
+        managers and of the testcases of the datasets in the cache:
+        the files and executables of submissions and user tests are
+        represented by their keys.
+
+        operations ([ESOperation]): the operations.
+
+        return (set): the keys.
+
+        """
+        keys = set()
+        for operation in operations:
+            keys.add(WorkerPool._get_object_key(operation))
+            cached = self._dataset_cache.get(operation.dataset_id)
+            if cached is None:
+                continue
+            template = cached[2]
+            keys.update(template["managers"].itervalues())
+            if operation.testcase_codename in template["testcases"]:
+                keys.update(
+                    template["testcases"][operation.testcase_codename])
+        return keys
+
+    def _choose_worker(self, keys):
+        """Choose the worker to assign some operations to.
+
+        We choose the idle worker that recently received the most of
+        the keys, at random among ties. If a busy worker received more
+        of them, we rather wait for it, but for at most
+        AFFINITY_MAX_WAIT seconds.
+
+        keys (set): the keys of what the operations need.
+
+        return ((int, int)|None): the chosen worker, or None if no
+            worker is available or we are waiting for a busy one.
+
+        """
+        scores = dict()
+        idle = []
+        for slot, operation in self._operations.iteritems():
+            shard = slot[0]
+            if operation == WorkerPool.WORKER_DISABLED \
+                    or self._schedule_disabling[slot] \
+                    or slot[1] >= self._slot_count[shard] \
+                    or not self._worker[shard].connected:
+                continue
+            if shard not in scores:
+                recent = self._recent[shard]
+                scores[shard] = sum(1 for key in keys if key in recent)
+            if operation == WorkerPool.WORKER_INACTIVE:
+                idle.append(slot)
+        if len(idle) == 0:
+            # There is nothing to fall back to, so we don't need to
+            # count the time we wait.
+            self._affinity_wait_start = None
+            return None
+
+        best = max(scores[slot[0]] for slot in idle)
+        if best < max(scores.itervalues()):
+            now = monotonic_time()
+            if self._affinity_wait_start is None:
+                self._affinity_wait_start = now
+            if now - self._affinity_wait_start < WorkerPool.AFFINITY_MAX_WAIT:
+                return None
+        self._affinity_wait_start = None
+        return random.choice([slot for slot in idle
+                              if scores[slot[0]] == best])
+
+    def _remember(self, shard, keys):
+        """Record that a worker received what some keys stand for.
+
+        Also log the fraction of them the worker likely had already.
+
+        shard (int): the worker.
+        keys (set): the keys.
+
+        """
+        recent = self._recent[shard]
+        hits = sum(1 for key in keys if key in recent)
+        self._cache_hits[shard][0] += hits
+        self._cache_hits[shard][1] += len(keys)
+        logger.info("Worker %s acquired, likely having in its cache %d "
+                    "out of %d of the files needed.", shard, hits, len(keys))
 
-    def release_worker(self, shard):
+        for key in keys:
+            recent.pop(key, None)
+            recent[key] = None
+        while len(recent) > WorkerPool.AFFINITY_SUMMARY_SIZE:
+            recent.popitem(last=False)
+
+    def _get_datasets(self, session, dataset_ids):
+        """Return the datasets needed to build some jobs.
+
+        The datasets are loaded together with their managers and
+        testcases, and kept between calls as long as their version
+        (checked with a single query) doesn't change.
+
+        session (Session): the session to use.
+        dataset_ids ({int}): the ids of the datasets.
+
+        return ({int: Dataset}): the datasets that exist, detached from
+            any session.
+
+        """
+        versions = dict(session.execute(
+            text(DATASET_VERSION_QUERY),
+            {"dataset_ids": list(dataset_ids)}).fetchall())
+
+        to_load = list(dataset_id for dataset_id, version
+                       in versions.iteritems()
+                       if self._dataset_cache.get(
+                           dataset_id, (None,))[0] != version)
+        if len(to_load) > 0:
+            for dataset in session.query(Dataset)\
+                    .filter(Dataset.id.in_(to_load))\
+                    .options(subqueryload(Dataset.managers))\
+                    .options(subqueryload(Dataset.testcases))\
+                    .all():
+                # Managers and testcases are expunged too, by cascade.
+                session.expunge(dataset)
+                self._dataset_cache[dataset.id] = \
+                    (versions[dataset.id], dataset, get_job_template(dataset))
+
+        for dataset_id in dataset_ids:
+            if dataset_id not in versions:
+                self._dataset_cache.pop(dataset_id, None)
+        return dict((dataset_id, self._dataset_cache[dataset_id][1])
+                    for dataset_id in versions
+                    if dataset_id in self._dataset_cache)
+
+    def get_job_template(self, dataset_id):
+        """Return the current template of the jobs of a dataset.
+
+        dataset_id (int): the id of the dataset.
+
+        return ((unicode, {string: object})|None): the version of the
+            dataset and the template, or None if the dataset doesn't
+            exist.
+
+        """
+        with SessionGen() as session:
+            self._get_datasets(session, set([dataset_id]))
+        if dataset_id not in self._dataset_cache:
+            return None
+        version, _, template = self._dataset_cache[dataset_id]
+        return version, template
+
+    def get_cached_job_template(self, dataset_id, version):
+        """Return the template of the jobs of a dataset, if known.
+
+        dataset_id (int): the id of the dataset.
+        version (unicode): the version of the dataset.
+
+        return ({string: object}|None): the template of that version
+            of the dataset, if it is still the one in the cache.
+
+        """
+        cached = self._dataset_cache.get(dataset_id)
+        if cached is None or cached[0] != version:
+            return None
+        return cached[2]
+
+    @staticmethod
+    def _get_submissions(session, submission_ids):
+        """Load the submissions needed to build some jobs.
+
+        Their files, task, contest, results and executables are loaded
+        in the same few queries.
+
+        session (Session): the session to use.
+        submission_ids ({int}): the ids of the submissions.
+
+        return ({int: Submission}): the submissions that exist.
+
+        """
+        if len(submission_ids) == 0:
+            return dict()
+        return dict((submission.id, submission) for submission in
+                    session.query(Submission)
+                    .filter(Submission.id.in_(submission_ids))
+                    .options(joinedload(Submission.task)
+                             .joinedload(Task.contest))
+                    .options(subqueryload(Submission.files))
+                    .options(subqueryload(Submission.results)
+                             .subqueryload(SubmissionResult.executables))
+                    .all())
+
+    @staticmethod
+    def _get_user_tests(session, user_test_ids):
+        """Load the user tests needed to build some jobs.
+
+        Their files, managers, task, contest, results and executables
+        are loaded in the same few queries.
+
+        session (Session): the session to use.
+        user_test_ids ({int}): the ids of the user tests.
+
+        return ({int: UserTest}): the user tests that exist.
+
+        """
+        if len(user_test_ids) == 0:
+            return dict()
+        return dict((user_test.id, user_test) for user_test in
+                    session.query(UserTest)
+                    .filter(UserTest.id.in_(user_test_ids))
+                    .options(joinedload(UserTest.task)
+                             .joinedload(Task.contest))
+                    .options(subqueryload(UserTest.files))
+                    .options(subqueryload(UserTest.managers))
+                    .options(subqueryload(UserTest.results)
+                             .subqueryload(UserTestResult.executables))
+                    .all())
+
+    def release_worker(self, slot):
         """To be called by ES when it receives a notification that an
         operation finished.
 
@@ -257,42 +676,76 @@ class WorkerPool(object):
         disable it, and notify the ES to discard the outcome obtained
         by the worker.
 
-        shard (int): the worker to release.
+        slot ((int, int)): the worker to release.
 
         return (bool|[ESOperation]): if boolean, whether the result is
             to be ignored; if a list, the list of operation for which
             the results should be ignored.
 
         """
-        if self._operations[shard] == WorkerPool.WORKER_INACTIVE:
+        if self._operations[slot] == WorkerPool.WORKER_INACTIVE:
             err_msg = "Trying to release worker while it's inactive."
             logger.error(err_msg)
             raise ValueError(err_msg)
 
         # If the worker has already been disabled, ignore the result
         # and keep the worker disabled.
-        if self._operations[shard] == WorkerPool.WORKER_DISABLED:
+        if self._operations[slot] == WorkerPool.WORKER_DISABLED:
             return True
 
-        ret = self._ignore[shard]
+        ret = self._ignore[slot]
         with self._operation_lock:
-            to_ignore = self._operations_to_ignore[shard]
-            self._operations_to_ignore[shard] = []
-        self._start_time[shard] = None
-        self._ignore[shard] = False
-        if self._schedule_disabling[shard]:
-            self._remove_operations(shard, WorkerPool.WORKER_DISABLED)
-            self._schedule_disabling[shard] = False
-            logger.info("Worker %s released and disabled.", shard)
+            to_ignore = self._operations_to_ignore[slot]
+            self._operations_to_ignore[slot] = []
+        self._start_time[slot] = None
+        self._ignore[slot] = False
+        if self._schedule_disabling[slot]:
+            self._remove_operations(slot, WorkerPool.WORKER_DISABLED)
+            self._schedule_disabling[slot] = False
+            logger.info("Worker %s released and disabled.",
+                        WorkerPool._repr_slot(slot))
         else:
-            self._remove_operations(shard, WorkerPool.WORKER_INACTIVE)
+            self._remove_operations(slot, WorkerPool.WORKER_INACTIVE)
             self._workers_available_event.set()
-            logger.debug("Worker %s released.", shard)
+            logger.debug("Worker %s released.", WorkerPool._repr_slot(slot))
+        # The Worker may have lost this slot while it was busy.
+        if slot[1] >= self._slot_count[slot[0]]:
+            self._remove_slot(slot)
         if ret is False and to_ignore != []:
             return to_ignore
         else:
             return ret
 
+    def get_usable_count(self):
+        """Return the number of workers that can take operations.
+
+        return (int): the number of slots of connected workers that
+            are not disabled (or about to be).
+
+        """
+        return sum(1 for slot, operation in self._operations.iteritems()
+                   if operation != WorkerPool.WORKER_DISABLED
+                   and not self._schedule_disabling[slot]
+                   and slot[1] < self._slot_count[slot[0]]
+                   and self._worker[slot[0]].connected)
+
+    def get_current_batch(self, slot):
+        """Return the operations of a worker, and since when it has them.
+
+        slot ((int, int)): the worker.
+
+        return (([ESOperation], float)|None): the operations assigned
+            to the worker and the seconds since then, or None if the
+            worker has no operations.
+
+        """
+        operations = self._operations[slot]
+        if not isinstance(operations, list) \
+                or self._start_time[slot] is None:
+            return None
+        elapsed = make_datetime() - self._start_time[slot]
+        return operations, elapsed.total_seconds()
+
     def find_worker(self, operation, require_connection=False,
                     random_worker=False):
         """Return a worker whose assigned operation is operation.
@@ -308,18 +761,19 @@ class WorkerPool(object):
         random_worker (bool): if True, choose uniformly amongst all
             workers doing the operation.
 
-        returns (int): the shard of a worker working on operation.
+        returns ((int, int)): the slot of a worker working on operation.
 
         raise (LookupError): if nothing has been found.
 
         """
         pool = []
-        for shard, worker_operation in self._operations.iteritems():
+        for slot, worker_operation in self._operations.iteritems():
             if worker_operation == operation:
-                if not require_connection or self._worker[shard].connected:
-                    pool.append(shard)
+                if not require_connection \
+                        or self._worker[slot[0]].connected:
+                    pool.append(slot)
                     if not random_worker:
-                        return shard
+                        return slot
         if pool == []:
             raise LookupError("No such operation.")
         else:
@@ -335,40 +789,63 @@ class WorkerPool(object):
         """
         try:
             with self._operation_lock:
-                shard = self._operations_reverse[operation]
-                self._operations_to_ignore[shard].append(operation)
+                slot = self._operations_reverse[operation]
+                self._operations_to_ignore[slot].append(operation)
         except LookupError:
             logger.debug("Asked to ignore operation `%s' "
                          "that cannot be found.", operation)
             raise
 
+    def ignore_operations(self, predicate):
+        """Mark all the operations satisfying a condition to be ignored.
+
+        predicate (function): a function taking an ESOperation and
+            returning whether to ignore it.
+
+        return (int): the number of operations marked.
+
+        """
+        with self._operation_lock:
+            operations = [operation for operation in self._operations_reverse
+                          if predicate(operation)]
+            for operation in operations:
+                slot = self._operations_reverse[operation]
+                self._operations_to_ignore[slot].append(operation)
+        return len(operations)
+
     def get_status(self):
         """Returns a dict with info about the current status of all
         workers.
 
-        return (dict): dict of info: current operation, starting time,
-            number of errors, and additional data specified in the
-            operation.
+        return (dict): dict of info, for each slot: the shard of its
+            worker, current operation, starting time, fraction of the
+            files sent to the worker likely found in the cache, and
+            additional data specified in the operation.
 
         """
         result = dict()
-        for shard in self._worker.keys():
-            s_time = self._start_time[shard]
+        for slot in sorted(self._operations.keys()):
+            shard = slot[0]
+            s_time = self._start_time[slot]
             s_time = make_timestamp(s_time) if s_time is not None else None
 
-            result["%d" % shard] = {
+            result[WorkerPool._repr_slot(slot)] = {
+                'shard': shard,
                 'connected': self._worker[shard].connected,
                 'operations': [operation.to_dict()
-                               for operation in self._operations[shard]]
-                if isinstance(self._operations[shard], list)
-                else self._operations[shard],
-                'start_time': s_time}
+                               for operation in self._operations[slot]]
+                if isinstance(self._operations[slot], list)
+                else self._operations[slot],
+                'start_time': s_time,
+                'cache_hits': float(self._cache_hits[shard][0]) /
+                self._cache_hits[shard][1]
+                if self._cache_hits[shard][1] > 0 else None}
         return result
 
     def check_timeouts(self):
         """Check if some worker is not responding in too much time. If
-        this is the case, the worker is scheduled for disabling, and
-        we send it a message trying to shut it down.
+        this is the case, the worker (with all its slots) is scheduled
+        for disabling, and we send it a message trying to shut it down.
 
         return ([ESOperation]): list of operations assigned to worker
             that timeout.
@@ -376,43 +853,67 @@ class WorkerPool(object):
         """
         now = make_datetime()
         lost_operations = []
-        for shard in self._worker:
-            if self._start_time[shard] is not None:
-                active_for = now - self._start_time[shard]
-
-                if active_for > WorkerPool.WORKER_TIMEOUT:
-                    # Here shard is a working worker with no sign of
-                    # intelligent life for too much time.
-                    logger.error("Disabling and shutting down "
-                                 "worker %d because of no response "
-                                 "in %s.", shard, active_for)
-                    is_busy = (self._operations[shard] !=
-                               WorkerPool.WORKER_INACTIVE and
-                               self._operations[shard] !=
-                               WorkerPool.WORKER_DISABLED)
-                    assert is_busy
-
-                    # We return the operation so ES can do what it needs.
-                    if not self._ignore[shard] and \
-                            isinstance(self._operations[shard], list):
-                        for operation in self._operations[shard]:
-                            if operation not in \
-                                    self._operations_to_ignore[shard]:
-                                lost_operations.append(operation)
-
-                    # Also, we are not trusting it, so we are not
-                    # assigning it new operations even if it comes back to
-                    # life.
-                    self._schedule_disabling[shard] = True
-                    self._ignore[shard] = True
-                    self.release_worker(shard)
-                    self._worker[shard].quit(
-                        reason="No response in %s." % active_for)
+        for slot in self._operations.keys():
+            if slot not in self._operations \
+                    or self._start_time[slot] is None:
+                continue
+            active_for = now - self._start_time[slot]
+
+            if active_for > WorkerPool.WORKER_TIMEOUT:
+                # Here slot is a working worker with no sign of
+                # intelligent life for too much time.
+                shard = slot[0]
+                logger.error("Disabling and shutting down "
+                             "worker %d because of no response "
+                             "in %s.", shard, active_for)
+
+                # We return the operations of all its slots so ES can
+                # do what it needs. Also, we are not trusting the
+                # worker, so we are not assigning it new operations
+                # even if it comes back to life.
+                for other_slot in self._get_slots(shard):
+                    if self._operations[other_slot] != \
+                            WorkerPool.WORKER_DISABLED:
+                        lost_operations += self._disable_slot(other_slot)
+                self._worker[shard].quit(
+                    reason="No response in %s." % active_for)
+
+        return lost_operations
+
+    def _disable_slot(self, slot):
+        """Disable a slot that is not disabled.
+
+        slot ((int, int)): the slot to disable.
+
+        return ([ESOperation]): list of non-ignored operations
+            assigned to the slot.
+
+        """
+        lost_operations = []
+        if self._operations[slot] == WorkerPool.WORKER_INACTIVE:
+            self._operations[slot] = WorkerPool.WORKER_DISABLED
+
+        else:
+            # We return all non-ignored operations so ES can do what
+            # it needs.
+            if not self._ignore[slot]:
+                to_ignore = self._operations_to_ignore[slot]
+                if isinstance(self._operations[slot], list):
+                    for operation in self._operations[slot]:
+                        if operation not in to_ignore:
+                            lost_operations.append(operation)
+
+            # And we mark the worker as disabled (until another action
+            # is taken).
+            self._schedule_disabling[slot] = True
+            self._operations_to_ignore[slot] = []
+            self._ignore[slot] = True
+            self.release_worker(slot)
 
         return lost_operations
 
     def disable_worker(self, shard):
-        """Disable a worker.
+        """Disable a worker, with all its slots.
 
         shard (int): which worker to disable.
 
@@ -422,32 +923,17 @@ class WorkerPool(object):
         raise (ValueError): if worker is already disabled.
 
         """
-        if self._operations[shard] == WorkerPool.WORKER_DISABLED:
+        slots = [slot for slot in self._get_slots(shard)
+                 if self._operations[slot] != WorkerPool.WORKER_DISABLED]
+        if len(slots) == 0:
             err_msg = \
                 "Trying to disable already disabled worker %s." % shard
             logger.warning(err_msg)
             raise ValueError(err_msg)
 
         lost_operations = []
-        if self._operations[shard] == WorkerPool.WORKER_INACTIVE:
-            self._operations[shard] = WorkerPool.WORKER_DISABLED
-
-        else:
-            # We return all non-ignored operations so ES can do what
-            # it needs.
-            if not self._ignore[shard]:
-                to_ignore = self._operations_to_ignore[shard]
-                if isinstance(self._operations[shard], list):
-                    for operation in self._operations[shard]:
-                        if operation not in to_ignore:
-                            lost_operations.append(operation)
-
-            # And we mark the worker as disabled (until another action
-            # is taken).
-            self._schedule_disabling[shard] = True
-            self._operations_to_ignore[shard] = []
-            self._ignore[shard] = True
-            self.release_worker(shard)
+        for slot in slots:
+            lost_operations += self._disable_slot(slot)
 
         logger.info("Worker %s disabled.", shard)
         return lost_operations
@@ -460,14 +946,17 @@ class WorkerPool(object):
         raise (ValueError): if worker is not disabled.
 
         """
-        if self._operations[shard] != WorkerPool.WORKER_DISABLED:
+        slots = self._get_slots(shard)
+        if any(self._operations[slot] != WorkerPool.WORKER_DISABLED
+               for slot in slots):
             err_msg = \
                 "Trying to enable worker %s which is not disabled." % shard
             logger.error(err_msg)
             raise ValueError(err_msg)
 
-        self._operations[shard] = WorkerPool.WORKER_INACTIVE
-        self._operations_to_ignore[shard] = []
+        for slot in slots:
+            self._operations[slot] = WorkerPool.WORKER_INACTIVE
+            self._operations_to_ignore[slot] = []
         self._workers_available_event.set()
         logger.info("Worker %s enabled.", shard)
 
@@ -480,13 +969,13 @@ class WorkerPool(object):
 
         """
         lost_operations = []
-        for shard in self._worker:
-            if not self._worker[shard].connected and \
-                    self._operations[shard] not in [
+        for slot in self._operations.keys():
+            if not self._worker[slot[0]].connected and \
+                    self._operations[slot] not in [
                         WorkerPool.WORKER_DISABLED,
                         WorkerPool.WORKER_INACTIVE]:
-                if not self._ignore[shard]:
-                    lost_operations += self._operations[shard]
-                self.release_worker(shard)
+                if not self._ignore[slot]:
+                    lost_operations += self._operations[slot]
+                self.release_worker(slot)
 
         return lost_operations
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This script checks that the content of each file in the storage
+matches its digest, using many processes. With a checkpoint file, an
+interrupted check can be resumed.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import multiprocessing
+import sys
+
+from cms import utf8_decoder
+from cms.db.filecacher import FileCacher
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the integrity of the files stored by "
+        "FileCacher.")
+    parser.add_argument("-p", "--path", action="store", type=utf8_decoder,
+                        help="root directory of a file system storage "
+                        "(default: use the database)")
+    parser.add_argument("-j", "--workers", action="store", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: the "
+                        "number of CPUs)")
+    parser.add_argument("-c", "--checkpoint", action="store",
+                        type=utf8_decoder,
+                        help="file recording the files already verified, "
+                        "which are skipped when running again")
+    parser.add_argument("-i", "--report-interval", action="store",
+                        type=float, default=60,
+                        help="seconds between progress reports "
+                        "(default 60)")
+    parser.add_argument("-d", "--delete", action="store_true",
+                        help="delete the files whose content doesn't "
+                        "match their digest")
+    args = parser.parse_args()
+
+    file_cacher = FileCacher(path=args.path)
+    try:
+        clean = file_cacher.check_backend_integrity(
+            delete=args.delete, workers=args.workers,
+            checkpoint_path=args.checkpoint,
+            report_interval=args.report_interval)
+    finally:
+        file_cacher.destroy_cache()
+
+    if clean:
+        logger.info("All the files are correct.")
+        return 0
+    else:
+        logger.error("Some files are corrupted.")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,65 +18,149 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""This script scans the whole database for file objects references
-and removes unreferenced file objects from the file store. If required,
-it also replaces all the executable digests in the database with a
-tombstone digest, to make executables removable in the clean pass.
+"""This script removes the files that are not referenced anywhere in
+the database from the file store. Unreferenced files are found with a
+few queries per range of digests, and then deleted in small batches,
+at a limited rate, after a grace period, checking again that they are
+unreferenced and that they were not used again in the meantime (see
+cms.db.orphans): it can be run during a contest, as long as the grace
+period is longer than the time results take to be stored after they
+are computed. If required, it also replaces all the executable digests
+in the database with a tombstone digest, to make executables
+removable.
 
 """
 
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
 import argparse
 import logging
 import sys
+import time
 
-from cms.db import Attachment, Executable, File, Manager, PrintJob, \
-    SessionGen, Statement, Testcase, UserTest, UserTestExecutable, \
-    UserTestFile, UserTestManager, UserTestResult
+from cms.db import Executable, SessionGen
 from cms.db.filecacher import FileCacher
+from cms.db.orphans import delete_orphans, find_orphans, \
+    get_digest_ranges, get_stored_sizes
 from cms.server.util import format_size
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger()
 
 
 def make_tombstone(session):
-    count = 0
-    for exe in session.query(Executable).all():
-        if exe.digest != FileCacher.TOMBSTONE_DIGEST:
-            count += 1
-        exe.digest = FileCacher.TOMBSTONE_DIGEST
+    count = session.query(Executable)\
+        .filter(Executable.digest != FileCacher.TOMBSTONE_DIGEST)\
+        .update({Executable.digest: FileCacher.TOMBSTONE_DIGEST},
+                synchronize_session=False)
     logger.info("Replaced %d executables with the tombstone.", count)
 
 
-def clean_files(session, dry_run):
-    filecacher = FileCacher()
-    files = set(file[0] for file in filecacher.list())
-    logger.info("A total number of %d files are present in the file store",
-                len(files))
-    for cls in [Attachment, Executable, File, Manager, PrintJob,
-                Statement, Testcase, UserTest, UserTestExecutable,
-                UserTestFile, UserTestManager, UserTestResult]:
-        for col in ["input", "output", "digest"]:
-            if hasattr(cls, col):
-                found_digests = set()
-                digests = session.query(cls).all()
-                digests = [getattr(obj, col) for obj in digests]
-                found_digests |= set(digests)
-                found_digests.discard(FileCacher.TOMBSTONE_DIGEST)
-                logger.info("Found %d digests while scanning %s.%s",
-                            len(found_digests), cls.__name__, col)
-                files -= found_digests
-    logger.info("%d digests are orphan.", len(files))
+def mark(slices):
+    """Find the orphan files, one range of digests at a time.
+
+    slices (int): the number of ranges, a power of 16.
+
+    return ([(float, unicode, unicode)]): the time each orphan was
+        found at, its digest and the version of its row, sorted by
+        time.
+
+    """
+    orphans = []
+    ranges = get_digest_ranges(slices)
+    for i, (start, end) in enumerate(ranges):
+        with SessionGen() as session:
+            found = find_orphans(session, start, end)
+        marked_at = monotonic_time()
+        orphans.extend((marked_at, digest, version)
+                       for digest, version in found)
+        logger.debug("Range %d/%d: %d orphans.", i + 1, len(ranges),
+                     len(found))
+    logger.info("%d digests are orphan.", len(orphans))
+    return orphans
+
+
+def report(orphans, batch_size):
+    """Log how much space the orphan files take.
+
+    orphans ([(float, unicode, unicode)]): the orphans, as returned by
+        mark.
+    batch_size (int): the number of files to query together.
+
+    """
     total_size = 0
-    for orphan in files:
-        total_size += filecacher.get_size(orphan)
+    for i in xrange(0, len(orphans), batch_size):
+        with SessionGen() as session:
+            total_size += sum(get_stored_sizes(
+                session,
+                [digest for _, digest, _ in orphans[i:i + batch_size]])
+                .itervalues())
     logger.info("Orphan files take %s disk space", format_size(total_size))
-    if not dry_run:
-        for count, orphan in enumerate(files):
-            filecacher.delete(orphan)
-            if count % 100 == 0:
-                logger.info("%d files deleted from the file store", count)
-        logger.info("All orphan files have been deleted")
+
+
+def sweep(orphans, batch_size, rate, grace):
+    """Delete the orphan files that are still so.
+
+    orphans ([(float, unicode, unicode)]): the orphans, as returned by
+        mark.
+    batch_size (int): the number of files to delete together.
+    rate (float): the maximum number of files to delete per second.
+    grace (float): the minimum number of seconds between finding an
+        orphan and deleting it, to let references to just stored files
+        be added.
+
+    return (int): the number of deleted files.
+
+    """
+    deleted = 0
+    for i in xrange(0, len(orphans), batch_size):
+        batch = orphans[i:i + batch_size]
+        wait = batch[-1][0] + grace - monotonic_time()
+        if wait > 0:
+            logger.info("Waiting %.0f seconds before deleting.", wait)
+            time.sleep(wait)
+
+        start = monotonic_time()
+        with SessionGen() as session:
+            deleted += len(delete_orphans(
+                session, [(digest, version)
+                          for _, digest, version in batch]))
+            session.commit()
+        logger.info("%d files deleted from the file store", deleted)
+
+        time.sleep(max(0.0, len(batch) / rate - (monotonic_time() - start)))
+
+    if deleted < len(orphans):
+        logger.info("%d files were not deleted as they are used "
+                    "again.", len(orphans) - deleted)
+    return deleted
+
+
+def clean_files(dry_run, slices=16, batch_size=100, rate=100.0, grace=300.0):
+    """Remove the files not referenced anywhere from the file store.
+
+    dry_run (bool): if True, only report how many files would be
+        deleted and how much space they take.
+    slices (int): the number of ranges of digests to look for orphans
+        in separately, a power of 16.
+    batch_size (int): the number of files to delete together.
+    rate (float): the maximum number of files to delete per second.
+    grace (float): the minimum number of seconds between finding an
+        orphan and deleting it.
+
+    return (int): the number of files deleted (or to be deleted).
+
+    """
+    orphans = mark(slices)
+    report(orphans, batch_size)
+    if dry_run:
+        return len(orphans)
+    deleted = sweep(orphans, batch_size, rate, grace)
+    logger.info("All orphan files have been deleted")
+    return deleted
 
 
 def main():
@@ -85,13 +169,36 @@ def main():
         "If -t is specified, also replace all executables with the tombstone")
     parser.add_argument("-t", "--tombstone", action="store_true")
     parser.add_argument("-n", "--dry-run", action="store_true")
+    parser.add_argument("-s", "--slices", action="store", type=int,
+                        default=16,
+                        help="number of ranges of digests to look for "
+                        "unused files in separately, a power of 16 "
+                        "(default 16)")
+    parser.add_argument("-b", "--batch-size", action="store", type=int,
+                        default=100,
+                        help="number of files deleted in each transaction "
+                        "(default 100)")
+    parser.add_argument("-r", "--rate", action="store", type=float,
+                        default=100.0,
+                        help="maximum number of files deleted per second "
+                        "(default 100)")
+    parser.add_argument("-g", "--grace", action="store", type=float,
+                        default=300.0,
+                        help="seconds to wait before deleting a file found "
+                        "unused, in case it has just been stored "
+                        "(default 300)")
     args = parser.parse_args()
-    with SessionGen() as session:
-        if args.tombstone:
+
+    if args.tombstone:
+        with SessionGen() as session:
             make_tombstone(session)
-        clean_files(session, args.dry_run)
-        if not args.dry_run:
-            session.commit()
+            if not args.dry_run:
+                session.commit()
+            else:
+                logger.info("Executables are not replaced in a dry run, "
+                            "so their files are not counted.")
+    clean_files(args.dry_run, args.slices, args.batch_size, args.rate,
+                args.grace)
     return 0
 
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This script stores again the files of a FileCacher backend with the
+given compression: files that are compressible enough are compressed,
+the others are left (or made) uncompressed. It can be run while the
+storage is in use, and can be interrupted and restarted at any time.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import sys
+
+from cms import config, utf8_decoder
+from cms.db.compression import CODECS, SAMPLE_SIZE, should_compress
+from cms.db.filecacher import DBBackend, FSBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+def compress_files(backend, codec, dry_run):
+    """Store again all the files of a backend.
+
+    backend (FileCacherBackend): the storage to convert.
+    codec (unicode|None): the codec to compress the files with, or
+        None to decompress them all.
+    dry_run (bool): if True, only report what would be done.
+
+    return (int): the number of files (to be) stored again.
+
+    """
+    files = backend.list()
+    logger.info("%d files are stored.", len(files))
+
+    changed = 0
+    total_size = 0
+    compressed_size = 0
+    for i, (digest, _) in enumerate(files):
+        size = backend.get_size(digest)
+        with backend.get_file(digest) as fobj:
+            sample = fobj.read(SAMPLE_SIZE)
+
+        target = None
+        if codec is not None and should_compress(sample, codec, size):
+            target = codec
+
+        total_size += size
+        if target is not None:
+            compressor = CODECS[target][0]()
+            ratio = float(len(compressor.compress(sample)) +
+                          len(compressor.flush())) / len(sample)
+            compressed_size += int(size * ratio)
+        else:
+            compressed_size += size
+
+        if dry_run:
+            if target is not None:
+                changed += 1
+        elif backend.set_compression(digest, target):
+            changed += 1
+
+        if (i + 1) % 1000 == 0:
+            logger.info("%d files processed.", i + 1)
+
+    if dry_run:
+        logger.info("%d files would be compressed, storing about %.1f MB "
+                    "instead of %.1f MB.", changed,
+                    compressed_size / 1024.0 / 1024.0,
+                    total_size / 1024.0 / 1024.0)
+    else:
+        logger.info("%d files have been stored again.", changed)
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compress (or decompress) the files already stored "
+        "by FileCacher.")
+    parser.add_argument("-p", "--path", action="store", type=utf8_decoder,
+                        help="root directory of a file system storage "
+                        "(default: use the database)")
+    parser.add_argument("-c", "--codec", action="store", type=utf8_decoder,
+                        choices=sorted(CODECS),
+                        default=config.storage_compression or "zlib",
+                        help="codec to compress the files with (default: "
+                        "storage_compression in cms.conf, or zlib)")
+    parser.add_argument("-d", "--decompress", action="store_true",
+                        help="store all the files uncompressed")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only estimate how much space compression "
+                        "would save")
+    args = parser.parse_args()
+
+    if args.path is not None:
+        backend = FSBackend(args.path)
+    else:
+        backend = DBBackend()
+
+    compress_files(backend, None if args.decompress else args.codec,
+                   args.dry_run)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
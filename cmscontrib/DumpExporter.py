@@ -216,6 +216,9 @@ class DumpExporter(object):
                     files = contest.enumerate_files(self.skip_submissions,
                                                     self.skip_user_tests,
                                                     self.skip_generated)
+                    # Fetch the files in bulk; failures are reported
+                    # by safe_get_file.
+                    self.file_cacher.load_many(files)
                     for file_ in files:
                         if not self.safe_get_file(file_,
                                                   os.path.join(files_dir,
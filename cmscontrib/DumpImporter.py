@@ -61,7 +61,6 @@ from cms.db import Contest, RepeatedUnicode, SessionGen, \
     init_db, drop_db
 from cms.db.filecacher import FileCacher
 
-from cmscontrib import sha1sum
 from cmscommon.datetime import make_datetime
 from cmscommon.archive import Archive
 
@@ -434,19 +433,21 @@ class DumpImporter(object):
         except IOError:
             description = ''
 
-        # Put the file.
+        # Put the file. It is named after its digest, which we give
+        # as a hint so that files already stored are not sent again.
+        expected_digest = os.path.basename(path)
         try:
-            digest = self.file_cacher.put_file_from_path(path, description)
+            digest = self.file_cacher.put_file_from_path(
+                path, description, digest=expected_digest)
         except Exception as error:
             logger.critical("File %s could not be put to file server (%r), "
                             "aborting.", path, error)
             return False
 
         # Then check the digest.
-        calc_digest = sha1sum(path)
-        if digest != calc_digest:
-            logger.critical("File %s has hash %s, but the server returned %s, "
-                            "aborting.", path, calc_digest, digest)
+        if digest != expected_digest:
+            logger.critical("File %s has hash %s, but it should be %s, "
+                            "aborting.", path, digest, expected_digest)
             return False
 
         return True
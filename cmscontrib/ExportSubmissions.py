@@ -203,7 +203,7 @@ def main():
 
             fso = FSObject.get_from_digest(f_digest, session)
             assert fso is not None
-            with fso.get_lobject(mode="rb") as file_obj:
+            with fso.get_file() as file_obj:
                 data = file_obj.read()
 
                 if args.utf8:
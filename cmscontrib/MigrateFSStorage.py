@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This script converts a file system storage for FileCacher from the
+old flat layout (all files in a single directory) to the sharded one,
+filling its index. It can be run while the storage is in use, and can
+be interrupted and restarted at any time. It can also compact the
+index, or rebuild it from the stored files.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import sys
+
+from cms import utf8_decoder
+from cms.db.filecacher import FSBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(backend, dry_run):
+    """Move all the files in the flat layout to the sharded one.
+
+    backend (FSBackend): the storage to migrate.
+    dry_run (bool): if True, only count the files to move.
+
+    return (int): the number of files (to be) moved.
+
+    """
+    digests = backend.list_legacy_files()
+    logger.info("%d files are stored with the flat layout.", len(digests))
+    if dry_run:
+        return len(digests)
+
+    moved = 0
+    for digest in digests:
+        if backend.migrate_legacy_file(digest):
+            moved += 1
+            if moved % 1000 == 0:
+                logger.info("%d files moved.", moved)
+    logger.info("%d files have been moved.", moved)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move the files of a file system storage for "
+        "FileCacher to the sharded layout.")
+    parser.add_argument("path", action="store", type=utf8_decoder,
+                        help="root directory of the storage")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only report how many files need to be moved")
+    parser.add_argument("-c", "--compact", action="store_true",
+                        help="compact the index after the migration")
+    parser.add_argument("-r", "--rebuild-index", action="store_true",
+                        help="rebuild the index from the stored files "
+                        "after the migration (sizes are recomputed, "
+                        "known descriptions are kept)")
+    args = parser.parse_args()
+
+    backend = FSBackend(args.path)
+    migrate(backend, args.dry_run)
+
+    if not args.dry_run and (args.compact or args.rebuild_index):
+        count = backend.rewrite_index(rescan=args.rebuild_index)
+        logger.info("The index now has %d records.", count)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,41 @@
 #!/bin/bash
 
-# Check whether files present if fs/objects and fs-cache/objects have their
-# filename matching their SHA1 sum
-for file in fs/objects/* fs-cache/objects/* ; do
-	REAL_SUM=`sha1sum $file | cut -d' ' -f1`
-	PRESUMED_SUM=`basename $file`
-	if diff <(echo $REAL_SUM) <(echo $PRESUMED_SUM) >/dev/null ; then
-		true
-	else
+# Check the integrity of the files known to CMS on this machine: first
+# check whether the files in the local caches of the services (in
+# $CACHE_DIR, by default /var/local/cache/cms) have their filename
+# matching their SHA1 sum, then check the files in the storage with
+# cmsCheckFiles.
+#
+# Usage: check_cache.sh [delete] [cmsCheckFiles options...]
+#
+# For example, "check_cache.sh -j 8 -c /tmp/check.checkpoint" checks the
+# storage with 8 processes and can be interrupted and run again with
+# the same options to resume the check.
+
+CACHE_DIR=${CACHE_DIR:-/var/local/cache/cms}
+
+DELETE=""
+if [ "z$1" == "zdelete" ] ; then
+	DELETE="--delete"
+	shift
+fi
+
+for file in "$CACHE_DIR"/fs-cache-*/* ; do
+	# Skip the housekeeping files and directories of the cache.
+	if [ ! -f "$file" ] || [[ "$(basename "$file")" == _* ]] ; then
+		continue
+	fi
+	REAL_SUM=`sha1sum "$file" | cut -d' ' -f1`
+	PRESUMED_SUM=`basename "$file"`
+	if [ "$REAL_SUM" != "$PRESUMED_SUM" ] ; then
 		echo "File $file has wrong checksum $REAL_SUM"
 
 		# If requested, delete wrong files
-		if [ "z$1" == "zdelete" ] ; then
+		if [ -n "$DELETE" ] ; then
 			echo "Deleting file $file"
-			rm -f $file
+			rm -f "$file"
 		fi
 	fi
 done
 
+exec cmsCheckFiles $DELETE "$@"
@@ -4,7 +4,9 @@
 # For each regular file in ORIG_DIR (the directory is scanned
 # recursively) create a symbolic link in DEST_DIR with basename the
 # SHA1 sum of the file. You can use this script to set up a directory
-# for the FileCacher file system backend.
+# for the FileCacher file system backend; then run
+# cmsMigrateFSStorage DEST_DIR to move the links to the sharded layout
+# and index them.
 
 ORIG_DIR="$1"
 DEST_DIR="$2"
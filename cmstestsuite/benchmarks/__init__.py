@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks for performance-sensitive parts of CMS.
+
+Each module is a script meant to be run as, for example:
+
+    python -m cmstestsuite.benchmarks.largeobject_benchmark
+
+Benchmarks that need the database use the one in cms.conf, and remove
+everything they create.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+
+class Timer(object):
+    """Context manager measuring the wall clock time of its body.
+
+    """
+
+    def __init__(self):
+        self.elapsed = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, unused1, unused2, unused3):
+        self.elapsed = time.time() - self._start
+
+
+def print_results(title, rows):
+    """Print a table of results.
+
+    title (unicode): the title of the table.
+    rows ([(unicode, float|int, unicode)]): for each measurement, its
+        name, its value and a suffix (for example the unit).
+
+    """
+    print(title)
+    width = max(len(name) for name, _, _ in rows)
+    for name, value, suffix in rows:
+        if isinstance(value, float):
+            print("  %-*s %12.3f %s" % (width, name, value, suffix))
+        else:
+            print("  %-*s %12d %s" % (width, name, value, suffix))
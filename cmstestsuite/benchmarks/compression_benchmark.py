@@ -0,0 +1,168 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the compression of stored files.
+
+Read the files of one or more contest dumps (as created by
+cmsDumpExporter) and, for each available codec, measure how much space
+they would take in the storage (which is also how much data Workers
+would download) following the same per-file policy as FileCacher, and
+how long compressing and decompressing them takes. Optionally, also
+store them in the database and time fetching them into an empty cache.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import os
+import sys
+
+from cms import utf8_decoder
+from cms.db.compression import CODECS, SAMPLE_SIZE, should_compress
+from cms.db.filecacher import DBBackend, FileCacher
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+def read_dumps(paths):
+    """Read all the files of the given dumps.
+
+    paths ([unicode]): directories of dumps, or of plain files.
+
+    return ([bytes]): the contents of the files.
+
+    """
+    files = []
+    for path in paths:
+        files_dir = os.path.join(path, "files")
+        if not os.path.isdir(files_dir):
+            files_dir = path
+        for name in sorted(os.listdir(files_dir)):
+            file_path = os.path.join(files_dir, name)
+            if os.path.isfile(file_path):
+                with io.open(file_path, 'rb') as fobj:
+                    files.append(fobj.read())
+    return files
+
+
+def measure_codec(files, codec):
+    """Compress and decompress the files with a codec.
+
+    files ([bytes]): the contents of the files.
+    codec (unicode|None): the codec, or None for no compression.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    stored = []
+    with Timer() as compress_timer:
+        for content in files:
+            if codec is not None and \
+                    should_compress(content[:SAMPLE_SIZE], codec,
+                                    len(content)):
+                compressor = CODECS[codec][0]()
+                stored.append((codec, compressor.compress(content) +
+                               compressor.flush()))
+            else:
+                stored.append((None, content))
+    with Timer() as decompress_timer:
+        for used, data in stored:
+            if used is not None:
+                decompressor = CODECS[used][1]()
+                decompressor.decompress(data)
+                decompressor.flush()
+
+    total_size = sum(len(content) for content in files)
+    stored_size = sum(len(data) for _, data in stored)
+    return [
+        ("files compressed", sum(1 for used, _ in stored
+                                 if used is not None), ""),
+        ("stored size", stored_size / 1024.0 / 1024.0, "MB"),
+        ("stored / original", 100.0 * stored_size / max(total_size, 1), "%"),
+        ("compression time", compress_timer.elapsed, "s"),
+        ("decompression time", decompress_timer.elapsed, "s"),
+    ]
+
+
+def measure_database(files, codec):
+    """Store the files in the database and fetch them.
+
+    files ([bytes]): the contents of the files.
+    codec (unicode|None): the codec, or None for no compression.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    file_cacher = FileCacher()
+    file_cacher.compression = codec
+    backend = DBBackend()
+    existing = set(digest for digest, _ in backend.list())
+    digests = []
+    try:
+        with Timer() as put_timer:
+            for content in files:
+                digests.append(
+                    file_cacher.put_file_content(content, "Benchmark"))
+        file_cacher.purge_cache()
+        with Timer() as get_timer:
+            file_cacher.load_many(digests)
+    finally:
+        for digest in set(digests) - existing:
+            backend.delete(digest)
+        file_cacher.destroy_cache()
+
+    return [
+        ("store", put_timer.elapsed, "s"),
+        ("fetch into empty cache", get_timer.elapsed, "s"),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the compression of stored files on the "
+        "files of contest dumps.")
+    parser.add_argument("dumps", action="store", type=utf8_decoder,
+                        nargs="+",
+                        help="directories of dumps (or of plain files)")
+    parser.add_argument("-d", "--database", action="store_true",
+                        help="also store and fetch the files using the "
+                        "database in cms.conf (they are deleted "
+                        "afterwards, unless they were already there)")
+    args = parser.parse_args()
+
+    files = read_dumps(args.dumps)
+    if len(files) == 0:
+        print("No files found.")
+        return 1
+    print("%d files, %.3f MB." % (
+        len(files), sum(len(content) for content in files) / 1024.0 / 1024.0))
+
+    for codec in [None] + sorted(CODECS):
+        results = measure_codec(files, codec)
+        if args.database:
+            results += measure_database(files, codec)
+        print_results("%s:" % (codec or "uncompressed"), results)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
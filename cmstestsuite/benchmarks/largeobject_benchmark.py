@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of large object I/O with and without pooled connections.
+
+Store a number of small files in the database and read them back,
+first opening a new connection for each file (as CMS used to do) and
+then reusing the connections of a LargeObjectConnectionPool.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import sys
+
+import cms.db.fsobject
+from cms.db.filecacher import DBBackend, FileCacher
+from cms.db.fsobject import LargeObjectConnectionPool
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+def run(files, size, pool):
+    """Store and fetch the files using the given pool.
+
+    files ([bytes]): the contents of the files.
+    size (int): the size of each file, in bytes.
+    pool (LargeObjectConnectionPool): the pool to use.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    cms.db.fsobject.lo_connection_pool = pool
+    file_cacher = FileCacher()
+    backend = DBBackend()
+    try:
+        with Timer() as put_timer:
+            digests = [file_cacher.put_file_content(content, "Benchmark")
+                       for content in files]
+        file_cacher.purge_cache()
+        with Timer() as get_timer:
+            for digest in digests:
+                file_cacher.load(digest)
+    finally:
+        for digest in set(digests):
+            backend.delete(digest)
+        file_cacher.destroy_cache()
+        pool.close_idle()
+
+    stats = pool.get_stats()
+    return [
+        ("store", put_timer.elapsed, "s"),
+        ("fetch", get_timer.elapsed, "s"),
+        ("fetch per file", get_timer.elapsed * 1000 / len(files), "ms"),
+        ("fetch throughput",
+         len(files) * size / 1024.0 / 1024.0 / get_timer.elapsed, "MB/s"),
+        ("connections created", stats["connections_created"], ""),
+        ("connections reused", stats["connections_reused"], ""),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark large object I/O with and without a "
+        "connection pool.")
+    parser.add_argument(
+        "-n", "--files", action="store", type=int, default=500,
+        help="number of files to store and fetch (default 500)")
+    parser.add_argument(
+        "-s", "--size", action="store", type=int, default=4096,
+        help="size of each file in bytes (default 4096)")
+    args = parser.parse_args()
+
+    files = [os.urandom(args.size) for _ in xrange(args.files)]
+
+    print_results("Connect per file:",
+                  run(files, args.size, LargeObjectConnectionPool(
+                      1, max_idle=0)))
+    print_results("Pooled connections:",
+                  run(files, args.size, LargeObjectConnectionPool(1)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the priority queue of the triggered services.
+
+Fill the queue with evaluation operations as ES would (one per
+testcase of each submission), then time popping them, removing those
+of a dataset (as an invalidation does) and getting the status of the
+queue. The same is done with the previous implementation of the queue
+(a single heap of entries compared by a Python method) for reference.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import random
+import sys
+
+from cms.io import PriorityQueue
+from cms.service.esoperations import ESOperation
+from cmscommon.datetime import make_datetime, make_timestamp
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+class OldQueueEntry(object):
+    """Entry of the previous implementation of the queue."""
+
+    def __init__(self, item, priority, timestamp, index):
+        self.item = item
+        self.priority = priority
+        self.timestamp = timestamp
+        self.index = index
+
+    def __cmp__(self, other):
+        if self.priority != other.priority:
+            return cmp(self.priority, other.priority)
+        elif self.timestamp != other.timestamp:
+            return cmp(self.timestamp, other.timestamp)
+        else:
+            return cmp(self.index, other.index)
+
+
+class OldPriorityQueue(object):
+    """The previous implementation of the queue, without waiting."""
+
+    def __init__(self):
+        self._queue = []
+        self._reverse = {}
+        self._next_index = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _swap(self, idx1, idx2):
+        self._queue[idx1], self._queue[idx2] = \
+            self._queue[idx2], self._queue[idx1]
+        self._reverse[self._queue[idx1].item] = idx1
+        self._reverse[self._queue[idx2].item] = idx2
+
+    def _up_heap(self, idx):
+        while idx > 0:
+            parent = (idx - 1) // 2
+            if self._queue[idx] < self._queue[parent]:
+                self._swap(parent, idx)
+                idx = parent
+            else:
+                break
+        return idx
+
+    def _down_heap(self, idx):
+        last = len(self._queue) - 1
+        while 2 * idx + 1 <= last:
+            child = 2 * idx + 1
+            if 2 * idx + 2 <= last and \
+                    self._queue[2 * idx + 2] < self._queue[child]:
+                child = 2 * idx + 2
+            if self._queue[child] < self._queue[idx]:
+                self._swap(child, idx)
+                idx = child
+            else:
+                break
+        return idx
+
+    def push(self, item, priority, timestamp):
+        if item in self._reverse:
+            return False
+        self._queue.append(
+            OldQueueEntry(item, priority, timestamp, self._next_index))
+        self._next_index += 1
+        last = len(self._queue) - 1
+        self._reverse[item] = last
+        self._up_heap(last)
+        return True
+
+    def pop(self):
+        top = self._queue[0]
+        last = len(self._queue) - 1
+        self._swap(0, last)
+        del self._reverse[top.item]
+        del self._queue[last]
+        if last > 0:
+            self._down_heap(0)
+        return top
+
+    def remove(self, item):
+        pos = self._reverse[item]
+        entry = self._queue[pos]
+        last = len(self._queue) - 1
+        self._swap(pos, last)
+        del self._reverse[item]
+        del self._queue[last]
+        if pos != last:
+            self._down_heap(self._up_heap(pos))
+        return entry
+
+    def get_status(self):
+        return [{'item': entry.item.to_dict(),
+                 'priority': entry.priority,
+                 'timestamp': make_timestamp(entry.timestamp)}
+                for entry in self._queue]
+
+
+def make_operations(submissions, testcases, datasets):
+    """Return the operations to push, in random order.
+
+    submissions (int): the number of submissions.
+    testcases (int): the number of testcases of each dataset.
+    datasets (int): the number of datasets.
+
+    return ([(ESOperation, int, datetime)]): the operations, with
+        their priority and timestamp.
+
+    """
+    operations = []
+    for submission_id in xrange(submissions):
+        timestamp = make_datetime(1500000000 + submission_id)
+        dataset_id = submission_id % datasets
+        priority = random.choice([PriorityQueue.PRIORITY_HIGH,
+                                  PriorityQueue.PRIORITY_MEDIUM,
+                                  PriorityQueue.PRIORITY_EXTRA_LOW])
+        for codename in xrange(testcases):
+            operations.append((ESOperation(
+                ESOperation.EVALUATION, submission_id, dataset_id,
+                "%03d" % codename), priority, timestamp))
+    random.shuffle(operations)
+    return operations
+
+
+def measure(queue, operations, bulk):
+    """Time the operations on a queue.
+
+    queue (PriorityQueue|OldPriorityQueue): an empty queue.
+    operations ([(ESOperation, int, datetime)]): the operations.
+    bulk (bool): whether to use the bulk methods of the queue.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    with Timer() as push_timer:
+        if bulk:
+            queue.push_many(operations)
+        else:
+            for operation, priority, timestamp in operations:
+                queue.push(operation, priority, timestamp)
+    with Timer() as status_timer:
+        queue.get_status()
+    with Timer() as remove_timer:
+        if bulk:
+            queue.remove_many(lambda operation: operation.dataset_id == 0)
+        else:
+            for operation, _, _ in operations:
+                if operation.dataset_id == 0:
+                    queue.remove(operation)
+    remaining = len(queue)
+    with Timer() as pop_timer:
+        for _ in xrange(remaining):
+            queue.pop()
+
+    return [
+        ("push", push_timer.elapsed, "s"),
+        ("full status", status_timer.elapsed, "s"),
+        ("remove a dataset", remove_timer.elapsed, "s"),
+        ("pop %d" % remaining, pop_timer.elapsed, "s"),
+    ]
+
+
+def measure_pages(operations):
+    """Time getting pages of the status of a queue.
+
+    operations ([(ESOperation, int, datetime)]): the operations.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    queue = PriorityQueue()
+    queue.push_many(operations)
+    with Timer() as first_timer:
+        queue.get_status(0, 100)
+    with Timer() as middle_timer:
+        queue.get_status(len(queue) // 2, 100)
+    with Timer() as grouped_timer:
+        queue.get_status(0, 100, group_by=lambda operation: (
+            operation.type_, operation.object_id, operation.dataset_id))
+    return [
+        ("first 100", first_timer.elapsed, "s"),
+        ("100 in the middle", middle_timer.elapsed, "s"),
+        ("first 100 submissions", grouped_timer.elapsed, "s"),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the priority queue of the triggered "
+        "services.")
+    parser.add_argument("-s", "--submissions", action="store", type=int,
+                        default=2000, help="number of submissions")
+    parser.add_argument("-t", "--testcases", action="store", type=int,
+                        default=50, help="number of testcases")
+    parser.add_argument("-d", "--datasets", action="store", type=int,
+                        default=4, help="number of datasets")
+    args = parser.parse_args()
+
+    random.seed(0)
+    operations = make_operations(args.submissions, args.testcases,
+                                 args.datasets)
+    print("%d operations." % len(operations))
+
+    print_results("Previous queue:",
+                  measure(OldPriorityQueue(), operations, False))
+    print_results("Queue, one operation at a time:",
+                  measure(PriorityQueue(), operations, False))
+    print_results("Queue, bulk operations:",
+                  measure(PriorityQueue(), operations, True))
+    print_results("Pages of the status:", measure_pages(operations))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the lifecycle of the isolate sandboxes.
+
+Create many sandboxes one after the other, as the evaluation of the
+testcases does, optionally running a trivial program in each, and
+delete them: first initializing and cleaning up a box for each
+sandbox, then reusing the boxes of the deleted ones. Finally, reset a
+single sandbox instead, as Batch does when evaluating several
+testcases together. Boxes with ids from 0 to 9 are used, as the
+command line tools do.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import sys
+
+from cms import config
+from cms.grading.Sandbox import IsolateSandbox
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+def measure(cycles, execute):
+    """Time creating, using and deleting sandboxes.
+
+    cycles (int): the number of sandboxes.
+    execute (bool): whether to run a program in each sandbox.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    with Timer() as timer:
+        for _ in xrange(cycles):
+            sandbox = IsolateSandbox(False, None)
+            if execute:
+                sandbox.execute_without_std(["/bin/true"], wait=True)
+            sandbox.delete()
+
+    return [
+        ("total", timer.elapsed, "s"),
+        ("per sandbox", timer.elapsed * 1000 / cycles, "ms"),
+        ("sandboxes", cycles / timer.elapsed, "/s"),
+    ]
+
+
+def measure_reset(cycles, execute):
+    """Time using the same sandbox many times, resetting it.
+
+    cycles (int): the number of uses.
+    execute (bool): whether to run a program at each use.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    with Timer() as timer:
+        sandbox = IsolateSandbox(False, None)
+        for _ in xrange(cycles):
+            sandbox.reset()
+            if execute:
+                sandbox.execute_without_std(["/bin/true"], wait=True)
+        sandbox.delete()
+
+    return [
+        ("total", timer.elapsed, "s"),
+        ("per use", timer.elapsed * 1000 / cycles, "ms"),
+        ("uses", cycles / timer.elapsed, "/s"),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the creation and deletion of isolate "
+        "sandboxes, with and without reusing the boxes.")
+    parser.add_argument("-c", "--cycles", action="store", type=int,
+                        default=200, help="number of sandboxes")
+    parser.add_argument("-e", "--execute", action="store_true",
+                        help="run /bin/true in each sandbox")
+    args = parser.parse_args()
+
+    config.sandbox_reuse_boxes = False
+    print_results("New boxes:", measure(args.cycles, args.execute))
+    config.sandbox_reuse_boxes = True
+    # Fill the pool first.
+    measure(10, False)
+    print_results("Reused boxes:", measure(args.cycles, args.execute))
+    print_results("Reset sandbox:",
+                  measure_reset(args.cycles, args.execute))
+    IsolateSandbox.clear_pool()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
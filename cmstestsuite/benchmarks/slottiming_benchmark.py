@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Calibration of the timings of execution slots running together.
+
+Run the same CPU-bound program in all the slots at the same time, many
+times, and report for each slot how much its CPU time (what the
+sandbox measures) varies: first without pinning, then with each slot
+pinned to its cores as the sandboxes would be (see
+cms.grading.cpuaffinity). A low variation with all the slots busy
+means that the machine can host that many slots without making the
+time limits unfair.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import math
+import os
+import subprocess
+import sys
+
+from cms.grading.cpuaffinity import format_cpu_list, get_cores, \
+    split_cores
+from cmstestsuite.benchmarks import print_results
+
+
+def run_round(command, slot_cpus):
+    """Run the command once in each slot, at the same time.
+
+    command ([unicode]): the command.
+    slot_cpus ([[int]|None]): for each slot, the CPUs to pin it to, or
+        None.
+
+    return ([float]): the CPU time used in each slot, in seconds.
+
+    """
+    pids = []
+    for cpus in slot_cpus:
+        args = command
+        if cpus is not None:
+            args = ["taskset", "--cpu-list", format_cpu_list(cpus)] + args
+        pids.append(subprocess.Popen(args).pid)
+    times = dict()
+    while len(times) < len(pids):
+        pid, _, usage = os.wait4(-1, 0)
+        times[pid] = usage.ru_utime + usage.ru_stime
+    return [times[pid] for pid in pids]
+
+
+def measure(command, slot_cpus, runs):
+    """Time the command in all the slots, many times.
+
+    command ([unicode]): the command.
+    slot_cpus ([[int]|None]): for each slot, the CPUs to pin it to, or
+        None.
+    runs (int): the number of rounds.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    samples = [[] for _ in slot_cpus]
+    for _ in xrange(runs):
+        for slot, time in enumerate(run_round(command, slot_cpus)):
+            samples[slot].append(time)
+
+    results = []
+    all_samples = sum(samples, [])
+    for name, times in [("slot %d" % slot, times)
+                        for slot, times in enumerate(samples)] + \
+            [("all slots", all_samples)]:
+        mean = sum(times) / len(times)
+        stdev = math.sqrt(sum((time - mean) ** 2 for time in times)
+                          / len(times))
+        results += [
+            ("%s mean" % name, mean, "s"),
+            ("%s stdev" % name, stdev, "s (%.1f%%)" % (100 * stdev / mean)),
+            ("%s spread" % name, max(times) - min(times), "s"),
+        ]
+    return results
+
+
+def main():
+    cores = get_cores()
+    parser = argparse.ArgumentParser(
+        description="Measure the variation of the timings of execution "
+        "slots running together, with and without pinning them to CPUs.")
+    parser.add_argument("-s", "--slots", action="store", type=int,
+                        default=len(cores), help="number of slots")
+    parser.add_argument("-r", "--runs", action="store", type=int,
+                        default=20, help="number of rounds")
+    parser.add_argument("-l", "--loops", action="store", type=int,
+                        default=3000000,
+                        help="iterations of the timed program")
+    parser.add_argument("--keep-smt-siblings", action="store_true",
+                        help="pin also to the SMT siblings of the cores")
+    args = parser.parse_args()
+
+    command = [sys.executable, "-c",
+               "for i in xrange(%d): pass" % args.loops]
+    slot_cpus = split_cores(cores, args.slots, not args.keep_smt_siblings)
+    print("%d cores, %d slots." % (len(cores), args.slots))
+    for slot, cpus in enumerate(slot_cpus):
+        print("  slot %d: CPUs %s" % (slot, format_cpu_list(cpus)))
+
+    print_results("Not pinned:",
+                  measure(command, [None] * args.slots, args.runs))
+    print_results("Pinned:", measure(command, slot_cpus, args.runs))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
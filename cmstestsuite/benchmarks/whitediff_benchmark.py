@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the white diff comparator on large outputs.
+
+Write synthetic outputs (many short lines of numbers, or a single long
+line of them) to temporary files, with the same bytes as the correct
+output, with different whitespaces, or with a wrong value near the
+end, and compare them with the line by line implementation and with
+white_diff.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from cms.grading import _white_diff_by_line, white_diff
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+def write_output(path, size, per_line, spaces=b" ", newline=b"\n",
+                 wrong=False):
+    """Write a synthetic output of random numbers.
+
+    path (unicode): the path of the file.
+    size (int): the approximate size of the file (with spaces and
+        newlines of one byte), in bytes.
+    per_line (int): the number of numbers in each line.
+    spaces (bytes): the separator of the numbers in a line.
+    newline (bytes): the separator of the lines.
+    wrong (bool): whether to change a number near the end.
+
+    """
+    rand = random.Random(0)
+    numbers = [b"%d" % rand.randint(0, 10 ** 9) for _ in xrange(per_line)]
+    line_size = len(b" ".join(numbers)) + 1
+    line = spaces.join(numbers) + newline
+    with io.open(path, "wb") as f:
+        f.write(line * max(1, size // line_size))
+        f.write((b"0 " if wrong else b"1 ") + line)
+
+
+def measure(compare, output, res):
+    """Time comparing two files.
+
+    compare (function): the comparator.
+    output (unicode): the path of the first file.
+    res (unicode): the path of the second file.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    with io.open(output, "rb") as output_file, \
+            io.open(res, "rb") as res_file:
+        with Timer() as timer:
+            result = compare(output_file, res_file)
+    size = os.path.getsize(output) / 1024.0 / 1024.0
+    return [
+        ("total", timer.elapsed, "s"),
+        ("throughput", size / timer.elapsed, "MB/s"),
+        ("equal", int(result), ""),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the white diff comparator on large "
+        "synthetic outputs.")
+    parser.add_argument("-s", "--size", action="store", type=int,
+                        default=100, help="size of the outputs, in MB")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        size = args.size * 1024 * 1024
+        res = os.path.join(temp_dir, "res")
+        output = os.path.join(temp_dir, "output")
+        cases = [
+            ("Short lines, same bytes", 10, b" ", b"\n", False),
+            ("Short lines, other whitespaces", 10, b" \t", b" \r\n",
+             False),
+            ("Short lines, wrong at the end", 10, b" ", b"\n", True),
+            ("One long line, same bytes", 1000, b" ", b" ", False),
+            ("One long line, other whitespaces", 1000, b"  ", b"  ",
+             False),
+        ]
+        for name, per_line, spaces, newline, wrong in cases:
+            write_output(res, size, per_line,
+                         newline=b"\n" if b"\n" in newline else b" ")
+            write_output(output, size, per_line, spaces, newline, wrong)
+            print("%s:" % name)
+            print_results("  Line by line:",
+                          measure(_white_diff_by_line, output, res))
+            print_results("  Chunked:", measure(white_diff, output, res))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of writing the results of the evaluations to the database.
+
+Create a contest with compiled submissions on a dataset, then write a
+synthetic stream of evaluation results (a few of them failures) in
+flushes, as ES does: first as ES used to, through the ORM with a
+savepoint for each evaluation, then with the set-based statements of
+cms.db.bulkwrite. Everything created is deleted at the end.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import random
+import sys
+
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from cms.db import SessionGen, Contest, Dataset, Evaluation, \
+    Participation, Submission, SubmissionResult, Task, Testcase, User
+from cms.db.bulkwrite import set_evaluation_outcomes
+from cms.grading.Job import EvaluationJob
+from cms.service.EvaluationService import EvaluationService, Result
+from cms.service.esoperations import ESOperation
+from cmstestsuite.benchmarks import Timer, print_results
+
+
+def create_data(session, submissions, testcases):
+    """Create a contest with compiled submissions on a dataset.
+
+    session (Session): the session to use.
+    submissions (int): the number of submissions.
+    testcases (int): the number of testcases of the dataset.
+
+    return ((int, int, int)): the ids of the contest, the user and the
+        dataset.
+
+    """
+    name = "benchmark_%d" % random.randint(0, 2 ** 31)
+    contest = Contest(name=name, description=name)
+    user = User(username=name, password="", first_name="", last_name="")
+    participation = Participation(user=user, contest=contest)
+    task = Task(contest=contest, name=name, title=name)
+    dataset = Dataset(task=task, description=name, task_type="",
+                      task_type_parameters="", score_type="",
+                      score_type_parameters="")
+    for i in xrange(testcases):
+        Testcase(dataset=dataset, codename="%03d" % i,
+                 input="%040x" % (2 * i), output="%040x" % (2 * i + 1))
+    for i in xrange(submissions):
+        submission = Submission(
+            task=task, participation=participation,
+            timestamp=contest.start + timedelta(seconds=i))
+        SubmissionResult(submission=submission, dataset=dataset,
+                         compilation_outcome="ok")
+    session.add(contest)
+    session.commit()
+    return contest.id, user.id, dataset.id
+
+
+def make_results(session, dataset_id, failures):
+    """Return the results of evaluating all the submissions.
+
+    session (Session): the session to use.
+    dataset_id (int): the id of the dataset.
+    failures (float): the fraction of failed evaluations.
+
+    return ([(ESOperation, Result)]): the results, in random order.
+
+    """
+    dataset = Dataset.get_from_id(dataset_id, session)
+    items = []
+    for submission in dataset.task.submissions:
+        for codename in dataset.testcases:
+            operation = ESOperation(ESOperation.EVALUATION, submission.id,
+                                    dataset_id, codename)
+            success = random.random() >= failures
+            job = EvaluationJob(
+                operation=operation.to_dict(), shard=0,
+                sandboxes=["/tmp/box"], success=success,
+                outcome="1.0" if success else None,
+                text=["Output is correct"],
+                plus={"execution_time": 0.1,
+                      "execution_wall_clock_time": 0.2,
+                      "execution_memory": 1024 * 1024})
+            items.append((operation, Result(job, success)))
+    random.shuffle(items)
+    return items
+
+
+def group(items):
+    """Group the results by submission, as ES does.
+
+    items ([(ESOperation, Result)]): the results.
+
+    return ({(int, int): [(ESOperation, Result)]}): the results for
+        each pair of submission id and dataset id.
+
+    """
+    by_object = defaultdict(list)
+    for operation, result in items:
+        by_object[(operation.object_id, operation.dataset_id)].append(
+            (operation, result))
+    return by_object
+
+
+def load(session, by_object):
+    """Load the submission results of some results, as ES used to.
+
+    session (Session): the session to use.
+    by_object ({(int, int): [(ESOperation, Result)]}): the results.
+
+    return ({(int, int): SubmissionResult}): the submission results.
+
+    """
+    datasets = dict()
+    srs = dict()
+    for submission_id, dataset_id in by_object:
+        if dataset_id not in datasets:
+            datasets[dataset_id] = session.query(Dataset)\
+                .filter(Dataset.id == dataset_id)\
+                .options(joinedload(Dataset.testcases))\
+                .first()
+        srs[(submission_id, dataset_id)] = \
+            Submission.get_from_id(submission_id, session)\
+            .get_result_or_create(datasets[dataset_id])
+    return srs
+
+
+def write_by_row(session, items):
+    """Write a flush of results through the ORM, one at a time.
+
+    session (Session): the session to use.
+    items ([(ESOperation, Result)]): the results.
+
+    """
+    by_object = group(items)
+    srs = load(session, by_object)
+    for key, operation_results in by_object.iteritems():
+        sr = srs[key]
+        for _, result in operation_results:
+            try:
+                with session.begin_nested():
+                    if result.job_success:
+                        result.job.to_submission(sr)
+                    else:
+                        sr.evaluation_tries += 1
+            except IntegrityError:
+                pass
+    session.commit()
+    for key in by_object:
+        sr = srs[key]
+        if len(sr.evaluations) == len(sr.dataset.testcases):
+            sr.set_evaluation_outcome()
+    session.commit()
+
+
+def write_in_bulk(session, items):
+    """Write a flush of results with the set-based statements.
+
+    session (Session): the session to use.
+    items ([(ESOperation, Result)]): the results.
+
+    """
+    by_object = group(items)
+    srs = EvaluationService._get_submission_results(
+        session, by_object.keys())
+    # Loaded with their testcases, which are needed for the rows.
+    EvaluationService._get_datasets(
+        session, set(sr.dataset_id for sr in srs))
+    rows = []
+    tries = defaultdict(int)
+    for sr in srs:
+        EvaluationService.collect_evaluation_results(
+            sr, by_object[(sr.submission_id, sr.dataset_id)], rows, tries)
+    EvaluationService.write_evaluations_in_bulk(session, rows, tries)
+    set_evaluation_outcomes(session, by_object.keys())
+    session.commit()
+
+
+def measure(dataset_id, items, flush_size, write):
+    """Time writing the results, and then delete them.
+
+    dataset_id (int): the id of the dataset.
+    items ([(ESOperation, Result)]): the results.
+    flush_size (int): the number of results in each flush.
+    write (function): the function writing a flush.
+
+    return ([(unicode, float|int, unicode)]): the results.
+
+    """
+    with Timer() as timer:
+        for start in xrange(0, len(items), flush_size):
+            with SessionGen() as session:
+                write(session, items[start:start + flush_size])
+
+    with SessionGen() as session:
+        evaluations = session.query(Evaluation)\
+            .filter(Evaluation.dataset_id == dataset_id).count()
+        evaluated = session.query(SubmissionResult)\
+            .filter(SubmissionResult.dataset_id == dataset_id)\
+            .filter(SubmissionResult.filter_evaluated()).count()
+        session.query(Evaluation)\
+            .filter(Evaluation.dataset_id == dataset_id)\
+            .delete(synchronize_session=False)
+        session.query(SubmissionResult)\
+            .filter(SubmissionResult.dataset_id == dataset_id)\
+            .update({"evaluation_outcome": None, "evaluation_tries": 0},
+                    synchronize_session=False)
+        session.commit()
+
+    return [
+        ("total", timer.elapsed, "s"),
+        ("throughput", len(items) / timer.elapsed, "results/s"),
+        ("evaluations written", evaluations, ""),
+        ("submissions evaluated", evaluated, ""),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark writing evaluation results to the "
+        "database.")
+    parser.add_argument("-s", "--submissions", action="store", type=int,
+                        default=200, help="number of submissions")
+    parser.add_argument("-t", "--testcases", action="store", type=int,
+                        default=50, help="number of testcases")
+    parser.add_argument("-f", "--flush-size", action="store", type=int,
+                        default=1000, help="number of results in a flush")
+    parser.add_argument("--failures", action="store", type=float,
+                        default=0.01, help="fraction of failed results")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with SessionGen() as session:
+        contest_id, user_id, dataset_id = create_data(
+            session, args.submissions, args.testcases)
+    try:
+        with SessionGen() as session:
+            items = make_results(session, dataset_id, args.failures)
+        print("%d results." % len(items))
+        print_results("One row at a time:",
+                      measure(dataset_id, items, args.flush_size,
+                              write_by_row))
+        print_results("Bulk writes:",
+                      measure(dataset_id, items, args.flush_size,
+                              write_in_bulk))
+    finally:
+        with SessionGen() as session:
+            session.delete(Contest.get_from_id(contest_id, session))
+            session.delete(User.get_from_id(user_id, session))
+            session.commit()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the set-based writes of the evaluation results.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import patch
+from sqlalchemy.exc import IntegrityError
+
+from cmstestsuite.unit_tests.testdbgenerator import TestCaseWithDatabase
+
+from cms.db import Evaluation
+from cms.db.bulkwrite import EVALUATION_COLUMNS, increment_evaluation_tries, \
+    insert_evaluations, set_evaluation_outcomes
+
+
+class TestBulkWrite(TestCaseWithDatabase):
+
+    def setUp(self):
+        super(TestBulkWrite, self).setUp()
+        self.dataset = self.add_dataset()
+        self.testcases = [self.add_testcase(self.dataset) for _ in xrange(3)]
+        self.srs = [self.add_submission_result(dataset=self.dataset)
+                    for _ in xrange(2)]
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.close()
+        super(TestBulkWrite, self).tearDown()
+
+    def row(self, sr, testcase, outcome="1.0"):
+        row = dict((column, None) for column in EVALUATION_COLUMNS)
+        row.update({"submission_id": sr.submission_id,
+                    "dataset_id": sr.dataset_id,
+                    "testcase_id": testcase.id,
+                    "outcome": outcome,
+                    "text": "[\"Correct\"]",
+                    "execution_time": 0.5,
+                    "evaluation_shard": 2})
+        return row
+
+    def evaluations(self, sr):
+        return dict((evaluation.testcase_id, evaluation.outcome)
+                    for evaluation in self.session.query(Evaluation)
+                    .filter(Evaluation.submission_id == sr.submission_id)
+                    .filter(Evaluation.dataset_id == sr.dataset_id))
+
+    def test_insert(self):
+        """Duplicates are skipped and returned."""
+        self.add_evaluation(self.srs[0], self.testcases[0], outcome="0.0")
+        self.session.flush()
+        rows = [self.row(sr, testcase)
+                for sr in self.srs for testcase in self.testcases]
+        with patch("cms.db.bulkwrite.CHUNK_SIZE", 4):
+            skipped = insert_evaluations(self.session, rows)
+        self.assertEqual(skipped, rows[:1])
+        self.assertEqual(self.evaluations(self.srs[0]), {
+            self.testcases[0].id: "0.0",
+            self.testcases[1].id: "1.0",
+            self.testcases[2].id: "1.0"})
+        self.assertEqual(len(self.evaluations(self.srs[1])), 3)
+
+    def test_insert_invalid(self):
+        row = self.row(self.srs[0], self.testcases[0])
+        row["testcase_id"] = -1
+        with self.assertRaises(IntegrityError):
+            insert_evaluations(self.session, [row])
+
+    def test_tries(self):
+        increment_evaluation_tries(self.session, {
+            (self.srs[0].submission_id, self.srs[0].dataset_id): 2})
+        increment_evaluation_tries(self.session, {
+            (self.srs[0].submission_id, self.srs[0].dataset_id): 1,
+            (self.srs[1].submission_id, self.srs[1].dataset_id): 1})
+        self.session.expire_all()
+        self.assertEqual([sr.evaluation_tries for sr in self.srs], [3, 1])
+
+    def test_outcomes(self):
+        """Only complete submission results are marked as evaluated."""
+        insert_evaluations(self.session, [
+            self.row(self.srs[0], testcase) for testcase in self.testcases] +
+            [self.row(self.srs[1], self.testcases[0])])
+        keys = [(sr.submission_id, sr.dataset_id) for sr in self.srs]
+        self.assertEqual(set_evaluation_outcomes(self.session, keys),
+                         set(keys[:1]))
+        self.session.expire_all()
+        self.assertTrue(self.srs[0].evaluated())
+        self.assertFalse(self.srs[1].evaluated())
+
+        # Those already evaluated are not returned again.
+        self.assertEqual(set_evaluation_outcomes(self.session, keys), set())
+
+
+class TestBulkWriteOldServer(TestBulkWrite):
+    """The same tests, as if the server didn't support ON CONFLICT."""
+
+    def setUp(self):
+        super(TestBulkWriteOldServer, self).setUp()
+        patcher = patch("cms.db.bulkwrite.ON_CONFLICT_SERVER_VERSION",
+                        (1000,))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+if __name__ == "__main__":
+    unittest.main()
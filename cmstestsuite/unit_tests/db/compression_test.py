@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the compression of stored files.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import unittest
+
+from cms.db.compression import CODECS, CompressingWriter, \
+    DecompressingReader, get_uncompressed_size, should_compress
+
+
+class TestCompression(unittest.TestCase):
+
+    def compress(self, content, codec, chunk_size):
+        dst = io.BytesIO()
+        # Keep the content when the writer closes dst.
+        dst.close = lambda: None
+        with CompressingWriter(dst, codec) as writer:
+            for i in xrange(0, len(content), chunk_size):
+                writer.write(content[i:i + chunk_size])
+        return dst.getvalue()
+
+    def test_round_trip(self):
+        """Content survives compression and decompression with every
+        codec, in any chunking.
+
+        """
+        content = os.urandom(5000) + b"a" * 100000 + os.urandom(5000)
+        for codec in CODECS:
+            compressed = self.compress(content, codec, 1000)
+            self.assertLess(len(compressed), len(content))
+            reader = DecompressingReader(io.BytesIO(compressed), codec)
+            chunks = []
+            buf = reader.read(777)
+            while len(buf) > 0:
+                chunks.append(buf)
+                buf = reader.read(777)
+            reader.close()
+            self.assertEqual(b"".join(chunks), content)
+            self.assertEqual(
+                get_uncompressed_size(io.BytesIO(compressed), codec),
+                len(content))
+
+    def test_empty(self):
+        """An empty file is compressed and decompressed correctly.
+
+        """
+        compressed = self.compress(b"", "zlib", 1)
+        with DecompressingReader(io.BytesIO(compressed), "zlib") as reader:
+            self.assertEqual(reader.read(), b"")
+
+    def test_should_compress(self):
+        """Only large enough compressible files are compressed.
+
+        """
+        self.assertTrue(should_compress(b"1 2 3\n" * 10000, "zlib"))
+        self.assertFalse(should_compress(b"1 2 3\n", "zlib"))
+        self.assertFalse(should_compress(os.urandom(10000), "zlib"))
+        # The size of the whole file matters, not the one of the sample.
+        self.assertTrue(should_compress(b"1 2 3\n" * 10, "zlib", 100000))
+
+
+if __name__ == "__main__":
+    unittest.main()
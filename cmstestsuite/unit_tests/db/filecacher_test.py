@@ -28,15 +28,27 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
 import io
 import os
 import random
 from StringIO import StringIO
 import hashlib
 import shutil
+import stat
+import tempfile
 import unittest
 
-from cms.db.filecacher import FileCacher
+import gevent
+from mock import Mock, patch
+from sqlalchemy import text
+
+from cms import config
+from cms.db import SessionGen, FSObject
+from cms.db import filecacher
+from cms.db.compression import CODECS
+from cms.db.filecacher import FileCacher, FSBackend, TombstoneError
+from cms.db.fsobject import LargeObjectConnectionPool
 
 
 class RandomFile(object):
@@ -323,6 +335,768 @@ class TestFileCacher(unittest.TestCase):
         finally:
             self.file_cacher.delete(self.digest)
 
+    def test_load_many(self):
+        """Put some files (one bigger than what is fetched by the first
+        query of a batch) into the storage, drop them from the cache,
+        then load them back together with a missing file and the
+        tombstone.
+
+        """
+        contents = [os.urandom(100) for unused_i in xrange(5)]
+        contents.append(os.urandom(1000000))
+        digests = [self.file_cacher.put_file_content(content, u"Test #008")
+                   for content in contents]
+        try:
+            for digest in digests[1:]:
+                self.file_cacher.drop(digest)
+            missing = "0" * 40
+
+            errors = self.file_cacher.load_many(
+                digests + [missing, FileCacher.TOMBSTONE_DIGEST])
+
+            self.assertEqual(set(errors), set([
+                missing, FileCacher.TOMBSTONE_DIGEST]))
+            self.assertIsInstance(errors[missing], KeyError)
+            for digest, content in zip(digests, contents):
+                with io.open(os.path.join(self.cache_base_path, digest),
+                             "rb") as cached_file:
+                    self.assertEqual(cached_file.read(), content)
+            stats = self.file_cacher.get_cache_stats()
+            self.assertEqual(stats["hits"], 1)
+            self.assertEqual(stats["misses"], 5)
+        finally:
+            for digest in digests:
+                self.file_cacher.delete(digest)
+
+    def test_digest_hint(self):
+        """Files already in the backend are not sent again when their
+        digest is given as a hint, and wrong hints are detected.
+
+        """
+        content = os.urandom(200000)
+        other_content = os.urandom(200000)
+        digest = self.file_cacher.put_file_content(content, u"Test #009")
+        other_digest = None
+        try:
+            self.file_cacher.drop(digest)
+            backend = self.file_cacher.backend
+            with patch.object(backend, "create_file") as create_file, \
+                    patch.object(backend, "put_file") as put_file:
+                self.assertEqual(self.file_cacher.put_file_content(
+                    content, u"Test #009", digest=digest), digest)
+                self.assertFalse(create_file.called)
+                self.assertFalse(put_file.called)
+            self.assertEqual(self.file_cacher.get_file_content(digest),
+                             content)
+
+            other_digest = self.file_cacher.put_file_content(
+                other_content, u"Test #010", digest=digest)
+            self.assertNotEqual(other_digest, digest)
+            self.file_cacher.drop(other_digest)
+            self.assertEqual(self.file_cacher.get_file_content(other_digest),
+                             other_content)
+        finally:
+            self.file_cacher.delete(digest)
+            if other_digest is not None:
+                self.file_cacher.delete(other_digest)
+
+    def test_touch(self):
+        """Touching a file writes its row again, so that a concurrent
+        collection of orphans keeps it.
+
+        """
+        def get_version():
+            with SessionGen() as session:
+                return session.execute(
+                    text("SELECT CAST(xmin AS TEXT) FROM fsobjects "
+                         "WHERE digest = :digest"),
+                    {"digest": digest}).scalar()
+
+        digest = self.file_cacher.put_file_content(b"touch", u"Test #011")
+        try:
+            version = get_version()
+            self.assertTrue(self.file_cacher.touch(digest))
+            self.assertNotEqual(get_version(), version)
+            self.assertEqual(self.file_cacher.describe(digest), u"Test #011")
+        finally:
+            self.file_cacher.delete(digest)
+        self.assertFalse(self.file_cacher.touch(digest))
+        with self.assertRaises(TombstoneError):
+            self.file_cacher.touch(FileCacher.TOMBSTONE_DIGEST)
+
+
+class TestFileCacherCompression(unittest.TestCase):
+    """Tests for storing compressed files in the database.
+
+    """
+
+    def setUp(self):
+        self.file_cacher = FileCacher()
+        self.file_cacher.compression = "zlib"
+        self.cache_base_path = self.file_cacher.file_dir
+        self.digests = []
+
+    def tearDown(self):
+        for digest in self.digests:
+            self.file_cacher.delete(digest)
+        shutil.rmtree(self.cache_base_path, ignore_errors=True)
+
+    def put(self, content):
+        digest = self.file_cacher.put_file_content(content, "Test")
+        self.digests.append(digest)
+        return digest
+
+    def get_compression(self, digest):
+        with SessionGen() as session:
+            return FSObject.get_from_digest(digest, session).compression
+
+    def set_size(self, digest, size):
+        with SessionGen() as session:
+            FSObject.get_from_digest(digest, session).size = size
+            session.commit()
+
+    def test_compressible_file(self):
+        """Compressible files are stored compressed, but read and
+        cached uncompressed.
+
+        """
+        content = b"1 2 3 4 5\n" * 10000
+        digest = self.put(content)
+        self.assertEqual(self.get_compression(digest), "zlib")
+
+        self.file_cacher.purge_cache()
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+        with io.open(os.path.join(self.cache_base_path, digest), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.file_cacher.get_size(digest), len(content))
+
+        self.file_cacher.purge_cache()
+        self.assertEqual(self.file_cacher.load_many([digest]), {})
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+
+    def test_recorded_size(self):
+        """The size of a compressed file is recorded when storing it,
+        and computed only for the files stored before.
+
+        """
+        content = b"1 2 3 4 5\n" * 10000
+        digest = self.put(content)
+        backend = self.file_cacher.backend
+        with patch("cms.db.filecacher.get_uncompressed_size",
+                   Mock(side_effect=AssertionError())):
+            self.assertEqual(backend.get_size(digest), len(content))
+
+        self.set_size(digest, None)
+        self.assertEqual(backend.get_size(digest), len(content))
+        self.assertTrue(backend.set_compression(digest, None))
+        with patch("cms.db.filecacher.get_uncompressed_size",
+                   Mock(side_effect=AssertionError())):
+            self.assertEqual(backend.get_size(digest), len(content))
+
+    def test_incomplete_file(self):
+        """A file whose content doesn't match its digest is not stored.
+
+        """
+        content = b"1 2 3 4 5\n" * 10000
+        digest = hashlib.sha1(content).hexdigest().decode("ascii")
+        backend = self.file_cacher.backend
+        fobj = backend.put_file(digest, "Test", compression="zlib")
+        fobj.write(content[:50])
+        fobj.close()
+        with self.assertRaises(KeyError):
+            backend.get_size(digest)
+
+        fobj = backend.put_file(digest, "Test", compression="zlib")
+        fobj.write(content)
+        fobj.close()
+        self.digests.append(digest)
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+
+    def test_incompressible_file(self):
+        """Small and random files are stored uncompressed.
+
+        """
+        small = self.put(b"1 2 3\n")
+        random_ = self.put(os.urandom(100000))
+        self.assertIsNone(self.get_compression(small))
+        self.assertIsNone(self.get_compression(random_))
+
+    def test_set_compression(self):
+        """Files can be compressed and decompressed after being stored.
+
+        """
+        self.file_cacher.compression = None
+        content = b"abc" * 10000
+        digest = self.put(content)
+        self.assertIsNone(self.get_compression(digest))
+
+        backend = self.file_cacher.backend
+        self.assertTrue(backend.set_compression(digest, "zlib"))
+        self.assertFalse(backend.set_compression(digest, "zlib"))
+        self.assertEqual(self.get_compression(digest), "zlib")
+        self.file_cacher.purge_cache()
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+
+        self.assertTrue(backend.set_compression(digest, None))
+        self.assertIsNone(self.get_compression(digest))
+        self.file_cacher.purge_cache()
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+
+    def test_set_compression_one_connection(self):
+        """Compression can be changed with a single connection for
+        large objects.
+
+        """
+        content = b"abc" * 10000
+        digest = self.put(content)
+        backend = self.file_cacher.backend
+        with patch("cms.db.fsobject.lo_connection_pool",
+                   LargeObjectConnectionPool(1, timeout=1)):
+            self.assertTrue(backend.set_compression(digest, None))
+            self.assertEqual(backend.get_size(digest), len(content))
+        self.assertIsNone(self.get_compression(digest))
+
+
+class TestFileCacherEviction(unittest.TestCase):
+    """Tests for the size-bounded local cache of FileCacher.
+
+    """
+
+    def setUp(self):
+        # The null backend is enough, as we just exercise the cache.
+        self.file_cacher = FileCacher(null=True)
+        self.file_cacher.max_cache_size = 250
+        self.cache_base_path = self.file_cacher.file_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_base_path, ignore_errors=True)
+
+    def put_file(self, access_time):
+        """Put a 100B random file in the cache and set its access time.
+
+        access_time (int): the access time to set.
+
+        return (unicode): the digest of the file.
+
+        """
+        digest = self.file_cacher.put_file_content(os.urandom(100))
+        os.utime(os.path.join(self.cache_base_path, digest),
+                 (access_time, access_time))
+        return digest
+
+    def in_cache(self, digest):
+        return os.path.exists(os.path.join(self.cache_base_path, digest))
+
+    def test_evict_least_recently_used(self):
+        """The oldest file is evicted when the cache is full, taking
+        into account the accesses through get_file.
+
+        """
+        first = self.put_file(1000)
+        second = self.put_file(2000)
+        self.file_cacher.get_file(first).close()
+        third = self.file_cacher.put_file_content(os.urandom(100))
+
+        self.assertTrue(self.in_cache(first))
+        self.assertFalse(self.in_cache(second))
+        self.assertTrue(self.in_cache(third))
+
+        stats = self.file_cacher.get_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["evicted_bytes"], 100)
+        self.assertEqual(stats["size"], 200)
+
+    def test_pinned_files_are_not_evicted(self):
+        """Pinned files survive eviction, even when pinned by another
+        FileCacher sharing the directory; unpinned ones don't.
+
+        """
+        first = self.put_file(1000)
+        second = self.put_file(2000)
+
+        other = FileCacher(null=True)
+        other.file_dir = self.file_cacher.file_dir
+        other.pins_dir = self.file_cacher.pins_dir
+        try:
+            other.pin(first)
+            self.file_cacher.pin(second)
+            third = self.file_cacher.put_file_content(os.urandom(100))
+            self.assertTrue(self.in_cache(first))
+            self.assertTrue(self.in_cache(second))
+            self.assertFalse(self.in_cache(third))
+
+            other.unpin(first)
+            self.file_cacher.evict(target_size=0)
+            self.assertFalse(self.in_cache(first))
+            self.assertTrue(self.in_cache(second))
+        finally:
+            self.file_cacher.unpin(second)
+            shutil.rmtree(other.temp_dir, ignore_errors=True)
+
+    def test_pin_files_are_deleted(self):
+        """The pin file of a file is deleted when its last pin is
+        released, and not before.
+
+        """
+        digest = self.put_file(100)
+        pin_path = os.path.join(self.file_cacher.pins_dir, digest)
+
+        other = FileCacher(null=True)
+        other.file_dir = self.file_cacher.file_dir
+        other.pins_dir = self.file_cacher.pins_dir
+        try:
+            self.file_cacher.pin(digest)
+            self.file_cacher.pin(digest)
+            other.pin(digest)
+            self.file_cacher.unpin(digest)
+            self.file_cacher.unpin(digest)
+            self.assertTrue(os.path.exists(pin_path))
+            other.unpin(digest)
+            self.assertFalse(os.path.exists(pin_path))
+
+            # Pinning again works as the first time.
+            self.file_cacher.pin(digest)
+            self.file_cacher.evict(target_size=0)
+            self.assertTrue(self.in_cache(digest))
+            self.file_cacher.unpin(digest)
+            self.assertEqual(os.listdir(self.file_cacher.pins_dir), [])
+        finally:
+            shutil.rmtree(other.temp_dir, ignore_errors=True)
+
+    def test_unbounded(self):
+        """Nothing is evicted when there is no maximum size.
+
+        """
+        self.file_cacher.max_cache_size = None
+        digests = [self.put_file(1000 + i) for i in xrange(5)]
+        self.assertTrue(all(self.in_cache(digest) for digest in digests))
+        self.assertEqual(self.file_cacher.get_cache_stats()["evictions"], 0)
+
+
+class TestFileCacherSharedCache(unittest.TestCase):
+    """Tests for the local cache shared by the services of a machine.
+
+    """
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        self.storage_path = os.path.join(self.base_dir, "storage")
+        patcher = patch.object(config, "cache_dir",
+                               os.path.join(self.base_dir, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def make_file_cacher(self, shard):
+        service = Mock()
+        service.name = "Worker"
+        service.shard = shard
+        return FileCacher(service, path=self.storage_path)
+
+    def test_directory(self):
+        """Shards share the cache directory, unless configured not to.
+
+        """
+        self.assertEqual(self.make_file_cacher(0).file_dir,
+                         self.make_file_cacher(1).file_dir)
+        with patch.object(config, "shared_cache", False):
+            self.assertNotEqual(self.make_file_cacher(0).file_dir,
+                                self.make_file_cacher(1).file_dir)
+
+    def test_single_flight(self):
+        """A file needed at the same time by many services sharing the
+        cache is downloaded only once.
+
+        """
+        first = self.make_file_cacher(0)
+        second = self.make_file_cacher(1)
+        content = os.urandom(100)
+        digest = first.put_file_content(content)
+        first.drop(digest)
+
+        fetches = []
+        get_file = FSBackend.get_file
+
+        def slow_get_file(backend, digest):
+            fetches.append(digest)
+            # Give the other greenlets the time to ask for the file.
+            gevent.sleep(0.2)
+            return get_file(backend, digest)
+
+        with patch.object(FSBackend, "get_file", slow_get_file):
+            greenlets = [
+                gevent.spawn(first.get_file_content, digest),
+                gevent.spawn(second.get_file_content, digest),
+                gevent.spawn(second.load_many, [digest]),
+            ]
+            gevent.joinall(greenlets, raise_error=True)
+
+        self.assertEqual(fetches, [digest])
+        self.assertEqual(greenlets[0].value, content)
+        self.assertEqual(greenlets[1].value, content)
+        self.assertEqual(greenlets[2].value, {})
+        self.assertEqual(os.listdir(first.fetch_dir), [])
+
+    def test_shared_size(self):
+        """The size of the cache accounts for the files of everyone.
+
+        """
+        first = self.make_file_cacher(0)
+        second = self.make_file_cacher(1)
+        first.max_cache_size = second.max_cache_size = 250
+        first.put_file_content(os.urandom(100))
+        second.put_file_content(os.urandom(100))
+        self.assertEqual(second.get_cache_stats()["size"], 200)
+        first.put_file_content(os.urandom(100))
+        self.assertEqual(first.get_cache_stats()["evictions"], 1)
+
+
+class TestFileCacherLinks(unittest.TestCase):
+    """Tests for link_file_to_path.
+
+    """
+
+    def setUp(self):
+        self.file_cacher = FileCacher(null=True)
+        self.cache_base_path = self.file_cacher.file_dir
+        # Created in the same directory as the cache, so that linking
+        # is possible.
+        self.dst_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        self.content = os.urandom(100)
+        self.digest = self.file_cacher.put_file_content(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_base_path, ignore_errors=True)
+        shutil.rmtree(self.dst_dir, ignore_errors=True)
+
+    def test_hardlink(self):
+        """Without reflinks, the file is hard linked and made read-only,
+        widening the permissions of previous links.
+
+        """
+        cache_path = os.path.join(self.cache_base_path, self.digest)
+        first = os.path.join(self.dst_dir, "first")
+        second = os.path.join(self.dst_dir, "second")
+        with patch.object(FileCacher, "_reflink",
+                          side_effect=OSError(errno.EOPNOTSUPP, "")):
+            self.assertTrue(self.file_cacher.link_file_to_path(
+                self.digest, first, 0o755))
+            self.assertTrue(self.file_cacher.link_file_to_path(
+                self.digest, second, 0o644))
+
+        self.assertEqual(os.stat(first).st_ino, os.stat(cache_path).st_ino)
+        self.assertEqual(os.stat(second).st_ino, os.stat(cache_path).st_ino)
+        self.assertEqual(stat.S_IMODE(os.stat(cache_path).st_mode), 0o555)
+        with io.open(second, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_cross_device(self):
+        """Nothing is created when no link is possible, and no link is
+        attempted again on the same device.
+
+        """
+        dst = os.path.join(self.dst_dir, "file")
+        with patch.object(FileCacher, "_reflink",
+                          side_effect=OSError(errno.EOPNOTSUPP, "")), \
+                patch("os.link", side_effect=OSError(errno.EXDEV, "")) \
+                as link:
+            self.assertFalse(self.file_cacher.link_file_to_path(
+                self.digest, dst))
+            self.assertFalse(self.file_cacher.link_file_to_path(
+                self.digest, dst))
+            self.assertEqual(link.call_count, 1)
+        self.assertFalse(os.path.exists(dst))
+
+    def test_no_hardlink(self):
+        """When hard links are not allowed, the cached copy is never
+        shared.
+
+        """
+        cache_path = os.path.join(self.cache_base_path, self.digest)
+        dst = os.path.join(self.dst_dir, "file")
+        if self.file_cacher.link_file_to_path(self.digest, dst, 0o644,
+                                              hardlink=False):
+            # The file system supports reflinks.
+            self.assertNotEqual(os.stat(dst).st_ino,
+                                os.stat(cache_path).st_ino)
+            self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0o644)
+        else:
+            self.assertFalse(os.path.exists(dst))
+
+    def test_existing_destination(self):
+        """Existing files are never replaced.
+
+        """
+        dst = os.path.join(self.dst_dir, "file")
+        io.open(dst, "wb").close()
+        with self.assertRaises(OSError):
+            self.file_cacher.link_file_to_path(self.digest, dst)
+
+
+class TestFileCacherIntegrity(unittest.TestCase):
+    """Tests for check_backend_integrity.
+
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file_cacher = FileCacher(path=self.path)
+        self.digests = [self.file_cacher.put_file_content(os.urandom(1000))
+                        for unused_i in xrange(5)]
+        self.checkpoint_path = os.path.join(self.path, ".checkpoint")
+
+        # Corrupt a file.
+        self.corrupted = self.digests[0]
+        with io.open(self.file_cacher.backend.get_path(self.corrupted),
+                     "wb") as stored:
+            stored.write(b"corrupted")
+
+    def tearDown(self):
+        self.file_cacher.destroy_cache()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_check(self):
+        """Corrupted files are found, both serially and in parallel.
+
+        """
+        self.assertFalse(self.file_cacher.check_backend_integrity())
+        self.assertFalse(self.file_cacher.check_backend_integrity(workers=2))
+        self.assertFalse(
+            self.file_cacher.check_backend_integrity(delete=True, workers=2))
+        self.assertTrue(self.file_cacher.check_backend_integrity(workers=2))
+        self.assertEqual(
+            sorted(digest for digest, _ in self.file_cacher.list()),
+            sorted(self.digests[1:]))
+
+    def test_checkpoint(self):
+        """Files verified by a previous run are skipped.
+
+        """
+        self.assertFalse(self.file_cacher.check_backend_integrity(
+            workers=2, checkpoint_path=self.checkpoint_path))
+        with io.open(self.checkpoint_path, "rt") as checkpoint:
+            self.assertEqual(sorted(checkpoint.read().split()),
+                             sorted(self.digests[1:]))
+
+        # Only the corrupted file is checked again.
+        with patch("cms.db.filecacher._check_file_integrity",
+                   wraps=filecacher._check_file_integrity) as check:
+            self.assertFalse(self.file_cacher.check_backend_integrity(
+                checkpoint_path=self.checkpoint_path))
+            check.assert_called_once_with(self.corrupted)
+
+
+class TestFSBackend(unittest.TestCase):
+    """Tests for the sharded layout and the index of FSBackend.
+
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = FSBackend(self.path)
+        self.content = os.urandom(100)
+        self.digest = hashlib.sha1(self.content).hexdigest().decode("ascii")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def store(self, backend, content, desc):
+        fobj = backend.put_file(hashlib.sha1(content).hexdigest(), desc)
+        fobj.write(content)
+        fobj.close()
+
+    def test_file_life(self):
+        """Store a file, check its placement and metadata (also from
+        another backend instance), then delete it.
+
+        """
+        self.store(self.backend, self.content, "Test #000")
+        file_path = os.path.join(self.path, self.digest[0:2],
+                                 self.digest[2:4], self.digest)
+        with io.open(file_path, "rb") as stored:
+            self.assertEqual(stored.read(), self.content)
+        self.assertIsNone(self.backend.put_file(self.digest))
+
+        other = FSBackend(self.path)
+        self.assertEqual(other.describe(self.digest), "Test #000")
+        self.assertEqual(other.get_size(self.digest), 100)
+        self.assertEqual(other.list(), [(self.digest, "Test #000")])
+
+        # The metadata doesn't need the file itself.
+        os.unlink(file_path)
+        self.assertEqual(other.get_size(self.digest), 100)
+
+        other.delete(self.digest)
+        self.assertEqual(self.backend.list(), [])
+        with self.assertRaises(KeyError):
+            self.backend.describe(self.digest)
+
+    def test_create_file(self):
+        """Store files whose digest is given only at the end.
+
+        """
+        fobj = self.backend.create_file("Test #000")
+        fobj.write(self.content)
+        fobj.commit(self.digest)
+        with self.backend.get_file(self.digest) as stored:
+            self.assertEqual(stored.read(), self.content)
+        self.assertEqual(self.backend.describe(self.digest), "Test #000")
+
+        # Files already stored and uncommitted files are discarded.
+        fobj = self.backend.create_file("Test #001")
+        fobj.write(self.content)
+        fobj.commit(self.digest)
+        fobj = self.backend.create_file("Test #002")
+        fobj.write(b"incomplete")
+        fobj.close()
+        self.assertEqual(self.backend.list(), [(self.digest, "Test #000")])
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         sorted([self.digest[0:2], FSBackend.INDEX_FILENAME,
+                                 FSBackend.INDEX_LOCK_FILENAME]))
+
+    def test_compressed_file(self):
+        """Store a compressed file, check its metadata and compress it
+        again with another codec.
+
+        """
+        content = b"0" * 10000
+        digest = hashlib.sha1(content).hexdigest().decode("ascii")
+        fobj = self.backend.put_file(digest, "Test #000", compression="zlib")
+        fobj.write(content)
+        fobj.close()
+
+        file_path = os.path.join(self.path, digest[0:2], digest[2:4], digest)
+        self.assertTrue(os.path.exists(file_path + ".zlib"))
+        self.assertLess(os.stat(file_path + ".zlib").st_size, len(content))
+        self.assertIsNone(self.backend.put_file(digest))
+        with self.backend.get_file(digest) as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertEqual(self.backend.get_size(digest), len(content))
+
+        # The size is recomputed when rebuilding the index.
+        self.backend.rewrite_index(rescan=True)
+        self.assertEqual(FSBackend(self.path).get_size(digest), len(content))
+
+        # Without the index, it is computed once and recorded.
+        os.remove(self.backend.index_path)
+        self.assertEqual(FSBackend(self.path).get_size(digest), len(content))
+        with patch("cms.db.filecacher.get_uncompressed_size",
+                   Mock(side_effect=AssertionError())):
+            self.assertEqual(FSBackend(self.path).get_size(digest),
+                             len(content))
+
+        self.assertTrue(self.backend.set_compression(digest, None))
+        self.assertFalse(os.path.exists(file_path + ".zlib"))
+        with io.open(file_path, "rb") as stored:
+            self.assertEqual(stored.read(), content)
+
+        self.assertTrue(self.backend.set_compression(digest, "zlib"))
+        self.backend.delete(digest)
+        self.assertEqual(os.listdir(os.path.dirname(file_path)), [])
+
+    def test_incomplete_file(self):
+        """A file whose content doesn't match its digest is not stored.
+
+        """
+        fobj = self.backend.put_file(self.digest, "Test #001")
+        fobj.write(self.content[:50])
+        fobj.close()
+        with self.assertRaises(KeyError):
+            self.backend.get_file(self.digest)
+        self.assertEqual(self.backend.list(), [])
+
+    def test_indexed_compression(self):
+        """Indexed files are looked for only where the index says, and
+        missing files only once everywhere.
+
+        """
+        content = b"0" * 10000
+        digest = hashlib.sha1(content).hexdigest().decode("ascii")
+        fobj = self.backend.put_file(digest, "Test #000", compression="zlib")
+        fobj.write(content)
+        fobj.close()
+
+        other = FSBackend(self.path)
+        self.assertEqual(other.describe(digest), "Test #000")
+        with patch("os.path.exists", wraps=os.path.exists) as exists:
+            with other.get_file(digest) as stored:
+                self.assertEqual(stored.read(), content)
+            self.assertIsNone(other.put_file(digest))
+            self.assertEqual(exists.call_count, 2)
+
+            exists.reset_mock()
+            self.assertIsNone(other._find(self.digest))
+            self.assertEqual(exists.call_count, 2 + len(CODECS))
+
+    def test_old_index(self):
+        """Records without the compression are still understood.
+
+        """
+        self.store(self.backend, self.content, "Test #000")
+        with io.open(self.backend.index_path, "wb") as index:
+            index.write(('["%s",100,"Test #001"]\n'
+                         % self.digest).encode("utf-8"))
+        other = FSBackend(self.path)
+        self.assertEqual(other.describe(self.digest), "Test #001")
+        with other.get_file(self.digest) as stored:
+            self.assertEqual(stored.read(), self.content)
+
+    def test_migration(self):
+        """Files in the flat layout are found, and can be moved to the
+        sharded layout; the index can then be compacted.
+
+        """
+        with io.open(os.path.join(self.path, self.digest), "wb") as flat:
+            flat.write(self.content)
+        self.assertEqual(self.backend.list(), [(self.digest, "")])
+        with self.backend.get_file(self.digest) as fobj:
+            self.assertEqual(fobj.read(), self.content)
+
+        self.assertEqual(self.backend.list_legacy_files(), [self.digest])
+        self.backend.migrate_legacy_file(self.digest)
+        self.assertEqual(self.backend.list_legacy_files(), [])
+        self.assertEqual(self.backend.list(), [(self.digest, "")])
+        with self.backend.get_file(self.digest) as fobj:
+            self.assertEqual(fobj.read(), self.content)
+
+        other_content = os.urandom(10)
+        self.store(self.backend, other_content, "Test #002")
+        self.backend.delete(hashlib.sha1(other_content).hexdigest())
+        self.assertEqual(self.backend.rewrite_index(), 1)
+        self.assertEqual(FSBackend(self.path).list(), [(self.digest, "")])
+        self.assertEqual(self.backend.rewrite_index(rescan=True), 1)
+
+    def test_rewrite_index_concurrent_append(self):
+        """A record appended while the index is being rewritten is
+        kept in the new index.
+
+        """
+        self.store(self.backend, self.content, "Test #000")
+        other = FSBackend(self.path)
+        other_content = os.urandom(10)
+        mkstemp = tempfile.mkstemp
+        stored = []
+
+        def store_and_mkstemp(*args, **kwargs):
+            # Store the other file when the new index is created,
+            # before the old one is replaced.
+            if len(stored) == 0:
+                stored.append(True)
+                self.store(other, other_content, "Test #001")
+            return mkstemp(*args, **kwargs)
+
+        with patch("cms.db.filecacher.tempfile.mkstemp",
+                   store_and_mkstemp):
+            self.backend.rewrite_index()
+        self.assertEqual(stored, [True])
+        self.assertItemsEqual(
+            FSBackend(self.path).list(),
+            [(self.digest, "Test #000"),
+             (hashlib.sha1(other_content).hexdigest(), "Test #001")])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the large objects and their connection pool.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import cms.db.fsobject
+from cms.db.fsobject import LargeObject, LargeObjectConnectionPool
+
+
+class TestLargeObjectConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.original_pool = cms.db.fsobject.lo_connection_pool
+        self.pool = LargeObjectConnectionPool(2)
+        cms.db.fsobject.lo_connection_pool = self.pool
+        self.loids = []
+
+    def tearDown(self):
+        for loid in self.loids:
+            LargeObject.unlink(loid)
+        self.pool.close_idle()
+        cms.db.fsobject.lo_connection_pool = self.original_pool
+
+    def write(self, content):
+        with LargeObject(0, 'wb') as lobj:
+            lobj.write(content)
+            self.loids.append(lobj.loid)
+        return lobj.loid
+
+    def test_connections_are_reused(self):
+        """Sequential large objects share a single connection.
+
+        """
+        loid = self.write(b"content")
+        for _ in xrange(3):
+            with LargeObject(loid, 'rb') as lobj:
+                self.assertEqual(lobj.read(), b"content")
+
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["connections_created"], 1)
+        self.assertEqual(stats["connections_reused"], 3)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["idle"], 1)
+
+    def test_failed_transaction_is_rolled_back(self):
+        """A connection left in a failed transaction is usable again
+        after being released.
+
+        """
+        loid = self.write(b"content")
+        lobj = LargeObject(loid, 'rb')
+        with self.assertRaises(IOError):
+            lobj._execute("SELECT lo_close(-1);", {}, "Expected failure.")
+        with self.assertRaises(IOError):
+            lobj.close()
+
+        with LargeObject(loid, 'rb') as lobj:
+            self.assertEqual(lobj.read(), b"content")
+        self.assertEqual(self.pool.get_stats()["in_use"], 0)
+
+    def test_no_idle_connections(self):
+        """With max_idle set to zero, every large object gets a new
+        connection.
+
+        """
+        self.pool = LargeObjectConnectionPool(2, max_idle=0)
+        cms.db.fsobject.lo_connection_pool = self.pool
+        loid = self.write(b"content")
+        with LargeObject(loid, 'rb') as lobj:
+            lobj.read()
+
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["connections_created"], 2)
+        self.assertEqual(stats["connections_reused"], 0)
+        self.assertEqual(stats["idle"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
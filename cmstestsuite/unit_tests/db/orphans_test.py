@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the garbage collection of stored files.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import patch
+from sqlalchemy import text
+
+from cmstestsuite.unit_tests.testdbgenerator import TestCaseWithDatabase
+from cmstestsuite.unit_tests.testidgenerator import unique_digest
+
+from cms.db import FSObject
+from cms.db.orphans import delete_orphans, find_orphans, \
+    get_digest_columns, get_digest_ranges, get_stored_sizes
+
+
+class TestOrphans(TestCaseWithDatabase):
+
+    def setUp(self):
+        super(TestOrphans, self).setUp()
+        self.testcase = self.add_testcase()
+        self.referenced = [self.add_file(self.testcase.input, b"in"),
+                           self.add_file(self.testcase.output, b"out")]
+        self.orphans = sorted(self.add_file(unique_digest(), b"x" * 10)
+                              for _ in xrange(3))
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.close()
+        super(TestOrphans, self).tearDown()
+
+    def add_file(self, digest, content):
+        """Store a file, with its large object, in the database."""
+        loid = self.session.execute(
+            text("SELECT lo_from_bytea(0, :content)"),
+            {"content": bytearray(content)}).scalar()
+        fso = FSObject(loid=loid)
+        fso.digest = digest
+        self.session.add(fso)
+        return digest
+
+    def find_orphans(self, start=None, end=None):
+        """Find the orphans among the files added by the test, with
+        the versions of their rows.
+
+        """
+        ours = set(self.referenced + self.orphans)
+        return [(digest, version) for digest, version
+                in find_orphans(self.session, start, end)
+                if digest in ours]
+
+    def find_orphan_digests(self, start=None, end=None):
+        """Find the digests of the orphans added by the test."""
+        return [digest for digest, _ in self.find_orphans(start, end)]
+
+    def test_digest_columns(self):
+        names = set("%s.%s" % (column.table.name, column.name)
+                    for column in get_digest_columns())
+        self.assertIn("testcases.input", names)
+        self.assertIn("user_test_results.output", names)
+        self.assertIn("executables.digest", names)
+        self.assertNotIn("fsobjects.digest", names)
+
+    def test_digest_ranges(self):
+        self.assertEqual(get_digest_ranges(1), [(None, None)])
+        ranges = get_digest_ranges(16)
+        self.assertEqual(len(ranges), 16)
+        self.assertEqual(ranges[0], (None, "1"))
+        self.assertEqual(ranges[10], ("a", "b"))
+        self.assertEqual(ranges[15], ("f", None))
+        self.assertEqual(get_digest_ranges(256)[255], ("ff", None))
+        with self.assertRaises(ValueError):
+            get_digest_ranges(10)
+
+    def test_find(self):
+        """Only the unreferenced files are found, in every range."""
+        self.assertEqual(self.find_orphan_digests(), self.orphans)
+        found = sum((self.find_orphan_digests(start, end)
+                     for start, end in get_digest_ranges(16)), [])
+        self.assertEqual(found, self.orphans)
+
+    def test_sizes(self):
+        sizes = get_stored_sizes(self.session,
+                                 self.orphans + self.referenced[:1])
+        self.assertEqual(sizes, dict(
+            [(digest, 10) for digest in self.orphans] +
+            [(self.referenced[0], 2)]))
+
+    def test_sizes_old_server(self):
+        """Servers without lo_lseek64 give the same sizes."""
+        digests = self.orphans + self.referenced[:1]
+        sizes = get_stored_sizes(self.session, digests)
+        with patch("cms.db.orphans.LO_LSEEK64_SERVER_VERSION", (1000,)):
+            self.assertEqual(get_stored_sizes(self.session, digests), sizes)
+
+    def test_delete(self):
+        """Files referenced after being found are not deleted."""
+        orphans = self.find_orphans()
+        self.add_testcase(input=self.orphans[0], output=self.referenced[1])
+        self.session.flush()
+        self.assertEqual(delete_orphans(self.session, orphans),
+                         self.orphans[1:])
+        self.assertEqual(self.find_orphans(), [])
+        self.assertEqual(
+            set(digest for digest, in self.session.query(FSObject.digest)
+                .filter(FSObject.digest.in_(self.referenced + self.orphans))),
+            set(self.referenced + self.orphans[:1]))
+
+    def test_delete_touched(self):
+        """Files touched after being found are not deleted."""
+        orphans = self.find_orphans()
+        # A subtransaction writes the row with a different xmin, as a
+        # later transaction would.
+        self.session.begin_nested()
+        self.assertTrue(FSObject.touch(self.orphans[0], self.session))
+        self.assertFalse(FSObject.touch(unique_digest(), self.session))
+        self.session.commit()
+        self.assertEqual(delete_orphans(self.session, orphans),
+                         self.orphans[1:])
+        self.assertEqual(self.find_orphan_digests(), self.orphans[:1])
+
+
+if __name__ == "__main__":
+    unittest.main()
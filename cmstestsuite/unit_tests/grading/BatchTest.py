@@ -0,0 +1,291 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the sharing of work among the jobs of Batch.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from cms import config
+from cms.db import Executable, File, Manager
+from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.grading.compilationcache import CompilationCache
+from cms.grading.tasktypes.Batch import Batch
+
+
+class FakeSandbox(object):
+    """A sandbox recording what happens to it."""
+
+    def __init__(self, multithreaded, file_cacher):
+        self.files = []
+        self.resets = 0
+        self.deleted = False
+        self.outer_temp_dir = "/tmp/fake"
+        self.path = "/tmp/fake/box"
+        self.max_processes = 1
+
+    def create_file_from_storage(self, filename, digest, executable=False):
+        self.files.append((filename, digest))
+
+    def create_file_from_fileobj(self, filename, file_obj):
+        self.files.append((filename, file_obj.read()))
+
+    def file_exists(self, filename):
+        return True
+
+    def get_file(self, filename):
+        return io.BytesIO(b"output")
+
+    def get_file_to_storage(self, filename, description=""):
+        return "%s_compiled" % self.files[0][1]
+
+    def reset(self, keep=None):
+        self.resets += 1
+        self.files = [f for f in self.files if f[0] in keep]
+
+    def delete(self):
+        self.deleted = True
+
+
+class TestBatchEvaluateTestcases(unittest.TestCase):
+
+    def setUp(self):
+        self.sandboxes = []
+        self.results = dict()
+
+        def create_sandbox(file_cacher, multithreaded=False):
+            sandbox = FakeSandbox(multithreaded, file_cacher)
+            self.sandboxes.append(sandbox)
+            return sandbox
+
+        def evaluate_in_sandbox(job, sandbox, file_cacher):
+            # What the job sees: only the executable.
+            job.plus = {"files": list(sandbox.files)}
+            job.success = self.results.get(job.info, True)
+            sandbox.create_file_from_storage("output.txt", "out")
+
+        for patcher in [
+                patch("cms.grading.tasktypes.Batch.create_sandbox",
+                      create_sandbox),
+                patch.object(Batch, "_evaluate_in_sandbox",
+                             Mock(side_effect=evaluate_in_sandbox)),
+                patch.object(config, "keep_sandbox", False)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.task_type = Batch(["alone", ["", ""], "diff"])
+
+    @staticmethod
+    def new_jobs(digests):
+        return [EvaluationJob(
+            executables={"exe": Executable("exe", digest)},
+            info="%d" % i) for i, digest in enumerate(digests)]
+
+    def check_same_results(self, digests):
+        """Evaluate the jobs together and one by one, and return the
+        sandboxes used together.
+
+        """
+        jobs = TestBatchEvaluateTestcases.new_jobs(digests)
+        self.task_type.evaluate_testcases(jobs, None)
+        sandboxes, self.sandboxes = self.sandboxes, []
+        expected = TestBatchEvaluateTestcases.new_jobs(digests)
+        for job in expected:
+            self.task_type.evaluate(job, None)
+        self.assertEqual([(job.success, job.plus) for job in jobs],
+                         [(job.success, job.plus) for job in expected])
+        return sandboxes
+
+    def test_shared(self):
+        """One sandbox, with the executable copied once."""
+        sandboxes = self.check_same_results(["d1"] * 3)
+        self.assertEqual(len(sandboxes), 1)
+        self.assertEqual(sandboxes[0].resets, 2)
+        self.assertTrue(sandboxes[0].deleted)
+
+    def test_executable_changes(self):
+        sandboxes = self.check_same_results(["d1", "d1", "d2", "d1"])
+        self.assertEqual(len(sandboxes), 3)
+        self.assertTrue(all(sandbox.deleted for sandbox in sandboxes))
+
+    def test_failure(self):
+        """The sandbox of a failed job is kept, as it is."""
+        self.results["1"] = False
+        sandboxes = self.check_same_results(["d1"] * 3)
+        self.assertEqual(len(sandboxes), 2)
+        self.assertFalse(sandboxes[0].deleted)
+        self.assertEqual(sandboxes[0].resets, 1)
+        self.assertTrue(sandboxes[1].deleted)
+
+    def test_reset_error(self):
+        """A sandbox that cannot be emptied is replaced."""
+        with patch.object(FakeSandbox, "reset",
+                          Mock(side_effect=OSError())):
+            sandboxes = self.check_same_results(["d1"] * 2)
+        self.assertEqual(len(sandboxes), 2)
+        self.assertTrue(all(sandbox.deleted for sandbox in sandboxes))
+
+    def test_keep_sandbox(self):
+        """Sandboxes kept for inspection are not shared."""
+        with patch.object(config, "keep_sandbox", True):
+            self.task_type.evaluate_testcases(
+                TestBatchEvaluateTestcases.new_jobs(["d1"] * 2), None)
+        self.assertEqual(len(self.sandboxes), 2)
+
+
+class TestBatchChecker(unittest.TestCase):
+
+    def setUp(self):
+        self.sandboxes = []
+        self.checker_results = []
+
+        def create_sandbox(file_cacher, multithreaded=False):
+            sandbox = FakeSandbox(multithreaded, file_cacher)
+            self.sandboxes.append(sandbox)
+            return sandbox
+
+        def evaluation_step(sandbox, commands, *args, **kwargs):
+            # What the checker sees.
+            if commands[0][0] == "./checker":
+                self.checker_results.append(
+                    (sandbox, list(sandbox.files), sandbox.max_processes))
+            return True, {"exit_status": "ok"}
+
+        for patcher in [
+                patch("cms.grading.tasktypes.Batch.create_sandbox",
+                      create_sandbox),
+                patch("cms.grading.tasktypes.Batch.evaluation_step",
+                      evaluation_step),
+                patch("cms.grading.tasktypes.Batch.extract_outcome_and_text",
+                      Mock(return_value=(1.0, ["ok"]))),
+                patch.object(config, "keep_sandbox", False)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.task_type = Batch(["alone", ["", ""], "comparator"])
+
+    @staticmethod
+    def new_jobs(count):
+        return [EvaluationJob(
+            language="C11 / gcc", input="in%d" % i, output="res%d" % i,
+            executables={"foo": Executable("foo", "exe")},
+            managers={"checker": Manager("checker", "chk")})
+            for i in xrange(count)]
+
+    def test_checker_sandbox(self):
+        """The checker runs in its own sandbox, with fresh files."""
+        job, = TestBatchChecker.new_jobs(1)
+        self.task_type.evaluate(job, None)
+        self.assertEqual(job.outcome, "1.0")
+        self.assertEqual(len(self.sandboxes), 2)
+        checker_sandbox, files, max_processes = self.checker_results[0]
+        self.assertIsNot(checker_sandbox, self.sandboxes[0])
+        self.assertEqual(files, [("checker", "chk"), ("input.txt", "in0"),
+                                 ("res.txt", "res0"),
+                                 ("output.txt", b"output")])
+        self.assertEqual(max_processes, 1000)
+        self.assertNotIn(("checker", "chk"), self.sandboxes[0].files)
+        self.assertEqual(job.sandboxes, [s.path for s in self.sandboxes])
+        self.assertTrue(all(s.deleted for s in self.sandboxes))
+
+    def test_shared(self):
+        """The checker is put once in a sandbox for all the jobs."""
+        jobs = TestBatchChecker.new_jobs(3)
+        self.task_type.evaluate_testcases(jobs, None)
+        self.assertEqual([job.outcome for job in jobs], ["1.0"] * 3)
+        self.assertEqual(len(self.sandboxes), 2)
+        checker_sandbox = self.sandboxes[1]
+        self.assertEqual(checker_sandbox.resets, 2)
+        self.assertEqual(self.checker_results[2][1],
+                         [("checker", "chk"), ("input.txt", "in2"),
+                          ("res.txt", "res2"), ("output.txt", b"output")])
+        self.assertTrue(checker_sandbox.deleted)
+
+    def test_failure(self):
+        """A checker sandbox where something went wrong is kept."""
+        extract = Mock(side_effect=[(1.0, ["ok"]), ValueError("bad"),
+                                    (0.0, ["no"])])
+        with patch("cms.grading.tasktypes.Batch.extract_outcome_and_text",
+                   extract):
+            jobs = TestBatchChecker.new_jobs(3)
+            self.task_type.evaluate_testcases(jobs, None)
+        self.assertEqual([job.success for job in jobs], [True, False, True])
+        checker_sandboxes = [sandbox for sandbox, _, _
+                             in self.checker_results]
+        self.assertIs(checker_sandboxes[0], checker_sandboxes[1])
+        self.assertIsNot(checker_sandboxes[1], checker_sandboxes[2])
+        self.assertFalse(checker_sandboxes[1].deleted)
+        self.assertTrue(checker_sandboxes[2].deleted)
+
+
+class TestBatchCompilationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.sandboxes = []
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.cache = CompilationCache(os.path.join(temp_dir, "cache"), 10)
+
+        def create_sandbox(file_cacher, multithreaded=False):
+            sandbox = FakeSandbox(multithreaded, file_cacher)
+            self.sandboxes.append(sandbox)
+            return sandbox
+
+        for patcher in [
+                patch("cms.grading.tasktypes.Batch.create_sandbox",
+                      create_sandbox),
+                patch("cms.grading.tasktypes.Batch.compilation_step",
+                      Mock(return_value=(True, True, ["ok"],
+                                         {"exit_status": "ok"}))),
+                patch("cms.grading.tasktypes.Batch.get_compilation_cache",
+                      Mock(return_value=self.cache))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.task_type = Batch(["alone", ["", ""], "diff"])
+
+    def compile(self, digest):
+        job = CompilationJob(language="C11 / gcc",
+                             files={"foo.%l": File("foo.%l", digest)})
+        self.task_type.compile(job, Mock())
+        return job
+
+    def test_cached(self):
+        """The same source is compiled only once."""
+        first = self.compile("d1")
+        second = self.compile("d1")
+        self.assertEqual(len(self.sandboxes), 1)
+        self.assertEqual(second.sandboxes, [])
+        second.sandboxes = first.sandboxes
+        self.assertEqual(second.export_to_dict(), first.export_to_dict())
+        self.assertEqual(second.executables["foo"].digest, "d1_compiled")
+
+        self.compile("d2")
+        self.assertEqual(len(self.sandboxes), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
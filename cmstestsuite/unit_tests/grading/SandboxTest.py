@@ -26,8 +26,17 @@ from __future__ import unicode_literals
 
 import unittest
 import io
+import os
+import shutil
+import tempfile
+import weakref
 
-from cms.grading.Sandbox import Truncator
+import gevent
+from mock import Mock, patch
+
+from cms import config
+from cms.grading.Sandbox import IsolateSandbox, \
+    SandboxInterfaceException, Truncator, set_execution_slot
 
 
 class TestTruncator(unittest.TestCase):
@@ -67,5 +76,205 @@ class TestTruncator(unittest.TestCase):
         self.perform_truncator_test(100, 40, 7)
 
 
+# A stand-in for isolate, keeping the boxes (and a log of the commands
+# initializing and cleaning them up) in the directory root.
+FAKE_ISOLATE = """#!/bin/sh
+for arg; do
+    case $arg in
+        --box-id=*) id=${arg#--box-id=} ;;
+        --init|--cleanup) action=$arg ;;
+    esac
+done
+echo "$action $id" >> %(root)s/log
+case $action in
+    --init)
+        rm -rf %(root)s/$id
+        mkdir -p %(root)s/$id/box
+        echo %(root)s/$id ;;
+    --cleanup) rm -rf %(root)s/$id ;;
+esac
+"""
+
+
+class IsolateSandboxTestCase(unittest.TestCase):
+    """Base class for the tests creating IsolateSandboxes, with a fake
+    isolate.
+
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.box_dir = os.path.join(self.temp_dir, "boxes")
+        os.mkdir(self.box_dir)
+        isolate = os.path.join(self.temp_dir, "isolate")
+        with io.open(isolate, "wt") as f:
+            f.write(FAKE_ISOLATE % {"root": self.box_dir})
+        os.chmod(isolate, 0o755)
+
+        for patcher in [
+                patch.object(IsolateSandbox, "detect_box_executable",
+                             Mock(return_value=isolate)),
+                patch.object(IsolateSandbox, "_next_ids", dict()),
+                patch.object(IsolateSandbox, "_live",
+                             weakref.WeakValueDictionary()),
+                patch.object(IsolateSandbox, "_pool", dict()),
+                patch.object(config, "use_cgroups", False),
+                patch.object(config, "sandbox_reuse_boxes", True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.file_cacher = Mock()
+        self.file_cacher.service.shard = 2
+
+    def new_sandbox(self):
+        return IsolateSandbox(False, self.file_cacher, temp_dir=self.temp_dir)
+
+    def get_log(self):
+        with io.open(os.path.join(self.box_dir, "log"), "rt") as f:
+            return f.read().splitlines()
+
+
+class TestIsolateSandboxBoxId(IsolateSandboxTestCase):
+    """Test the box ids used by IsolateSandbox."""
+
+    def box_ids(self, slot, slots, count):
+        def create():
+            set_execution_slot(slot, slots)
+            return [self.new_sandbox().box_id for _ in xrange(count)]
+        return gevent.spawn(create).get()
+
+    def test_single_slot(self):
+        """A Worker with one slot uses all its range."""
+        self.assertEqual(self.box_ids(0, 1, 12), range(30, 40) + [30, 31])
+
+    def test_slots(self):
+        """Each slot of a Worker uses its own part of the range."""
+        self.assertEqual(self.box_ids(0, 3, 4), [30, 31, 32, 30])
+        self.assertEqual(self.box_ids(2, 3, 4), [36, 37, 38, 36])
+
+    def in_slot(self, slot, slots, function):
+        def run():
+            set_execution_slot(slot, slots)
+            return function()
+        return gevent.spawn(run).get()
+
+    def test_live_sandboxes(self):
+        """Sandboxes alive at the same time in a slot never share a
+        box, whatever the other slots do.
+
+        """
+        sandboxes = [self.in_slot(0, 5, self.new_sandbox),
+                     self.in_slot(1, 5, self.new_sandbox),
+                     self.in_slot(0, 5, self.new_sandbox)]
+        self.assertEqual([sandbox.box_id for sandbox in sandboxes],
+                         [30, 32, 31])
+
+        # The slot has no more free boxes.
+        with self.assertRaises(SandboxInterfaceException):
+            self.in_slot(0, 5, self.new_sandbox)
+
+        # Deleting a sandbox frees its box.
+        sandboxes[0].delete()
+        self.assertEqual(self.in_slot(0, 5, self.new_sandbox).box_id, 30)
+
+    def test_pooled_box(self):
+        """A box kept for reuse with another temporary directory is
+        not initialized again.
+
+        """
+        other_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        IsolateSandbox(False, self.file_cacher, temp_dir=other_dir).delete()
+        self.assertIn((30, other_dir), IsolateSandbox._pool)
+        IsolateSandbox._next_ids.clear()
+        self.assertEqual(self.box_ids(0, 1, 1), [31])
+
+
+class TestIsolateSandboxPool(IsolateSandboxTestCase):
+    """Test the reuse of the boxes of deleted sandboxes."""
+
+    def use(self, sandbox):
+        """Write files where sandboxed programs can."""
+        io.open(os.path.join(sandbox.path, "output.txt"), "wb").close()
+        io.open(os.path.join(sandbox.box_root, "box", "stray"), "wb").close()
+
+    def test_reuse(self):
+        """A deleted box is reused, empty, without isolate."""
+        sandbox = self.new_sandbox()
+        self.assertEqual(sandbox.box_root, os.path.join(self.box_dir, "30"))
+        self.use(sandbox)
+        sandbox.delete()
+
+        IsolateSandbox._next_ids.clear()
+        reused = self.new_sandbox()
+        self.assertEqual(reused.box_id, 30)
+        self.assertEqual(reused.outer_temp_dir, sandbox.outer_temp_dir)
+        self.assertEqual(os.listdir(reused.path), [])
+        self.assertEqual(os.listdir(os.path.join(reused.box_root, "box")),
+                         [])
+        self.assertEqual(self.get_log(), ["--init 30"])
+
+        # Another box id needs its own box.
+        self.new_sandbox().delete()
+        self.assertEqual(self.get_log(), ["--init 30", "--init 31"])
+
+    def test_unhealthy(self):
+        """A box changed while in the pool is initialized again."""
+        sandbox = self.new_sandbox()
+        sandbox.delete()
+        shutil.rmtree(os.path.join(self.box_dir, "30"))
+
+        IsolateSandbox._next_ids.clear()
+        other = self.new_sandbox()
+        self.assertNotEqual(other.outer_temp_dir, sandbox.outer_temp_dir)
+        self.assertFalse(os.path.exists(sandbox.outer_temp_dir))
+        self.assertEqual(self.get_log(), ["--init 30", "--init 30"])
+
+    def test_disabled(self):
+        with patch.object(config, "sandbox_reuse_boxes", False):
+            sandbox = self.new_sandbox()
+            sandbox.delete()
+        self.assertFalse(os.path.exists(sandbox.outer_temp_dir))
+        self.assertEqual(self.get_log(), ["--init 30", "--cleanup 30"])
+        self.assertEqual(IsolateSandbox._pool, dict())
+
+    def test_clear(self):
+        sandboxes = [self.new_sandbox() for _ in xrange(2)]
+        for sandbox in sandboxes:
+            sandbox.delete()
+        IsolateSandbox.clear_pool()
+        self.assertEqual(IsolateSandbox._pool, dict())
+        for sandbox in sandboxes:
+            self.assertFalse(os.path.exists(sandbox.outer_temp_dir))
+        self.assertItemsEqual(self.get_log()[2:],
+                              ["--cleanup 30", "--cleanup 31"])
+
+
+class TestIsolateSandboxReset(IsolateSandboxTestCase):
+    """Test the preparation of a sandbox for another execution."""
+
+    def test_reset(self):
+        """Only the files kept remain, and the box is empty."""
+        sandbox = self.new_sandbox()
+        for filename in ["exe", "input.txt", "output.txt"]:
+            io.open(os.path.join(sandbox.path, filename), "wb").close()
+        os.mkdir(os.path.join(sandbox.path, "dir"))
+        io.open(os.path.join(sandbox.box_root, "box", "stray"), "wb").close()
+        sandbox.max_processes = 10
+
+        sandbox.reset(keep=["exe"])
+        self.assertEqual(os.listdir(sandbox.path), ["exe"])
+        self.assertEqual(os.listdir(os.path.join(sandbox.box_root, "box")),
+                         [])
+        self.assertEqual(sandbox.max_processes, 1)
+
+        sandbox.reset()
+        self.assertEqual(os.listdir(sandbox.path), [])
+
+    def test_unknown_box(self):
+        sandbox = self.new_sandbox()
+        sandbox.box_root = None
+        with self.assertRaises(OSError):
+            sandbox.reset()
+
+
 if __name__ == "__main__":
     unittest.main()
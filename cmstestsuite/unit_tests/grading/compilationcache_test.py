@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the cache of the compilation results.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from cms.db import Executable
+from cms.grading.Job import CompilationJob
+from cms.grading.Sandbox import Sandbox
+from cms.grading.compilationcache import CompilationCache
+from cms.grading.languagemanager import get_language
+
+
+class TestCompilationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache = CompilationCache(
+            os.path.join(self.temp_dir, "compilations"), 3)
+        self.compiler = os.path.join(self.temp_dir, "gcc")
+        io.open(self.compiler, "wb").close()
+        self.language = get_language("C11 / gcc")
+        self.file_cacher = Mock()
+        self.file_cacher.touch.return_value = True
+
+    def get_key(self, digest="d1", flags=None):
+        command = [self.compiler] + (flags or ["-O2"]) + ["foo.c"]
+        return self.cache.get_key(self.language, [command],
+                                  {"foo.c": digest}, False)
+
+    @staticmethod
+    def compiled_job(exit_status=Sandbox.EXIT_OK):
+        return CompilationJob(
+            success=True, compilation_success=True, text=["ok"],
+            plus={"exit_status": exit_status, "stdout": "out"},
+            executables={"foo": Executable("foo", "exe")})
+
+    def test_store_and_load(self):
+        key = self.get_key()
+        job = CompilationJob()
+        self.assertFalse(self.cache.load(key, job, self.file_cacher))
+        self.assertIsNone(job.success)
+
+        self.cache.store(key, TestCompilationCache.compiled_job())
+        self.assertTrue(self.cache.load(key, job, self.file_cacher))
+        self.assertTrue(job.success)
+        self.assertTrue(job.compilation_success)
+        self.assertEqual(job.text, ["ok"])
+        self.assertEqual(job.plus["stdout"], "out")
+        self.assertEqual(job.executables["foo"].digest, "exe")
+        self.file_cacher.touch.assert_called_once_with("exe")
+        self.assertEqual(self.cache.get_stats(),
+                         {"hits": 1, "misses": 1, "stores": 1})
+
+    def test_key(self):
+        """Everything determining the results is in the key."""
+        key = self.get_key()
+        self.assertEqual(key, self.get_key())
+        self.assertNotEqual(key, self.get_key(digest="d2"))
+        self.assertNotEqual(key, self.get_key(flags=["-O3"]))
+        # A new version of the compiler.
+        os.utime(self.compiler, (0, 0))
+        self.assertNotEqual(key, self.get_key())
+
+    def test_not_stored(self):
+        """Timeouts and failed operations are not cached."""
+        key = self.get_key()
+        self.cache.store(key, TestCompilationCache.compiled_job(
+            Sandbox.EXIT_TIMEOUT))
+        job = TestCompilationCache.compiled_job()
+        job.success = False
+        self.cache.store(key, job)
+        self.assertFalse(self.cache.load(key, CompilationJob(),
+                                         self.file_cacher))
+
+    def test_missing_executable(self):
+        key = self.get_key()
+        self.cache.store(key, TestCompilationCache.compiled_job())
+        self.file_cacher.touch.return_value = False
+        self.assertFalse(self.cache.load(key, CompilationJob(),
+                                         self.file_cacher))
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test_prune(self):
+        """The least recently used entries are deleted."""
+        keys = [self.get_key(digest="d%d" % i) for i in xrange(5)]
+        for i, key in enumerate(keys):
+            self.cache.store(key, TestCompilationCache.compiled_job())
+            os.utime(self.cache._get_entry_path(key), (i, i))
+        # Use the first entry.
+        self.cache.load(keys[0], CompilationJob(), self.file_cacher)
+        self.cache.prune()
+        self.assertItemsEqual(
+            os.listdir(self.cache.path),
+            ["%s.json" % key for key in [keys[0], keys[3], keys[4]]])
+
+
+if __name__ == "__main__":
+    unittest.main()
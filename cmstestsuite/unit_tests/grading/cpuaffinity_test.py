@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the assignment of the CPUs to the execution slots.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from cms import ServiceCoord, config
+from cms.grading.cpuaffinity import format_cpu_list, get_cores, \
+    get_slot_cpus, get_slot_index, parse_cpu_list, split_cores
+from cms.util import Address
+
+
+class TestCpuLists(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_cpu_list("0-3,8,10-11\n"),
+                         [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(parse_cpu_list("5"), [5])
+        self.assertEqual(parse_cpu_list(""), [])
+
+    def test_format(self):
+        self.assertEqual(format_cpu_list([0, 4]), "0,4")
+
+
+class TestGetCores(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        patcher = patch("cms.grading.cpuaffinity.SYSFS_CPU_DIR", self.sysfs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content):
+        path = os.path.join(self.sysfs, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, "wt") as f:
+            f.write(content)
+
+    def test_smt(self):
+        """Hardware threads are grouped by core."""
+        self.write("online", "0-3\n")
+        for cpu, siblings in enumerate(["0,2", "1,3", "0,2", "1,3"]):
+            self.write("cpu%d/topology/thread_siblings_list" % cpu,
+                       siblings)
+        self.assertEqual(get_cores(), [[0, 2], [1, 3]])
+
+    def test_no_topology(self):
+        self.write("online", "0-1\n")
+        self.assertEqual(get_cores(), [[0], [1]])
+
+
+class TestSplitCores(unittest.TestCase):
+
+    CORES = [[0, 4], [1, 5], [2, 6], [3, 7], [8, 9]]
+
+    def test_split(self):
+        """Each slot gets the same cores, the remainder is unused."""
+        self.assertEqual(split_cores(self.CORES, 2, False),
+                         [[0, 4, 1, 5], [2, 6, 3, 7]])
+        self.assertEqual(split_cores(self.CORES, 2, True),
+                         [[0, 1], [2, 3]])
+
+    def test_share(self):
+        self.assertEqual(split_cores(self.CORES[:2], 3, True),
+                         [[0], [1], [0]])
+
+
+class TestGetSlotCpus(unittest.TestCase):
+
+    def setUp(self):
+        services = {
+            ServiceCoord("Worker", 0): Address("10.0.0.1", 26000),
+            ServiceCoord("Worker", 1): Address("10.0.0.2", 26000),
+            ServiceCoord("Worker", 2): Address("10.0.0.1", 26001),
+            ServiceCoord("EvaluationService", 0): Address("10.0.0.1", 25000),
+        }
+        for patcher in [
+                patch.object(config.async, "core_services", services),
+                patch("cms.grading.cpuaffinity._slot_cpus", dict()),
+                patch("cms.grading.cpuaffinity.get_cores",
+                      lambda: [[cpu] for cpu in xrange(8)])]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_slot_index(self):
+        """Slots are numbered among the Workers on the same machine."""
+        self.assertEqual(get_slot_index(0, 1, 2), (1, 4))
+        self.assertEqual(get_slot_index(2, 0, 2), (2, 4))
+        self.assertEqual(get_slot_index(1, 1, 2), (1, 2))
+        self.assertEqual(get_slot_index(5, 1, 2), (1, 2))
+
+    def test_slot_cpus(self):
+        with patch.object(config, "sandbox_cpu_pinning", False):
+            self.assertIsNone(get_slot_cpus(2, 1, 2))
+        with patch.object(config, "sandbox_cpu_pinning", True):
+            self.assertEqual(get_slot_cpus(2, 1, 2), [6, 7])
+            self.assertEqual(get_slot_cpus(1, 0, 2), [0, 1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
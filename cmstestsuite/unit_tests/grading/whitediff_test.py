@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the white diff comparator.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import mmap
+import random
+import tempfile
+import unittest
+
+from cms.grading import _white_diff_by_line, white_diff
+
+
+class TestWhiteDiff(unittest.TestCase):
+
+    def check(self, output, res, expected=None, chunk_sizes=(1, 2, 3, 1024)):
+        """Compare two strings with white_diff, with different chunk
+        sizes, and with the line by line implementation.
+
+        """
+        reference = _white_diff_by_line(io.BytesIO(output), io.BytesIO(res))
+        if expected is not None:
+            self.assertEqual(reference, expected)
+        for chunk_size in chunk_sizes:
+            self.assertEqual(
+                white_diff(io.BytesIO(output), io.BytesIO(res), chunk_size),
+                reference, "%r vs %r, chunk size %d" % (output, res,
+                                                        chunk_size))
+            self.assertEqual(
+                white_diff(io.BytesIO(res), io.BytesIO(output), chunk_size),
+                reference)
+
+    def test_equal(self):
+        self.check(b"1 2\n3\n", b"1 2\n3\n", True)
+        self.check(b"", b"", True)
+
+    def test_whitespaces(self):
+        self.check(b"1 2\n3\n", b"  1\t\x0b2 \r\n 3\x0c", True)
+        self.check(b"1 2", b"1 2\n\n  \n\t\n", True)
+        self.check(b"", b" \n\r\n\n", True)
+
+    def test_different(self):
+        self.check(b"1 2\n3\n", b"1 2 3\n", False)
+        self.check(b"1 2\n3\n", b"1\n2\n3\n", False)
+        self.check(b"12\n", b"1 2\n", False)
+        self.check(b"1 2\n3\n", b"1 2\n3\n4", False)
+        self.check(b"1\n\n2\n", b"1\n2\n", False)
+        self.check(b"\n1\n", b"1\n", False)
+        self.check(b"", b"0", False)
+
+    def test_identical_prefix(self):
+        """Files differing after an identical part, possibly in the
+        middle of a run of whitespaces or of a token.
+
+        """
+        prefix = b"1 2 \n\n3 4\n  " * 10
+        self.check(prefix + b"5\n", prefix + b" 5 \n\n", True)
+        self.check(prefix + b"\n5\n", prefix + b"5\n", False)
+        self.check(prefix + b"5\n", prefix + b"56", False)
+        self.check(prefix + b"5", prefix, False)
+        self.check(b"12" * 10 + b"3", b"12" * 10 + b" 3", False)
+
+    def test_random(self):
+        """Compare random similar files with both implementations."""
+        rand = random.Random(0)
+        alphabet = [b"a", b"b", b" ", b"\n", b"\t", b"\r", b"  ", b"\n\n"]
+
+        def mutate(data):
+            data = bytearray(data)
+            for _ in xrange(rand.randint(0, 2)):
+                position = rand.randint(0, len(data))
+                data[position:position + rand.randint(0, 2)] = \
+                    rand.choice(alphabet)
+            return bytes(data)
+
+        for _ in xrange(2000):
+            output = b"".join(rand.choice(alphabet)
+                              for _ in xrange(rand.randint(0, 20)))
+            self.check(output, mutate(output))
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as output, \
+                tempfile.TemporaryFile() as res:
+            output.write(b"1 2\n3\n" * 1000)
+            output.flush()
+            res.write(b"1  2 \n3\n" * 1000)
+            res.flush()
+            self.assertTrue(white_diff(
+                mmap.mmap(output.fileno(), 0, access=mmap.ACCESS_READ),
+                mmap.mmap(res.fileno(), 0, access=mmap.ACCESS_READ), 100))
+
+
+if __name__ == "__main__":
+    unittest.main()
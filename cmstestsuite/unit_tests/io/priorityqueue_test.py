@@ -180,6 +180,77 @@ class TestPriorityQueue(unittest.TestCase):
         self.assertFalse(self.item_b in self.queue)
         self.queue._verify()
 
+    def test_remove_many(self):
+        """Test that items get removed in bulk, also lazily."""
+        # Enough items for the buckets to be compacted.
+        items = [FakeQueueItem("%d" % i) for i in xrange(600)]
+        self.assertEqual(self.queue.push_many(
+            [(item, i % 3, make_datetime(i)) for i, item in enumerate(items)]
+            + [(items[0], None, None)]), 600)
+        self.assertTrue(self.queue._verify())
+
+        removed = self.queue.remove_many(lambda item: int(str(item)) < 450)
+        self.assertEqual(len(removed), 450)
+        self.assertEqual(len(self.queue), 150)
+        self.assertTrue(self.queue._verify())
+        self.assertTrue(all(len(bucket) == 50
+                            for bucket in self.queue._buckets.itervalues()))
+        self.assertEqual(
+            [str(self.queue.pop().item) for _ in xrange(150)],
+            ["%d" % i for i in xrange(450, 600, 3)] +
+            ["%d" % i for i in xrange(451, 600, 3)] +
+            ["%d" % i for i in xrange(452, 600, 3)])
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(self.queue.remove_many(lambda item: True), [])
+
+    def test_set_priority_keeps_order(self):
+        """Test that an item moved keeps its place among its peers."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW,
+                        timestamp=make_datetime(10))
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_LOW,
+                        timestamp=make_datetime(5))
+        self.queue.push(self.item_c, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(7))
+
+        self.queue.set_priority(self.item_b, PriorityQueue.PRIORITY_MEDIUM)
+        self.queue.set_priority(self.item_b, PriorityQueue.PRIORITY_MEDIUM)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual([self.queue.pop().item for _ in xrange(3)],
+                         [self.item_b, self.item_c, self.item_a])
+        self.assertTrue(self.queue._verify())
+
+    def test_get_status(self):
+        """Test that the status is ordered and can be paginated."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW,
+                        timestamp=make_datetime(1))
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(10))
+        self.queue.push(self.item_c, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(5))
+        self.queue.push(self.item_d, PriorityQueue.PRIORITY_HIGH,
+                        timestamp=make_datetime(20))
+
+        def titles(status):
+            return [entry["item"]["_title"] for entry in status]
+
+        self.assertEqual(titles(self.queue.get_status()),
+                         ["d", "c", "b", "a"])
+        self.assertEqual(titles(self.queue.get_status(1, 2)), ["c", "b"])
+        self.assertEqual(titles(self.queue.get_status(3, 5)), ["a"])
+        self.assertEqual(titles(self.queue.get_status(4)), [])
+        self.assertEqual(self.queue.get_status(0, 1)[0]["priority"],
+                         PriorityQueue.PRIORITY_HIGH)
+        self.queue.remove(self.item_c)
+        self.assertEqual(titles(self.queue.get_status(0, 2)), ["d", "b"])
+        self.queue.push(self.item_c, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(5))
+
+        status = self.queue.get_status(
+            group_by=lambda item: str(item) in "bcd", limit=1)
+        self.assertEqual(titles(status), ["d"])
+        self.assertEqual(status[0]["item"]["multiplicity"], 3)
+        self.assertNotIn("multiplicity", self.item_d.to_dict())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -74,6 +74,12 @@ class FakeBatchExecutor(FakeExecutor):
         super(FakeBatchExecutor, self).execute(operations[0])
 
 
+class FakeSplittingBatchExecutor(FakeBatchExecutor):
+    def should_extend_batch(self, batch, entry, max_operations):
+        # Batches of at most two operations.
+        return len(batch) < 2
+
+
 class FakeTriggeredService(TriggeredService):
     def __init__(self, shard, timeout):
         super(FakeTriggeredService, self).__init__(shard)
@@ -83,10 +89,18 @@ class FakeTriggeredService(TriggeredService):
         # missing_operations().
         self._operations = []
 
+        # Kinds of the sweeps done.
+        self.sweeps = []
+
     def add_missing_operation(self, operation):
         self._operations.append(operation)
 
+    def _recent_missing_operations(self):
+        self.sweeps.append("recent")
+        return 0
+
     def _missing_operations(self):
+        self.sweeps.append("full")
         counter = 0
         while self._operations != []:
             counter += 1
@@ -138,6 +152,17 @@ class TestTriggeredService(unittest.TestCase):
         for notifier in self.notifiers:
             self.assertEqual(notifier.get_notifications(), 2)
 
+    def test_sweeper_full(self):
+        """Test that only some sweeps are full ones, unless asked."""
+        self.get_service_address.return_value = Address('127.0.0.1', '12345')
+        self.service = FakeTriggeredService(0, 0.05)
+        self.service.start_sweeper(0.05, 10.0)
+        gevent.sleep(0.12)
+        self.assertEqual(self.service.sweeps, ["full", "recent", "recent"])
+        self.service.search_operations_not_done()
+        gevent.sleep(0.01)
+        self.assertEqual(self.service.sweeps[-1], "full")
+
     def test_bad_executor(self):
         """Test that a slow executor does not block the others."""
         self.setUpService()
@@ -176,6 +201,16 @@ class TestTriggeredService(unittest.TestCase):
         # Just one call to the batch executor.
         self.assertEqual(batch_notifier.get_notifications(), 1)
 
+    def test_batch_split(self):
+        """Test a batch executor stopping batches early."""
+        self.setUpService()
+        batch_notifier = Notifier()
+        self.service.add_executor(FakeSplittingBatchExecutor(batch_notifier))
+        for i in xrange(3):
+            self.service.enqueue(FakeQueueItem('op %d' % i))
+        gevent.sleep(0.01)
+        self.assertEqual(batch_notifier.get_notifications(), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
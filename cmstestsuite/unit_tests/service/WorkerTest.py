@@ -27,15 +27,21 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import gevent
+import os
+import shutil
+import tempfile
 import unittest
-from mock import Mock, call
+from gevent.event import AsyncResult
+from mock import Mock, call, patch
 
 from cmstestsuite.unit_tests.testidgenerator import \
     unique_long_id, unique_unicode_id
 
 import cms.service.Worker
+from cms import config
+from cms.db import Manager
 from cms.grading import JobException
-from cms.grading.Job import JobGroup, EvaluationJob
+from cms.grading.Job import JobGroup, EvaluationJob, compact_job_dict
 from cms.service.Worker import Worker
 from cms.service.esoperations import ESOperation
 
@@ -43,6 +49,17 @@ from cms.service.esoperations import ESOperation
 class TestWorker(unittest.TestCase):
 
     def setUp(self):
+        # Keep the file cache (with its pins) and the compilation cache
+        # of the Workers out of the real cache directory.
+        self.cache_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        for patcher in [
+                patch.object(config, "cache_dir",
+                             os.path.join(self.cache_dir, "cache")),
+                patch("cms.grading.compilationcache._compilation_cache",
+                      None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.service = Worker(0)
 
     # Testing execute_job.
@@ -104,6 +121,23 @@ class TestWorker(unittest.TestCase):
         self.assertEquals(cms.service.Worker.get_task_type.call_count, n_jobs)
         self.assertEquals(task_type.call_count, n_jobs)
 
+    def test_execute_job_too_many_sandboxes(self):
+        """Fails the jobs needing more sandboxes at once than the
+        box ids of a slot.
+
+        """
+        with patch.object(config, "worker_slots", 5):
+            self.service = Worker(0)
+        jobs, unused_calls = TestWorker.new_jobs(1)
+        task_type = FakeTaskType([True])
+        task_type.get_max_sandboxes = Mock(return_value=3)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        job_group = JobGroup.import_from_dict(
+            self.service.execute_job_group(JobGroup(jobs).export_to_dict()))
+        self.assertFalse(job_group.jobs[0].success)
+        self.assertEqual(task_type.call_count, 0)
+
     def test_execute_job_subsequent_success(self):
         """Executes three successful jobs, then four others.
 
@@ -164,6 +198,64 @@ class TestWorker(unittest.TestCase):
                          cms.service.Worker.get_task_type.mock_calls)
         cms.service.Worker.get_task_type.assert_has_calls(calls_a)
 
+    def test_execute_job_group_slots(self):
+        """Executes two long job groups together, then declines a
+        third one while both slots are busy.
+
+        """
+        with patch.object(config, "worker_slots", 2):
+            self.service = Worker(0)
+        self.assertEqual(self.service.get_slots(), 2)
+        task_type = FakeTaskType([0.01, 0.01])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+        patcher = patch("cms.service.Worker.set_execution_slot")
+        set_execution_slot = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        job_groups, calls = TestWorker.new_job_groups([1, 1, 1])
+
+        def call_worker(job_group):
+            return JobGroup.import_from_dict(
+                self.service.execute_job_group(job_group.export_to_dict()))
+
+        greenlets = [gevent.spawn(call_worker, job_group)
+                     for job_group in job_groups[:2]]
+        gevent.sleep(0)  # To ensure both job groups have started.
+
+        with self.assertRaises(JobException):
+            call_worker(job_groups[2])
+
+        for greenlet in greenlets:
+            self.assertTrue(greenlet.get().jobs[0].success)
+        self.assertItemsEqual(set_execution_slot.mock_calls,
+                              [call(0, 2), call(1, 2)])
+        self.assertEqual(task_type.call_count, 2)
+        cms.service.Worker.get_task_type.assert_has_calls(calls[:2])
+
+    def test_execute_job_group_shared_sandbox(self):
+        """Evaluates together the consecutive jobs of the same task
+        type, if so configured.
+
+        """
+        job_groups, _ = TestWorker.new_job_groups([4])
+        jobs = job_groups[0].jobs
+        for job in jobs[:3]:
+            job.task_type_parameters = "fake_parameters"
+        task_type = FakeTaskType([True] * 4)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        with patch.object(config, "share_evaluation_sandbox", True):
+            ret = JobGroup.import_from_dict(
+                self.service.execute_job_group(
+                    job_groups[0].export_to_dict()))
+
+        self.assertEqual(task_type.runs, [3])
+        self.assertEqual(task_type.call_count, 4)
+        self.assertTrue(all(job.success for job in ret.jobs))
+        cms.service.Worker.get_task_type.assert_has_calls([
+            call("fake_task_type", "fake_parameters"),
+            call("fake_task_type", jobs[3].task_type_parameters)])
+
     def test_execute_job_failure_releases_lock(self):
         """After a failure, the worker should be able to accept another job.
 
@@ -254,6 +346,83 @@ class TestWorker(unittest.TestCase):
             JobGroup.import_from_dict(
                 self.service.execute_job_group(job_groups[0].export_to_dict()))
 
+    def test_execute_job_group_with_template(self):
+        """Executes compacted jobs, asking the template only once and
+        returning the results compacted.
+
+        """
+        checker = Manager("checker", unique_unicode_id())
+        template = {
+            "task_type": "fake_task_type",
+            "task_type_parameters": "fake_parameters",
+            "managers": {"checker": checker.digest},
+            "time_limit": 1.0,
+            "memory_limit": 256,
+            "testcases": {"000": ["input", "output"]},
+        }
+        result = AsyncResult()
+        result.set(["v1", template])
+        self.service.evaluation_service = Mock()
+        self.service.evaluation_service.get_job_template.return_value = \
+            result
+        task_type = FakeTaskType([True, True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        for _ in xrange(2):
+            job_group_dict = JobGroup([EvaluationJob(
+                ESOperation(ESOperation.EVALUATION, unique_long_id(), 7,
+                            "000").to_dict(),
+                "fake_task_type", "fake_parameters",
+                managers={"checker": checker}, input="input",
+                output="output", time_limit=1.0,
+                memory_limit=256)]).export_to_dict()
+            compact_job_dict(job_group_dict["jobs"][0], 7, "v1", template)
+            self.assertNotIn("input", job_group_dict["jobs"][0])
+
+            ret = self.service.execute_job_group(job_group_dict)
+            self.assertEqual(ret["jobs"][0]["dataset"], [7, "v1"])
+            self.assertNotIn("managers", ret["jobs"][0])
+            self.assertTrue(ret["jobs"][0]["success"])
+
+        self.service.evaluation_service.get_job_template\
+            .assert_called_once_with(dataset_id=7)
+        cms.service.Worker.get_task_type.assert_has_calls(
+            [call("fake_task_type", "fake_parameters")] * 2)
+        self.assertEqual(task_type.jobs[0].managers["checker"].digest,
+                         checker.digest)
+        self.assertEqual(task_type.jobs[0].input, "input")
+
+    def test_execute_job_group_with_changed_template(self):
+        """Refuses jobs compacted with an old version of the dataset.
+
+        """
+        template = {
+            "task_type": "fake_task_type",
+            "task_type_parameters": "fake_parameters",
+            "managers": {},
+            "time_limit": 1.0,
+            "memory_limit": 256,
+            "testcases": {},
+        }
+        result = AsyncResult()
+        result.set(["v2", template])
+        self.service.evaluation_service = Mock()
+        self.service.evaluation_service.get_job_template.return_value = \
+            result
+        task_type = FakeTaskType([True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        job_group_dict = JobGroup([EvaluationJob(
+            ESOperation(ESOperation.EVALUATION, unique_long_id(), 7,
+                        "000").to_dict(),
+            "fake_task_type", "fake_parameters", time_limit=1.0,
+            memory_limit=256)]).export_to_dict()
+        compact_job_dict(job_group_dict["jobs"][0], 7, "v1", template)
+
+        with self.assertRaises(JobException):
+            self.service.execute_job_group(job_group_dict)
+        self.assertEqual(task_type.call_count, 0)
+
     @staticmethod
     def new_jobs(number_of_jobs, prefix=None):
         prefix = prefix if prefix is not None else ""
@@ -293,9 +462,15 @@ class FakeTaskType(object):
         self.execute_results = execute_results
         self.index = 0
         self.call_count = 0
+        self.jobs = []
+        self.runs = []
+
+    def get_max_sandboxes(self):
+        return 1
 
     def execute_job(self, job, file_cacher):
         self.call_count += 1
+        self.jobs.append(job)
         result = self.execute_results[self.index]
         self.index += 1
         if isinstance(result, bool):
@@ -309,6 +484,11 @@ class FakeTaskType(object):
             job.success = True
             gevent.sleep(result)
 
+    def evaluate_testcases(self, jobs, file_cacher):
+        self.runs.append(len(jobs))
+        for job in jobs:
+            self.execute_job(job, file_cacher)
+
     def set_results(self, results):
         self.execute_results = results
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the batch sizer."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from cms.service.batchsizer import BatchSizer
+from cms.service.esoperations import ESOperation
+
+
+def evaluation(dataset_id, codename="1"):
+    return ESOperation(ESOperation.EVALUATION, 1, dataset_id, codename)
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBatchSizer, self).setUp()
+        self.sizer = BatchSizer(10.0, 25)
+
+    def test_without_estimate(self):
+        """Without measurements, the share of the queue is used."""
+        self.assertEqual(self.sizer.get_size(evaluation(1), 20, 4), 6)
+        self.assertEqual(self.sizer.get_size(evaluation(1), 1000, 4), 25)
+        self.assertEqual(self.sizer.get_size(evaluation(1), 20, 0), 21)
+        self.assertEqual(self.sizer.get_status()["decisions"],
+                         {"share": 2, "maximum": 1})
+
+    def test_estimate(self):
+        """Measurements limit the size for their kind only."""
+        self.sizer.record([evaluation(1, "%d" % i) for i in xrange(4)], 8.0)
+        self.assertEqual(self.sizer.get_size(evaluation(1), 1000, 4), 5)
+        self.assertEqual(self.sizer.get_size(evaluation(2), 1000, 4), 25)
+        self.assertEqual(self.sizer.get_size(
+            ESOperation(ESOperation.COMPILATION, 1, 1), 1000, 4), 25)
+
+        # Slow operations still make batches of one.
+        self.sizer.record([evaluation(3)], 60.0)
+        self.assertEqual(self.sizer.get_size(evaluation(3), 1000, 4), 1)
+
+    def test_smoothing(self):
+        self.sizer.record([evaluation(1)], 1.0)
+        self.sizer.record([evaluation(1)], 2.0)
+        estimate = 1.0 + BatchSizer.SMOOTHING
+        self.assertAlmostEqual(
+            self.sizer.get_status()["estimates"]["evaluate 1"], estimate)
+
+    def test_status(self):
+        self.assertIsNone(self.sizer.get_status()["average_size"])
+        self.sizer.record([evaluation(1), evaluation(2, "2")], 1.0)
+        self.sizer.record([evaluation(1)], 1.0)
+        status = self.sizer.get_status()
+        self.assertEqual(status["batches"], 2)
+        self.assertEqual(status["average_size"], 1.5)
+        self.assertEqual(sorted(status["estimates"]),
+                         ["evaluate 1", "evaluate 2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -31,7 +31,8 @@ import unittest
 from cmstestsuite.unit_tests.testdbgenerator import TestCaseWithDatabase
 
 from cms.io.priorityqueue import PriorityQueue
-from cms.service.esoperations import ESOperation, get_submissions_operations, \
+from cms.service.esoperations import ESOperation, \
+    get_datasets_to_judge_signature, get_submissions_operations, \
     get_user_tests_operations
 
 
@@ -119,6 +120,27 @@ class TestESOperations(TestCaseWithDatabase):
             set(get_submissions_operations(self.session, self.contest.id)),
             expected_operations)
 
+    def test_get_submissions_operations_from_id(self):
+        """Test for the operations of the recent submissions only."""
+        old_submission = self.add_submission(
+            self.tasks[0], self.participation)
+        self.session.flush()
+        submission = self.add_submission(self.tasks[0], self.participation)
+        self.session.flush()
+
+        expected_operations = set(
+            self.submission_compilation_operation(submission, dataset)
+            for dataset in submission.task.datasets if self.to_judge(dataset))
+
+        self.assertEqual(
+            set(get_submissions_operations(self.session, self.contest.id,
+                                           submission.id)),
+            expected_operations)
+        self.assertEqual(
+            len(get_submissions_operations(self.session, self.contest.id,
+                                           old_submission.id)),
+            2 * len(expected_operations))
+
     def test_get_submissions_operations_with_results(self):
         """Test for a submission with submission results."""
         submission, results = self.add_submission_with_results(
@@ -263,6 +285,43 @@ class TestESOperations(TestCaseWithDatabase):
                 else PriorityQueue.PRIORITY_EXTRA_LOW,
                 result.submission.timestamp)
 
+    # Testing get_datasets_to_judge_signature.
+
+    def test_get_datasets_to_judge_signature(self):
+        """The signature changes with the testcases of the datasets to
+        judge, and only with them.
+
+        """
+        signature = get_datasets_to_judge_signature(
+            self.session, self.contest.id)
+        self.assertEqual(
+            [dataset_id for dataset_id, _, _ in signature],
+            sorted(dataset.id for dataset in self.datasets
+                   if self.to_judge(dataset)))
+        self.assertTrue(all(count == 3 for _, count, _ in signature))
+
+        # A testcase added to a dataset not to judge doesn't matter.
+        self.add_testcase(self.datasets[2])
+        self.session.flush()
+        self.assertEqual(
+            get_datasets_to_judge_signature(self.session, self.contest.id),
+            signature)
+
+        # One added to the active dataset does.
+        self.add_testcase(self.datasets[0])
+        self.session.flush()
+        new_signature = get_datasets_to_judge_signature(
+            self.session, self.contest.id)
+        self.assertNotEqual(new_signature, signature)
+
+        # Replacing a testcase changes it too.
+        self.session.delete(self.testcases[0])
+        self.add_testcase(self.datasets[0])
+        self.session.flush()
+        self.assertNotEqual(
+            get_datasets_to_judge_signature(self.session, self.contest.id),
+            new_signature)
+
     # Testing get_user_tests_operations.
 
     def test_get_user_tests_operations_no_operations(self):
@@ -306,6 +365,22 @@ class TestESOperations(TestCaseWithDatabase):
             set(get_user_tests_operations(self.session, self.contest.id)),
             expected_operations)
 
+    def test_get_user_tests_operations_from_id(self):
+        """Test for the operations of the recent user tests only."""
+        self.add_user_test(self.tasks[0], self.participation)
+        self.session.flush()
+        user_test = self.add_user_test(self.tasks[0], self.participation)
+        self.session.flush()
+
+        expected_operations = set(
+            self.user_test_compilation_operation(user_test, dataset)
+            for dataset in user_test.task.datasets if self.to_judge(dataset))
+
+        self.assertEqual(
+            set(get_user_tests_operations(self.session, self.contest.id,
+                                          user_test.id)),
+            expected_operations)
+
     def test_get_user_tests_operations_with_results(self):
         """Test for a user_test with user_test results."""
         user_test, results = self.add_user_test_with_results()
@@ -24,9 +24,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import gevent
+import os
+import shutil
+import tempfile
 import unittest
 
-from cms.service.flushingdict import FlushingDict
+from cms.service.flushingdict import FlushingDict, Journal
 
 
 class TestFlushingDict(unittest.TestCase):
@@ -99,13 +102,122 @@ class TestFlushingDict(unittest.TestCase):
         gevent.sleep(TestFlushingDict.FLUSH_LATENCY_SECONDS + 0.1)
         self.assertItemsEqual(expected_data, sum(self.received_data, []))
 
+    def test_max_age(self):
+        """Entries arriving often are flushed after the maximum age."""
+        self.d = FlushingDict(
+            100, TestFlushingDict.FLUSH_LATENCY_SECONDS, self.callback,
+            max_age_seconds=0.3)
+        for i in range(10):
+            self.d.add(i, i)
+            gevent.sleep(0.1)
+        self.assertGreaterEqual(len(self.received_data), 2)
+
+    def test_failure(self):
+        """Entries are flushed again if the callback fails."""
+        self.fail_next = True
+        self.d = FlushingDict(
+            TestFlushingDict.SIZE, 0.05, self.failing_callback)
+        self.d.add(0, 0)
+        gevent.sleep(0.2)
+        self.assertEqual([[(0, 0)]], self.received_data)
+        self.assertEqual(1, self.d.get_status()["failures"])
+
+    def test_adapt(self):
+        """The size grows when entries arrive during slow flushes."""
+        self.d = FlushingDict(
+            TestFlushingDict.SIZE, TestFlushingDict.FLUSH_LATENCY_SECONDS,
+            self.long_callback, max_size=10)
+        for i in range(TestFlushingDict.SIZE):
+            self.d.add(i, i)
+        gevent.sleep(0.1)
+        for i in range(4):
+            self.d.add(TestFlushingDict.SIZE + i, i)
+        while len(self.received_data) == 0:
+            gevent.sleep(0.01)
+        size = TestFlushingDict.SIZE + FlushingDict.SMOOTHING * (
+            4 / FlushingDict.WRITING_FRACTION - TestFlushingDict.SIZE)
+        self.assertEqual(int(size), self.d.get_status()["size"])
+
+    def test_backpressure(self):
+        self.d = FlushingDict(
+            100, TestFlushingDict.FLUSH_LATENCY_SECONDS, self.callback,
+            max_pending=2)
+        self.d.add(0, 0)
+        self.d.wait_for_room()
+        self.d.add(1, 1)
+        self.d.wait_for_room()
+        self.assertEqual(1, len(self.received_data))
+        self.assertEqual(1, self.d.get_status()["waits"])
+
     def callback(self, data):
         self.received_data.append(data)
 
+    def failing_callback(self, data):
+        if self.fail_next:
+            self.fail_next = False
+            raise ValueError("Failing as requested.")
+        self.callback(data)
+
     def long_callback(self, data):
         gevent.sleep(TestFlushingDict.FLUSH_LATENCY_SECONDS * 2)
         self.callback(data)
 
 
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.base_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.base_dir, "journal")
+        self.received_data = []
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+        super(TestJournal, self).tearDown()
+
+    def journal(self):
+        return Journal(self.path, lambda key, value: [key, value],
+                       lambda data: tuple(data))
+
+    def test_replay(self):
+        """Entries not flushed are recovered from the journal."""
+        d = FlushingDict(2, 10, self.callback, journal=self.journal())
+        d.add(0, "zero")
+        d.add(1, "one")
+        gevent.sleep(0)
+        d.add(2, "two")
+        d.add(0, "zero again")
+        d.flush_greenlet.kill()
+        self.assertEqual(1, len(self.received_data))
+
+        # A line being written during the crash is ignored.
+        with open(self.path, "ab") as f:
+            f.write(b"[3, ")
+        d = FlushingDict(10, 0.05, self.callback, journal=self.journal())
+        gevent.sleep(0.2)
+        self.assertItemsEqual([(2, "two"), (0, "zero again")],
+                              self.received_data[1])
+        self.assertFalse(os.path.exists(self.path + ".flushing"))
+        self.assertEqual(0, os.path.getsize(self.path))
+
+    def test_crash_during_flush(self):
+        """Entries being flushed during a crash are recovered too."""
+        d = FlushingDict(2, 10, self.crashing_callback,
+                         journal=self.journal())
+        d.add(0, "zero")
+        d.add(1, "one")
+        gevent.sleep(0)
+        d.add(2, "two")
+        self.assertTrue(os.path.exists(self.path + ".flushing"))
+        self.assertEqual([(0, "zero"), (1, "one"), (2, "two")],
+                         self.journal().replay())
+
+    def callback(self, data):
+        self.received_data.append(data)
+
+    def crashing_callback(self, unused_data):
+        gevent.sleep(10)
+
+
 if __name__ == "__main__":
     unittest.main()
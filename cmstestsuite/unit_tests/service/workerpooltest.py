@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the choice of workers in the worker pool."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import Mock, patch
+from sqlalchemy import text
+
+from cmstestsuite.unit_tests.testdbgenerator import TestCaseWithDatabase
+
+from cms import ServiceCoord
+from cms.service.esoperations import ESOperation
+from cms.service.workerpool import DATASET_VERSION_QUERY, WorkerPool
+
+
+class TestWorkerPoolAffinity(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWorkerPoolAffinity, self).setUp()
+        service = Mock()
+        service.connect_to.side_effect = \
+            lambda coord, on_connect: Mock(connected=True)
+        self.pool = WorkerPool(service)
+        for shard in xrange(3):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+        self.time = 0.0
+        patcher = patch("cms.service.workerpool.monotonic_time",
+                        lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def busy(self, shard):
+        self.pool._add_operations(
+            (shard, 0), [ESOperation(ESOperation.EVALUATION, 99, 1, "99")])
+
+    def test_keys(self):
+        self.pool._dataset_cache[1] = ("v", None, {
+            "managers": {"checker": "m"},
+            "testcases": {"001": ["i1", "o1"], "002": ["i2", "o2"]}})
+        keys = self.pool._get_affinity_keys([
+            ESOperation(ESOperation.EVALUATION, 5, 1, "001"),
+            ESOperation(ESOperation.COMPILATION, 5, 1),
+            ESOperation(ESOperation.USER_TEST_COMPILATION, 6, 2)])
+        self.assertEqual(keys, set([("submission", 5), ("user_test", 6),
+                                    "m", "i1", "o1"]))
+
+    def test_prefer_recent(self):
+        """The idle worker that received the most keys is chosen."""
+        self.pool._remember(1, set(["a", "b"]))
+        self.pool._remember(2, set(["a"]))
+        self.assertEqual(self.pool._choose_worker(set(["a", "b"])), (1, 0))
+        self.assertIn(self.pool._choose_worker(set(["c"])),
+                      [(0, 0), (1, 0), (2, 0)])
+
+    def test_wait_for_busy(self):
+        """We wait a bounded time for a busy worker with the keys."""
+        self.pool._remember(1, set(["a"]))
+        self.busy(1)
+        self.assertIsNone(self.pool._choose_worker(set(["a"])))
+        self.time += WorkerPool.AFFINITY_MAX_WAIT / 2
+        self.assertIsNone(self.pool._choose_worker(set(["a"])))
+        self.time += WorkerPool.AFFINITY_MAX_WAIT
+        self.assertIn(self.pool._choose_worker(set(["a"])),
+                      [(0, 0), (2, 0)])
+
+        # The wait starts again for the next operations.
+        self.assertIsNone(self.pool._choose_worker(set(["a"])))
+
+    def test_no_idle(self):
+        for shard in xrange(3):
+            self.busy(shard)
+        self.pool._worker[0].connected = False
+        self.pool._remove_operations((0, 0), WorkerPool.WORKER_INACTIVE)
+        self.assertIsNone(self.pool._choose_worker(set()))
+        self.assertIsNone(self.pool._affinity_wait_start)
+
+    def test_summary(self):
+        """The summary is bounded, and the hits are accounted."""
+        with patch.object(WorkerPool, "AFFINITY_SUMMARY_SIZE", 2):
+            self.pool._remember(0, set(["a"]))
+            self.pool._remember(0, set(["b"]))
+            self.pool._remember(0, set(["a", "c"]))
+        self.assertItemsEqual(self.pool._recent[0], ["a", "c"])
+        self.assertEqual(self.pool._cache_hits[0], [1, 4])
+        self.assertEqual(self.pool.get_status()["0"]["cache_hits"], 0.25)
+        self.assertIsNone(self.pool.get_status()["1"]["cache_hits"])
+
+
+class TestWorkerPoolSlots(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWorkerPoolSlots, self).setUp()
+        service = Mock()
+        service.connect_to.side_effect = \
+            lambda coord, on_connect: Mock(connected=True)
+        self.pool = WorkerPool(service)
+        for shard in xrange(2):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+        self.operation = ESOperation(ESOperation.EVALUATION, 99, 1, "99")
+
+    def test_slots(self):
+        """Each slot of a worker takes operations by itself."""
+        self.pool.set_slot_count(0, 2)
+        self.assertEqual(len(self.pool), 3)
+        self.assertEqual(self.pool.get_usable_count(), 3)
+        self.pool._add_operations((0, 0), [self.operation])
+        self.assertIn(self.pool._choose_worker(set()), [(0, 1), (1, 0)])
+        self.assertEqual(sorted(self.pool.get_status().keys()),
+                         ["0", "0.1", "1"])
+        self.assertEqual(self.pool.get_status()["0.1"]["shard"], 0)
+
+    def test_fewer_slots(self):
+        """A busy slot the worker has lost is removed when released."""
+        self.pool.set_slot_count(0, 3)
+        self.pool._add_operations((0, 2), [self.operation])
+        self.pool.set_slot_count(0, 1)
+        self.assertEqual(self.pool._get_slots(0), [(0, 0), (0, 2)])
+        self.assertEqual(self.pool.get_usable_count(), 2)
+        for shard in xrange(2):
+            self.pool._add_operations((shard, 0), [
+                ESOperation(ESOperation.EVALUATION, shard, 1, "99")])
+        self.assertIsNone(self.pool._choose_worker(set()))
+        self.assertFalse(self.pool.release_worker((0, 2)))
+        self.assertEqual(self.pool._get_slots(0), [(0, 0)])
+
+    def test_disable(self):
+        """Disabling a worker disables all its slots."""
+        self.pool.set_slot_count(0, 2)
+        self.pool._add_operations((0, 1), [self.operation])
+        self.assertEqual(self.pool.disable_worker(0), [self.operation])
+        self.assertEqual(self.pool.get_usable_count(), 1)
+        with self.assertRaises(ValueError):
+            self.pool.disable_worker(0)
+
+        # New slots of a disabled worker are disabled too.
+        self.pool.set_slot_count(0, 3)
+        self.assertEqual(self.pool.get_usable_count(), 1)
+        self.pool.enable_worker(0)
+        self.assertEqual(self.pool.get_usable_count(), 4)
+
+    def test_slots_error(self):
+        """A worker that cannot tell its slots keeps one."""
+        self.pool._on_slots(None, 0, error="error")
+        self.assertEqual(self.pool._get_slots(0), [(0, 0)])
+        self.pool._on_slots(2, 0)
+        self.assertEqual(self.pool._get_slots(0), [(0, 0), (0, 1)])
+
+
+class TestDatasetVersion(TestCaseWithDatabase):
+
+    def versions(self, datasets):
+        self.session.flush()
+        return dict(self.session.execute(
+            text(DATASET_VERSION_QUERY),
+            {"dataset_ids": [d.id for d in datasets]}).fetchall())
+
+    def test_null_limits(self):
+        # Swapping which limit is NULL must change the version.
+        task = self.add_task()
+        first = self.add_dataset(task, time_limit=None, memory_limit=1)
+        second = self.add_dataset(task, time_limit=1.0, memory_limit=None)
+        versions = self.versions([first, second])
+        self.assertEqual(len(versions), 2)
+        self.assertNotEqual(versions[first.id], versions[second.id])
+
+    def test_changes(self):
+        dataset = self.add_dataset()
+        before = self.versions([dataset])[dataset.id]
+        self.add_testcase(dataset)
+        after = self.versions([dataset])[dataset.id]
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, self.versions([dataset])[dataset.id])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -128,7 +128,9 @@ setup(
             "cmsAddTeam=cmscontrib.AddTeam:main",
             "cmsAddTestcases=cmscontrib.AddTestcases:main",
             "cmsAddUser=cmscontrib.AddUser:main",
+            "cmsCheckFiles=cmscontrib.CheckFiles:main",
             "cmsCleanFiles=cmscontrib.CleanFiles:main",
+            "cmsCompressFiles=cmscontrib.CompressFiles:main",
             "cmsComputeComplexity=cmscontrib.ComputeComplexity:main",
             "cmsDumpExporter=cmscontrib.DumpExporter:main",
             "cmsDumpImporter=cmscontrib.DumpImporter:main",
@@ -139,6 +141,7 @@ setup(
             "cmsImportTask=cmscontrib.ImportTask:main",
             "cmsImportTeam=cmscontrib.ImportTeam:main",
             "cmsImportUser=cmscontrib.ImportUser:main",
+            "cmsMigrateFSStorage=cmscontrib.MigrateFSStorage:main",
             "cmsRWSHelper=cmscontrib.RWSHelper:main",
             "cmsRemoveContest=cmscontrib.RemoveContest:main",
             "cmsRemoveParticipation=cmscontrib.RemoveParticipation:main",